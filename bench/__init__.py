@@ -0,0 +1,292 @@
+# Copyright the RTMPy Project
+#
+# RTMPy is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# RTMPy is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with RTMPy.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Micro-benchmarks for the RTMPy hot paths.
+
+Each suite is a module in this package that provides a C{get_benchmarks}
+function. It returns a list of C{(name, setup)} tuples where C{setup} is called
+once and returns the callable to be timed. Results are written as JSON and
+compared against the stored baseline in C{bench/baselines/<suite>.json}.
+
+Example usage::
+
+    python -m bench codec
+    python -m bench codec --threshold 0.1 --output results.json
+    python -m bench codec --save-baseline
+
+Baselines are machine specific, regenerate them with C{--save-baseline} when
+moving to a different box.
+"""
+
+import os.path
+import sys
+import platform
+import gc
+from timeit import default_timer
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+
+__all__ = ['measure', 'run_suite', 'compare', 'main']
+
+
+#: All the known suites, in the order that they are run by default.
+SUITES = ['codec', 'amf', 'rpc', 'flv']
+
+#: The default regression threshold, expressed as a fraction of the baseline
+#: operations per second.
+DEFAULT_THRESHOLD = 0.25
+
+BASELINE_DIR = os.path.join(os.path.dirname(__file__), 'baselines')
+
+
+
+def measure(func, warmup=0.1, repeat=3, minTime=0.1):
+    """
+    Times C{func}, returning the best time (in seconds) for one call.
+
+    C{func} is first called repeatedly for C{warmup} seconds. The number of
+    calls per timing run is then calibrated so that each run takes at least
+    C{minTime} seconds and the best of C{repeat} runs is kept. The garbage
+    collector is disabled whilst timing.
+    """
+    end = default_timer() + warmup
+    number = 0
+
+    while default_timer() < end:
+        func()
+        number += 1
+
+    number = max(number, 1)
+
+    # calibrate
+    while True:
+        t = _time(func, number)
+
+        if t >= minTime:
+            break
+
+        number *= 2
+
+    best = t
+
+    for i in xrange(repeat - 1):
+        best = min(best, _time(func, number))
+
+    return best / number
+
+
+
+def _time(func, number):
+    r = xrange(number)
+    enabled = gc.isenabled()
+
+    gc.disable()
+
+    try:
+        start = default_timer()
+
+        for i in r:
+            func()
+
+        return default_timer() - start
+    finally:
+        if enabled:
+            gc.enable()
+
+
+
+def get_suite(name):
+    """
+    Imports and returns the suite module called C{name}.
+    """
+    mod_name = '%s.%s' % (__name__, name)
+
+    __import__(mod_name)
+
+    return sys.modules[mod_name]
+
+
+
+def run_suite(name, filter=None, out=None, **kwargs):
+    """
+    Runs all the benchmarks in the suite called C{name}.
+
+    @param filter: Only run the benchmarks containing this string.
+    @param out: A file like object to report progress to.
+    @param kwargs: Passed to L{measure}.
+    @return: A C{dict} of benchmark name -> result.
+    """
+    results = {}
+
+    for bench_name, setup in get_suite(name).get_benchmarks():
+        if filter and filter not in bench_name:
+            continue
+
+        t = measure(setup(), **kwargs)
+
+        results[bench_name] = {
+            'usec_per_op': round(t * 1e6, 4),
+            'ops_per_second': round(1.0 / t, 1),
+        }
+
+        if out:
+            out.write('%-60s %12.1f ops/s\n' % (bench_name, 1.0 / t))
+            out.flush()
+
+    return results
+
+
+
+def compare(results, baseline, threshold=DEFAULT_THRESHOLD):
+    """
+    Compares C{results} against C{baseline} (both as returned by
+    L{run_suite}).
+
+    @return: A list of C{(name, baseline ops, current ops, change)} tuples for
+        every benchmark that is slower than the baseline by more than
+        C{threshold}. C{change} is the relative difference in ops per second.
+    """
+    regressions = []
+
+    for name, result in sorted(results.items()):
+        try:
+            expected = baseline[name]['ops_per_second']
+        except KeyError:
+            continue
+
+        actual = result['ops_per_second']
+        change = (actual - expected) / float(expected)
+
+        if change < -threshold:
+            regressions.append((name, expected, actual, change))
+
+    return regressions
+
+
+
+def get_environment():
+    """
+    Returns a description of the machine the benchmarks were run on.
+    """
+    return {
+        'python': platform.python_version(),
+        'implementation': getattr(platform, 'python_implementation',
+            lambda: 'CPython')(),
+        'machine': platform.machine(),
+        'platform': platform.platform(),
+    }
+
+
+
+def load(filename):
+    fp = open(filename, 'rt')
+
+    try:
+        return json.load(fp)
+    finally:
+        fp.close()
+
+
+
+def dump(data, filename):
+    fp = open(filename, 'wt')
+
+    try:
+        json.dump(data, fp, indent=2, sort_keys=True)
+        fp.write('\n')
+    finally:
+        fp.close()
+
+
+
+def main(args=None):
+    """
+    Command line entry point. Returns the exit code, C{1} if a regression was
+    found.
+    """
+    from optparse import OptionParser
+
+    parser = OptionParser(usage='%prog [options] [suite ...]')
+
+    parser.add_option('-o', '--output', dest='output',
+        help='Write the results as JSON to this file')
+    parser.add_option('-t', '--threshold', dest='threshold', type='float',
+        default=DEFAULT_THRESHOLD,
+        help='Allowed slowdown relative to the baseline [default: %default]')
+    parser.add_option('-b', '--baseline-dir', dest='baseline_dir',
+        default=BASELINE_DIR, help='Directory containing the baselines')
+    parser.add_option('-s', '--save-baseline', dest='save',
+        action='store_true', default=False,
+        help='Store the results as the new baseline')
+    parser.add_option('-f', '--filter', dest='filter',
+        help='Only run benchmarks containing this string')
+    parser.add_option('-q', '--quick', dest='quick', action='store_true',
+        default=False, help='Shorter runs, less accurate numbers')
+
+    options, suites = parser.parse_args(args)
+
+    kwargs = {}
+
+    if options.quick:
+        kwargs = {'warmup': 0.02, 'repeat': 2, 'minTime': 0.02}
+
+    report = {
+        'environment': get_environment(),
+        'threshold': options.threshold,
+        'suites': {},
+    }
+
+    exit_code = 0
+
+    for name in suites or SUITES:
+        sys.stdout.write('%s\n%s\n' % (name, '=' * len(name)))
+
+        results = run_suite(name, options.filter, sys.stdout, **kwargs)
+        baseline_file = os.path.join(options.baseline_dir, name + '.json')
+
+        report['suites'][name] = {'results': results}
+
+        if options.save:
+            dump({'environment': report['environment'], 'results': results},
+                baseline_file)
+
+            continue
+
+        if not os.path.exists(baseline_file):
+            sys.stdout.write('No baseline for %r\n' % (name,))
+
+            continue
+
+        regressions = compare(results, load(baseline_file)['results'],
+            options.threshold)
+
+        report['suites'][name]['regressions'] = [
+            {'name': n, 'baseline': b, 'current': c, 'change': round(x, 4)}
+            for n, b, c, x in regressions]
+
+        for n, b, c, x in regressions:
+            exit_code = 1
+            sys.stdout.write('REGRESSION %s: %.1f -> %.1f ops/s (%+.1f%%)\n' % (
+                n, b, c, x * 100))
+
+    if options.output:
+        dump(report, options.output)
+
+    return exit_code
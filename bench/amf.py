@@ -0,0 +1,113 @@
+# Copyright the RTMPy Project
+#
+# RTMPy is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# RTMPy is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with RTMPy.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Benchmarks for the AMF encoding of RPC messages, with a new codec per message
+(C{fresh}) and with the per connection L{message.AMFCodecs} (C{cached}).
+"""
+
+from pyamf.util import BufferedByteStream
+
+from rtmpy import message, status
+
+
+
+def connect():
+    return message.Invoke('connect', 1, None, {
+        'app': 'live',
+        'flashVer': 'WIN 10,1,85,3',
+        'swfUrl': 'http://example.com/player.swf',
+        'tcUrl': 'rtmp://example.com/live',
+        'fpad': False,
+        'capabilities': 239,
+        'audioCodecs': 3191,
+        'videoCodecs': 252,
+        'videoFunction': 1,
+        'pageUrl': 'http://example.com/',
+        'objectEncoding': 0,
+    })
+
+
+def onStatus():
+    return message.Invoke('onStatus', 0, None, status.status(
+        'NetStream.Play.Start', description='Started playing foo.',
+        clientid='Ahe7Yy8Xa'))
+
+
+def result():
+    return message.Invoke('_result', 1, {
+        'fmsVer': 'FMS/3,5,1,516', 'capabilities': 31, 'mode': 1},
+        status.status('NetConnection.Connect.Success',
+            description='Connection succeeded.', objectEncoding=0))
+
+
+#: Typical RPC messages.
+MESSAGES = [
+    ('connect', connect),
+    ('onStatus', onStatus),
+    ('_result', result),
+]
+
+
+
+def encode(build, cached):
+    def setup():
+        msg = build()
+        codecs = None
+
+        if cached:
+            codecs = message.AMFCodecs()
+
+        def run():
+            msg.encode(BufferedByteStream(), codecs)
+
+        return run
+
+    return setup
+
+
+
+def decode(build, cached):
+    def setup():
+        buf = BufferedByteStream()
+        build().encode(buf)
+        data = buf.getvalue()
+        codecs = None
+
+        if cached:
+            codecs = message.AMFCodecs()
+
+        def run():
+            message.Invoke().decode(BufferedByteStream(data), codecs)
+
+        return run
+
+    return setup
+
+
+
+def get_benchmarks():
+    benchmarks = []
+
+    for name, build in MESSAGES:
+        for mode in ['fresh', 'cached']:
+            cached = mode == 'cached'
+
+            benchmarks.append(('Invoke.encode/%s/%s' % (name, mode),
+                encode(build, cached)))
+            benchmarks.append(('Invoke.decode/%s/%s' % (name, mode),
+                decode(build, cached)))
+
+    return benchmarks
@@ -0,0 +1,281 @@
+# Copyright the RTMPy Project
+#
+# RTMPy is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# RTMPy is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with RTMPy.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Benchmarks for L{rtmpy.protocol.rtmp.codec} and friends.
+"""
+
+from pyamf.util import BufferedByteStream
+
+from rtmpy import message
+from rtmpy.protocol.rtmp import header, codec, MessageDispatcher
+
+
+#: RTMP frame sizes to benchmark against.
+FRAME_SIZES = [128, 4096]
+#: Message payload sizes to benchmark against.
+PAYLOAD_SIZES = [64, 1024, 16384]
+#: The number of frames bundled into each aggregate message.
+AGGREGATE_TAGS = 10
+
+
+
+class NullOutput(object):
+    """
+    Swallows everything written to it.
+    """
+
+    def write(self, data):
+        pass
+
+
+
+class NullStream(object):
+    """
+    Receives dispatched messages and does nothing with them.
+    """
+
+    streamId = 1
+
+    def onAudioData(self, data, timestamp):
+        pass
+
+    def onVideoData(self, data, timestamp):
+        pass
+
+    def onInvoke(self, name, callId, args, timestamp):
+        pass
+
+    def onNotify(self, name, args, timestamp):
+        pass
+
+
+
+class NullStreamFactory(object):
+
+    def __init__(self):
+        self.stream = NullStream()
+
+    def getStream(self, streamId):
+        return self.stream
+
+
+
+def encode_message(payload, frameSize, datatype=message.VIDEO_DATA):
+    """
+    Returns the raw RTMP bytes for one message containing C{payload}.
+    """
+    output = BufferedByteStream()
+    encoder = codec.Encoder(output)
+    encoder.setFrameSize(frameSize)
+
+    encoder.send(payload, datatype, 1, 0)
+
+    while encoder.active:
+        encoder.next()
+
+    return output.getvalue()
+
+
+
+def header_encode(mask):
+    def setup():
+        h = header.Header(3, 1000, message.VIDEO_DATA, 1024, 1)
+
+        if mask == 'full':
+            previous = None
+        elif mask == 'relative':
+            previous = header.Header(3, 960, message.VIDEO_DATA, 1024, 1)
+        else:
+            previous = h
+            h = header.Header(3, continuation=True)
+
+        stream = BufferedByteStream()
+        encode = header.encode
+
+        def run():
+            stream.seek(0)
+            encode(stream, h, previous)
+
+        return run
+
+    return setup
+
+
+
+def header_decode(mask):
+    def setup():
+        stream = BufferedByteStream()
+
+        h = header.Header(3, 1000, message.VIDEO_DATA, 1024, 1)
+
+        previous = None
+
+        if mask == 'relative':
+            previous = header.Header(3, 960, message.VIDEO_DATA, 1024, 1)
+        elif mask == 'continuation':
+            previous = h
+            h = header.Header(3, continuation=True)
+
+        header.encode(stream, h, previous)
+        decode = header.decode
+
+        def run():
+            stream.seek(0)
+            decode(stream)
+
+        return run
+
+    return setup
+
+
+
+def frame_reader(frameSize, payloadSize):
+    def setup():
+        data = encode_message('x' * payloadSize, frameSize)
+
+        def run():
+            reader = codec.FrameReader(BufferedByteStream(data))
+            reader.setFrameSize(frameSize)
+
+            while not reader.readFrame()[1]:
+                pass
+
+        return run
+
+    return setup
+
+
+
+def channel_demuxer(frameSize, payloadSize):
+    def setup():
+        data = encode_message('x' * payloadSize, frameSize)
+
+        def run():
+            demuxer = codec.ChannelDemuxer(BufferedByteStream(data))
+            demuxer.setFrameSize(frameSize)
+
+            while demuxer.readFrame()[0] is None:
+                pass
+
+        return run
+
+    return setup
+
+
+
+def channel_muxer(frameSize, payloadSize):
+    def setup():
+        encoder = codec.Encoder(NullOutput())
+        encoder.setFrameSize(frameSize)
+        payload = 'x' * payloadSize
+        state = {'timestamp': 0}
+
+        def run():
+            state['timestamp'] += 40
+            encoder.send(payload, message.VIDEO_DATA, 1, state['timestamp'])
+
+            while encoder.active:
+                encoder.next()
+
+        return run
+
+    return setup
+
+
+
+def streaming_channel(frameSize, payloadSize):
+    def setup():
+        encoder = codec.Encoder(NullOutput())
+        encoder.setFrameSize(frameSize)
+
+        channel = codec.StreamingChannel(encoder, 1, NullOutput())
+        channel.setType(message.VIDEO_DATA)
+
+        payload = 'x' * payloadSize
+        state = {'timestamp': 0}
+
+        def run():
+            state['timestamp'] += 40
+            channel.sendData(payload, state['timestamp'])
+
+        return run
+
+    return setup
+
+
+
+def dispatch(datatype, payload):
+    def setup():
+        dispatcher = MessageDispatcher(None)
+        stream = NullStream()
+
+        if datatype == message.INVOKE:
+            buf = BufferedByteStream()
+            message.Invoke('onStatus', 0, None, {
+                'level': 'status',
+                'code': 'NetStream.Play.Start',
+                'description': 'Started playing foo'}).encode(buf)
+            data = buf.getvalue()
+        elif datatype == message.AGGREGATE:
+            buf = BufferedByteStream()
+            message.Aggregate([(message.VIDEO_DATA, i * 40, payload)
+                for i in xrange(AGGREGATE_TAGS)]).encode(buf)
+            data = buf.getvalue()
+        else:
+            data = payload
+
+        def run():
+            dispatcher.dispatchMessage(stream, datatype, 0, data)
+
+        return run
+
+    return setup
+
+
+
+def get_benchmarks():
+    benchmarks = []
+
+    for mask in ['full', 'relative', 'continuation']:
+        benchmarks.append(('header.encode/%s' % (mask,), header_encode(mask)))
+        benchmarks.append(('header.decode/%s' % (mask,), header_decode(mask)))
+
+    for frameSize in FRAME_SIZES:
+        for payloadSize in PAYLOAD_SIZES:
+            suffix = 'frame=%d/payload=%d' % (frameSize, payloadSize)
+
+            benchmarks.extend([
+                ('FrameReader.readFrame/' + suffix,
+                    frame_reader(frameSize, payloadSize)),
+                ('ChannelDemuxer.readFrame/' + suffix,
+                    channel_demuxer(frameSize, payloadSize)),
+                ('ChannelMuxer.next/' + suffix,
+                    channel_muxer(frameSize, payloadSize)),
+                ('StreamingChannel.sendData/' + suffix,
+                    streaming_channel(frameSize, payloadSize)),
+            ])
+
+    for payloadSize in PAYLOAD_SIZES:
+        benchmarks.append(('MessageDispatcher.dispatchMessage/video/payload=%d' % (
+            payloadSize,), dispatch(message.VIDEO_DATA, 'x' * payloadSize)))
+        benchmarks.append(('MessageDispatcher.dispatchMessage/aggregate/'
+            'tags=%d/payload=%d' % (AGGREGATE_TAGS, payloadSize),
+            dispatch(message.AGGREGATE, 'x' * payloadSize)))
+
+    benchmarks.append(('MessageDispatcher.dispatchMessage/invoke',
+        dispatch(message.INVOKE, None)))
+
+    return benchmarks
@@ -0,0 +1,351 @@
+# Copyright the RTMPy Project
+#
+# RTMPy is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# RTMPy is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with RTMPy.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Benchmarks for recording published streams to FLV and playing FLV files.
+
+Each operation is one second of a stream (25 video frames with a keyframe
+every 2 seconds and 43 AAC frames), so the operations per second are the
+number of concurrent recordings or viewers that one core can sustain.
+
+Recording goes through the L{server.StreamPublisher} to an
+L{flv.FLVRecorder}, the blocks are written to C{os.devnull} inline rather
+than in a thread. Playing seeks an L{flv.FLVPlayer} to the start of a memory
+mapped file and sends the first second to a subscriber that does nothing.
+
+The index benchmarks compare building the L{flv.KeyframeIndex} of a file of
+C{INDEX_MINUTES} by scanning it with loading it from its sidecar, and time a
+seek in the loaded index.
+
+The send benchmarks put one second of a played file on the streaming
+channels of a viewer, split into frames for every message
+(C{StreamingChannel.sendData}) or taken from a warm L{flv.ChunkCache}.
+"""
+
+import os
+import atexit
+import shutil
+import tempfile
+
+from twisted.internet import defer, task
+
+from rtmpy import flv, server, message
+from rtmpy.protocol.rtmp import codec
+
+
+#: Stream bitrates to benchmark against, in kbps.
+BITRATES = [500, 1000, 3000]
+
+VIDEO_FPS = 25
+AUDIO_FPS = 43
+AUDIO_BITRATE = 128
+KEYFRAME_INTERVAL = 2
+
+#: The length of the file that is indexed.
+INDEX_MINUTES = 10
+
+#: RTMP frame sizes to send the played tags with.
+FRAME_SIZES = [128, 4096]
+
+#: The bitrate of the played file, in kbps.
+SEND_BITRATE = 1000
+
+
+
+class Writer(flv.FLVWriter):
+    """
+    Runs the file operations inline.
+    """
+
+    def _submit(self, func, *args):
+        return defer.execute(func, *args)
+
+
+
+class NullOutput(object):
+    """
+    Throws away the encoded RTMP frames.
+    """
+
+    def write(self, data):
+        pass
+
+
+
+class Subscriber(object):
+    """
+    Throws away what an L{flv.FLVPlayer} plays.
+    """
+
+    def videoDataReceived(self, data, timestamp):
+        pass
+
+
+    def audioDataReceived(self, data, timestamp):
+        pass
+
+
+    def onMetaData(self, meta):
+        pass
+
+
+
+def frames(bitrate):
+    """
+    Returns the keyframe, interframe and audio frame for C{bitrate}.
+    """
+    videoSize = (bitrate - AUDIO_BITRATE) * 1000 / 8 / VIDEO_FPS
+    audioSize = AUDIO_BITRATE * 1000 / 8 / AUDIO_FPS
+
+    return ('\x17' + 'k' * (videoSize * 4), '\x27' + 'i' * videoSize,
+        '\xaf' + 'a' * audioSize)
+
+
+
+def record(bitrate):
+    def setup():
+        client = server.Client(None)
+        client.id = 'foo'
+
+        publisher = server.StreamPublisher(None, client)
+        writer = Writer(os.devnull)
+        writer.open()
+
+        publisher.addSubscriber(flv.FLVRecorder(writer))
+
+        # the sequence headers that start a stream
+        publisher.videoDataReceived('\x17\x00' + 'c' * 32, 0)
+        publisher.audioDataReceived('\xaf\x00\x12\x10', 0)
+
+        keyframe, interframe, audio = frames(bitrate)
+
+        state = {'second': 0}
+
+        def run():
+            second = state['second']
+            state['second'] += 1
+            start = second * 1000
+
+            for i in xrange(VIDEO_FPS):
+                if i == 0 and second % KEYFRAME_INTERVAL == 0:
+                    data = keyframe
+                else:
+                    data = interframe
+
+                publisher.videoDataReceived(data, start + i * 40)
+
+            for i in xrange(AUDIO_FPS):
+                publisher.audioDataReceived(audio, start + i * 23)
+
+            # keep the index from growing without bounds
+            del writer.index.times[:], writer.index.offsets[:]
+
+        return run
+
+    return setup
+
+
+
+def play(bitrate):
+    def setup():
+        keyframe, interframe, audio = frames(bitrate)
+        tags = []
+
+        for second in xrange(KEYFRAME_INTERVAL):
+            start = second * 1000
+
+            for i in xrange(VIDEO_FPS):
+                if i == 0 and second % KEYFRAME_INTERVAL == 0:
+                    data = keyframe
+                else:
+                    data = interframe
+
+                tags.append((message.VIDEO_DATA, start + i * 40, data))
+
+            for i in xrange(AUDIO_FPS):
+                tags.append((message.AUDIO_DATA, start + i * 23, audio))
+
+        tags.sort(key=lambda tag: tag[1])
+
+        # removed when the file (and so the benchmark) is garbage collected
+        f = tempfile.NamedTemporaryFile(suffix='.flv')
+        f.write(flv.HEADER)
+
+        for tag in tags:
+            f.write(flv.encodeTag(*tag))
+
+        f.flush()
+
+        vod = flv.FLVFile(f.name)
+        vod._opened(vod._open())
+
+        clock = task.Clock()
+        player = flv.FLVPlayer(vod, 1.0, reactor=clock)
+        player.addSubscriber(Subscriber())
+
+        def run():
+            player.seek(0)
+            clock.advance(0)
+
+        run.file = f
+
+        return run
+
+    return setup
+
+
+
+def indexed(func):
+    """
+    Calls C{func} with an L{flv.FLVFile} of C{INDEX_MINUTES} of small tags,
+    with a sidecar.
+    """
+    def setup():
+        path = tempfile.mkdtemp()
+        atexit.register(shutil.rmtree, path, True)
+
+        f = open(os.path.join(path, 'index.flv'), 'wb')
+        f.write(flv.HEADER)
+
+        for second in xrange(INDEX_MINUTES * 60):
+            start = second * 1000
+            tags = []
+
+            for i in xrange(VIDEO_FPS):
+                if i == 0 and second % KEYFRAME_INTERVAL == 0:
+                    data = '\x17key'
+                else:
+                    data = '\x27inter'
+
+                tags.append((message.VIDEO_DATA, start + i * 40, data))
+
+            for i in xrange(AUDIO_FPS):
+                tags.append((message.AUDIO_DATA, start + i * 23, '\xafaudio'))
+
+            tags.sort(key=lambda tag: tag[1])
+
+            f.write(''.join([flv.encodeTag(*tag) for tag in tags]))
+
+        f.close()
+
+        vod = flv.FLVFile(f.name)
+        vod._opened(vod._open())
+
+        return func(vod)
+
+    return setup
+
+
+
+def scan(vod):
+    def run():
+        vod.scan(vod.mmap, vod.dataOffset)
+
+    return run
+
+
+
+def load(vod):
+    def run():
+        flv.readIndex(vod.filename).close()
+
+    return run
+
+
+
+def seek(vod):
+    index = flv.readIndex(vod.filename)
+    state = {'timestamp': 0}
+    duration = index.duration
+
+    def run():
+        state['timestamp'] = (state['timestamp'] + 7919) % duration
+
+        index.seek(state['timestamp'])
+
+    return run
+
+
+
+def send(frameSize, cached):
+    def setup():
+        encoder = codec.Encoder(NullOutput())
+        encoder.setFrameSize(frameSize)
+
+        video = codec.StreamingChannel(encoder, 1, NullOutput())
+        video.setType(message.VIDEO_DATA)
+
+        audio = codec.StreamingChannel(encoder, 1, NullOutput())
+        audio.setType(message.AUDIO_DATA)
+
+        keyframe, interframe, sound = frames(SEND_BITRATE)
+        tags = []
+
+        for i in xrange(VIDEO_FPS):
+            if i == 0:
+                data = keyframe
+            else:
+                data = interframe
+
+            tags.append((video, data, i * 40))
+
+        for i in xrange(AUDIO_FPS):
+            tags.append((audio, sound, i * 23))
+
+        # the offset of the tag in the file is the key
+        tags = [(channel, data, timestamp, i)
+            for i, (channel, data, timestamp) in enumerate(sorted(tags,
+                key=lambda tag: tag[2]))]
+
+        cache = flv.ChunkCache(64 * 1024 * 1024)
+        state = {'second': 0}
+
+        def run():
+            start = state['second'] * 1000
+            state['second'] += 1
+
+            for channel, data, timestamp, key in tags:
+                if cached:
+                    channel.sendFrames(cache.getFrames(key, data, channel),
+                        len(data), start + timestamp)
+                else:
+                    channel.sendData(data, start + timestamp)
+
+        return run
+
+    return setup
+
+
+
+def get_benchmarks():
+    index = 'minutes=%d' % (INDEX_MINUTES,)
+    sends = []
+
+    for frameSize in FRAME_SIZES:
+        suffix = '/second/bitrate=%dk/frame=%d' % (SEND_BITRATE, frameSize)
+
+        sends.extend([
+            ('StreamingChannel/sendData' + suffix, send(frameSize, False)),
+            ('ChunkCache/sendFrames' + suffix, send(frameSize, True)),
+        ])
+
+    return [('StreamPublisher/FLVRecorder/second/bitrate=%dk' % (bitrate,),
+        record(bitrate)) for bitrate in BITRATES] + [
+        ('FLVPlayer/second/bitrate=%dk' % (bitrate,), play(bitrate))
+        for bitrate in BITRATES] + [
+        ('KeyframeIndex/scan/' + index, indexed(scan)),
+        ('KeyframeIndex/load/' + index, indexed(load)),
+        ('KeyframeIndex/seek/' + index, indexed(seek)),
+    ] + sends
@@ -0,0 +1,90 @@
+# Copyright the RTMPy Project
+#
+# RTMPy is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# RTMPy is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with RTMPy.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Benchmarks for dispatching a received invoke to the exposed method, including
+sending the response. The messages are not encoded.
+"""
+
+from twisted.internet import defer
+
+from rtmpy import rpc, server
+
+
+
+class Handler(rpc.AbstractCallHandler):
+    def sendMessage(self, msg, whenDone=None):
+        pass
+
+
+    @rpc.expose
+    def sync(self, arg):
+        return arg
+
+
+    @rpc.expose
+    def deferred(self, arg):
+        return defer.succeed(arg)
+
+
+
+class NetConnection(server.NetConnection):
+    def sendMessage(self, msg, whenDone=None):
+        pass
+
+
+
+def invoke(name, notify):
+    def setup():
+        handler = Handler()
+
+        def run():
+            callId = rpc.NO_RESULT
+
+            if not notify:
+                callId = handler.getNextCallId()
+
+            handler.callReceived(name, callId, 'foo')
+
+        return run
+
+    return setup
+
+
+
+def client(name):
+    def setup():
+        protocol = server.ServerFactory().buildProtocol(None)
+        nc = NetConnection(protocol)
+        nc.client = server.Client(nc)
+        nc.client.foo = lambda arg: arg
+
+        def run():
+            nc.callReceived(name, nc.getNextCallId(), 'foo')
+
+        return run
+
+    return setup
+
+
+
+def get_benchmarks():
+    return [
+        ('invoke/sync', invoke('sync', False)),
+        ('invoke/deferred', invoke('deferred', False)),
+        ('notify/sync', invoke('sync', True)),
+        ('NetConnection/client', client('foo')),
+        ('NetConnection/exposed', client('releaseStream')),
+    ]
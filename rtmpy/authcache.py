@@ -0,0 +1,166 @@
+# -*- test-case-name: rtmpy.tests.test_authcache -*-
+
+# Copyright the RTMPy Project
+#
+# RTMPy is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# RTMPy is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with RTMPy.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Caches the connect and publish authorization decisions of an application, so
+that clients reconnecting with the same credentials do not reach the auth
+backend again::
+
+    app = MyApplication()
+    app.authCache = authcache.AuthorizationCache(ttl=300, negativeTtl=30)
+
+The cache keys are built by L{rtmpy.server.Application}, see
+C{authCacheParams}, C{authCacheQueryArgs} and C{authCacheByIP}.
+
+@since: 0.2
+"""
+
+from rtmpy import util
+
+
+__all__ = ['AuthorizationCache']
+
+
+
+class AuthorizationCache(object):
+    """
+    A least recently used cache of authorization decisions that expire.
+
+    A decision is C{True} for an accepted request or the exception that
+    rejected it.
+
+    @ivar ttl: Seconds for which an accepted request is remembered.
+    @ivar negativeTtl: Seconds for which a rejected request is remembered,
+        C{0} does not remember rejections.
+    @ivar maxSize: The most decisions to keep, the least recently used are
+        evicted first.
+    @ivar hits: The number of lookups answered from the cache.
+    @ivar misses: The number of lookups that were not.
+    @ivar evictions: The number of decisions evicted before they expired.
+    """
+
+    ttl = 60
+    negativeTtl = 10
+    maxSize = 10000
+
+
+    def __init__(self, ttl=None, negativeTtl=None, maxSize=None,
+            reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+
+        if ttl is not None:
+            self.ttl = ttl
+
+        if negativeTtl is not None:
+            self.negativeTtl = negativeTtl
+
+        if maxSize is not None:
+            self.maxSize = maxSize
+
+        self.reactor = reactor
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._entries = util.OrderedDict()
+
+
+    def __len__(self):
+        return len(self._entries)
+
+
+    def __contains__(self, key):
+        return self.get(key, False) is not None
+
+
+    def get(self, key, count=True):
+        """
+        Returns the decision for C{key}, or C{None} if there is none or it has
+        expired.
+        """
+        entry = self._entries.pop(key, None)
+
+        if entry is not None and entry[0] <= self.reactor.seconds():
+            entry = None
+
+        if entry is None:
+            if count:
+                self.misses += 1
+
+            return None
+
+        # most recently used last
+        self._entries[key] = entry
+
+        if count:
+            self.hits += 1
+
+        return entry[1]
+
+
+    def set(self, key, decision):
+        """
+        Remembers the C{decision} for C{key}.
+
+        @param decision: C{True}, or the exception that rejected the request.
+        """
+        ttl = self.ttl
+
+        if decision is not True:
+            ttl = self.negativeTtl
+
+        self._entries.pop(key, None)
+
+        if not ttl:
+            return
+
+        self._entries[key] = (self.reactor.seconds() + ttl, decision)
+
+        while len(self._entries) > self.maxSize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+
+    def invalidate(self, key):
+        """
+        Forgets the decision for C{key}.
+        """
+        self._entries.pop(key, None)
+
+
+    def invalidateIf(self, predicate):
+        """
+        Forgets every decision whose key satisfies C{predicate(key)}, e.g. all
+        the decisions for a client ip.
+
+        @return: The number of decisions forgotten.
+        """
+        keys = [key for key in self._entries if predicate(key)]
+
+        for key in keys:
+            del self._entries[key]
+
+        return len(keys)
+
+
+    def clear(self):
+        """
+        Forgets all the decisions.
+        """
+        self._entries.clear()
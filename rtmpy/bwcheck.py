@@ -0,0 +1,237 @@
+# -*- test-case-name: rtmpy.tests.test_bwcheck -*-
+
+# Copyright the RTMPy Project
+#
+# RTMPy is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# RTMPy is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with RTMPy.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Server side bandwidth check, as expected by adaptive Flash players.
+
+The player calls C{checkBandwidth} on the NetConnection. The server calls
+C{onBWCheck} on the player, first without a payload to measure the latency
+and then in doubling bursts of sized payloads until a burst takes longer than
+C{targetDuration}. Every C{onBWCheck} is answered by the player. Finally the
+server calls C{onBWDone(kbps, kbytes, milliseconds, latency)}.
+
+The payloads are sent through the normal encoder, so the measurement includes
+any shaping or flow control applied to the connection.
+
+@since: 0.2
+"""
+
+from twisted.internet import defer
+
+
+__all__ = ['BandwidthCheck', 'Result']
+
+
+
+class Result(object):
+    """
+    The outcome of a L{BandwidthCheck}.
+
+    @ivar kbps: The measured downstream bandwidth in kilobits per second.
+    @ivar latency: The round trip time in seconds.
+    @ivar bytes: The payload bytes sent.
+    @ivar duration: The seconds that the payloads took, less the latency.
+    @ivar measuredAt: When the check finished, in reactor seconds.
+    """
+
+
+    def __init__(self, kbps, latency, bytes, duration, measuredAt):
+        self.kbps = kbps
+        self.latency = latency
+        self.bytes = bytes
+        self.duration = duration
+        self.measuredAt = measuredAt
+
+
+    def __repr__(self):
+        return '<%s kbps=%d latency=%.3f at 0x%x>' % (
+            self.__class__.__name__, self.kbps, self.latency, id(self))
+
+
+
+class BandwidthCheck(object):
+    """
+    Measures the bandwidth to the peer of a NetConnection.
+
+    @ivar payloadSize: Bytes per C{onBWCheck} payload.
+    @ivar targetDuration: A burst that takes longer than this (in seconds)
+        ends the check.
+    @ivar maxBursts: The most bursts to send. The first has one payload, each
+        burst doubles the number of payloads.
+    @ivar timeout: Seconds that the whole check may take.
+    """
+
+    payloadSize = 16384
+    targetDuration = 0.5
+    maxBursts = 6
+    timeout = 10
+
+
+    def __init__(self, nc, wheel, pinger=None):
+        """
+        @param nc: Makes the C{onBWCheck} calls, see L{rtmpy.rpc.
+            AbstractCallHandler.call}. The calls that are still unanswered
+            when the check fails are discarded.
+        @param wheel: The L{rtmpy.timers.TimerWheel} for the timeout, its
+            reactor is the clock.
+        @param pinger: A L{rtmpy.protocol.ping.Pinger}. If it has measured the
+            round trip time, the latency probe is skipped.
+        """
+        self.nc = nc
+        self.wheel = wheel
+        self.clock = wheel.reactor.seconds
+        self.pinger = pinger
+
+        self.deferred = None
+
+        self._timer = None
+        self._payload = None
+        self._callIds = set()
+
+
+    def start(self):
+        """
+        Runs the check.
+
+        @return: A L{defer.Deferred} that fires with a L{Result}, or fails with
+            L{defer.TimeoutError}.
+        """
+        if self.deferred is not None:
+            return self.deferred
+
+        self.deferred = defer.Deferred()
+        self._timer = self.wheel.schedule(self.timeout, self._timedOut)
+
+        srtt = getattr(self.pinger, 'srtt', None)
+
+        if srtt is not None:
+            d = defer.succeed(srtt)
+        else:
+            d = self._probe(0)
+
+        d.addCallback(self._measure)
+        d.addCallbacks(self._finished, self._failed)
+
+        return self.deferred
+
+
+    def _probe(self, count):
+        """
+        Makes C{count} C{onBWCheck} calls with a payload (or one without if
+        C{count} is C{0}) and returns a L{defer.Deferred} that fires with the
+        seconds taken for all of them to be answered.
+        """
+        started = self.clock()
+
+        if not count:
+            calls = [self._call()]
+        else:
+            if self._payload is None:
+                self._payload = 'x' * self.payloadSize
+
+            calls = [self._call(self._payload) for i in xrange(count)]
+
+        d = defer.gatherResults(calls, consumeErrors=True)
+
+        return d.addCallback(lambda _: self.clock() - started)
+
+
+    def _call(self, *args):
+        callId = self.nc.getNextCallId()
+        d = self.nc.call('onBWCheck', notify=True, *args)
+
+        self._callIds.add(callId)
+
+        def answered(result):
+            self._callIds.discard(callId)
+
+            return result
+
+        return d.addBoth(answered)
+
+
+    def _discardCalls(self):
+        """
+        Forgets the C{onBWCheck} calls that the peer has not answered.
+        """
+        callIds, self._callIds = self._callIds, set()
+
+        for callId in callIds:
+            self.nc.discardCall(callId)
+
+
+    def _measure(self, latency):
+        state = {'bytes': 0, 'duration': 0.0}
+
+        def burst(count):
+            if self.deferred.called:
+                raise defer.CancelledError('Bandwidth check timed out')
+
+            d = self._probe(count)
+
+            def done(elapsed):
+                state['bytes'] += count * self.payloadSize
+                state['duration'] += max(elapsed - latency, 0.001)
+
+                if elapsed >= self.targetDuration or count >= \
+                        2 ** (self.maxBursts - 1):
+                    return
+
+                return burst(count * 2)
+
+            return d.addCallback(done)
+
+        d = burst(1)
+
+        def result(_):
+            return Result((state['bytes'] * 8 / 1000.0) / state['duration'],
+                latency, state['bytes'], state['duration'], self.clock())
+
+        return d.addCallback(result)
+
+
+    def _finished(self, result):
+        self._cancelTimer()
+
+        if not self.deferred.called:
+            self.deferred.callback(result)
+
+
+    def _failed(self, fail):
+        self._cancelTimer()
+        self._discardCalls()
+
+        if fail.check(defer.FirstError):
+            fail = fail.value.subFailure
+
+        if not self.deferred.called:
+            self.deferred.errback(fail)
+
+
+    def _cancelTimer(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+
+    def _timedOut(self):
+        self._timer = None
+        self._discardCalls()
+
+        self.deferred.errback(defer.TimeoutError(
+            'Bandwidth check did not finish within %s seconds' % (
+                self.timeout,)))
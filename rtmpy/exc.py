@@ -58,6 +58,14 @@ class CallFailed(NetConnectionError):
 
 
 
+class ExecutorBusy(CallFailed):
+    """
+    Raised when a call cannot be queued because the executor that it runs in
+    is full. See L{rtmpy.executor}.
+    """
+
+
+
 class ConnectError(NetConnectionError):
     """
     Base error class for all connection related errors.
@@ -136,6 +144,25 @@ class StreamNotFound(PlayError):
 
 
 
+class PlayFailed(PlayError):
+    """
+    Raised when a play request cannot be satisfied, for example when the server
+    is too busy to accept new subscribers.
+    """
+
+    register(codes.NS_PLAY_FAILED)
+
+
+
+class SharedObjectError(BaseError):
+    """
+    Raised when a peer is not allowed to use or create a shared object.
+    """
+
+    register(codes.SO_CREATION_FAILED)
+
+
+
 def codeByClass(cls):
     """
     """
@@ -168,7 +195,10 @@ for k, v in globals().items():
 
     code = v.__status_code__
 
-    CLASS_CODES[code] = v
+    # subclasses share the code but the declaring class keeps the reverse map
+    if '__status_code__' in v.__dict__:
+        CLASS_CODES[code] = v
+
     CLASS_CODES[v.__name__] = code
 
 del k, v
@@ -0,0 +1,505 @@
+# -*- test-case-name: rtmpy.tests.test_executor -*-
+
+# Copyright the RTMPy Project
+#
+# RTMPy is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# RTMPy is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with RTMPy.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Runs blocking or CPU heavy work away from the reactor thread.
+
+An L{Executor} runs at most C{maxWorkers} calls at a time and queues up to
+C{maxQueued} more. Anything beyond that fails straight away with
+L{exc.ExecutorBusy}. Results are always delivered on the reactor thread.
+
+Exposed RPC methods name the executor to run in::
+
+    class NetConnection(server.NetConnection):
+        @rpc.expose(executor='thread')
+        def checkSignature(self, payload):
+            ...
+
+        @rpc.expose(executor='process')
+        @staticmethod
+        def transform(payload):
+            ...
+
+Methods run in a thread must not touch the connection or any other Twisted
+API. Methods run in a process must be staticmethods of a module level class,
+their arguments and result must be picklable (the call fails if they are
+not).
+
+The default C{thread} and C{process} executors can be replaced, or others
+added, with L{register}.
+
+@since: 0.2
+"""
+
+import sys
+import pickle
+import collections
+
+from twisted.python import failure
+from twisted.internet import defer
+
+from rtmpy import exc
+
+
+__all__ = [
+    'Executor',
+    'ThreadExecutor',
+    'ProcessExecutor',
+    'register',
+    'get',
+]
+
+
+#: Named executors, see L{get}.
+_executors = {}
+
+
+
+class Executor(object):
+    """
+    Runs functions with bounded concurrency. Subclasses implement L{dispatch}.
+
+    @ivar name: Identifies the executor, e.g. in the metrics.
+    @ivar maxWorkers: The most calls to run at the same time.
+    @ivar maxQueued: The most calls waiting for a worker.
+    @ivar timeout: Seconds to wait for the result of a call before failing it
+        with L{defer.TimeoutError}. The call keeps its worker until it
+        finishes. C{None} waits for ever.
+    @ivar running: The number of calls running.
+    @ivar abandoned: The number of running calls that have timed out.
+    @ivar completed: The number of calls that have finished.
+    @ivar rejected: The number of calls failed with L{exc.ExecutorBusy}.
+    """
+
+    maxWorkers = 4
+    maxQueued = 64
+    timeout = None
+
+
+    def __init__(self, maxWorkers=None, maxQueued=None, name=None,
+            reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+
+        if maxWorkers is not None:
+            self.maxWorkers = maxWorkers
+
+        if maxQueued is not None:
+            self.maxQueued = maxQueued
+
+        if self.maxWorkers < 1:
+            raise ValueError('maxWorkers must be > 0')
+
+        self.name = name
+        self.reactor = reactor
+
+        self.running = 0
+        self.abandoned = 0
+        self.completed = 0
+        self.rejected = 0
+
+        self._queue = collections.deque()
+        self._started = False
+        self._trigger = None
+
+
+    def __repr__(self):
+        return '<%s %r running=%d queued=%d at 0x%x>' % (
+            self.__class__.__name__, self.name, self.running, self.queued,
+            id(self))
+
+
+    @property
+    def queued(self):
+        """
+        The number of calls waiting for a worker.
+        """
+        return len(self._queue)
+
+
+    def submit(self, func, *args, **kwargs):
+        """
+        Runs C{func(*args, **kwargs)} on a worker.
+
+        @return: A L{defer.Deferred} that fires on the reactor thread with the
+            result, or fails with L{exc.ExecutorBusy} if the queue is full.
+        """
+        d = defer.Deferred()
+
+        if self.running < self.maxWorkers:
+            self._run(d, func, args, kwargs)
+        elif len(self._queue) < self.maxQueued:
+            self._queue.append((d, func, args, kwargs))
+        else:
+            self.rejected += 1
+
+            d.errback(exc.ExecutorBusy('Too many calls waiting for %s' % (
+                self.name or 'executor',)))
+
+        return d
+
+
+    def wrap(self, cls, name, method):
+        """
+        Returns a callable that submits C{method}, found as C{name} on
+        C{cls}, to this executor.
+        """
+        def submit(*args):
+            return self.submit(method, *args)
+
+        return submit
+
+
+    def _run(self, d, func, args, kwargs):
+        if not self._started:
+            self._started = True
+            self.start()
+
+        self.running += 1
+        timer = None
+
+        if self.timeout is not None:
+            timer = self.reactor.callLater(self.timeout, self._timedOut, d)
+
+        def finished(success, result):
+            self.reactor.callFromThread(self._finished, d, timer, success,
+                result)
+
+        self.dispatch(func, args, kwargs, finished)
+
+
+    def _finished(self, d, timer, success, result):
+        self.running -= 1
+        self.completed += 1
+
+        if self._queue and self._started:
+            self._run(*self._queue.popleft())
+
+        if timer is not None:
+            if not timer.active():
+                # the caller has already been failed by _timedOut
+                self.abandoned -= 1
+
+                return
+
+            timer.cancel()
+
+        if success:
+            d.callback(result)
+        else:
+            d.errback(result)
+
+
+    def _timedOut(self, d):
+        """
+        Fails the caller of a call that has run for C{timeout} seconds. The
+        call holds on to its worker until it finishes.
+        """
+        self.abandoned += 1
+
+        if not d.called:
+            d.errback(defer.TimeoutError('No result from %s after %s '
+                'seconds' % (self.name or 'executor', self.timeout)))
+
+
+    def start(self):
+        """
+        Called before the first call is dispatched. The workers are stopped
+        when the reactor shuts down.
+        """
+        self._trigger = self.reactor.addSystemEventTrigger('during',
+            'shutdown', self.stop)
+
+
+    def stop(self):
+        """
+        Stops the workers. Queued calls fail with L{defer.CancelledError}.
+        """
+        self._started = False
+
+        if self._trigger is not None:
+            try:
+                self.reactor.removeSystemEventTrigger(self._trigger)
+            except ValueError:
+                # the reactor is shutting down
+                pass
+
+            self._trigger = None
+
+        while self._queue:
+            d = self._queue.popleft()[0]
+
+            d.errback(defer.CancelledError('%s stopped' % (
+                self.name or 'executor',)))
+
+
+    def dispatch(self, func, args, kwargs, finished):
+        """
+        Runs C{func(*args, **kwargs)} on a worker and calls
+        C{finished(success, result)} from any thread when done.
+        """
+        raise NotImplementedError
+
+
+
+class ThreadExecutor(Executor):
+    """
+    Runs calls in a L{twisted.python.threadpool.ThreadPool}.
+    """
+
+    pool = None
+
+
+    def start(self):
+        from twisted.python import threadpool
+
+        Executor.start(self)
+
+        self.pool = threadpool.ThreadPool(0, self.maxWorkers,
+            self.name or 'rtmpy-executor')
+        self.pool.start()
+
+
+    def stop(self):
+        Executor.stop(self)
+
+        if self.pool is not None:
+            self.pool.stop()
+            self.pool = None
+
+
+    def dispatch(self, func, args, kwargs, finished):
+        self.pool.callInThreadWithCallback(finished, func, *args, **kwargs)
+
+
+
+class FunctionReference(object):
+    """
+    A picklable reference to the attribute C{path} of C{module}.
+    """
+
+
+    def __init__(self, module, path):
+        self.module = module
+        self.path = tuple(path)
+
+
+    def __repr__(self):
+        return '<%s %s.%s>' % (self.__class__.__name__, self.module,
+            '.'.join(self.path))
+
+
+    def __call__(self, *args, **kwargs):
+        __import__(self.module)
+
+        obj = sys.modules[self.module]
+
+        for name in self.path:
+            obj = getattr(obj, name)
+
+        return obj(*args, **kwargs)
+
+
+
+def _initProcess():
+    """
+    Runs in each new worker process. The workers are forked from the reactor
+    process and must not inherit its signal handlers, the pool stops them with
+    C{SIGTERM}.
+    """
+    import signal
+
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+
+def _callInProcess(data):
+    """
+    Runs in the worker process. C{data} is the pickled C{(func, args,
+    kwargs)} and the result is returned pickled, so that a result that cannot
+    be pickled is reported like any other failure. Exceptions are returned
+    rather than raised, the multiprocessing pool of Python 2 cannot report
+    them asynchronously.
+    """
+    try:
+        func, args, kwargs = pickle.loads(data)
+
+        return True, pickle.dumps(func(*args, **kwargs),
+            pickle.HIGHEST_PROTOCOL)
+    except Exception, e:
+        try:
+            pickle.dumps(e)
+        except Exception:
+            e = RuntimeError('%s: %s' % (e.__class__.__name__, e))
+
+        return False, e
+
+
+
+class ProcessExecutor(Executor):
+    """
+    Runs calls in a C{multiprocessing.Pool}.
+
+    The pool never answers a call whose worker died. Such a call times out,
+    and once only timed out calls are running the pool is replaced and their
+    workers are freed.
+    """
+
+    pool = None
+    timeout = 300
+
+
+    def wrap(self, cls, name, method):
+        """
+        The function behind the staticmethod C{name} is sent to the pool by
+        reference, see L{FunctionReference}.
+
+        @raise TypeError: C{name} is not a staticmethod.
+        """
+        for klass in cls.__mro__:
+            if name in klass.__dict__:
+                break
+
+        if not isinstance(klass.__dict__.get(name), staticmethod):
+            raise TypeError('%s.%s must be a staticmethod to run in a '
+                'process' % (cls.__name__, name))
+
+        return Executor.wrap(self, cls, name,
+            FunctionReference(klass.__module__, [klass.__name__, name]))
+
+
+    def start(self):
+        import multiprocessing
+
+        Executor.start(self)
+
+        self.pool = multiprocessing.Pool(self.maxWorkers, _initProcess)
+        self._calls = set()
+
+
+    def replacePool(self):
+        """
+        Terminates the workers and starts new ones. The running calls fail
+        with L{defer.CancelledError}.
+        """
+        import multiprocessing
+
+        self.pool.terminate()
+        self.pool.join()
+
+        self.pool = multiprocessing.Pool(self.maxWorkers, _initProcess)
+        calls, self._calls = self._calls, set()
+
+        while calls:
+            calls.pop()(False, failure.Failure(defer.CancelledError(
+                '%s replaced its workers' % (self.name or 'executor',))))
+
+
+    def _timedOut(self, d):
+        Executor._timedOut(self, d)
+
+        if self.pool is not None and self.abandoned == self.running:
+            self.replacePool()
+
+
+    def stop(self):
+        Executor.stop(self)
+
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+
+
+    def dispatch(self, func, args, kwargs, finished):
+        try:
+            data = pickle.dumps((func, args, kwargs), pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            finished(False, failure.Failure())
+
+            return
+
+        calls = self._calls
+        calls.add(finished)
+
+        def complete(success, result):
+            # the call has been failed by replacePool
+            if finished not in calls:
+                return
+
+            calls.remove(finished)
+            finished(success, result)
+
+        def callback(result):
+            success, result = result
+
+            try:
+                if success:
+                    result = pickle.loads(result)
+                else:
+                    result = failure.Failure(result)
+            except Exception:
+                success, result = False, failure.Failure()
+
+            self.reactor.callFromThread(complete, success, result)
+
+        self.pool.apply_async(_callInProcess, (data,), callback=callback)
+
+
+
+#: Builds the default executors, see L{get}.
+DEFAULT_EXECUTORS = {
+    'thread': ThreadExecutor,
+    'process': ProcessExecutor,
+}
+
+
+
+def register(name, executor):
+    """
+    Makes C{executor} available as C{name}, replacing any existing executor
+    of that name.
+    """
+    _executors[name] = executor
+
+    if executor.name is None:
+        executor.name = name
+
+
+
+def get(name):
+    """
+    Returns the executor registered as C{name}. The C{thread} and C{process}
+    executors are built on first use.
+
+    @raise LookupError: Unknown executor.
+    """
+    try:
+        return _executors[name]
+    except KeyError:
+        pass
+
+    try:
+        klass = DEFAULT_EXECUTORS[name]
+    except KeyError:
+        raise LookupError('Unknown executor %r' % (name,))
+
+    executor = klass(name=name)
+    register(name, executor)
+
+    return executor
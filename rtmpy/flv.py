@@ -0,0 +1,1279 @@
+# -*- test-case-name: rtmpy.tests.test_flv -*-
+
+# Copyright the RTMPy Project
+#
+# RTMPy is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# RTMPy is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with RTMPy.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Reads and writes FLV files.
+
+L{FLVWriter} never touches the file on the reactor thread. Tags are encoded
+into an in memory buffer that is handed to a thread in blocks of
+C{blockSize} bytes. One block per file is written at a time, in order. The
+writer keeps an index of the keyframes and, when it is closed, patches the
+C{duration} and C{filesize} of the C{onMetaData} tag at the start of the
+file.
+
+Streams published with the type C{record} or C{append} are recorded by an
+L{FLVRecorder} when the application has a C{recordPath}, see
+L{rtmpy.server.Application.startRecording}.
+
+Streams that are not published are played from the C{vodPath} of the
+application by an L{FLVPlayer}. The files are memory mapped (L{FLVFile}), so
+the viewers of a file share the page cache.
+
+The seek points of a file are kept in a L{KeyframeIndex}. It is saved next to
+the file (C{<filename>.idx}) when a recording is closed or, for other files,
+when the file is first played, so that a file is only scanned once. The
+sidecar is stamped with the size and modification time of the file and is
+memory mapped and searched in place, without being read. The sidecar is
+loaded, or the file scanned and the sidecar written, in the thread that
+opens the file; the file is only handed out once its index is complete.
+
+Applications with a C{vodCacheSize} keep the tags of the files they play
+split into RTMP frames in a L{ChunkCache}, so that each viewer of a popular
+file only has to encode the first header of each message.
+
+@since: 0.2
+"""
+
+import os
+import mmap
+import bisect
+import struct
+import collections
+
+import pyamf
+from pyamf.util import BufferedByteStream
+from twisted.python import log, failure
+from twisted.internet import defer, threads
+
+from rtmpy import message, util
+
+
+__all__ = [
+    'FLVWriter',
+    'FLVRecorder',
+    'FLVFile',
+    'FLVPlayer',
+    'KeyframeIndex',
+    'ChunkCache',
+    'readIndex',
+    'writeIndex',
+]
+
+
+#: The FLV file header, version 1 with audio and video.
+HEADER = 'FLV\x01\x05\x00\x00\x00\x09\x00\x00\x00\x00'
+
+#: FLV video frame type of a keyframe (the upper 4 bits of the first byte).
+KEYFRAME = 1
+
+#: FLV video codec id of H.264 (the lower 4 bits of the first byte).
+AVC = 7
+
+#: FLV audio format of AAC (the upper 4 bits of the first byte).
+AAC = 10
+
+#: type | data size | timestamp | timestamp extended | stream id
+_tagHeader = '!BBHBHBBH'
+_tagHeaderSize = struct.calcsize(_tagHeader)
+_tagSize = '!L'
+_double = '!d'
+
+#: The slots of C{onMetaData} that are patched when the file is closed.
+PATCHED_SLOTS = ('duration', 'filesize')
+
+#: Milliseconds between the seek points of files without video.
+AUDIO_SEEK_INTERVAL = 1000
+
+#: Appended to the name of an FLV file for its index sidecar.
+INDEX_SUFFIX = '.idx'
+
+INDEX_MAGIC = 'FLVI'
+INDEX_VERSION = 1
+
+#: magic | version | flags | file size | file mtime | duration | data offset |
+#: metadata offset | video config offset | audio config offset | count,
+#: followed by the timestamps (uint32) and the offsets (uint64) of the seek
+#: points.
+_indexHeader = '!4sBBQdLLQQQL'
+_indexHeaderSize = struct.calcsize(_indexHeader)
+_uint32 = '!L'
+_uint64 = '!Q'
+
+#: The flag of an index of a file with video.
+_INDEX_VIDEO = 0x01
+
+_metaDataPrefix = '\x02\x00\x0aonMetaData'
+
+
+
+def encodeTag(datatype, timestamp, data):
+    """
+    Returns the FLV tag for C{data}, including the trailing tag size.
+    """
+    size = len(data)
+
+    return ''.join([
+        struct.pack(_tagHeader, datatype, size >> 16, size & 0xffff,
+            (timestamp >> 16) & 0xff, timestamp & 0xffff,
+            (timestamp >> 24) & 0xff, 0, 0),
+        data,
+        struct.pack(_tagSize, size + 11),
+    ])
+
+
+
+def _readHeader(buf, offset):
+    """
+    Decodes the header of the tag at C{offset} in C{buf}.
+
+    @return: C{(datatype, size, timestamp)}
+    """
+    datatype, sizeHigh, sizeLow, tsHigh, tsLow, tsExtended, streamHigh, \
+        streamLow = struct.unpack(_tagHeader,
+            buf[offset:offset + _tagHeaderSize])
+
+    return (datatype, (sizeHigh << 16) | sizeLow,
+        (tsExtended << 24) | (tsHigh << 16) | tsLow)
+
+
+
+def encodeMetaData(meta):
+    """
+    Encodes the body of an C{onMetaData} script tag. The patched slots come
+    first, so that they can be found again when a file is appended to.
+
+    @return: The body and a C{dict} of slot name -> offset of its value.
+    """
+    buf = BufferedByteStream()
+    encoder = pyamf.get_encoder(pyamf.AMF0, buf)
+    offsets = {}
+
+    encoder.writeElement(u'onMetaData')
+
+    items = [(k, v) for k, v in meta.iteritems() if k not in PATCHED_SLOTS]
+
+    # an ECMA array
+    buf.write_uchar(0x08)
+    buf.write_ulong(len(items) + len(PATCHED_SLOTS))
+
+    for name in PATCHED_SLOTS:
+        buf.write_ushort(len(name))
+        buf.write(name)
+        buf.write_uchar(0x00)
+
+        offsets[name] = buf.tell()
+        buf.write(struct.pack(_double, float(meta.get(name, 0))))
+
+    for name, value in items:
+        name = unicode(name).encode('utf-8')
+
+        buf.write_ushort(len(name))
+        buf.write(name)
+        encoder.writeElement(value)
+
+    buf.write('\x00\x00\x09')
+
+    return buf.getvalue(), offsets
+
+
+
+def getIndexFilename(filename):
+    """
+    Returns the index sidecar of the FLV file C{filename}.
+    """
+    return filename + INDEX_SUFFIX
+
+
+
+def readIndex(filename, size=None, mtime=None):
+    """
+    Returns the L{KeyframeIndex} of the FLV file C{filename} from its sidecar,
+    or C{None} if there is no sidecar or it is out of date.
+
+    @param size: The size of C{filename}, if it has been stat'ed already.
+    @param mtime: The modification time of C{filename}.
+    """
+    if size is None:
+        st = os.stat(filename)
+        size, mtime = st.st_size, st.st_mtime
+
+    try:
+        f = open(getIndexFilename(filename), 'rb')
+    except IOError:
+        return None
+
+    try:
+        header = f.read(_indexHeaderSize)
+
+        if len(header) != _indexHeaderSize:
+            return None
+
+        magic, version, flags, fileSize, fileTime, duration, dataOffset, \
+            metaData, videoConfig, audioConfig, count = \
+            struct.unpack(_indexHeader, header)
+
+        if magic != INDEX_MAGIC or version != INDEX_VERSION:
+            return None
+
+        if fileSize != size or fileTime != mtime:
+            return None
+
+        if os.fstat(f.fileno()).st_size != _indexHeaderSize + count * 12:
+            return None
+
+        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    finally:
+        f.close()
+
+    start = _indexHeaderSize
+
+    index = KeyframeIndex(_Column(m, start, count, _uint32),
+        _Column(m, start + count * struct.calcsize(_uint32), count, _uint64),
+        duration, dataOffset, metaData, videoConfig, audioConfig,
+        bool(flags & _INDEX_VIDEO))
+    index.mmap = m
+
+    return index
+
+
+
+def writeIndex(filename, index, size=None, mtime=None):
+    """
+    Writes C{index} to the sidecar of the FLV file C{filename}, stamped with
+    the size and modification time of the file.
+    """
+    if size is None:
+        st = os.stat(filename)
+        size, mtime = st.st_size, st.st_mtime
+
+    count = len(index.times)
+    flags = 0
+
+    if index.hasVideo:
+        flags |= _INDEX_VIDEO
+
+    sidecar = getIndexFilename(filename)
+    tmp = sidecar + '.tmp'
+    f = open(tmp, 'wb')
+
+    try:
+        f.write(struct.pack(_indexHeader, INDEX_MAGIC, INDEX_VERSION, flags,
+            size, mtime, index.duration, index.dataOffset, index.metaData,
+            index.videoConfig, index.audioConfig, count))
+        f.write(struct.pack('!%dL' % (count,), *index.times))
+        f.write(struct.pack('!%dQ' % (count,), *index.offsets))
+    finally:
+        f.close()
+
+    os.rename(tmp, sidecar)
+
+
+
+def removeIndex(filename):
+    """
+    Removes the sidecar of the FLV file C{filename}, if any.
+    """
+    try:
+        os.remove(getIndexFilename(filename))
+    except OSError:
+        pass
+
+
+
+def findMetaData(data):
+    """
+    Returns the offsets of the patched slots in the C{onMetaData} body
+    C{data} if it was written by L{encodeMetaData}, otherwise C{None}.
+    """
+    prefix = _metaDataPrefix + '\x08'
+    offset = len(prefix) + 4
+    offsets = {}
+
+    if not data.startswith(prefix):
+        return None
+
+    for name in PATCHED_SLOTS:
+        slot = struct.pack('!H', len(name)) + name + '\x00'
+
+        if data[offset:offset + len(slot)] != slot:
+            return None
+
+        offset += len(slot)
+        offsets[name] = offset
+        offset += 8
+
+    return offsets
+
+
+
+class _Column(object):
+    """
+    A read only sequence of the packed integers of an index sidecar, so that
+    it can be searched with L{bisect} without being read.
+    """
+
+
+    def __init__(self, buffer, start, count, format):
+        self.buffer = buffer
+        self.start = start
+        self.count = count
+        self.format = format
+        self.size = struct.calcsize(format)
+
+
+    def __len__(self):
+        return self.count
+
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self.count
+
+        if not 0 <= i < self.count:
+            raise IndexError(i)
+
+        offset = self.start + i * self.size
+
+        return struct.unpack(self.format,
+            self.buffer[offset:offset + self.size])[0]
+
+
+
+class KeyframeIndex(object):
+    """
+    The seek points of an FLV file, the video keyframes (or every
+    C{AUDIO_SEEK_INTERVAL} for files without video), and the tags that a
+    player needs before it can start at one of them.
+
+    Indexes loaded by L{readIndex} are read only.
+
+    @ivar times: The timestamps of the seek points.
+    @ivar offsets: The offsets of the seek points.
+    @ivar duration: The timestamp of the last tag, in milliseconds.
+    @ivar dataOffset: The offset of the first tag.
+    @ivar metaData: The offset of the C{onMetaData} tag, or C{0}.
+    @ivar videoConfig: The offset of the first H.264 sequence header, or
+        C{0}.
+    @ivar audioConfig: The offset of the first AAC sequence header, or C{0}.
+    @ivar hasVideo: Whether there is a video tag in the file.
+    @ivar mmap: The mapping of the sidecar the index was loaded from.
+    """
+
+
+    def __init__(self, times=None, offsets=None, duration=0,
+                 dataOffset=len(HEADER), metaData=0, videoConfig=0,
+                 audioConfig=0, hasVideo=False):
+        if times is None:
+            times = []
+
+        if offsets is None:
+            offsets = []
+
+        self.times = times
+        self.offsets = offsets
+        self.duration = duration
+        self.dataOffset = dataOffset
+        self.metaData = metaData
+        self.videoConfig = videoConfig
+        self.audioConfig = audioConfig
+        self.hasVideo = hasVideo
+
+        self.mmap = None
+
+
+    def __repr__(self):
+        return '<%s seekpoints=%d duration=%d at 0x%x>' % (
+            self.__class__.__name__, len(self.times), self.duration, id(self))
+
+
+    def add(self, datatype, timestamp, offset, data):
+        """
+        Adds the tag at C{offset} to the index.
+
+        @param data: The body of the tag, or at least its first 13 bytes.
+        """
+        if timestamp > self.duration:
+            self.duration = timestamp
+
+        if datatype == message.VIDEO_DATA:
+            if not self.hasVideo:
+                # the audio seek points are of no use any more
+                self.hasVideo = True
+                del self.times[:], self.offsets[:]
+
+            if not data:
+                return
+
+            flags = ord(data[0])
+
+            # sequence headers are keyframes too
+            if flags >> 4 != KEYFRAME:
+                return
+
+            if flags & 0x0f == AVC and data[1:2] == '\x00':
+                if not self.videoConfig:
+                    self.videoConfig = offset
+            else:
+                self.times.append(timestamp)
+                self.offsets.append(offset)
+        elif datatype == message.AUDIO_DATA:
+            if not self.audioConfig and data and ord(data[0]) >> 4 == AAC \
+                    and data[1:2] == '\x00':
+                self.audioConfig = offset
+
+                return
+
+            if self.hasVideo:
+                return
+
+            if not self.times or \
+                    timestamp >= self.times[-1] + AUDIO_SEEK_INTERVAL:
+                self.times.append(timestamp)
+                self.offsets.append(offset)
+        elif datatype == message.NOTIFY:
+            if not self.metaData and data.startswith(_metaDataPrefix):
+                self.metaData = offset
+
+
+    def seek(self, timestamp):
+        """
+        Returns the offset of the last seek point at or before C{timestamp}.
+        """
+        i = bisect.bisect_right(self.times, timestamp) - 1
+
+        if i < 0:
+            return self.dataOffset
+
+        return self.offsets[i]
+
+
+    def copy(self):
+        """
+        Returns a copy of this index that can be added to.
+        """
+        return self.__class__(list(self.times), list(self.offsets),
+            self.duration, self.dataOffset, self.metaData, self.videoConfig,
+            self.audioConfig, self.hasVideo)
+
+
+    def close(self):
+        if self.mmap is not None:
+            self.mmap.close()
+            self.mmap = None
+
+
+
+class FLVWriter(object):
+    """
+    Writes FLV tags to C{filename} from a thread.
+
+    @ivar filename: The FLV file.
+    @ivar append: Whether to append to an existing file. The appended tags
+        follow on from the timestamp of the last tag in the file.
+    @ivar metaData: Written as the C{onMetaData} tag at the start of the file,
+        before the first audio/video tag.
+    @ivar blockSize: Bytes to buffer before they are written.
+    @ivar size: The size of the file, including the buffered tags.
+    @ivar duration: The timestamp of the last tag written, in milliseconds.
+    @ivar index: The L{KeyframeIndex} of the file, written to its sidecar
+        when the writer is closed. C{None} when appending to a file without
+        an up to date sidecar.
+    @ivar failure: The L{failure.Failure} of the write that failed, the
+        following tags are discarded.
+    """
+
+    blockSize = 65536
+
+
+    def __init__(self, filename, append=False, metaData=None, blockSize=None):
+        self.filename = filename
+        self.append = append
+        self.metaData = dict(metaData or {})
+
+        if blockSize is not None:
+            self.blockSize = blockSize
+
+        self.size = 0
+        self.duration = 0
+        self.index = KeyframeIndex()
+        self.failure = None
+
+        self.opened = False
+        self.closed = False
+
+        self._file = None
+        self._baseTimestamp = 0
+        self._offsets = None
+        self._headerWritten = False
+        self._early = []
+        self._buffer = []
+        self._buffered = 0
+        self._jobs = collections.deque()
+        self._busy = False
+
+
+    def __repr__(self):
+        return '<%s %r size=%d at 0x%x>' % (self.__class__.__name__,
+            self.filename, self.size, id(self))
+
+
+    def open(self):
+        """
+        Opens the file in a thread. Tags written before it is open are kept
+        until it is.
+
+        @return: A L{defer.Deferred} that fires when the file is open.
+        """
+        d = self._submit(self._open, self.filename, self.append)
+
+        def opened(result):
+            self._file, self.size, self._baseTimestamp, self._offsets, \
+                self.index = result
+            self.duration = self._baseTimestamp
+            self.opened = True
+            self._headerWritten = self.size > 0
+
+            early, self._early = self._early, []
+
+            for args in early:
+                self._writeTag(*args)
+
+            return self
+
+        return d.addCallback(opened)
+
+
+    def writeTag(self, datatype, timestamp, data):
+        """
+        Writes an audio, video or script data tag.
+
+        @param timestamp: Milliseconds since the start of the recording.
+        """
+        if self.closed or self.failure is not None:
+            return
+
+        if not self.opened:
+            self._early.append((datatype, timestamp, data))
+
+            return
+
+        self._writeTag(datatype, timestamp, data)
+
+
+    def writeMetaData(self, meta):
+        """
+        Updates the metadata. If the C{onMetaData} tag at the start of the
+        file has been written the metadata is written as a script data tag.
+        """
+        if not self._headerWritten and not self._early:
+            self.metaData.update(meta)
+
+            return
+
+        buf = BufferedByteStream()
+        message.Notify('onMetaData', meta).encode(buf)
+
+        self.writeTag(message.NOTIFY, self.duration - self._baseTimestamp,
+            buf.getvalue())
+
+
+    def _writeTag(self, datatype, timestamp, data):
+        if not self._headerWritten:
+            self._writeHeader()
+
+        timestamp += self._baseTimestamp
+        index = self.index
+
+        # most tags are audio, that is of no interest once there is video
+        if index is not None and (datatype != message.AUDIO_DATA or
+                not index.hasVideo or not index.audioConfig):
+            index.add(datatype, timestamp, self.size, data)
+
+        tag = encodeTag(datatype, timestamp, data)
+
+        self._buffer.append(tag)
+        self._buffered += len(tag)
+        self.size += len(tag)
+        self.duration = max(self.duration, timestamp)
+
+        if self._buffered >= self.blockSize:
+            self.flush()
+
+
+    def _writeHeader(self):
+        self._headerWritten = True
+
+        body, offsets = encodeMetaData(self.metaData)
+        start = len(HEADER) + 11
+
+        self._offsets = dict([(name, start + offset)
+            for name, offset in offsets.iteritems()])
+
+        if self.index is not None:
+            self.index.add(message.NOTIFY, 0, len(HEADER), body)
+
+        self._buffer.append(HEADER)
+        self._buffer.append(encodeTag(message.NOTIFY, 0, body))
+        self._buffered += len(HEADER) + len(body) + 15
+        self.size += len(HEADER) + len(body) + 15
+
+
+    def flush(self):
+        """
+        Hands the buffered tags to the thread.
+        """
+        if not self._buffer:
+            return
+
+        data = ''.join(self._buffer)
+
+        self._buffer = []
+        self._buffered = 0
+
+        self._submit(self._write, data)
+
+
+    def close(self):
+        """
+        Writes the buffered tags, patches the metadata and closes the file.
+
+        @return: A L{defer.Deferred} that fires with this writer when done.
+        """
+        if self.closed:
+            return defer.succeed(self)
+
+        if self._busy and not self.opened:
+            # still opening, the tags written so far are written once it is
+            return self._submit(lambda: None).addCallback(
+                lambda _: self.close())
+
+        self.closed = True
+
+        if not self._headerWritten and self.opened:
+            self._writeHeader()
+
+        self.flush()
+
+        patches = {}
+
+        if self._offsets:
+            patches[self._offsets['duration']] = self.duration / 1000.0
+            patches[self._offsets['filesize']] = float(self.size)
+
+        if self.index is not None:
+            self.index.duration = self.duration
+
+        return self._submit(self._close, patches, self.index).addCallback(
+            lambda _: self)
+
+
+    def _submit(self, func, *args):
+        """
+        Runs C{func} in a thread after the jobs submitted before it.
+        """
+        d = defer.Deferred()
+
+        self._jobs.append((d, func, args))
+
+        if not self._busy:
+            self._next()
+
+        return d
+
+
+    def _next(self):
+        if not self._jobs:
+            self._busy = False
+
+            return
+
+        self._busy = True
+        d, func, args = self._jobs.popleft()
+
+        if self.failure is not None and func == self._write:
+            # the file is broken, don't bother
+            d.callback(None)
+
+            return self._next()
+
+        def done(result):
+            if isinstance(result, failure.Failure) and self.failure is None:
+                self.failure = result
+                log.err(result, 'Failed to write %r' % (self.filename,))
+
+            self._next()
+
+            return result
+
+        threads.deferToThread(func, *args).addBoth(done).chainDeferred(d)
+
+
+    def _open(self, filename, append):
+        """
+        Runs in a thread.
+
+        @return: The file, its size, the timestamp of its last tag, the
+            offsets of the patched slots and the L{KeyframeIndex} of the file
+            so far (C{None} if the file is not to be indexed).
+        """
+        if not append or not os.path.exists(filename) or \
+                os.path.getsize(filename) <= len(HEADER):
+            return open(filename, 'wb'), 0, 0, None, KeyframeIndex()
+
+        # the index of what is there already, there is no index at all if it
+        # is out of date (the file is indexed when it is played)
+        index = readIndex(filename)
+
+        if index is None:
+            removeIndex(filename)
+        else:
+            loaded, index = index, index.copy()
+            loaded.close()
+
+        f = open(filename, 'r+b')
+
+        try:
+            f.seek(len(HEADER))
+            offsets = None
+            header = f.read(11)
+
+            if len(header) == 11 and ord(header[0]) == message.NOTIFY:
+                size = struct.unpack('!L', '\x00' + header[1:4])[0]
+                found = findMetaData(f.read(size))
+
+                if found:
+                    offsets = dict([(name, len(HEADER) + 11 + offset)
+                        for name, offset in found.iteritems()])
+
+            f.seek(-4, os.SEEK_END)
+            size = struct.unpack(_tagSize, f.read(4))[0]
+
+            f.seek(-4 - size, os.SEEK_END)
+            header = f.read(8)
+            timestamp = struct.unpack('!L', header[7] + header[4:7])[0]
+
+            f.seek(0, os.SEEK_END)
+            end = f.tell()
+        except:
+            f.close()
+
+            raise
+
+        return f, end, timestamp, offsets, index
+
+
+    def _write(self, data):
+        self._file.write(data)
+
+
+    def _close(self, patches, index):
+        if self._file is None:
+            return
+
+        try:
+            for offset, value in patches.iteritems():
+                self._file.seek(offset)
+                self._file.write(struct.pack(_double, value))
+        finally:
+            self._file.close()
+
+        if index is None or self.failure is not None:
+            return
+
+        try:
+            writeIndex(self.filename, index)
+        except (IOError, OSError), e:
+            log.msg('Failed to write the index of %r: %s' % (self.filename,
+                e))
+
+
+
+class FLVRecorder(object):
+    """
+    Subscribes to a L{rtmpy.server.StreamPublisher} and writes what is
+    published with an L{FLVWriter}.
+
+    @ivar writer: The L{FLVWriter}.
+    """
+
+
+    def __init__(self, writer):
+        self.writer = writer
+
+
+    def start(self):
+        """
+        Opens the file.
+        """
+        d = self.writer.open()
+
+        d.addErrback(log.err, 'Failed to open %r' % (self.writer.filename,))
+
+        return d
+
+
+    def videoDataReceived(self, data, timestamp):
+        self.writer.writeTag(message.VIDEO_DATA, timestamp, data)
+
+
+    def audioDataReceived(self, data, timestamp):
+        self.writer.writeTag(message.AUDIO_DATA, timestamp, data)
+
+
+    def onMetaData(self, data):
+        self.writer.writeMetaData(data)
+
+
+    def unpublish(self):
+        """
+        Closes the file.
+        """
+        return self.writer.close()
+
+
+
+class FLVFile(object):
+    """
+    A memory mapped FLV file.
+
+    @ivar filename: The FLV file.
+    @ivar key: C{(filename, size, modification time)} of the file when it
+        was opened, identifies its tags in a L{ChunkCache}.
+    @ivar dataOffset: The offset of the first tag.
+    @ivar duration: The timestamp of the last tag, in milliseconds.
+    @ivar index: The L{KeyframeIndex}, loaded from the sidecar of the file or
+        built (and saved to the sidecar) when the file is opened.
+    """
+
+
+    def __init__(self, filename):
+        self.filename = filename
+
+        self.key = None
+        self.mmap = None
+        self.index = None
+        self.dataOffset = None
+        self.duration = 0
+
+        self._waiting = []
+        self._closing = False
+
+
+    def __repr__(self):
+        return '<%s %r at 0x%x>' % (self.__class__.__name__, self.filename,
+            id(self))
+
+
+    def open(self):
+        """
+        Maps the file and builds the index in a thread. The file is only
+        usable once the returned L{defer.Deferred} has fired; opening it
+        again before then waits for the same thread.
+
+        @return: A L{defer.Deferred} that fires with this file.
+        """
+        if self.index is not None:
+            return defer.succeed(self)
+
+        d = defer.Deferred()
+        self._waiting.append(d)
+        self._closing = False
+
+        if len(self._waiting) == 1:
+            threads.deferToThread(self._open).addBoth(self._opened)
+
+        return d
+
+
+    def _opened(self, result):
+        waiting, self._waiting = self._waiting, []
+
+        if not isinstance(result, failure.Failure):
+            m, index, key = result
+
+            if self._closing:
+                # closed while it was being opened
+                self._closing = False
+
+                index.close()
+                m.close()
+
+                result = failure.Failure(defer.CancelledError(
+                    '%r was closed while opening' % (self.filename,)))
+            else:
+                self.index = index
+                self.key = key
+                self.dataOffset = index.dataOffset
+                self.duration = index.duration
+                self.mmap = m
+
+        for d in waiting:
+            if isinstance(result, failure.Failure):
+                d.errback(result)
+            else:
+                d.callback(self)
+
+
+    def _open(self):
+        """
+        Runs in a thread. Nothing is set on the file here, see L{_opened}.
+
+        @return: C{(mmap, index, key)}
+        """
+        f = open(self.filename, 'rb')
+
+        try:
+            st = os.fstat(f.fileno())
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+
+        try:
+            if m[:4] != HEADER[:4]:
+                raise ValueError('%r is not an FLV file' % (self.filename,))
+
+            index = readIndex(self.filename, st.st_size, st.st_mtime)
+
+            if index is None:
+                index = self.scan(m, struct.unpack('!L', m[5:9])[0] + 4)
+
+                try:
+                    writeIndex(self.filename, index, st.st_size, st.st_mtime)
+                except (IOError, OSError), e:
+                    log.msg('Failed to write the index of %r: %s' % (
+                        self.filename, e))
+        except:
+            m.close()
+
+            raise
+
+        return m, index, (self.filename, st.st_size, st.st_mtime)
+
+
+    def scan(self, m, dataOffset):
+        """
+        Reads the tag headers of the mapping C{m} to build the index.
+
+        @return: The L{KeyframeIndex}.
+        """
+        index = KeyframeIndex(dataOffset=dataOffset)
+        offset = dataOffset
+        size = len(m)
+
+        while offset + 11 <= size:
+            datatype, dataSize, timestamp = _readHeader(m, offset)
+            start = offset + 11
+
+            if start + dataSize > size:
+                # truncated
+                break
+
+            index.add(datatype, timestamp, offset, m[start:start + 13])
+            offset = start + dataSize + 4
+
+        return index
+
+
+    def readTag(self, offset):
+        """
+        Reads the tag at C{offset}.
+
+        @return: C{(datatype, timestamp, data, offset of the next tag)} or
+            C{None} at the end of the file.
+        """
+        if offset + 11 > len(self.mmap):
+            return None
+
+        datatype, size, timestamp = _readHeader(self.mmap, offset)
+        start = offset + 11
+
+        if start + size > len(self.mmap):
+            # truncated
+            return None
+
+        return datatype, timestamp, self.mmap[start:start + size], \
+            start + size + 4
+
+
+    def seek(self, timestamp):
+        """
+        Returns the offset of the last seek point at or before C{timestamp}.
+        """
+        return self.index.seek(timestamp)
+
+
+    def close(self):
+        """
+        Unmaps the file. If it is still opening, it is unmapped once the
+        thread is done with it and the pending opens fail.
+        """
+        if self._waiting:
+            self._closing = True
+
+        if self.mmap is not None:
+            self.mmap.close()
+            self.mmap = None
+
+        if self.index is not None:
+            self.index.close()
+            self.index = None
+
+
+
+class FLVPlayer(object):
+    """
+    Plays an L{FLVFile} to a subscriber, like a L{server.StreamPublisher}.
+
+    Tags are sent when they are due according to their timestamps, after an
+    initial burst of C{burst} seconds. After a seek the codec configuration
+    (the H.264 and AAC sequence headers) is sent again before the keyframe.
+
+    @ivar file: The L{FLVFile}.
+    @ivar burst: Seconds of media sent straight away when playback starts or
+        seeks, to fill the buffer of the player.
+    @ivar release: Called with the file when the player has stopped.
+    @ivar subscriber: The L{server.NetStream} playing the file.
+    @ivar cache: The L{ChunkCache} of the subscriber, or C{None}. When set,
+        the audio/video tags are passed to the subscriber with their key in
+        the cache.
+    """
+
+    burst = 2.0
+
+    #: The most tags to send in one reactor iteration.
+    maxTags = 100
+
+
+    def __init__(self, file, burst=None, release=None, reactor=None,
+                 cache=None):
+        if reactor is None:
+            from twisted.internet import reactor
+
+        self.file = file
+        self.release = release
+        self.reactor = reactor
+        self.cache = cache
+
+        if burst is not None:
+            self.burst = burst
+
+        self.subscriber = None
+        self.offset = file.dataOffset
+
+        self._call = None
+        self._startTime = None
+        self._startTimestamp = None
+        self._config = []
+
+
+    def addSubscriber(self, subscriber):
+        """
+        Starts playing to C{subscriber}, on the next reactor iteration.
+        """
+        self.subscriber = subscriber
+
+        self._start(self.file.dataOffset)
+
+
+    def removeSubscriber(self, subscriber):
+        """
+        Stops playing and releases the file.
+        """
+        if subscriber is not self.subscriber:
+            return
+
+        self.stop()
+        self.subscriber = None
+
+        if self.release is not None:
+            self.release(self.file)
+
+
+    def seek(self, timestamp):
+        """
+        Carries on playing from the seek point at or before C{timestamp}
+        milliseconds.
+        """
+        index = self.file.index
+        offset = index.seek(timestamp)
+
+        self._start(offset)
+        self._config = [config for config in (index.videoConfig,
+            index.audioConfig) if 0 < config < offset]
+
+
+    def stop(self):
+        if self._call is not None:
+            if self._call.active():
+                self._call.cancel()
+
+            self._call = None
+
+
+    def _start(self, offset):
+        self.stop()
+
+        self.offset = offset
+        self._config = []
+        self._startTime = self.reactor.seconds()
+        self._startTimestamp = None
+
+        self._call = self.reactor.callLater(0, self._send)
+
+
+    def _send(self):
+        self._call = None
+        subscriber = self.subscriber
+        now = self.reactor.seconds()
+
+        if self._config:
+            config, self._config = self._config, []
+            tag = self.file.readTag(self.offset)
+
+            if tag is not None:
+                for offset in config:
+                    datatype, timestamp, data, nextOffset = \
+                        self.file.readTag(offset)
+
+                    self._dispatch(subscriber, datatype, data, tag[1], offset)
+
+        for i in xrange(self.maxTags):
+            tag = self.file.readTag(self.offset)
+
+            if tag is None:
+                complete = getattr(subscriber, 'playComplete', None)
+
+                if complete is not None:
+                    complete()
+
+                return
+
+            datatype, timestamp, data, nextOffset = tag
+
+            if self._startTimestamp is None:
+                self._startTimestamp = timestamp
+
+            due = self._startTime - self.burst + \
+                (timestamp - self._startTimestamp) / 1000.0
+
+            if due > now:
+                self._call = self.reactor.callLater(due - now, self._send)
+
+                return
+
+            offset, self.offset = self.offset, nextOffset
+
+            self._dispatch(subscriber, datatype, data, timestamp, offset)
+
+        self._call = self.reactor.callLater(0, self._send)
+
+
+    def _dispatch(self, subscriber, datatype, data, timestamp, offset):
+        args = (data, timestamp)
+
+        if self.cache is not None:
+            args += ((self.file.key, offset),)
+
+        if datatype == message.VIDEO_DATA:
+            subscriber.videoDataReceived(*args)
+        elif datatype == message.AUDIO_DATA:
+            subscriber.audioDataReceived(*args)
+        elif datatype == message.NOTIFY:
+            msg = message.Notify()
+            msg.decode(BufferedByteStream(data))
+
+            if msg.name == 'onMetaData' and msg.argv:
+                subscriber.onMetaData(msg.argv[0])
+
+
+
+class ChunkCache(object):
+    """
+    The tags of FLV files split into RTMP frames, see
+    L{codec.StreamingChannel.encodeFrames}.
+
+    The frames are cached per frame size and continuation header (so per
+    channel id), the least recently used are discarded once the cache holds
+    more than C{maxSize} bytes. Tags that fit in one frame are not cached,
+    there is nothing to split.
+
+    @ivar maxSize: The most bytes to cache.
+    @ivar size: The bytes cached.
+    @ivar hits: The number of tags found in the cache.
+    @ivar misses: The number of tags split and added to the cache.
+    """
+
+
+    def __init__(self, maxSize):
+        self.maxSize = maxSize
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+        self._entries = util.OrderedDict()
+
+
+    def __repr__(self):
+        return '<%s size=%d/%d hits=%d misses=%d at 0x%x>' % (
+            self.__class__.__name__, self.size, self.maxSize, self.hits,
+            self.misses, id(self))
+
+
+    def getFrames(self, key, data, channel):
+        """
+        Returns the tag C{data} split into frames for the
+        L{codec.StreamingChannel} C{channel}.
+
+        @param key: Identifies the tag, see L{FLVPlayer.cache}.
+        """
+        frameSize = channel.frameSize
+
+        if len(data) <= frameSize:
+            return data
+
+        key = (key, frameSize, channel.continuationHeader)
+        entries = self._entries
+
+        try:
+            frames = entries.pop(key)
+        except KeyError:
+            pass
+        else:
+            self.hits += 1
+            entries[key] = frames
+
+            return frames
+
+        self.misses += 1
+        frames = channel.encodeFrames(data)
+
+        if len(frames) > self.maxSize:
+            return frames
+
+        entries[key] = frames
+        self.size += len(frames)
+
+        while self.size > self.maxSize:
+            old, evicted = entries.popitem(False)
+            self.size -= len(evicted)
+
+        return frames
+
+
+    def clear(self):
+        self._entries.clear()
+        self.size = 0
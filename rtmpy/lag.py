@@ -0,0 +1,200 @@
+# -*- test-case-name: rtmpy.tests.test_lag -*-
+
+# Copyright the RTMPy Project
+#
+# RTMPy is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# RTMPy is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with RTMPy.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Measures how late the reactor runs scheduled calls.
+
+A saturated reactor runs timed calls late. L{LagMonitor} schedules a call
+every C{interval} seconds and records how late it ran. L{rtmpy.server.
+ServerFactory} uses the lag to turn away new connections, plays and
+publishes before the existing viewers start to stutter::
+
+    from rtmpy import lag, server
+
+    factory = server.ServerFactory(apps)
+    factory.lagMonitor = lag.LagMonitor()
+    factory.connectLagThreshold = 0.5
+    factory.playLagThreshold = 0.25
+
+@since: 0.2
+"""
+
+from twisted.internet import defer
+
+from rtmpy import metrics
+
+
+__all__ = ['LagMonitor']
+
+
+
+class LagMonitor(object):
+    """
+    Samples the reactor scheduling delay.
+
+    The lag rises to a new sample immediately and decays towards lower
+    samples with a factor of C{smoothing}, so a burst of load is seen at
+    once but a single quiet tick does not clear it.
+
+    @ivar interval: Seconds between samples.
+    @ivar lag: The smoothed lag in seconds.
+    @ivar maxLag: The highest sample seen.
+    @ivar samples: Number of samples taken.
+    """
+
+    smoothing = 0.3
+
+
+    def __init__(self, interval=0.1, reactor=None, registry=metrics.registry):
+        if reactor is None:
+            from twisted.internet import reactor
+
+        self.interval = interval
+        self.reactor = reactor
+        self.registry = registry
+
+        self.lag = 0.0
+        self.maxLag = 0.0
+        self.samples = 0
+
+        self._call = None
+        self._expected = None
+        self._waiters = []
+
+
+    @property
+    def running(self):
+        return self._call is not None
+
+
+    def start(self):
+        """
+        Starts sampling. The lag is exported as C{rtmpy_reactor_lag_seconds}
+        if a metrics registry was supplied.
+        """
+        if self._call is not None:
+            return
+
+        if self.registry is not None:
+            self.registry.addCollector(self.collect)
+
+        self._schedule()
+
+
+    def stop(self):
+        """
+        Stops sampling. Requests waiting in L{whenBelow} fail with
+        L{defer.CancelledError}.
+        """
+        if self._call is None:
+            return
+
+        if self._call.active():
+            self._call.cancel()
+
+        self._call = None
+
+        if self.registry is not None:
+            self.registry.removeCollector(self.collect)
+
+        waiters, self._waiters = self._waiters, []
+
+        for threshold, d, timeout in waiters:
+            if timeout.active():
+                timeout.cancel()
+
+            d.errback(defer.CancelledError())
+
+
+    def _schedule(self):
+        self._expected = self.reactor.seconds() + self.interval
+        self._call = self.reactor.callLater(self.interval, self._tick)
+
+
+    def _tick(self):
+        sample = max(0.0, self.reactor.seconds() - self._expected)
+
+        self.samples += 1
+        self.maxLag = max(self.maxLag, sample)
+
+        if sample >= self.lag:
+            self.lag = sample
+        else:
+            self.lag += (sample - self.lag) * self.smoothing
+
+        self._schedule()
+
+        if self._waiters:
+            self._notify()
+
+
+    def _notify(self):
+        waiting = []
+
+        for waiter in self._waiters:
+            threshold, d, timeout = waiter
+
+            if self.lag > threshold:
+                waiting.append(waiter)
+
+                continue
+
+            timeout.cancel()
+            d.callback(self.lag)
+
+        self._waiters = waiting
+
+
+    def isLagging(self, threshold):
+        """
+        Whether the lag is above C{threshold} seconds.
+        """
+        return self.lag > threshold
+
+
+    def whenBelow(self, threshold, timeout):
+        """
+        Returns a L{defer.Deferred} that fires with the lag once it falls to
+        C{threshold} seconds or below, or fails with L{defer.TimeoutError}
+        after C{timeout} seconds.
+        """
+        if self.lag <= threshold:
+            return defer.succeed(self.lag)
+
+        d = defer.Deferred()
+
+        def expire():
+            self._waiters.remove(waiter)
+
+            d.errback(defer.TimeoutError())
+
+        waiter = (threshold, d, self.reactor.callLater(timeout, expire))
+        self._waiters.append(waiter)
+
+        return d
+
+
+    def collect(self):
+        lag = metrics.Gauge('rtmpy_reactor_lag_seconds',
+            'Smoothed delay of scheduled reactor calls')
+        maxLag = metrics.Gauge('rtmpy_reactor_lag_max_seconds',
+            'Highest delay of a scheduled reactor call')
+
+        lag.set(self.lag)
+        maxLag.set(self.maxLag)
+
+        return [lag, maxLag]
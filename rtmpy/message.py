@@ -19,6 +19,7 @@ RTMP message implementations.
 
 from zope.interface import Interface, implements
 import pyamf
+from pyamf.util import BufferedByteStream
 
 from rtmpy.util import add_to_class
 
@@ -52,8 +53,12 @@ SHARED_OBJECT = 0x13
 #: Like remoting call, used for stream actions too
 INVOKE = 0x14
 # 0x15 anyone?
-#: FLV data
+#: FLV data, audio/video/data tags bundled into one message
 FLV_DATA = 0x16
+AGGREGATE = FLV_DATA
+
+#: The message types with an AMF encoded body, see L{AMFCodecs}.
+AMF_TYPES = (FLEX_SHARED_OBJECT, FLEX_MESSAGE, NOTIFY, SHARED_OBJECT, INVOKE)
 
 
 @add_to_class
@@ -240,6 +245,16 @@ class IMessageListener(Interface):
         """
 
 
+    def onSharedObject(message, timestamp):
+        """
+        Called when a shared object message is received.
+
+        @param message: The received message.
+        @type message: L{SharedObjectMessage}
+        @param timestamp: The timestamp that this message was dispatched.
+        """
+
+
 
 class IMessageSender(Interface):
     """
@@ -258,6 +273,59 @@ class IMessageSender(Interface):
 
 
 
+class AMFCodecs(object):
+    """
+    Reusable AMF encoders and decoders, one of each per AMF version.
+
+    C{pyamf.get_encoder}/C{get_decoder} build a new codec (with its context,
+    reference tables and type lookup cache) for every message. A connection
+    keeps one of these instead and the codecs are reset between messages.
+    The codecs must not be shared between threads.
+    """
+
+
+    def __init__(self):
+        self.encoders = {}
+        self.decoders = {}
+
+
+    def getEncoder(self, encoding, stream):
+        """
+        Returns an AMF C{encoding} encoder that writes to C{stream}.
+        """
+        try:
+            encoder = self.encoders[encoding]
+        except KeyError:
+            encoder = self.encoders[encoding] = pyamf.get_encoder(encoding,
+                stream)
+
+            return encoder
+
+        encoder.context.clear()
+        encoder.stream = stream
+
+        return encoder
+
+
+    def getDecoder(self, encoding, stream):
+        """
+        Returns an AMF C{encoding} decoder that reads from C{stream}.
+        """
+        try:
+            decoder = self.decoders[encoding]
+        except KeyError:
+            decoder = self.decoders[encoding] = pyamf.get_decoder(encoding,
+                stream=stream)
+
+            return decoder
+
+        decoder.context.clear()
+        decoder.stream = stream
+
+        return decoder
+
+
+
 class Message(object):
     """
     An abstract class that all message types extend.
@@ -632,23 +700,33 @@ class Notify(Message):
         self.argv = list(args)
 
 
-    def decode(self, buf):
+    def decode(self, buf, codecs=None):
         """
         Decode a notification message.
+
+        @param codecs: The L{AMFCodecs} of the connection, if any.
         """
-        decoder = pyamf.get_decoder(pyamf.AMF0, stream=buf)
+        if codecs is None:
+            decoder = pyamf.get_decoder(pyamf.AMF0, stream=buf)
+        else:
+            decoder = codecs.getDecoder(pyamf.AMF0, buf)
 
         self.name = decoder.next()
         self.argv = [x for x in decoder]
 
 
-    def encode(self, buf):
+    def encode(self, buf, codecs=None):
         """
         Encode a notification message.
+
+        @param codecs: The L{AMFCodecs} of the connection, if any.
         """
         args = [self.name] + self.argv
 
-        encoder = pyamf.get_encoder(pyamf.AMF0, buf)
+        if codecs is None:
+            encoder = pyamf.get_encoder(pyamf.AMF0, buf)
+        else:
+            encoder = codecs.getEncoder(pyamf.AMF0, buf)
 
         for a in args:
             encoder.writeElement(a)
@@ -678,24 +756,34 @@ class Invoke(Message):
         self.argv = list(args)
 
 
-    def decode(self, buf):
+    def decode(self, buf, codecs=None):
         """
         Decode a notification message.
+
+        @param codecs: The L{AMFCodecs} of the connection, if any.
         """
-        decoder = pyamf.get_decoder(self.encoding, stream=buf)
+        if codecs is None:
+            decoder = pyamf.get_decoder(self.encoding, stream=buf)
+        else:
+            decoder = codecs.getDecoder(self.encoding, buf)
 
         self.name = decoder.next()
         self.id = decoder.next()
         self.argv = list(decoder)
 
 
-    def encode(self, buf):
+    def encode(self, buf, codecs=None):
         """
         Encode a notification message.
+
+        @param codecs: The L{AMFCodecs} of the connection, if any.
         """
         args = [self.name, self.id] + self.argv
 
-        encoder = pyamf.get_encoder(self.encoding, buf)
+        if codecs is None:
+            encoder = pyamf.get_encoder(self.encoding, buf)
+        else:
+            encoder = codecs.getEncoder(self.encoding, buf)
 
         for a in args:
             encoder.writeElement(a)
@@ -719,12 +807,175 @@ class FlexMessage(Invoke):
 
     encoding = pyamf.AMF3
 
-    def decode(self, buf):
+    def decode(self, buf, codecs=None):
         if buf.peek(1) == '\x00':
             buf.seek(1, 1)
             self.encoding = pyamf.AMF0
 
-        return Invoke.decode(self, buf)
+        return Invoke.decode(self, buf, codecs)
+
+
+
+class SharedObjectMessage(Message):
+    """
+    Events for a remote shared object.
+
+    @ivar name: The name of the shared object.
+    @ivar version: The version of the shared object.
+    @ivar persistent: Whether the shared object is persistent.
+    @ivar events: A list of C{(type, value)} tuples. The value depends on the
+        type of the event:
+
+         - C{CHANGE}, C{REQUEST_CHANGE}: a C{(name, value)} tuple.
+         - C{SUCCESS}, C{REMOVE}, C{REQUEST_REMOVE}: the slot name.
+         - C{SEND_MESSAGE}: a list of the handler name and its arguments.
+         - C{STATUS}: a C{(code, level)} tuple.
+         - C{USE}, C{RELEASE}, C{CLEAR}, C{USE_SUCCESS}: C{None}.
+    """
+
+    set_type(SHARED_OBJECT)
+
+    encoding = pyamf.AMF0
+
+    USE = 0x01
+    RELEASE = 0x02
+    REQUEST_CHANGE = 0x03
+    CHANGE = 0x04
+    SUCCESS = 0x05
+    SEND_MESSAGE = 0x06
+    STATUS = 0x07
+    CLEAR = 0x08
+    REMOVE = 0x09
+    REQUEST_REMOVE = 0x0a
+    USE_SUCCESS = 0x0b
+
+
+    def __init__(self, name=None, version=0, persistent=False, events=None):
+        self.name = name
+        self.version = version
+        self.persistent = persistent
+        self.events = events or []
+
+
+    def _getDecoder(self, data, codecs):
+        if codecs is None:
+            return pyamf.get_decoder(self.encoding,
+                stream=BufferedByteStream(data))
+
+        return codecs.getDecoder(self.encoding, BufferedByteStream(data))
+
+
+    def _getEncoder(self, buf, codecs):
+        if codecs is None:
+            return pyamf.get_encoder(self.encoding, buf)
+
+        return codecs.getEncoder(self.encoding, buf)
+
+
+    def decode(self, buf, codecs=None):
+        """
+        Decode a shared object message.
+
+        @param codecs: The L{AMFCodecs} of the connection, if any.
+        """
+        self.name = buf.read_utf8_string(buf.read_ushort())
+        self.version = buf.read_ulong()
+        self.persistent = buf.read_ulong() == 2
+        buf.read_ulong()
+
+        self.events = []
+
+        while not buf.at_eof():
+            type_ = buf.read_uchar()
+            data = buf.read(buf.read_ulong())
+
+            if type_ in (self.CHANGE, self.REQUEST_CHANGE):
+                key = data[2:2 + ord(data[0]) * 256 + ord(data[1])]
+                decoder = self._getDecoder(data[2 + len(key):], codecs)
+
+                value = (key.decode('utf-8'), decoder.next())
+            elif type_ in (self.SUCCESS, self.REMOVE, self.REQUEST_REMOVE):
+                value = data[2:].decode('utf-8')
+            elif type_ in (self.SEND_MESSAGE, self.STATUS):
+                value = list(self._getDecoder(data, codecs))
+
+                if type_ == self.STATUS:
+                    value = tuple(value)
+            else:
+                value = None
+
+            self.events.append((type_, value))
+
+
+    def encode(self, buf, codecs=None):
+        """
+        Encode a shared object message.
+
+        @param codecs: The L{AMFCodecs} of the connection, if any.
+        """
+        name = self.name.encode('utf-8')
+
+        buf.write_ushort(len(name))
+        buf.write(name)
+        buf.write_ulong(self.version)
+        buf.write_ulong(self.persistent and 2 or 0)
+        buf.write_ulong(0)
+
+        for type_, value in self.events:
+            data = BufferedByteStream()
+
+            if type_ in (self.CHANGE, self.REQUEST_CHANGE):
+                key = value[0].encode('utf-8')
+
+                data.write_ushort(len(key))
+                data.write(key)
+                self._getEncoder(data, codecs).writeElement(value[1])
+            elif type_ in (self.SUCCESS, self.REMOVE, self.REQUEST_REMOVE):
+                key = value.encode('utf-8')
+
+                data.write_ushort(len(key))
+                data.write(key)
+            elif type_ in (self.SEND_MESSAGE, self.STATUS):
+                encoder = self._getEncoder(data, codecs)
+
+                for x in value:
+                    encoder.writeElement(x)
+
+            buf.write_uchar(type_)
+            buf.write_ulong(len(data))
+            buf.write(data.getvalue())
+
+
+    def dispatch(self, listener, timestamp):
+        """
+        Dispatches the message to the listener.
+        """
+        return listener.onSharedObject(self, timestamp)
+
+
+
+class FlexSharedObjectMessage(SharedObjectMessage):
+    """
+    A L{SharedObjectMessage} for a peer that uses AMF3. The body is preceded
+    by a byte with the encoding of the values.
+    """
+
+    set_type(FLEX_SHARED_OBJECT)
+
+    encoding = pyamf.AMF3
+
+
+    def decode(self, buf, codecs=None):
+        if buf.read_uchar() == pyamf.AMF0:
+            self.encoding = pyamf.AMF0
+
+        return SharedObjectMessage.decode(self, buf, codecs)
+
+
+    def encode(self, buf, codecs=None):
+        buf.write_uchar(self.encoding)
+
+        return SharedObjectMessage.encode(self, buf, codecs)
 
 
 
@@ -798,6 +1049,98 @@ class VideoData(StreamingMessage):
 
 
 
+class Aggregate(Message):
+    """
+    A bundle of audio, video and data messages, encoded as FLV tags.
+
+    The tag timestamps are absolute, the timestamp of the RTMP message is that
+    of the first tag. Each tag is dispatched on its own, with its offset from
+    the first tag added to the timestamp of the message.
+
+    @ivar tags: A list of C{(datatype, timestamp, data)} tuples.
+    """
+
+    set_type(AGGREGATE)
+
+    #: The types of message that may be bundled.
+    TAG_TYPES = (AUDIO_DATA, VIDEO_DATA, NOTIFY)
+
+
+    def __init__(self, tags=None):
+        self.tags = tags or []
+
+
+    def addTag(self, datatype, timestamp, data):
+        """
+        Appends a tag to this aggregate.
+        """
+        self.tags.append((datatype, timestamp, data))
+
+
+    def decode(self, buf):
+        """
+        Decode an aggregate message.
+        """
+        self.tags = []
+
+        while buf.remaining() >= 11:
+            datatype = buf.read_uchar()
+            size = buf.read_24bit_uint()
+            timestamp = buf.read_24bit_uint() | (buf.read_uchar() << 24)
+            buf.read_24bit_uint()
+
+            data = buf.read(size)
+
+            # back pointer, the size of the tag
+            if buf.remaining() >= 4:
+                buf.read_ulong()
+
+            self.tags.append((datatype, timestamp, data))
+
+
+    def encode(self, buf):
+        """
+        Encode an aggregate message.
+        """
+        for datatype, timestamp, data in self.tags:
+            if datatype not in self.TAG_TYPES:
+                raise EncodeError('Cannot aggregate message type %r' % (
+                    datatype,))
+
+            size = len(data)
+
+            buf.write_uchar(datatype)
+            buf.write_24bit_uint(size)
+            buf.write_24bit_uint(timestamp & 0xffffff)
+            buf.write_uchar((timestamp >> 24) & 0xff)
+            buf.write_24bit_uint(0)
+            buf.write(data)
+            buf.write_ulong(size + 11)
+
+
+    def dispatch(self, listener, timestamp):
+        """
+        Dispatches each tag to the listener.
+        """
+        if not self.tags:
+            return
+
+        base = self.tags[0][1]
+
+        for datatype, tagTimestamp, data in self.tags:
+            if datatype not in self.TAG_TYPES:
+                continue
+
+            if datatype == NOTIFY:
+                msg = Notify()
+                msg.decode(BufferedByteStream(data))
+            else:
+                msg = classByType(datatype)(data)
+
+            msg.dispatch(listener, timestamp + tagTimestamp - base)
+
+
+
 #: Map event types to event classes
 TYPE_MAP = {}
 
@@ -0,0 +1,733 @@
+# -*- test-case-name: rtmpy.tests.test_metrics -*-
+
+# Copyright the RTMPy Project
+#
+# RTMPy is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# RTMPy is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with RTMPy.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Live metrics for RTMPy connections, streams and applications.
+
+Metrics are disabled by default and cost nothing until L{enable} is called,
+which wraps a handful of protocol methods to count and time what passes
+through them. Most values (bytes per connection, encoder queues, subscribers)
+are not counted at all, they are read from the live connections when the
+metrics are collected.
+
+Example::
+
+    from rtmpy import metrics
+
+    metrics.enable()
+    metrics.listen(9100)
+
+    # or, from Python
+    for name, labels, value in metrics.registry.samples():
+        print name, labels, value
+
+The text format is the U{Prometheus exposition format<http://prometheus.io/
+docs/instrumenting/exposition_formats/>}.
+
+@since: 0.2
+"""
+
+import bisect
+import weakref
+from time import time
+
+from twisted.internet import defer
+
+from rtmpy import message, rpc, util, executor
+from rtmpy.protocol import rtmp
+from rtmpy.protocol.rtmp import codec
+
+
+__all__ = [
+    'Counter',
+    'Gauge',
+    'Histogram',
+    'Registry',
+    'registry',
+    'enable',
+    'disable',
+    'listen',
+]
+
+
+#: Default buckets for L{Histogram}, in seconds.
+DEFAULT_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1.0, 2.5,
+    5.0, 10.0)
+
+#: Whether the protocol instrumentation is installed.
+enabled = False
+
+#: RTMP datatype -> label value.
+DATATYPES = {}
+
+for _name in ['FRAME_SIZE', 'ABORT', 'BYTES_READ', 'CONTROL',
+        'DOWNSTREAM_BANDWIDTH', 'UPSTREAM_BANDWIDTH', 'AUDIO_DATA',
+        'VIDEO_DATA', 'FLEX_SHARED_OBJECT', 'FLEX_MESSAGE', 'NOTIFY',
+        'SHARED_OBJECT', 'INVOKE', 'FLV_DATA']:
+    DATATYPES[getattr(message, _name)] = _name.lower()
+
+del _name
+
+#: The label value of RPC calls to methods that are not exposed, so that the
+#: peer cannot create label sets at will.
+OTHER_METHOD = 'other'
+
+
+def datatypeName(datatype):
+    """
+    Returns the label value for an RTMP datatype.
+    """
+    try:
+        return DATATYPES[datatype]
+    except KeyError:
+        return str(datatype)
+
+
+
+def _escape(value):
+    return unicode(value).replace('\\', '\\\\').replace('\n', '\\n').replace(
+        '"', '\\"')
+
+
+def _formatLabels(labels):
+    if not labels:
+        return ''
+
+    return '{%s}' % (','.join(['%s="%s"' % (k, _escape(v))
+        for k, v in labels]),)
+
+
+def _formatValue(value):
+    if value == float('inf'):
+        return '+Inf'
+
+    return repr(float(value))
+
+
+
+class Metric(object):
+    """
+    Base class for all metrics.
+
+    @ivar name: The metric name.
+    @ivar help: A short description.
+    @ivar labelNames: The names of the labels, in order.
+    @ivar values: Label values C{tuple} -> value.
+    """
+
+    type = None
+
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labelNames = tuple(labels)
+        self.values = {}
+
+
+    def _key(self, labels):
+        if sorted(labels) != sorted(self.labelNames):
+            raise ValueError('%s expects labels %r, got %r' % (
+                self.name, self.labelNames, labels.keys()))
+
+        return tuple([labels[n] for n in self.labelNames])
+
+
+    def get(self, **labels):
+        """
+        Returns the current value for C{labels}.
+        """
+        return self.values.get(self._key(labels), 0)
+
+
+    def samples(self):
+        """
+        Returns a list of C{(name, labels, value)} for this metric. C{labels}
+        is a list of C{(name, value)} tuples.
+        """
+        return [(self.name, zip(self.labelNames, key), value)
+            for key, value in sorted(self.values.items())]
+
+
+    def render(self):
+        """
+        Returns this metric in the Prometheus text format.
+        """
+        lines = [
+            '# HELP %s %s' % (self.name, self.help.replace('\n', ' ')),
+            '# TYPE %s %s' % (self.name, self.type),
+        ]
+
+        for name, labels, value in self.samples():
+            lines.append('%s%s %s' % (name, _formatLabels(labels),
+                _formatValue(value)))
+
+        return '\n'.join(lines) + '\n'
+
+
+
+class Counter(Metric):
+    """
+    A value that only goes up.
+    """
+
+    type = 'counter'
+
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+
+        self.values[key] = self.values.get(key, 0) + amount
+
+
+
+class Gauge(Metric):
+    """
+    A value that can go up and down.
+    """
+
+    type = 'gauge'
+
+
+    def set(self, value, **labels):
+        self.values[self._key(labels)] = value
+
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+
+        self.values[key] = self.values.get(key, 0) + amount
+
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+
+class Histogram(Metric):
+    """
+    Counts observations into buckets.
+
+    The value for each set of labels is a C{[counts, sum]} list, C{counts}
+    has one entry per bucket (not cumulative) plus one for C{+Inf}.
+    """
+
+    type = 'histogram'
+
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        Metric.__init__(self, name, help, labels)
+
+        self.buckets = tuple(sorted(buckets))
+
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+
+        try:
+            v = self.values[key]
+        except KeyError:
+            v = self.values[key] = [[0] * (len(self.buckets) + 1), 0]
+
+        v[0][bisect.bisect_left(self.buckets, value)] += 1
+        v[1] += value
+
+
+    def get(self, **labels):
+        """
+        Returns a C{(count, sum)} tuple for C{labels}.
+        """
+        v = self.values.get(self._key(labels), None)
+
+        if v is None:
+            return 0, 0
+
+        return sum(v[0]), v[1]
+
+
+    def samples(self):
+        result = []
+
+        for key, (counts, total) in sorted(self.values.items()):
+            labels = zip(self.labelNames, key)
+            cumulative = 0
+
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                result.append((self.name + '_bucket',
+                    labels + [('le', _formatValue(bound))], cumulative))
+
+            result.append((self.name + '_sum', labels, total))
+            result.append((self.name + '_count', labels, cumulative))
+
+        return result
+
+
+
+class Registry(object):
+    """
+    A collection of metrics.
+
+    @ivar collectors: Callables that return a list of metrics. They are called
+        each time the registry is collected, to provide values that are read
+        rather than counted.
+    """
+
+
+    def __init__(self):
+        self.metrics = {}
+        self.collectors = []
+
+
+    def register(self, metric):
+        """
+        Adds C{metric} to this registry and returns it. If a metric with the
+        same name is already registered, that metric is returned instead.
+        """
+        existing = self.metrics.get(metric.name, None)
+
+        if existing is not None:
+            if existing.__class__ is not metric.__class__:
+                raise ValueError('%s is already registered as a %s' % (
+                    metric.name, existing.type))
+
+            return existing
+
+        self.metrics[metric.name] = metric
+
+        return metric
+
+
+    def unregister(self, name):
+        self.metrics.pop(name, None)
+
+
+    def counter(self, name, help, labels=()):
+        return self.register(Counter(name, help, labels))
+
+
+    def gauge(self, name, help, labels=()):
+        return self.register(Gauge(name, help, labels))
+
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, help, labels, buckets))
+
+
+    def addCollector(self, collector):
+        self.collectors.append(collector)
+
+
+    def removeCollector(self, collector):
+        if collector in self.collectors:
+            self.collectors.remove(collector)
+
+
+    def collect(self):
+        """
+        Returns all the metrics, sorted by name.
+        """
+        result = dict(self.metrics)
+
+        for collector in self.collectors:
+            for metric in collector():
+                result[metric.name] = metric
+
+        return [result[k] for k in sorted(result.keys())]
+
+
+    def samples(self):
+        """
+        Returns a list of C{(name, labels, value)} for every metric, C{labels}
+        is a C{dict}.
+        """
+        result = []
+
+        for metric in self.collect():
+            for name, labels, value in metric.samples():
+                result.append((name, dict(labels), value))
+
+        return result
+
+
+    def render(self):
+        """
+        Returns all the metrics in the Prometheus text format.
+        """
+        return ''.join([m.render() for m in self.collect()])
+
+
+
+#: The default registry.
+registry = Registry()
+
+
+
+def _peer(protocol):
+    try:
+        peer = protocol.transport.getPeer()
+
+        return '%s:%s' % (peer.host, peer.port)
+    except AttributeError:
+        return str(id(protocol))
+
+
+def _application(protocol):
+    app = getattr(getattr(protocol, 'nc', None), 'application', None)
+
+    return getattr(app, 'name', None) or ''
+
+
+
+class Instrumentation(object):
+    """
+    Wraps protocol methods to record metrics into C{registry}.
+
+    @ivar connections: The live protocols, mapped to the time that they
+        connected.
+    """
+
+
+    def __init__(self, registry):
+        self.registry = registry
+        self.connections = weakref.WeakKeyDictionary()
+        self._patched = []
+
+        self.connectionsTotal = registry.counter('rtmpy_connections_total',
+            'Connections made')
+        self.handshakeTime = registry.histogram('rtmpy_handshake_seconds',
+            'Time from connecting to completing the handshake')
+        self.messagesReceived = registry.counter(
+            'rtmpy_messages_received_total', 'Messages received',
+            ['datatype'])
+        self.bytesReceived = registry.counter('rtmpy_received_bytes_total',
+            'Message bytes received', ['datatype'])
+        self.messagesSent = registry.counter('rtmpy_messages_sent_total',
+            'Messages sent', ['datatype'])
+        self.bytesSent = registry.counter('rtmpy_sent_bytes_total',
+            'Message bytes sent', ['datatype'])
+        self.rpcTime = registry.histogram('rtmpy_rpc_seconds',
+            'Time taken to respond to an RPC call', ['method'])
+
+
+    def _patch(self, cls, name, wrapper):
+        self._patched.append(util.wrapMethod(cls, name, wrapper))
+
+
+    def install(self):
+        i = self
+
+        def connectionMade(orig):
+            def connectionMade(self):
+                i.connections[self] = time()
+                i.connectionsTotal.inc()
+
+                return orig(self)
+
+            return connectionMade
+
+        def handshakeSuccess(orig):
+            def handshakeSuccess(self, data):
+                started = i.connections.get(self, None)
+
+                if started is not None:
+                    i.handshakeTime.observe(time() - started)
+
+                return orig(self, data)
+
+            return handshakeSuccess
+
+        def connectionLost(orig):
+            def connectionLost(self, reason):
+                i.connections.pop(self, None)
+
+                return orig(self, reason)
+
+            return connectionLost
+
+        def dispatchMessage(orig):
+            def dispatchMessage(self, stream, datatype, timestamp, data):
+                name = datatypeName(datatype)
+
+                i.messagesReceived.inc(datatype=name)
+                i.bytesReceived.inc(len(data), datatype=name)
+
+                return orig(self, stream, datatype, timestamp, data)
+
+            return dispatchMessage
+
+        def send(orig):
+            def send(self, data, datatype, *args, **kwargs):
+                name = datatypeName(datatype)
+
+                i.messagesSent.inc(datatype=name)
+                i.bytesSent.inc(len(data), datatype=name)
+
+                return orig(self, data, datatype, *args, **kwargs)
+
+            return send
+
+        def sendData(orig):
+            def sendData(self, data, timestamp):
+                name = datatypeName(self.type)
+
+                i.messagesSent.inc(datatype=name)
+                i.bytesSent.inc(len(data), datatype=name)
+
+                return orig(self, data, timestamp)
+
+            return sendData
+
+        def sendFrames(orig):
+            def sendFrames(self, frames, bodyLength, timestamp):
+                name = datatypeName(self.type)
+
+                i.messagesSent.inc(datatype=name)
+                i.bytesSent.inc(bodyLength, datatype=name)
+
+                return orig(self, frames, bodyLength, timestamp)
+
+            return sendFrames
+
+        def callReceived(orig):
+            def callReceived(self, name, callId, *args):
+                started = time()
+
+                try:
+                    self.getCallable(name)
+                except Exception:
+                    method = OTHER_METHOD
+                else:
+                    method = name
+
+                def observe(result):
+                    i.rpcTime.observe(time() - started, method=method)
+
+                    return result
+
+                result = orig(self, name, callId, *args)
+
+                if callId == rpc.NO_RESULT:
+                    return result
+
+                if isinstance(result, defer.Deferred):
+                    return result.addBoth(observe)
+
+                return observe(result)
+
+            return callReceived
+
+        self._patch(rtmp.StateEngine, 'connectionMade', connectionMade)
+        self._patch(rtmp.StateEngine, 'handshakeSuccess', handshakeSuccess)
+        self._patch(rtmp.StateEngine, 'connectionLost', connectionLost)
+        self._patch(rtmp.MessageDispatcher, 'dispatchMessage',
+            dispatchMessage)
+        self._patch(codec.ChannelMuxer, 'send', send)
+        self._patch(codec.StreamingChannel, 'sendData', sendData)
+        self._patch(codec.StreamingChannel, 'sendFrames', sendFrames)
+        self._patch(rpc.AbstractCallHandler, 'callReceived', callReceived)
+
+        self.registry.addCollector(self.collect)
+
+
+    def uninstall(self):
+        while self._patched:
+            util.unwrapMethod(self._patched.pop())
+
+        self.registry.removeCollector(self.collect)
+
+
+    def collect(self):
+        """
+        Reads the state of the live connections.
+        """
+        connections = Gauge('rtmpy_connections', 'Open connections',
+            ['application'])
+        received = Gauge('rtmpy_connection_received_bytes',
+            'Bytes decoded on the connection', ['connection', 'application'])
+        sent = Gauge('rtmpy_connection_sent_bytes',
+            'Bytes encoded on the connection', ['connection', 'application'])
+        pending = Gauge('rtmpy_encoder_pending_messages',
+            'Messages waiting for an RTMP channel',
+            ['connection', 'application'])
+        channels = Gauge('rtmpy_encoder_active_channels',
+            'RTMP channels with data to be written',
+            ['connection', 'application'])
+        buffered = Gauge('rtmpy_decoder_buffered_bytes',
+            'Bytes received but not yet decoded',
+            ['connection', 'application'])
+        rtt = Gauge('rtmpy_connection_rtt_seconds',
+            'Smoothed ping round trip time', ['connection', 'application'])
+        jitter = Gauge('rtmpy_connection_rtt_jitter_seconds',
+            'Variation of the ping round trip time',
+            ['connection', 'application'])
+        subscribers = Gauge('rtmpy_stream_subscribers',
+            'Subscribers to each published stream', ['application', 'stream'])
+        throttled = Gauge('rtmpy_connection_throttled_bytes',
+            'Audio/video bytes dropped by the bandwidth shaper',
+            ['connection', 'application'])
+        dropped = Gauge('rtmpy_shaper_dropped_bytes',
+            'Audio/video bytes dropped while a shared bucket was empty',
+            ['bucket'])
+        tokens = Gauge('rtmpy_shaper_tokens',
+            'Bytes left in a shared bucket', ['bucket'])
+        running = Gauge('rtmpy_executor_running_calls',
+            'Calls running in an executor thread/process', ['executor'])
+        queued = Gauge('rtmpy_executor_queued_calls',
+            'Calls waiting for an executor thread/process', ['executor'])
+        rejected = Gauge('rtmpy_executor_rejected_calls',
+            'Calls failed because the executor queue was full', ['executor'])
+
+        applications = {}
+        buckets = {}
+
+        for protocol in self.connections.keys():
+            appName = _application(protocol)
+            labels = {'connection': _peer(protocol), 'application': appName}
+
+            connections.inc(application=appName)
+
+            app = getattr(getattr(protocol, 'nc', None), 'application', None)
+
+            if app is not None:
+                applications[id(app)] = app
+
+            decoder = getattr(protocol, 'decoder', None)
+            encoder = getattr(protocol, 'encoder', None)
+
+            if decoder is not None:
+                received.set(decoder.bytes, **labels)
+
+                buf = getattr(protocol, '_decodingBuffer', None)
+
+                if buf is not None:
+                    buffered.set(buf.remaining(), **labels)
+
+            pinger = getattr(protocol, 'pinger', None)
+
+            if pinger is not None and pinger.srtt is not None:
+                rtt.set(pinger.srtt, **labels)
+                jitter.set(pinger.jitter, **labels)
+
+            if encoder is not None:
+                sent.set(encoder.bytes, **labels)
+                pending.set(len(encoder.pending), **labels)
+                channels.set(len(encoder.activeChannels), **labels)
+
+                shaper = getattr(encoder, 'shaper', None)
+
+                if shaper is not None:
+                    throttled.set(shaper.dropped, **labels)
+
+                    for bucket in shaper.buckets:
+                        if bucket.name != 'connection':
+                            buckets[id(bucket)] = bucket
+
+        executors = dict([(id(e), e) for e in executor._executors.values()])
+
+        for app in applications.values():
+            for name, publisher in getattr(app, 'streams', {}).items():
+                subscribers.set(len(publisher.subscribers),
+                    application=app.name or '', stream=name)
+
+            e = getattr(app, 'executor', None)
+
+            if e is not None:
+                executors[id(e)] = e
+
+        for e in executors.values():
+            running.set(e.running, executor=e.name or '')
+            queued.set(e.queued, executor=e.name or '')
+            rejected.set(e.rejected, executor=e.name or '')
+
+        for bucket in buckets.values():
+            bucket.refill()
+
+            dropped.set(bucket.dropped, bucket=bucket.name)
+            tokens.set(bucket.tokens, bucket=bucket.name)
+
+        return [connections, received, sent, pending, channels, buffered,
+            rtt, jitter, subscribers, throttled, dropped, tokens, running,
+            queued, rejected]
+
+
+
+_instrumentation = None
+
+
+def enable(registry=registry):
+    """
+    Starts recording metrics into C{registry}.
+    """
+    global enabled, _instrumentation
+
+    if _instrumentation is not None:
+        return
+
+    _instrumentation = Instrumentation(registry)
+    _instrumentation.install()
+
+    enabled = True
+
+
+def disable():
+    """
+    Stops recording metrics. Values already recorded are kept.
+    """
+    global enabled, _instrumentation
+
+    if _instrumentation is None:
+        return
+
+    _instrumentation.uninstall()
+    _instrumentation = None
+
+    enabled = False
+
+
+
+def getResource(registry=registry):
+    """
+    Returns a C{twisted.web} resource that renders C{registry}.
+    """
+    from twisted.web import resource
+
+    class MetricsResource(resource.Resource):
+        isLeaf = True
+
+        def render_GET(self, request):
+            request.setHeader('Content-Type', 'text/plain; version=0.0.4')
+
+            return registry.render().encode('utf-8')
+
+    return MetricsResource()
+
+
+def listen(port, interface='127.0.0.1', registry=registry, reactor=None):
+    """
+    Serves C{registry} over HTTP on C{port}. Only the loopback interface is
+    used by default.
+
+    @return: The C{IListeningPort}.
+    """
+    from twisted.web import server
+
+    if reactor is None:
+        from twisted.internet import reactor
+
+    return reactor.listenTCP(port, server.Site(getResource(registry)),
+        interface=interface)
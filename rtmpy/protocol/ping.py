@@ -0,0 +1,146 @@
+# -*- test-case-name: rtmpy.tests.test_ping -*-
+
+# Copyright the RTMPy Project
+#
+# RTMPy is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# RTMPy is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with RTMPy.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Round trip time and liveness using RTMP ping/pong control messages.
+
+A ping is a L{message.ControlMessage} of type C{PING} carrying a timestamp.
+The peer echoes the timestamp back in a C{PONG}. A peer that does not answer
+within the timeout is considered dead (typically a half open TCP connection)
+and the connection is dropped.
+
+@since: 0.2
+"""
+
+from rtmpy import message
+
+
+__all__ = ['Pinger']
+
+
+
+class Pinger(object):
+    """
+    Pings the peer of C{protocol} every C{interval} seconds.
+
+    The smoothed round trip time and jitter are calculated as per U{RFC 6298
+    <http://tools.ietf.org/html/rfc6298>} (where the jitter is called
+    RTTVAR).
+
+    @ivar rtt: The last round trip time in seconds, or C{None}.
+    @ivar srtt: The smoothed round trip time in seconds, or C{None}.
+    @ivar jitter: The smoothed variation of the round trip time.
+    @ivar sent: Number of pings sent.
+    @ivar received: Number of pongs received for pings that are still pending.
+    """
+
+    alpha = 0.125
+    beta = 0.25
+
+
+    def __init__(self, protocol, interval, timeout, wheel):
+        """
+        @param protocol: Must provide C{sendMessage}, C{controlStream} and
+            C{timeoutConnection}. See L{rtmpy.protocol.rtmp.StateEngine}.
+        @param timeout: Seconds to wait for a pong. Defaults to 3 intervals.
+        @param wheel: The L{rtmpy.timers.TimerWheel} to schedule pings on.
+        """
+        if timeout is None:
+            timeout = interval * 3
+
+        self.protocol = protocol
+        self.interval = interval
+        self.timeout = timeout
+        self.wheel = wheel
+        self.clock = wheel.reactor.seconds
+
+        self.rtt = self.srtt = self.jitter = None
+        self.sent = self.received = 0
+
+        self._started = self.clock()
+        self._pending = {}
+        self._timer = None
+
+
+    def start(self):
+        self._timer = self.wheel.schedule(self.interval, self.ping)
+
+
+    def stop(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        for sentAt, timer in self._pending.values():
+            timer.cancel()
+
+        self._pending = {}
+
+
+    def ping(self):
+        """
+        Sends a ping to the peer and schedules the next one.
+        """
+        now = self.clock()
+        stamp = int((now - self._started) * 1000) & 0x7fffffff
+
+        if stamp not in self._pending:
+            self._pending[stamp] = (now, self.wheel.schedule(self.timeout,
+                self.pingTimedOut, stamp))
+
+            self.sent += 1
+
+            self.protocol.sendMessage(message.ControlMessage(
+                message.ControlMessage.PING, stamp),
+                self.protocol.controlStream)
+
+        self._timer = self.wheel.schedule(self.interval, self.ping)
+
+
+    def pongReceived(self, stamp):
+        """
+        Called when the peer answers the ping that carried C{stamp}.
+        """
+        try:
+            sentAt, timer = self._pending.pop(stamp)
+        except KeyError:
+            return
+
+        timer.cancel()
+
+        rtt = self.clock() - sentAt
+
+        self.received += 1
+        self.rtt = rtt
+
+        if self.srtt is None:
+            self.srtt = rtt
+            self.jitter = rtt / 2
+        else:
+            self.jitter += self.beta * (abs(self.srtt - rtt) - self.jitter)
+            self.srtt += self.alpha * (rtt - self.srtt)
+
+
+    def pingTimedOut(self, stamp):
+        """
+        The peer did not answer in time, drop the connection.
+        """
+        self._pending.pop(stamp, None)
+        self.stop()
+
+        self.protocol.timeoutConnection('Peer did not answer a ping within '
+            '%s seconds' % (self.timeout,))
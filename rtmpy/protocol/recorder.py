@@ -0,0 +1,299 @@
+# Copyright the RTMPy Project
+#
+# RTMPy is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# RTMPy is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with RTMPy.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Records the raw bytes of an RTMP connection to a compact binary file.
+
+A recording can be switched on and off for a single connection at runtime::
+
+    r = recorder.record(protocol, '/tmp/conn.rec')
+    ...
+    r.stop()
+
+Nothing is touched on a connection that is not being recorded. The file
+starts with a header (magic, format version, the wall clock time that the
+recording started and the state of the protocol at that moment), followed by
+one record per read from/write to the transport::
+
+    direction (uchar) | seconds since start (double) | length (ulong) | bytes
+
+Recordings that are started in L{connectionMade<rtmpy.protocol.rtmp.StateEngine
+.connectionMade>} contain the entire session and can be fed back into a
+server by L{rtmpy.scripts.replay}.
+
+@since: 0.2
+"""
+
+import time
+import struct
+
+
+__all__ = [
+    'Recorder',
+    'RecordingReader',
+    'record',
+    'INBOUND',
+    'OUTBOUND',
+]
+
+
+MAGIC = 'RTMPyREC'
+FORMAT_VERSION = 1
+
+#: Direction of the recorded bytes, relative to the recorded endpoint.
+INBOUND = 0
+OUTBOUND = 1
+
+#: The protocol states (see L{rtmpy.protocol.rtmp.StateEngine}) that are
+#: stored in the file header.
+STATES = [None, 'version', 'handshake', 'stream']
+
+_fileHeader = '!8sBdB'
+_fileHeaderSize = struct.calcsize(_fileHeader)
+_record = '!BdL'
+_recordSize = struct.calcsize(_record)
+
+
+class RecordingError(Exception):
+    """
+    Raised when a recording file cannot be read.
+    """
+
+
+
+class Recorder(object):
+    """
+    Writes the bytes sent and received by a protocol instance to C{fileobj}.
+
+    Inbound data is intercepted by wrapping the instance C{dataReceived},
+    outbound data by wrapping the C{write}/C{writeSequence} methods of the
+    transport instance. Both are put back when the recording is stopped.
+
+    @ivar fileobj: The file like object that the recording is written to.
+    @ivar protocol: The protocol being recorded or C{None}.
+    @ivar startTime: Wall clock time that the recording started.
+    """
+
+
+    def __init__(self, fileobj, clock=time.time):
+        self.fileobj = fileobj
+        self.clock = clock
+        self.protocol = None
+        self.startTime = None
+
+
+    @property
+    def recording(self):
+        """
+        Whether a protocol is currently being recorded.
+        """
+        return self.protocol is not None
+
+
+    def _write(self, direction, data):
+        self.fileobj.write(struct.pack(_record, direction,
+            self.clock() - self.startTime, len(data)))
+        self.fileobj.write(data)
+
+
+    def start(self, protocol):
+        """
+        Starts recording C{protocol}. The protocol must already be connected.
+        """
+        if self.protocol is not None:
+            raise RuntimeError('Already recording %r' % (self.protocol,))
+
+        self.protocol = protocol
+        self.transport = protocol.transport
+        self.startTime = self.clock()
+
+        self.fileobj.write(struct.pack(_fileHeader, MAGIC, FORMAT_VERSION,
+            self.startTime, STATES.index(getattr(protocol, 'state', None))))
+
+        self._saved = {}
+
+        self._patch(self.transport, 'write', self._transportWrite)
+        self._patch(self.transport, 'writeSequence',
+            self._transportWriteSequence)
+        self._patch(protocol, 'connectionLost', self._connectionLost)
+
+        self._inbound = self._dataReceived
+        self._patch(protocol, 'dataReceived', self._inbound)
+
+
+    def stop(self):
+        """
+        Stops recording and restores the protocol and transport. The file is
+        flushed but not closed.
+        """
+        if self.protocol is None:
+            return
+
+        for (obj, name), value in self._saved.items():
+            if value is None:
+                del obj.__dict__[name]
+            else:
+                setattr(obj, name, value)
+
+        self._saved = {}
+        self.protocol = self.transport = None
+
+        self.fileobj.flush()
+
+
+    def close(self):
+        """
+        Stops recording and closes the file.
+        """
+        self.stop()
+        self.fileobj.close()
+
+
+    def _patch(self, obj, name, func):
+        """
+        Replaces C{obj.name} with C{func}, remembering the original so that it
+        can be restored by L{stop}.
+        """
+        self._saved[obj, name] = obj.__dict__.get(name, None)
+        self._original(obj, name)
+
+        setattr(obj, name, func)
+
+
+    def _original(self, obj, name):
+        """
+        Stores the current (unwrapped) C{obj.name} callable.
+        """
+        setattr(self, '_orig_' + name, getattr(obj, name))
+
+
+    def _transportWrite(self, data):
+        self._write(OUTBOUND, data)
+        self._orig_write(data)
+
+
+    def _transportWriteSequence(self, seq):
+        self._write(OUTBOUND, ''.join(seq))
+        self._orig_writeSequence(seq)
+
+
+    def _dataReceived(self, data):
+        protocol = self.protocol
+
+        self._write(INBOUND, data)
+
+        try:
+            self._orig_dataReceived(data)
+        finally:
+            # the state engine replaces the instance dataReceived when
+            # streaming starts, make sure the recording carries on.
+            if self.protocol is protocol:
+                current = protocol.__dict__.get('dataReceived', None)
+
+                if current is not self._inbound:
+                    self._saved[protocol, 'dataReceived'] = current
+                    self._original(protocol, 'dataReceived')
+
+                    protocol.dataReceived = self._inbound
+
+
+    def _connectionLost(self, reason):
+        orig = self._orig_connectionLost
+
+        self.close()
+
+        return orig(reason)
+
+
+
+def record(protocol, filename, clock=time.time):
+    """
+    Starts recording C{protocol} to the file C{filename}.
+
+    @return: The L{Recorder}. Call C{close} on it to stop recording, this also
+        happens automatically when the connection is lost.
+    """
+    r = Recorder(open(filename, 'wb'), clock=clock)
+
+    r.start(protocol)
+
+    return r
+
+
+
+class RecordingReader(object):
+    """
+    Reads a recording made by L{Recorder}. Iterating over the reader returns
+    C{(direction, timestamp, data)} tuples.
+
+    @ivar startTime: The wall clock time that the recording was started.
+    @ivar state: The state of the protocol when recording started. Only
+        recordings with a state of C{None} or C{'version'} contain the entire
+        session.
+    """
+
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+
+        header = fileobj.read(_fileHeaderSize)
+
+        if len(header) != _fileHeaderSize:
+            raise RecordingError('Truncated recording header')
+
+        magic, version, self.startTime, state = struct.unpack(_fileHeader,
+            header)
+
+        if magic != MAGIC:
+            raise RecordingError('Not an RTMPy recording')
+
+        if version != FORMAT_VERSION:
+            raise RecordingError('Unknown recording version %d' % (version,))
+
+        try:
+            self.state = STATES[state]
+        except IndexError:
+            raise RecordingError('Unknown protocol state %d' % (state,))
+
+
+    @property
+    def complete(self):
+        """
+        Whether the recording contains the entire session.
+        """
+        return self.state in (None, 'version')
+
+
+    def __iter__(self):
+        read = self.fileobj.read
+        size = _recordSize
+        unpack = struct.unpack
+
+        while True:
+            header = read(size)
+
+            if not header:
+                return
+
+            if len(header) != size:
+                raise RecordingError('Truncated record header')
+
+            direction, timestamp, length = unpack(_record, header)
+            data = read(length)
+
+            if len(data) != length:
+                raise RecordingError('Truncated record')
+
+            yield direction, timestamp, data
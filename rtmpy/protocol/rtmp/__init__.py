@@ -34,9 +34,9 @@ from twisted.internet import protocol, task
 from zope.interface import Interface, Attribute, implements
 from pyamf.util import BufferedByteStream
 
-from rtmpy import message
+from rtmpy import message, timers
 from rtmpy.protocol.rtmp import codec
-from rtmpy.protocol import interfaces
+from rtmpy.protocol import interfaces, ping
 
 
 
@@ -66,6 +66,7 @@ class MessageDispatcher(object):
     A proxy class that listens for events fired from the L{codec.Decoder}.
 
     @param streamer: The L{BaseStreamer} instance attached to the decoder.
+    @ivar codecs: The L{message.AMFCodecs} used to decode AMF messages.
     """
 
     implements(interfaces.IMessageDispatcher)
@@ -73,6 +74,7 @@ class MessageDispatcher(object):
 
     def __init__(self, streamer):
         self.streamer = streamer
+        self.codecs = message.AMFCodecs()
 
 
     def dispatchMessage(self, stream, datatype, timestamp, data):
@@ -86,7 +88,11 @@ class MessageDispatcher(object):
         """
         m = message.classByType(datatype)()
 
-        m.decode(BufferedByteStream(data))
+        if datatype in message.AMF_TYPES:
+            m.decode(BufferedByteStream(data), self.codecs)
+        else:
+            m.decode(BufferedByteStream(data))
+
         m.dispatch(stream, timestamp)
 
 
@@ -108,12 +114,16 @@ class BaseStreamer(object):
     Provides all the base functionality for handling an RTMP input/output.
 
     @ivar decoder: RTMP Decoder that is fed data via L{dataReceived}
+    @ivar amfCodecs: The L{message.AMFCodecs} used to encode AMF messages.
     """
 
     implements(message.IMessageListener)
 
     dispatcher = MessageDispatcher
 
+    amfCodecs = None
+    _shaperCall = None
+
 
     @property
     def decoding(self):
@@ -175,6 +185,8 @@ class BaseStreamer(object):
         self._decodingBuffer = BufferedByteStream()
         self._encodingBuffer = BufferedByteStream()
 
+        self.amfCodecs = message.AMFCodecs()
+
         self.decoder = codec.Decoder(self.getDispatcher(), self.streamManager,
             stream=self._decodingBuffer)
         self.encoder = codec.Encoder(self.getWriter(),
@@ -189,6 +201,10 @@ class BaseStreamer(object):
         """
         self.streamManager.closeAllStreams()
 
+        if self._shaperCall is not None:
+            self._shaperCall.cancel()
+            self._shaperCall = None
+
         self._decodingBuffer.truncate()
         self._encodingBuffer.truncate()
 
@@ -239,6 +255,12 @@ class BaseStreamer(object):
         def cullTask(result):
             self.encoder_task = None
 
+            # the connection may have been lost in the meantime
+            e = getattr(self, 'encoder', None)
+
+            if e is not None and e.active and e.throttled:
+                self.waitForShaper()
+
             return result
 
         self.encoder_task = task.coiterate(self.encoder)
@@ -248,6 +270,25 @@ class BaseStreamer(object):
         return self.encoder_task
 
 
+    def waitForShaper(self):
+        """
+        Called when encoding was paused because the bandwidth budget of the
+        encoder's shaper is spent. Encoding restarts once it has refilled.
+        """
+        if self._shaperCall is not None:
+            return
+
+        def resume():
+            self._shaperCall = None
+
+            e = self.encoder
+
+            if e.active and not self.encoder_task and not e.congested:
+                self.startEncoding()
+
+        self._shaperCall = self.encoder.shaper.callWhenAvailable(resume)
+
+
     def sendMessage(self, msg, stream, whenDone=None):
         """
         Sends an RTMP message to the peer. Not part of a public api, use
@@ -261,15 +302,30 @@ class BaseStreamer(object):
             the RTMP stream. See L{BaseStream.sendMessage}
         """
         buf = BufferedByteStream()
-        e = self.encoder
 
         # this will probably need to be rethought as this could block for an
         # unacceptable amount of time. For most messages however it seems to be
         # fast enough and the penalty for setting up a new thread is too high.
-        msg.encode(buf)
+        if msg.__data_type__ in message.AMF_TYPES:
+            msg.encode(buf, self.amfCodecs)
+        else:
+            msg.encode(buf)
 
-        e.send(buf.getvalue(), msg.__data_type__,
-            stream.streamId, stream.timestamp, whenDone)
+        self.sendEncodedMessage(buf.getvalue(), msg.__data_type__, stream,
+            whenDone)
+
+
+    def sendEncodedMessage(self, data, datatype, stream, whenDone=None):
+        """
+        Sends a message body that has already been encoded. Allows the same
+        bytes to be sent to many peers, see L{sendMessage}.
+
+        @param data: The encoded message body.
+        @param datatype: The RTMP message type.
+        """
+        e = self.encoder
+
+        e.send(data, datatype, stream.streamId, stream.timestamp, whenDone)
 
         if e.active and not self.encoder_task:
             self.startEncoding()
@@ -304,6 +360,33 @@ class BaseStreamer(object):
         self.decoder.abort(channelId)
 
 
+    def onControlMessage(self, msg, timestamp):
+        """
+        Answers pings from the peer and hands pongs to the L{ping.Pinger}.
+        """
+        if msg.type == message.ControlMessage.PING:
+            self.sendMessage(message.ControlMessage(
+                message.ControlMessage.PONG, msg.value1), self.controlStream)
+        elif msg.type == message.ControlMessage.PONG:
+            pinger = getattr(self, 'pinger', None)
+
+            if pinger is not None:
+                pinger.pongReceived(msg.value1)
+
+
+    def onBytesRead(self, bytes, timestamp):
+        """
+        Called when the peer acknowledges the bytes it has received. Restarts
+        encoding if it was paused waiting for the acknowledgement.
+        """
+        e = self.encoder
+
+        e.bytesAcknowledged(bytes)
+
+        if e.active and not self.encoder_task and not e.congested:
+            self.startEncoding()
+
+
     def onDownstreamBandwidth(self, interval, timestamp):
         """
         Called when the peer sends its RTMP bytes interval.
@@ -314,6 +397,13 @@ class BaseStreamer(object):
         self.decoder.setBytesInterval(interval)
 
 
+    def onSharedObject(self, msg, timestamp):
+        """
+        Called when the peer sends a shared object message. Shared objects
+        are only supported by the server, see L{rtmpy.sharedobject}.
+        """
+
+
 
 class StateEngine(BaseStreamer):
     """
@@ -349,6 +439,17 @@ class StateEngine(BaseStreamer):
     Some docstring here.
 
     @ivar state: The state of the protocol.
+    @ivar handshakeTimeout: Seconds allowed for stages 1 and 2 before the
+        connection is dropped. C{None} waits forever.
+    @ivar idleTimeout: Seconds without any RTMP traffic in either direction
+        before the connection is dropped. C{None} waits forever.
+    @ivar timerWheel: The L{timers.TimerWheel} for the timeouts. The shared
+        wheel is used if this is C{None}.
+    @ivar pingInterval: Seconds between pings to the peer once streaming has
+        started. C{None} does not ping.
+    @ivar pingTimeout: Seconds to wait for a pong before the peer is
+        considered dead, see L{ping.Pinger}.
+    @ivar pinger: The L{ping.Pinger} measuring the round trip time, if any.
     """
 
     STATE_VERSION = 'version'
@@ -358,6 +459,17 @@ class StateEngine(BaseStreamer):
     state = None
     protocolVersion = 3
 
+    handshakeTimeout = None
+    idleTimeout = None
+    timerWheel = None
+
+    pingInterval = None
+    pingTimeout = None
+    pinger = None
+
+    _handshakeTimer = None
+    _idleTimer = None
+
 
     def connectionMade(self):
         """
@@ -365,6 +477,11 @@ class StateEngine(BaseStreamer):
         """
         self.state = self.STATE_VERSION
 
+        if self.handshakeTimeout is not None:
+            self._handshakeTimer = self.getTimerWheel().schedule(
+                self.handshakeTimeout, self.timeoutConnection,
+                'Handshake timed out')
+
         self.startVersioning()
 
 
@@ -374,6 +491,8 @@ class StateEngine(BaseStreamer):
 
         @param reason: The reason for the disconnection
         """
+        self.cancelTimeouts()
+
         if self.state == self.STATE_VERSION:
             self.stopVersioning(reason)
         elif self.state == self.STATE_HANDSHAKE:
@@ -500,14 +619,75 @@ class StateEngine(BaseStreamer):
 
         self.stopHandshaking()
 
+        if self._handshakeTimer is not None:
+            self._handshakeTimer.cancel()
+            self._handshakeTimer = None
+
         self.state = self.STATE_STREAM
 
         self.startStreaming()
 
+        if self.idleTimeout is not None:
+            self._lastActivity = None
+            self.checkIdle()
+
+        if self.pingInterval is not None:
+            self.pinger = ping.Pinger(self, self.pingInterval,
+                self.pingTimeout, self.getTimerWheel())
+            self.pinger.start()
+
         if data:
             self.dataReceived(data)
 
 
+    def getTimerWheel(self):
+        if self.timerWheel is None:
+            return timers.getWheel()
+
+        return self.timerWheel
+
+
+    def checkIdle(self):
+        """
+        Drops the connection if no bytes have been decoded or encoded since the
+        last check, otherwise checks again in L{idleTimeout} seconds. Nothing
+        is done on the data path to track activity.
+        """
+        activity = self.decoder.bytes + self.encoder.bytes
+
+        if activity == self._lastActivity:
+            self._idleTimer = None
+            self.timeoutConnection('Connection idle for %s seconds' % (
+                self.idleTimeout,))
+
+            return
+
+        self._lastActivity = activity
+        self._idleTimer = self.getTimerWheel().schedule(self.idleTimeout,
+            self.checkIdle)
+
+
+    def cancelTimeouts(self):
+        for name in ('_handshakeTimer', '_idleTimer'):
+            timer = getattr(self, name)
+
+            if timer is not None:
+                timer.cancel()
+                setattr(self, name, None)
+
+        if self.pinger is not None:
+            self.pinger.stop()
+
+
+    def timeoutConnection(self, reason):
+        """
+        Called when one of the timeouts expires.
+        """
+        log.msg('Dropping %r: %s' % (self, reason))
+
+        self.transport.loseConnection()
+
+
     def startStreaming(self):
         """
         Because Python is awesome we can short circuit checking state each time
@@ -26,6 +26,7 @@ The Encoder/Decoder is not thread safe.
    facilities. To be worked out in the future.
 """
 
+import bisect
 import collections
 
 from pyamf.util import BufferedByteStream
@@ -40,7 +41,8 @@ __all__ = [
     'Decoder',
     'DecodeError',
     'EncodeError',
-    'StreamingChannel'
+    'StreamingChannel',
+    'splitFrames',
 ]
 
 
@@ -633,7 +635,7 @@ class ChannelMuxer(Codec):
     @type releasedChannels: C{collections.deque}
     @ivar channelsInUse: Number of RTMP channels currently in use.
     @ivar activeChannels: A list of L{BaseChannel} objects that are active (and
-        therefore unavailable)
+        therefore unavailable), in channel id order.
     @ivar nextHeaders: A collection of L{header.Header}s to be applied to the
         channel the next time it is asked to marshall a frame.
     @ivar timestamps: A collection of last known timestamps for a given channel.
@@ -649,7 +651,8 @@ class ChannelMuxer(Codec):
         self.pending = []
 
         self.releasedChannels = collections.deque()
-        self.activeChannels = {}
+        self.activeChannels = []
+        self._activeIds = []
         self.channelsInUse = 0
 
         self.nextHeaders = {}
@@ -796,7 +799,30 @@ class ChannelMuxer(Codec):
 
             return
 
-        self.activeChannels[channel] = channel.channelId
+        self._activate(channel)
+
+
+    def _activate(self, channel):
+        """
+        Adds C{channel} to C{activeChannels}, keeping them in channel id order
+        so that L{next} interleaves the channels in a stable order.
+        """
+        ids = self._activeIds
+        channelId = channel.channelId
+        i = bisect.bisect_left(ids, channelId)
+
+        if i < len(ids) and ids[i] == channelId:
+            return
+
+        ids.insert(i, channelId)
+        self.activeChannels.insert(i, channel)
+
+
+    def _deactivate(self, channel):
+        i = bisect.bisect_left(self._activeIds, channel.channelId)
+
+        del self._activeIds[i]
+        del self.activeChannels[i]
 
 
     def next(self):
@@ -811,14 +837,15 @@ class ChannelMuxer(Codec):
 
         to_release = []
 
-        for channel in self.activeChannels:
+        # a copy, the callbacks of the channels may send more messages
+        for channel in self.activeChannels[:]:
             if self._encodeOneFrame(channel):
                 channel.reset()
                 to_release.append(channel)
 
         for channel in to_release:
             self.releaseChannel(channel.channelId)
-            del self.activeChannels[channel]
+            self._deactivate(channel)
 
 
 
@@ -837,8 +864,20 @@ class Encoder(ChannelMuxer):
     @ivar output: A C{write}able object that will receive the final encoded RTMP
         stream. The instance only needs to implement C{write} and accept 1 param
         (the data).
+    @ivar ackWindow: The acknowledgement window size advertised to the peer,
+        see L{setAckWindow}. C{None} disables flow control.
+    @ivar maxUnacknowledged: The number of bytes that can be sent before the
+        peer must acknowledge them.
+    @ivar acknowledged: The byte count last acknowledged by the peer.
+    @ivar shaper: An L{rtmpy.shaping.Shaper} that is charged for every byte
+        written, or C{None}.
     """
 
+    ackWindow = None
+    maxUnacknowledged = None
+    acknowledged = 0
+    shaper = None
+
 
     def __init__(self, output, stream=None):
         ChannelMuxer.__init__(self, stream=stream)
@@ -846,10 +885,68 @@ class Encoder(ChannelMuxer):
         self.output = output
 
 
+    def setAckWindow(self, size, windows=2):
+        """
+        Enables flow control. The peer has been asked to acknowledge every
+        C{size} bytes that it receives, at most C{size * windows} bytes are
+        sent without an acknowledgement. Must be more than one window or the
+        peer will never acknowledge.
+        """
+        self.ackWindow = size
+        self.maxUnacknowledged = size * windows
+
+
+    def bytesAcknowledged(self, total):
+        """
+        Called when the peer reports the total number of bytes it has received.
+        """
+        self.acknowledged = total
+
+
+    @property
+    def unacknowledged(self):
+        """
+        The number of bytes sent but not yet acknowledged by the peer.
+        """
+        # the peer's counter wraps and includes the handshake bytes, which
+        # can put it ahead of ours.
+        wrap = message.BytesRead.FOUR_GB_THRESHOLD
+        n = (self.bytes - self.acknowledged) % wrap
+
+        if n > wrap // 2:
+            return 0
+
+        return n
+
+
+    @property
+    def congested(self):
+        """
+        Whether the peer's acknowledgement window is exhausted. Only command
+        type messages are sent until it acknowledges more bytes.
+        """
+        return self.maxUnacknowledged is not None and \
+            self.unacknowledged >= self.maxUnacknowledged
+
+
+    @property
+    def throttled(self):
+        """
+        Whether the bandwidth budget of the L{shaper} is spent.
+        """
+        return self.shaper is not None and self.shaper.exhausted
+
+
     def next(self):
         """
         Called iteratively to produce an RTMP encoded stream.
         """
+        if self.maxUnacknowledged is not None and self.congested:
+            raise StopIteration
+
+        if self.shaper is not None and self.shaper.exhausted:
+            raise StopIteration
+
         ChannelMuxer.next(self)
 
         self.flush()
@@ -866,6 +963,9 @@ class Encoder(ChannelMuxer):
 
         self.bytes += len(s)
 
+        if self.shaper is not None:
+            self.shaper.consume(len(s))
+
     @property
     def active(self):
         return bool(self.activeChannels)
@@ -878,8 +978,27 @@ class Encoder(ChannelMuxer):
 
 
 
+def splitFrames(data, frameSize, continuation):
+    """
+    Returns the body of an RTMP message split into frames of C{frameSize}
+    bytes and joined by the C{continuation} header, as it follows the first
+    header of the message.
+    """
+    if len(data) <= frameSize:
+        return data
+
+    return continuation.join([data[i:i + frameSize]
+        for i in xrange(0, len(data), frameSize)])
+
+
+
 class StreamingChannel(object):
     """
+    Sends audio/video messages of one type straight to the output, bypassing
+    the muxing of the L{Encoder}.
+
+    @ivar continuationHeader: The encoded header of a continuation frame on
+        this channel.
     """
 
 
@@ -907,7 +1026,7 @@ class StreamingChannel(object):
         # encode a continuation header for speed
         header.encode(self.stream, h, h)
 
-        self._continuationHeader = self.stream.getvalue()
+        self.continuationHeader = self.stream.getvalue()
         self.stream.consume()
 
 
@@ -922,7 +1041,12 @@ class StreamingChannel(object):
         self.type = type
 
 
-    def sendData(self, data, timestamp):
+    @property
+    def frameSize(self):
+        return self.channel.frameSize
+
+
+    def _encodeHeader(self, timestamp, bodyLength):
         c = self.channel
 
         if timestamp < c.timestamp:
@@ -930,31 +1054,76 @@ class StreamingChannel(object):
         else:
             relTimestamp = timestamp - c.timestamp
 
-        h = header.Header(c.channelId, relTimestamp, self.type, len(data), self.streamId)
+        h = header.Header(c.channelId, relTimestamp, self.type, bodyLength, self.streamId)
 
         if self._lastHeader is None:
             h.full = True
 
         c.setHeader(h)
-        c.append(data)
 
         header.encode(self.stream, h, self._lastHeader)
         self._lastHeader = h
 
+
+    def _sent(self, size):
+        self.encoder.bytes += size
+
+        if self.encoder.shaper is not None:
+            self.encoder.shaper.consume(size)
+
+
+    def sendData(self, data, timestamp):
+        c = self.channel
+
+        self._encodeHeader(timestamp, len(data))
+        c.append(data)
+
         c.marshallOneFrame()
 
         while not c.complete():
-            self.stream.write(self._continuationHeader)
+            self.stream.write(self.continuationHeader)
             c.marshallOneFrame()
 
         c.reset()
         s = self.stream.getvalue()
         self.output.write(s)
-        self.encoder.bytes += len(s)
+        self._sent(len(s))
 
         self.stream.consume()
 
 
+    def encodeFrames(self, data):
+        """
+        Returns C{data} split into frames for L{sendFrames}. The frames can be
+        sent on any channel with the same C{frameSize} and
+        C{continuationHeader}.
+        """
+        return splitFrames(data, self.channel.frameSize,
+            self.continuationHeader)
+
+
+    def sendFrames(self, frames, bodyLength, timestamp):
+        """
+        Sends a message body that has already been split into frames by
+        L{encodeFrames}. Only the first header of the message is encoded, the
+        frames are written to the output as they are.
+
+        @param bodyLength: The length of the message body, without the
+            continuation headers.
+        """
+        c = self.channel
+
+        self._encodeHeader(timestamp, bodyLength)
+        c.reset()
+
+        s = self.stream.getvalue()
+        self.stream.consume()
+
+        self.output.write(s)
+        self.output.write(frames)
+        self._sent(len(s) + len(frames))
+
+
 
 def is_command_type(datatype):
     """
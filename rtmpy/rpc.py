@@ -21,7 +21,7 @@ from zope.interface import implements
 from twisted.python import failure, log
 from twisted.internet import defer
 
-from rtmpy import message, exc, status
+from rtmpy import message, exc, status, timers, executor
 
 
 
@@ -78,7 +78,7 @@ class ResultWithCallback(object):
 
 
 
-def expose(func):
+def expose(func=None, executor=None):
     """
     A decorator that provides an easy way to expose methods that the peer can
     'call' via RTMP C{invoke} or C{notify} messages.
@@ -94,7 +94,14 @@ def expose(func):
             def anotherExposedMethod(self, *args):
                 pass
 
-    If expose is called with no args, the function name is used.
+            @expose(executor='thread')
+            def blockingMethod(self, *args):
+                pass
+
+    If expose is called with no name, the function name is used.
+
+    @param executor: The name of the L{rtmpy.executor} to run the method in,
+        off the reactor thread.
     """
     import sys
 
@@ -103,6 +110,11 @@ def expose(func):
 
         methods[exposed_name] = func_name or exposed_name
 
+        if executor is not None:
+            executors = locals.setdefault('__exposed_executors__', {})
+
+            executors[func_name or exposed_name] = executor
+
 
     if callable(func):
         frame = sys._getframe(1)
@@ -113,7 +125,10 @@ def expose(func):
 
     def decorator(f):
         frame = sys._getframe(1)
-        add_meta(frame.f_locals, func, f.__name__)
+        # staticmethods run in a process executor
+        name = getattr(f, '__func__', f).__name__
+
+        add_meta(frame.f_locals, func or name, name)
 
         return f
 
@@ -170,6 +185,36 @@ def getExposedMethods(cls):
 
 
 
+def getExposedExecutors(cls):
+    """
+    Returns a C{dict} of C{class method name} to C{executor name} for the
+    exposed methods of the given class object that run in an executor, see
+    L{expose}.
+
+    The results of this function are stored on the class in the
+    C{__exposed_executors_mro__} slot.
+    """
+    executors = cls.__dict__.get('__exposed_executors_mro__', None)
+
+    if executors is not None:
+        return executors
+
+    import inspect
+
+    ret = {}
+
+    for i in reversed(inspect.getmro(cls)):
+        executors = i.__dict__.get('__exposed_executors__', None)
+
+        if executors is not None:
+            ret.update(executors)
+
+    cls.__exposed_executors_mro__ = ret
+
+    return ret
+
+
+
 def callExposedMethod(obj, name, *args, **kwargs):
     """
     Calls an exposed methood on C{obj}. If the method is not exposed,
@@ -209,12 +254,20 @@ class BaseCallHandler(object):
     @type _lastCallId: C{int}
     @ivar _activeCalls: A C{dict} of callId -> context. An active call has been
         I{initiated} but not yet I{finished}.
+    @ivar callTimeout: Seconds to wait for a call to finish before it is
+        discarded, see L{callTimedOut}. C{None} waits forever.
+    @ivar timerWheel: The L{timers.TimerWheel} used for call timeouts. The
+        shared wheel is used if this is C{None}.
     """
 
+    callTimeout = None
+    timerWheel = None
+
 
     def __init__(self, strict=True):
         self._lastCallId = 0
         self._activeCalls = {}
+        self._callTimers = {}
 
         self.strict = strict
 
@@ -273,6 +326,15 @@ class BaseCallHandler(object):
 
         self._activeCalls[callId] = args
 
+        if self.callTimeout is not None:
+            wheel = self.timerWheel
+
+            if wheel is None:
+                wheel = timers.getWheel()
+
+            self._callTimers[callId] = wheel.schedule(self.callTimeout,
+                self.callTimedOut, callId)
+
         return callId
 
 
@@ -286,6 +348,8 @@ class BaseCallHandler(object):
         @return: The context with which this call was initiated or C{None} if no
             active call could be found.
         """
+        self._cancelCallTimer(callId)
+
         return self._activeCalls.pop(callId, None)
 
 
@@ -302,17 +366,46 @@ class BaseCallHandler(object):
         @return: The context with which this call was initiated or C{None} if no
             active call could be found.
         """
+        self._cancelCallTimer(callId)
+
         return self._activeCalls.pop(callId, None)
 
 
+    def _cancelCallTimer(self, callId):
+        if not self._callTimers:
+            return
+
+        timer = self._callTimers.pop(callId, None)
+
+        if timer is not None:
+            timer.cancel()
+
+
+    def callTimedOut(self, callId):
+        """
+        Called when an active call has not finished within L{callTimeout}
+        seconds. The call is discarded and its id is freed.
+
+        @return: The context with which this call was initiated.
+        """
+        self._callTimers.pop(callId, None)
+
+        return self.discardCall(callId)
+
+
 
 class AbstractCallHandler(BaseCallHandler):
     """
     Provides an API to make RPC calls and handle the response.
+
+    @ivar _dispatchTable: A C{dict} of exposed name -> bound method, built on
+        the first call received. See L{getDispatchTable}.
     """
 
     implements(message.IMessageSender)
 
+    _dispatchTable = None
+
 
     # IMessageSender
     def sendMessage(self, msg, whenDone=None):
@@ -370,6 +463,22 @@ class AbstractCallHandler(BaseCallHandler):
         return d
 
 
+    def callTimedOut(self, callId):
+        """
+        Fails the L{defer.Deferred} returned by L{call} with a
+        L{defer.TimeoutError}. Calls received from the peer are discarded.
+        """
+        context = BaseCallHandler.callTimedOut(self, callId)
+
+        if not context or not isinstance(context[0], defer.Deferred):
+            return
+
+        d, name, args, command = context
+
+        d.errback(defer.TimeoutError('RPC call %r (id %r) timed out' % (
+            name, callId)))
+
+
     def handleResponse(self, name, callId, result, **kwargs):
         """
         Handles the response to a previously initiated RPC call.
@@ -418,8 +527,8 @@ class AbstractCallHandler(BaseCallHandler):
     def callReceived(self, name, callId, *args):
         """
         Called when an RPC request as been made. Determines which locally
-        exposed method to call and then returns a L{defer.Deferred} which
-        handles the result.
+        exposed method to call and handles the result. A L{defer.Deferred} is
+        only created when the method returns one (or raises).
 
         RPC methods can return a L{CommandResult} which will supply the command
         arg to the message.
@@ -429,7 +538,7 @@ class AbstractCallHandler(BaseCallHandler):
         @param callId: The callId for the RPC request.
         @type callId: C{int}
         @param args: The args to be called on the exposed method.
-        @return: A L{defer.Deferred} containing the result of the call.
+        @return: The result of the call, or a L{defer.Deferred} containing it.
         """
         def cb(result):
             if callId == NO_RESULT:
@@ -476,24 +585,74 @@ class AbstractCallHandler(BaseCallHandler):
 
         try:
             self.initiateCall(name, callId=callId, *args)
+            result = self.callExposedMethod(name, *args)
         except:
             return defer.fail().addErrback(eb)
 
-        d = self.callExposedMethod(name, *args)
+        if isinstance(result, defer.Deferred):
+            return result.addCallbacks(cb, eb)
 
-        d.addCallbacks(cb, eb)
+        # a synchronous result is answered straight away, without a Deferred
+        try:
+            return cb(result)
+        except:
+            return defer.fail()
 
-        return d
+
+    def getDispatchTable(self):
+        """
+        Returns a C{dict} of exposed name -> bound method for this instance.
+        The table is built on first use and kept for the life of the instance.
+        """
+        table = self._dispatchTable
+
+        if table is not None:
+            return table
+
+        table = {}
+        cls = self.__class__
+        executors = getExposedExecutors(cls)
+
+        for name, methodName in getExposedMethods(cls).iteritems():
+            try:
+                method = getattr(self, methodName)
+            except AttributeError:
+                log.err("'%s' is exposed but %r does not exist on %r " % (
+                    name, methodName, self))
+
+                continue
+
+            if methodName in executors:
+                method = executor.get(executors[methodName]).wrap(
+                    cls, methodName, method)
+
+            table[name] = method
+
+        self._dispatchTable = table
+
+        return table
+
+
+    def getCallable(self, name):
+        """
+        Returns the callable for the exposed method C{name}.
+
+        @raise exc.CallFailed: C{name} is not exposed.
+        """
+        try:
+            return self.getDispatchTable()[name]
+        except KeyError:
+            raise exc.CallFailed("Method not found (%s)" % (name,))
 
 
     def callExposedMethod(self, name, *args):
         """
-        Returns a L{defer.Deferred} that will hold the result of the called
-        method.
+        Calls the exposed method C{name} and returns its result, which may be
+        a L{defer.Deferred}.
 
         This api allows subclasses to hook into the calling process.
 
         @param name: The name of the method to call
         @param args: The supplied args from the invoke/notify call.
         """
-        return defer.maybeDeferred(callExposedMethod, self, name, *args)
+        return self.getCallable(name)(*args)
@@ -0,0 +1,681 @@
+# Copyright the RTMPy Project
+#
+# RTMPy is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# RTMPy is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with RTMPy.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+In-process RTMP load generator.
+
+Starts a L{server.ServerFactory} on the loopback interface and connects a
+number of synthetic publishers and subscribers to it over real TCP
+connections. Publishers push a generated FLV-like audio/video stream,
+subscribers play it back. Once the run is complete a JSON report is written,
+suitable for tracking performance regressions.
+
+Every generated packet carries the wall clock time that it was created so the
+subscribers can calculate the end to end latency through the server.
+
+@since: 0.2
+"""
+
+import os
+import sys
+import time
+import random
+import struct
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from twisted.internet import protocol, task
+from twisted.python import usage, log
+
+from rtmpy import server, core, message, rpc
+from rtmpy.protocol import rtmp, handshake
+from rtmpy.protocol.rtmp import handshake as rtmp_handshake
+
+
+__all__ = ['Statistics', 'run', 'main']
+
+
+#: The name of the application that all synthetic clients connect to.
+APP_NAME = 'bench'
+
+#: Generated packets start with the FLV tag header byte followed by the time
+#: (in seconds since the epoch) that the packet was created.
+_timestamp = struct.Struct('!d')
+
+#: FLV tag header bytes (AVC keyframe, AVC inter frame, AAC)
+VIDEO_KEYFRAME = '\x17'
+VIDEO_INTERFRAME = '\x27'
+AUDIO_FRAME = '\xaf'
+
+
+
+class Statistics(object):
+    """
+    Collects the numbers for one load generating run.
+
+    @ivar latencies: A reservoir sample of end to end latencies (in seconds).
+    @ivar maxSamples: The maximum number of latencies to keep in memory.
+    """
+
+    maxSamples = 100000
+
+
+    def __init__(self):
+        self.reset()
+
+
+    def reset(self):
+        """
+        Forget everything measured so far. Called when the warmup period has
+        elapsed.
+        """
+        self.messagesSent = 0
+        self.bytesSent = 0
+        self.messagesReceived = 0
+        self.bytesReceived = 0
+        self.errors = 0
+        self.latencies = []
+        self._seen = 0
+
+        self.started = time.time()
+        self.cpuStarted = cpu_time()
+
+
+    def packetSent(self, size):
+        self.messagesSent += 1
+        self.bytesSent += size
+
+
+    def packetReceived(self, data, now=None):
+        """
+        Called when a subscriber receives an audio/video packet.
+        """
+        self.messagesReceived += 1
+        self.bytesReceived += len(data)
+
+        if len(data) < 1 + _timestamp.size:
+            return
+
+        if now is None:
+            now = time.time()
+
+        latency = now - _timestamp.unpack_from(data, 1)[0]
+
+        self._seen += 1
+
+        if len(self.latencies) < self.maxSamples:
+            self.latencies.append(latency)
+
+            return
+
+        i = random.randint(0, self._seen - 1)
+
+        if i < self.maxSamples:
+            self.latencies[i] = latency
+
+
+    def report(self, publishers, subscribers, memory):
+        """
+        Returns a C{dict} of the collected statistics, ready to be encoded to
+        JSON.
+
+        @param memory: The number of bytes of memory consumed per connection.
+        """
+        elapsed = time.time() - self.started or 1e-9
+        cpu = cpu_time() - self.cpuStarted
+
+        latencies = sorted(self.latencies)
+
+        return {
+            'publishers': publishers,
+            'subscribers': subscribers,
+            'duration': round(elapsed, 3),
+            'messages_sent': self.messagesSent,
+            'messages_received': self.messagesReceived,
+            'messages_per_second': round(self.messagesReceived / elapsed, 2),
+            'bytes_per_second': round(self.bytesReceived / elapsed, 2),
+            'publish_bytes_per_second': round(self.bytesSent / elapsed, 2),
+            'cpu_seconds': round(cpu, 3),
+            'cpu_per_subscriber': round(cpu / elapsed / max(subscribers, 1), 6),
+            'memory_per_connection': memory,
+            'errors': self.errors,
+            'latency_ms': {
+                'p50': percentile(latencies, 50),
+                'p90': percentile(latencies, 90),
+                'p99': percentile(latencies, 99),
+                'max': percentile(latencies, 100),
+            }
+        }
+
+
+
+class ClientNegotiator(rtmp_handshake.ClientNegotiator):
+    """
+    The RTMPy server acknowledges the clients syn with a random payload rather
+    than echoing it back so only the uptime is verified.
+    """
+
+
+    def ackReceived(self):
+        if self.peer_ack.uptime != self.my_syn.uptime:
+            raise handshake.VerificationError('Received uptime is not the same')
+
+        self.my_ack = handshake.Packet(self.peer_syn.uptime, self.my_syn.version)
+        self.my_ack.payload = self.peer_syn.payload
+
+        self.writeAck()
+
+
+
+class ClientStream(core.NetStream):
+    """
+    A synthetic NetStream. Either publishes generated a/v data or counts the
+    a/v data played back from the server.
+    """
+
+
+    def __init__(self, nc, streamId):
+        core.NetStream.__init__(self, nc, streamId)
+
+        self.statusCodes = []
+
+
+    @rpc.expose
+    def onStatus(self, status):
+        code = status['code']
+
+        self.statusCodes.append(code)
+        self.nc.protocol.streamStatus(self, code)
+
+
+    @rpc.expose
+    def onMetaData(self, data):
+        pass
+
+
+    def onAudioData(self, data, timestamp):
+        self.nc.protocol.packetReceived(data)
+
+
+    def onVideoData(self, data, timestamp):
+        self.nc.protocol.packetReceived(data)
+
+
+    def onControlMessage(self, msg, timestamp):
+        pass
+
+
+    def closeStream(self):
+        pass
+
+
+
+class ClientNetConnection(core.NetConnection):
+    """
+    The client side of the NetConnection for the synthetic clients.
+    """
+
+
+    def buildStream(self, streamId):
+        return ClientStream(self, streamId)
+
+
+    def sendMessage(self, msg, stream=None, whenDone=None):
+        self.protocol.sendMessage(msg, stream or self, whenDone=whenDone)
+
+
+    def closeStream(self):
+        pass
+
+
+    @rpc.expose
+    def onStatus(self, status):
+        pass
+
+
+    @rpc.expose
+    def onBWDone(self, *args):
+        pass
+
+
+
+class ClientProtocol(rtmp.RTMPProtocol):
+    """
+    Base class for the synthetic clients. Connects to L{APP_NAME} and creates a
+    stream, it is up to subclasses to decide what to do with it.
+
+    @ivar stream: The L{ClientStream} once it has been created.
+    """
+
+    stream = None
+
+
+    def connectionMade(self):
+        # the RTMP version byte, the server will not start handshaking until it
+        # has received this.
+        self.transport.write('\x03')
+
+        rtmp.RTMPProtocol.connectionMade(self)
+
+
+    def connectionLost(self, reason):
+        rtmp.RTMPProtocol.connectionLost(self, reason)
+
+        self.factory.clientDisconnected(self, reason)
+
+
+    def buildStreamManager(self):
+        return self.nc
+
+
+    def startStreaming(self):
+        self.nc = ClientNetConnection(self)
+
+        rtmp.RTMPProtocol.startStreaming(self)
+
+
+    def handshakeSuccess(self, data):
+        rtmp.RTMPProtocol.handshakeSuccess(self, data)
+
+        if self.factory.frameSize:
+            self.setFrameSize(self.factory.frameSize)
+
+        d = self.nc.call('connect', {
+            'app': APP_NAME,
+            'flashVer': 'LNX 10,1,85,3',
+            'tcUrl': 'rtmp://127.0.0.1/%s' % (APP_NAME,),
+        }, notify=True)
+
+        d.addCallback(lambda _: self.nc.call('createStream', notify=True))
+        d.addCallback(self._streamCreated)
+        d.addErrback(self.logAndDisconnect)
+
+
+    def _streamCreated(self, result):
+        streamId = int(result[-1])
+
+        self.stream = self.nc.streams[streamId] = self.nc.buildStream(streamId)
+
+        self.streamReady(self.stream)
+
+
+    def streamReady(self, stream):
+        """
+        Called when the stream has been created on the server.
+        """
+        raise NotImplementedError
+
+
+    def streamStatus(self, stream, code):
+        """
+        Called when the stream has received an C{onStatus} notification.
+        """
+
+
+    def packetReceived(self, data):
+        """
+        Called when an a/v packet has been received from the server.
+        """
+        self.factory.stats.packetReceived(data)
+
+
+    # IMessageListener for the control stream
+
+    def onInvoke(self, name, callId, args, timestamp):
+        self.nc.onInvoke(name, callId, args, timestamp)
+
+
+    def onNotify(self, name, args, timestamp):
+        self.nc.onNotify(name, args, timestamp)
+
+
+    def onDownstreamBandwidth(self, interval, timestamp):
+        rtmp.RTMPProtocol.onDownstreamBandwidth(self, interval, timestamp)
+
+        # the server will not complete the connect request until the window
+        # size has been acknowledged.
+        self.sendMessage(message.DownstreamBandwidth(interval), self.nc)
+
+
+    def onUpstreamBandwidth(self, bandwidth, extra, timestamp):
+        pass
+
+
+    def onBytesRead(self, bytes, timestamp):
+        pass
+
+
+    def closeStream(self):
+        pass
+
+
+
+class PublishingProtocol(ClientProtocol):
+    """
+    Publishes a generated a/v stream once connected.
+    """
+
+    loop = None
+
+
+    def streamReady(self, stream):
+        stream.call('publish', self.factory.streamName, 'live')
+
+
+    def streamStatus(self, stream, code):
+        if code != 'NetStream.Publish.Start' or self.loop:
+            return
+
+        self.videoChannel = self.getStreamingChannel(stream)
+        self.videoChannel.setType(message.VIDEO_DATA)
+
+        self.audioChannel = self.getStreamingChannel(stream)
+        self.audioChannel.setType(message.AUDIO_DATA)
+
+        self.frames = 0
+        self.startTime = time.time()
+
+        self.loop = task.LoopingCall(self.sendFrame)
+        self.loop.start(1.0 / self.factory.fps)
+
+
+    def buildPacket(self, marker, size):
+        now = time.time()
+        p = marker + _timestamp.pack(now)
+
+        return p + self.factory.padding[:max(0, size - len(p))]
+
+
+    def sendFrame(self):
+        f = self.factory
+        stats = f.stats
+        timestamp = int((time.time() - self.startTime) * 1000)
+
+        if self.frames % f.keyframeInterval == 0:
+            marker = VIDEO_KEYFRAME
+        else:
+            marker = VIDEO_INTERFRAME
+
+        self.frames += 1
+
+        data = self.buildPacket(marker, f.videoSize)
+        self.videoChannel.sendData(data, timestamp)
+        stats.packetSent(len(data))
+
+        for i in xrange(f.audioPerFrame):
+            data = self.buildPacket(AUDIO_FRAME, f.audioSize)
+            self.audioChannel.sendData(data, timestamp)
+            stats.packetSent(len(data))
+
+
+    def connectionLost(self, reason):
+        if self.loop and self.loop.running:
+            self.loop.stop()
+
+        ClientProtocol.connectionLost(self, reason)
+
+
+
+class SubscribingProtocol(ClientProtocol):
+    """
+    Plays the stream as published by a L{PublishingProtocol}.
+    """
+
+
+    def streamReady(self, stream):
+        stream.call('play', self.factory.streamName)
+
+
+
+class ClientFactory(protocol.ClientFactory):
+    """
+    Builds synthetic client connections.
+
+    @ivar stats: The shared L{Statistics} for the run.
+    @ivar streamName: The name of the stream to publish or play.
+    """
+
+    handshake = ClientNegotiator
+
+    frameSize = None
+    fps = 25
+    keyframeInterval = 50
+    videoSize = 2500
+    audioPerFrame = 2
+    audioSize = 200
+
+
+    def __init__(self, protocol, stats, streamName, **kwargs):
+        self.protocol = protocol
+        self.stats = stats
+        self.streamName = streamName
+
+        self.__dict__.update(kwargs)
+
+        self.padding = os.urandom(max(self.videoSize, self.audioSize))
+
+
+    def buildHandshakeNegotiator(self, observer, output):
+        return self.handshake(observer, output)
+
+
+    def clientDisconnected(self, client, reason):
+        if not self.stats.finished:
+            self.stats.errors += 1
+
+
+    def clientConnectionFailed(self, connector, reason):
+        log.err(reason)
+        self.stats.errors += 1
+
+
+
+def cpu_time():
+    """
+    Returns the user + system CPU time consumed by this process.
+    """
+    t = os.times()
+
+    return t[0] + t[1]
+
+
+
+def memory_usage():
+    """
+    Returns the resident set size of this process in bytes, or C{None} if it
+    cannot be determined.
+    """
+    try:
+        fp = open('/proc/self/statm')
+    except IOError:
+        pass
+    else:
+        try:
+            return int(fp.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        finally:
+            fp.close()
+
+    try:
+        import resource
+    except ImportError:
+        return None
+
+    # ru_maxrss is kilobytes on Linux and a high water mark only
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+
+def percentile(values, p):
+    """
+    Returns the C{p}th percentile (in milliseconds) of the pre-sorted list of
+    C{values} (in seconds). Returns C{None} for an empty list.
+    """
+    if not values:
+        return None
+
+    i = int(round((len(values) - 1) * p / 100.0))
+
+    return round(values[i] * 1000, 3)
+
+
+
+class Options(usage.Options):
+    """
+    Command line options for C{rtmpy-bench}.
+    """
+
+    synopsis = 'Usage: rtmpy-bench [options]'
+
+    optParameters = [
+        ['publishers', 'p', 1, 'Number of publishing connections', int],
+        ['subscribers', 's', 10, 'Number of subscribing connections', int],
+        ['duration', 'd', 10.0, 'Measured duration of the run (seconds)',
+            float],
+        ['warmup', 'w', 2.0, 'Seconds to wait before measuring', float],
+        ['fps', 'f', 25, 'Video frames per second for each publisher', int],
+        ['video-size', None, 2500, 'Bytes per video frame', int],
+        ['audio-size', None, 200, 'Bytes per audio frame', int],
+        ['chunk-size', None, 4096, 'RTMP chunk size used by publishers', int],
+        ['output', 'o', None, 'Write the JSON report to this file'],
+    ]
+
+
+
+def run(config, reactor=None):
+    """
+    Runs the load generator as described by C{config} (an L{Options} instance
+    or a C{dict}). Returns a L{defer.Deferred} that fires with the report
+    C{dict} once the run is complete.
+    """
+    from twisted.internet import defer
+
+    if reactor is None:
+        from twisted.internet import reactor
+
+    stats = Statistics()
+    stats.finished = False
+
+    memBefore = memory_usage()
+
+    factory = server.ServerFactory({APP_NAME: server.Application()})
+    port = reactor.listenTCP(0, factory, interface='127.0.0.1')
+    portNumber = port.getHost().port
+
+    numPublishers = max(config['publishers'], 1)
+    numSubscribers = config['subscribers']
+
+    kwargs = {
+        'fps': config['fps'],
+        'videoSize': config['video-size'],
+        'audioSize': config['audio-size'],
+        'frameSize': config['chunk-size'],
+        'keyframeInterval': config['fps'] * 2,
+    }
+
+    publishers = []
+    subscribers = []
+
+    for i in xrange(numPublishers):
+        f = ClientFactory(PublishingProtocol, stats, 'stream%d' % (i,),
+            **kwargs)
+        publishers.append(reactor.connectTCP('127.0.0.1', portNumber, f))
+
+    for i in xrange(numSubscribers):
+        f = ClientFactory(SubscribingProtocol, stats,
+            'stream%d' % (i % numPublishers,), **kwargs)
+        subscribers.append(reactor.connectTCP('127.0.0.1', portNumber, f))
+
+    d = defer.Deferred()
+    result = {}
+
+    def start_measuring():
+        memAfter = memory_usage()
+
+        if memBefore is not None and memAfter is not None:
+            result['memory'] = (memAfter - memBefore) // (
+                numPublishers + numSubscribers)
+        else:
+            result['memory'] = None
+
+        stats.reset()
+        reactor.callLater(config['duration'], finish)
+
+    def finish():
+        report = stats.report(numPublishers, numSubscribers, result['memory'])
+        stats.finished = True
+
+        # publishers go first so that the server can tell the subscribers
+        # that the streams have been unpublished
+        for c in publishers:
+            c.disconnect()
+
+        reactor.callLater(0.1, disconnect_subscribers, report)
+
+    def disconnect_subscribers(report):
+        for c in subscribers:
+            c.disconnect()
+
+        port.stopListening()
+        d.callback(report)
+
+    reactor.callLater(config['warmup'], start_measuring)
+
+    return d
+
+
+
+def main(args=None):
+    """
+    Entry point for C{rtmpy-bench}.
+    """
+    from twisted.internet import reactor
+
+    config = Options()
+
+    try:
+        config.parseOptions(args)
+    except usage.UsageError, e:
+        print >> sys.stderr, '%s\n%s' % (config, e)
+
+        raise SystemExit(1)
+
+    def write_report(report):
+        output = json.dumps(report, indent=2, sort_keys=True)
+
+        if config['output']:
+            fp = open(config['output'], 'wt')
+
+            try:
+                fp.write(output + '\n')
+            finally:
+                fp.close()
+        else:
+            print output
+
+    def stop(result):
+        reactor.stop()
+
+        return result
+
+    d = run(config, reactor)
+
+    d.addCallback(write_report)
+    d.addErrback(log.err)
+    d.addBoth(stop)
+
+    reactor.run()
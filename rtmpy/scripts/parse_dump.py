@@ -14,17 +14,46 @@
 # with RTMPy.  If not, see <http://www.gnu.org/licenses/>.
 
 """
-Parses RTMP dumps from Wireshark - converted to c array format.
+Parses RTMP dumps from Wireshark - converted to c array format - or raw pcap
+capture files.
+
+Both formats are read as a stream, only one block (or packet) is held in
+memory at a time so multi gigabyte captures can be parsed. Any number of dumps
+can be analyzed in parallel (see L{analyze}), producing JSON lines statistics
+for each dump and optionally every decoded message.
 
 @since: 0.1.1
 """
 
+import os
+import re
+import struct
+import binascii
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
 from pyamf.util import BufferedByteStream
 from rtmpy.protocol.rtmp import codec
 from rtmpy import message
+from rtmpy.scripts.loadgen import percentile
+
 
+__all__ = ['parse_dump', 'parse_pcap', 'analyze', 'XMLObserver',
+    'JSONObserver', 'StatisticsObserver']
 
-__all__ = ['parse_dump', 'XMLObserver']
+
+#: The default RTMP port, used to work out the direction of pcap'd packets.
+RTMP_PORT = 1935
+
+#: Big and little endian pcap magic, micro and nanosecond resolution.
+PCAP_MAGIC = (
+    '\xa1\xb2\xc3\xd4', '\xa1\xb2\x3c\x4d',
+    '\xd4\xc3\xb2\xa1', '\x4d\x3c\xb2\xa1')
+
+_hex_byte = re.compile(r'0x([0-9a-fA-F]{1,2})')
 
 
 
@@ -43,10 +72,44 @@ def parse_dump(f, observer):
     C{observer} must implement C{messageStart}, C{messageReceived} and
     C{messageComplete}. See L{XMLObserver} as an example.
     """
+    parse_blocks(((label, data, None) for label, data in read_dump(f)),
+        observer)
+
+
+
+def parse_pcap(f, observer, port=RTMP_PORT):
+    """
+    Reads a pcap capture file of an RTMP connection from C{f} and sends the
+    messages to C{observer}. See L{read_pcap}.
+    """
+    parse_blocks(read_pcap(f, port, times=True), observer)
+
+
+
+def parse_file(f, observer, port=RTMP_PORT):
+    """
+    Parses C{f}, which may be a pcap capture or a c array dump.
+    """
+    magic = f.read(4)
+    f.seek(0)
+
+    if magic in PCAP_MAGIC:
+        parse_pcap(f, observer, port)
+    else:
+        parse_dump(f, observer)
+
+
+
+def parse_blocks(blocks, observer):
+    """
+    Feeds C{(label, data, time)} tuples from C{blocks} to the relevant
+    L{RTMPEndpoint}. C{time} is the capture time of the data, or C{None} if
+    it is not known.
+    """
     recv = RTMPEndpoint('server', observer)
     send = RTMPEndpoint('client', observer)
 
-    for label, data in read_dump(f):
+    for label, data, time in blocks:
         endpoint = None
 
         if label == 'recv':
@@ -57,12 +120,10 @@ def parse_dump(f, observer):
         if not endpoint:
             continue
 
-        if data.startswith('[') and data.endswith('bytes missing in capture file]'):
-            raise MissingDataError
-
-        endpoint.dataReceived(data)
+        endpoint.dataReceived(data, time)
 
-        [y for y in endpoint]
+        for y in endpoint:
+            pass
 
 
 
@@ -72,22 +133,24 @@ def read_dump(f):
     generator that will return tuples containing the label for the endpoint
     (we assume the first block is from the sender, but the labelling is
     arbitrary) and the bytes sent.
+
+    Each line is converted as it is read, only the bytes for the current block
+    are kept.
     """
     to = 'send'
-    buf = ''
-
-    while True:
-        line = f.readline()
-
-        if not line:
-            raise StopIteration
+    buf = []
 
+    for line in f:
         line = clean_line(line)
 
         if line == '':
             continue
 
-        if line.endswith('{'):
+        if line.startswith('[') and line.endswith(
+                'bytes missing in capture file]'):
+            raise MissingDataError
+
+        if line.startswith('char '):
             # parse a "char peer1_188[] = {" line
             ch = line[9]
             if ch == '0':
@@ -95,13 +158,15 @@ def read_dump(f):
             else:
                 to = 'recv'
 
-            buf = ''
+            buf = []
         elif line.endswith('};'):
-            buf += line[:-2]
+            buf.append(parse_bytes(line[:-2]))
+
+            yield (to, ''.join(buf))
 
-            yield (to, parse_bytes(buf.strip()))
+            buf = []
         else:
-            buf += line
+            buf.append(parse_bytes(line))
 
 
 
@@ -115,25 +180,240 @@ def clean_line(l):
 
 
 def parse_bytes(buf):
-    # this could be *a lot* faster ..
-    buf = buf.replace(', ', '')
-    buf = buf.replace(',', '')
-    buf = buf.replace('0x', 'x')
+    """
+    Converts c array formatted text (C{0x03, 0x00, ..}) to the bytes it
+    represents.
+    """
+    digits = _hex_byte.findall(buf)
+    s = ''.join(digits)
+
+    if len(s) != len(digits) * 2:
+        # some bytes were written without a leading zero
+        s = ''.join([x.zfill(2) for x in digits])
+
+    return binascii.unhexlify(s)
+
+
+
+class PcapError(Exception):
+    """
+    Raised if a pcap file cannot be read.
+    """
+
+
+
+def _ethernet(frame):
+    ethertype, = struct.unpack('!H', frame[12:14])
+    offset = 14
+
+    # 802.1Q VLAN tags
+    while ethertype == 0x8100:
+        ethertype, = struct.unpack('!H', frame[offset + 2:offset + 4])
+        offset += 4
 
-    s = ''
+    if ethertype in (0x0800, 0x86dd):
+        return offset
 
-    for x in buf[1:].split('x'):
-        s += chr(int(x, 16))
 
-    return s
+def _linux_sll(frame):
+    if struct.unpack('!H', frame[14:16])[0] in (0x0800, 0x86dd):
+        return 16
+
+
+def _linux_sll2(frame):
+    if struct.unpack('!H', frame[0:2])[0] in (0x0800, 0x86dd):
+        return 20
+
+
+def _null(frame):
+    return 4
+
+
+def _raw(frame):
+    return 0
+
+
+#: pcap link layer types, mapped to a function returning the offset of the IP
+#: header (or C{None} if the frame is not IP).
+LINK_TYPES = {
+    0: _null,
+    1: _ethernet,
+    12: _raw,
+    101: _raw,
+    108: _null,
+    113: _linux_sll,
+    276: _linux_sll2,
+}
+
+
+
+def read_pcap_packets(f):
+    """
+    Returns a generator of C{(time, packet)} for the raw IP packets in the
+    pcap file C{f}.
+
+    @raise PcapError: The file is not a pcap capture, or uses an unsupported
+        link layer.
+    @raise MissingDataError: A packet was truncated by the capture.
+    """
+    header = f.read(24)
+
+    if len(header) < 24:
+        raise PcapError('Truncated pcap header')
+
+    magic = header[:4]
+
+    if magic in PCAP_MAGIC[:2]:
+        endian = '>'
+    elif magic in PCAP_MAGIC[2:]:
+        endian = '<'
+    else:
+        raise PcapError('Not a pcap file (pcapng is not supported)')
+
+    linktype, = struct.unpack(endian + 'L', header[20:24])
+    resolution = magic in (PCAP_MAGIC[1], PCAP_MAGIC[3]) and 1e-9 or 1e-6
+
+    try:
+        get_offset = LINK_TYPES[linktype]
+    except KeyError:
+        raise PcapError('Unsupported link type %d' % (linktype,))
+
+    record = struct.Struct(endian + 'LLLL')
+
+    while True:
+        h = f.read(record.size)
+
+        if not h:
+            return
+
+        if len(h) < record.size:
+            raise PcapError('Truncated packet header')
+
+        sec, usec, caplen, length = record.unpack(h)
+        frame = f.read(caplen)
+
+        if len(frame) < caplen:
+            raise PcapError('Truncated packet')
+
+        if caplen < length:
+            raise MissingDataError
+
+        offset = get_offset(frame)
+
+        if offset is not None:
+            yield sec + usec * resolution, frame[offset:]
+
+
+
+def read_tcp_segments(packets):
+    """
+    Returns a generator of C{(time, src, dst, seq, flags, payload)} for each
+    TCP segment in C{packets}, C{src} and C{dst} are C{(host, port)} tuples.
+    """
+    unpack = struct.unpack
+
+    for time, packet in packets:
+        version = ord(packet[0]) >> 4
+
+        if version == 4:
+            ihl = (ord(packet[0]) & 0x0f) * 4
+            total, = unpack('!H', packet[2:4])
+
+            if ord(packet[9]) != 6:
+                continue
+
+            src, dst = packet[12:16], packet[16:20]
+            # strip any link layer padding
+            tcp = packet[ihl:total]
+        elif version == 6:
+            # extension headers are not supported
+            if ord(packet[6]) != 6:
+                continue
+
+            length, = unpack('!H', packet[4:6])
+            src, dst = packet[8:24], packet[24:40]
+            tcp = packet[40:40 + length]
+        else:
+            continue
+
+        sport, dport, seq = unpack('!HHL', tcp[:8])
+        offset = (ord(tcp[12]) >> 4) * 4
+        flags = ord(tcp[13])
+
+        yield time, (src, sport), (dst, dport), seq, flags, tcp[offset:]
+
+
+
+def read_pcap(f, port=RTMP_PORT, times=False):
+    """
+    Reads the first RTMP connection to C{port} from the pcap file C{f} and
+    returns a generator of C{(label, data)} tuples, like L{read_dump}. Data
+    sent to C{port} is labelled C{send}, data from C{port} C{recv}.
+
+    Retransmitted data is dropped.
+
+    @param times: Whether to append the capture time of the packet to each
+        tuple.
+
+    @raise MissingDataError: There is a gap in the TCP stream.
+    """
+    connection = None
+    expected = {}
+
+    for time, src, dst, seq, flags, payload in read_tcp_segments(
+            read_pcap_packets(f)):
+        if dst[1] == port:
+            key, label = (src, dst), 'send'
+        elif src[1] == port:
+            key, label = (dst, src), 'recv'
+        else:
+            continue
+
+        if connection is None:
+            connection = key
+        elif key != connection:
+            continue
+
+        if flags & 0x02:
+            # SYN
+            expected[label] = (seq + 1) & 0xffffffff
+
+            continue
+
+        if not payload:
+            continue
+
+        next_seq = expected.get(label, seq)
+        # handles sequence number wrap around
+        delta = (seq - next_seq + 0x80000000) % 0x100000000 - 0x80000000
+
+        if delta > 0:
+            raise MissingDataError
+
+        if -delta >= len(payload):
+            # retransmission
+            continue
+
+        payload = payload[-delta:]
+        expected[label] = (next_seq + len(payload)) & 0xffffffff
+
+        if times:
+            yield label, payload, time
+        else:
+            yield label, payload
 
 
 
 class Message(object):
     """
     An RTMP message that has a type and context.
+
+    @ivar time: The capture time of the data that completed the message, if
+        known.
     """
 
+    time = None
+
     def __init__(self, __type, **kwargs):
         self.type = __type
         self.context = kwargs
@@ -221,6 +501,8 @@ class StreamFactory(object):
     to the stream accordingly.
     """
 
+    time = None
+
     def __init__(self, type, observer):
         self.streams = {}
         self.type = type
@@ -244,8 +526,9 @@ class StreamFactory(object):
         return s
 
     def dispatchMessage(self, stream, datatype, timestamp, data):
-        p = Packet(self.type,
-            streamId=stream.streamId, datatype=datatype, timestamp=timestamp)
+        p = Packet(self.type, streamId=stream.streamId, datatype=datatype,
+            timestamp=timestamp, length=len(data))
+        p.time = self.time
 
         self.observer.messageStart(p)
 
@@ -282,9 +565,12 @@ class RTMPEndpoint(object):
         self.handshake = False
         self.buffer = ''
 
-    def dataReceived(self, data):
+    def dataReceived(self, data, time=None):
         """
+        @param time: The capture time of C{data}, if known.
         """
+        self.factory.time = time
+
         if not self.handshake:
             self.buffer += data
 
@@ -314,8 +600,7 @@ class XMLObserver(object):
         self.file = file
 
     def _to_xml(self, dict, shorten=False):
-        s = ''
-
+        s = []
         as_tags = []
 
         for k, n in dict.iteritems():
@@ -324,26 +609,24 @@ class XMLObserver(object):
 
                 continue
 
-            s += ' %s="%s"' % (k, str(n))
+            s.append(' %s="%s"' % (k, str(n)))
 
         if not as_tags:
             if shorten:
-                s += '/>'
+                s.append('/>')
             else:
-                s += '>'
+                s.append('>')
         else:
-            s += '>\n'
+            s.append('>\n')
 
             for k, v in as_tags:
-                s += '  <%s>%r</%s>\n' % (k, v, k)
+                s.append('  <%s>%r</%s>\n' % (k, v, k))
 
-        return s
+        return ''.join(s)
 
     def messageStart(self, packet):
-        xml = '<message from="%s"%s' % (
-            packet.type, self._to_xml(packet.context))
-
-        self.file.write(xml + '\n')
+        self.file.write('<message from="%s"%s\n' % (
+            packet.type, self._to_xml(packet.context)))
 
     def messageReceived(self, message):
         xml = ' <%s%s' % (message.type, self._to_xml(message.context, True))
@@ -351,25 +634,363 @@ class XMLObserver(object):
         if not xml.endswith('/>'):
             xml += ' </%s>' % (message.type,)
 
-        xml += '\n'
-
-        self.file.write(xml)
+        self.file.write(xml + '\n')
 
     def messageComplete(self, packet):
         self.file.write('</message>\n')
 
 
-def run():
-    import sys
 
-    observer = XMLObserver(sys.stdout)
+class JSONObserver(object):
+    """
+    An RTMP observer that writes one JSON object per message to a file
+    object (JSON lines).
+
+    @ivar dump: The name of the dump, added to every event.
+    """
+
+    def __init__(self, file, dump=None):
+        self.file = file
+        self.dump = dump
+        self.packet = None
+
+    def messageStart(self, packet):
+        self.packet = packet
 
-    f = open(sys.argv[1], 'rb')
+    def messageReceived(self, message):
+        p = self.packet
+        event = dict(message.context)
+
+        event.update({
+            'dump': self.dump,
+            'from': p.type,
+            'type': message.type,
+            'stream': p.context['streamId'],
+            'datatype': p.context['datatype'],
+            'timestamp': p.context['timestamp'],
+            'time': p.time,
+        })
+
+        self.file.write(json.dumps(event, default=repr) + '\n')
+
+    def messageComplete(self, packet):
+        self.packet = None
+
+
+
+class StatisticsObserver(object):
+    """
+    An RTMP observer that aggregates statistics for one dump.
+
+    @ivar messages: Message type -> count.
+    @ivar frameSizes: Every change of the RTMP chunk size.
+    @ivar streams: Bytes sent on each stream, keyed by C{<from>/<streamId>}.
+    @ivar latencies: Method name -> list of seconds between an invoke and its
+        C{_result}/C{_error}. Only capture files have the timing information.
+    @ivar gaps: Audio/video timestamp jumps larger than C{gapThreshold}
+        milliseconds.
+    """
+
+    gapThreshold = 1000
+
+    def __init__(self):
+        self.packets = 0
+        self.messages = {}
+        self.frameSizes = []
+        self.streams = {}
+        self.latencies = {}
+        self.gaps = []
+        self.packet = None
+
+        self._calls = {}
+        self._timestamps = {}
+
+    def messageStart(self, packet):
+        self.packet = packet
+        self.packets += 1
+
+        key = '%s/%s' % (packet.type, packet.context['streamId'])
+        self.streams[key] = self.streams.get(key, 0) + packet.context['length']
+
+    def messageReceived(self, message):
+        p = self.packet
+        kind = message.type
+
+        self.messages[kind] = self.messages.get(kind, 0) + 1
+
+        if kind == 'frame_size':
+            self.frameSizes.append({
+                'from': p.type,
+                'size': message.context['size'],
+                'time': p.time,
+            })
+        elif kind in ('audio', 'video'):
+            self._checkGap(p, kind, message.context['timestamp'])
+        elif kind == 'invoke':
+            self._checkCall(p, message.context['name'], message.context['id'])
+
+    def messageComplete(self, packet):
+        self.packet = None
+
+    def _checkGap(self, packet, kind, timestamp):
+        key = (packet.type, packet.context['streamId'], kind)
+        last = self._timestamps.get(key, None)
+
+        self._timestamps[key] = timestamp
+
+        if last is None or timestamp - last <= self.gapThreshold:
+            return
+
+        self.gaps.append({
+            'from': packet.type,
+            'stream': packet.context['streamId'],
+            'type': kind,
+            'timestamp': last,
+            'gap': timestamp - last,
+        })
+
+    def _checkCall(self, packet, name, id_):
+        if not id_:
+            # notifications do not get a response
+            return
+
+        if name not in ('_result', '_error'):
+            self._calls[packet.type, id_] = (name, packet.time)
+
+            return
+
+        peer = packet.type == 'server' and 'client' or 'server'
+
+        try:
+            method, started = self._calls.pop((peer, id_))
+        except KeyError:
+            return
+
+        if started is None or packet.time is None:
+            return
+
+        self.latencies.setdefault(method, []).append(packet.time - started)
+
+    def summary(self):
+        """
+        Returns the statistics as a C{dict}, ready to be encoded to JSON.
+        """
+        latencies = {}
+
+        for method, values in self.latencies.iteritems():
+            values = sorted(values)
+
+            latencies[method] = {
+                'count': len(values),
+                'p50': percentile(values, 50),
+                'p90': percentile(values, 90),
+                'max': percentile(values, 100),
+            }
+
+        return {
+            'packets': self.packets,
+            'messages': self.messages,
+            'frame_sizes': self.frameSizes,
+            'stream_bytes': self.streams,
+            'invoke_latency_ms': latencies,
+            'unanswered_invokes': len(self._calls),
+            'timestamp_gaps': self.gaps,
+        }
+
+
+
+class ObserverList(object):
+    """
+    Passes every event on to a list of observers.
+    """
+
+    def __init__(self, *observers):
+        self.observers = observers
+
+    def messageStart(self, packet):
+        for o in self.observers:
+            o.messageStart(packet)
+
+    def messageReceived(self, message):
+        for o in self.observers:
+            o.messageReceived(message)
+
+    def messageComplete(self, packet):
+        for o in self.observers:
+            o.messageComplete(packet)
+
+
+
+def analyze_file(args):
+    """
+    Parses one dump and returns its statistics. Runs in a worker process.
+
+    @param args: A C{(filename, events, port)} tuple. If C{events} is not
+        C{None} it is the directory that the JSON lines events are written to.
+    """
+    filename, events, port = args
+
+    stats = StatisticsObserver()
+    observer = stats
+    out = None
+
+    if events is not None:
+        name = os.path.splitext(os.path.basename(filename))[0]
+        out = open(os.path.join(events, name + '.jsonl'), 'wt')
+        observer = ObserverList(stats, JSONObserver(out, filename))
+
+    result = {'dump': filename, 'error': None}
+    f = open(filename, 'rb')
 
     try:
-        parse_dump(f, observer)
-    except MissingDataError:
-        print('Dump file is corrupt - missing data?')
-        raise SystemExit(1)
+        try:
+            parse_file(f, observer, port)
+        except MissingDataError:
+            result['error'] = 'missing data'
+        except Exception, e:
+            result['error'] = '%s: %s' % (e.__class__.__name__, e)
     finally:
         f.close()
+
+        if out is not None:
+            out.close()
+
+    result.update(stats.summary())
+
+    return result
+
+
+
+def analyze(filenames, processes=None, events=None, port=RTMP_PORT):
+    """
+    Analyzes C{filenames} in a pool of C{processes} worker processes (defaults
+    to the number of CPUs).
+
+    @param events: A directory to write the JSON lines events for each dump to.
+    @return: A generator of the L{analyze_file} results, in the order that the
+        dumps complete.
+    """
+    jobs = [(filename, events, port) for filename in filenames]
+
+    try:
+        import multiprocessing
+    except ImportError:
+        multiprocessing = None
+
+    if multiprocessing is None or processes == 1 or len(jobs) < 2:
+        for job in jobs:
+            yield analyze_file(job)
+
+        return
+
+    pool = multiprocessing.Pool(processes)
+
+    try:
+        for result in pool.imap_unordered(analyze_file, jobs):
+            yield result
+    except:
+        pool.terminate()
+        pool.join()
+
+        raise
+
+    # terminate() can hang when the reactor has installed a SIGCHLD handler
+    pool.close()
+    pool.join()
+
+
+
+def aggregate(results):
+    """
+    Combines the L{analyze_file} results of a number of dumps.
+    """
+    total = {
+        'dumps': 0,
+        'errors': 0,
+        'packets': 0,
+        'messages': {},
+        'frame_size_changes': 0,
+        'bytes_from': {},
+        'timestamp_gaps': 0,
+        'max_timestamp_gap': None,
+        'unanswered_invokes': 0,
+    }
+
+    for r in results:
+        total['dumps'] += 1
+        total['packets'] += r['packets']
+        total['frame_size_changes'] += len(r['frame_sizes'])
+        total['timestamp_gaps'] += len(r['timestamp_gaps'])
+        total['unanswered_invokes'] += r['unanswered_invokes']
+
+        if r['error']:
+            total['errors'] += 1
+
+        for kind, count in r['messages'].iteritems():
+            total['messages'][kind] = total['messages'].get(kind, 0) + count
+
+        for key, count in r['stream_bytes'].iteritems():
+            peer = key.split('/')[0]
+            total['bytes_from'][peer] = total['bytes_from'].get(peer, 0) + count
+
+        for gap in r['timestamp_gaps']:
+            total['max_timestamp_gap'] = max(total['max_timestamp_gap'],
+                gap['gap'])
+
+    return total
+
+
+
+def run(args=None):
+    import sys
+    from optparse import OptionParser
+
+    parser = OptionParser(usage='%prog [options] dump [dump ...]',
+        description='Decodes RTMP c array dumps or pcap files. A single dump '
+            'is written as XML, use --stats for JSON lines statistics.')
+
+    parser.add_option('-s', '--stats', dest='stats', action='store_true',
+        default=False, help='Write per dump statistics as JSON lines, this is '
+            'the default for more than one dump')
+    parser.add_option('-e', '--events', dest='events', metavar='DIR',
+        help='Write the messages of each dump as JSON lines to DIR')
+    parser.add_option('-p', '--processes', dest='processes', type='int',
+        help='Number of worker processes [default: number of CPUs]')
+    parser.add_option('--port', dest='port', type='int', default=RTMP_PORT,
+        help='RTMP server port in pcap files [default: %default]')
+
+    options, filenames = parser.parse_args(args)
+
+    if not filenames:
+        parser.error('No dump files specified')
+
+    if len(filenames) == 1 and not (options.stats or options.events):
+        observer = XMLObserver(sys.stdout)
+
+        f = open(filenames[0], 'rb')
+
+        try:
+            try:
+                parse_file(f, observer, options.port)
+            except MissingDataError:
+                print('Dump file is corrupt - missing data?')
+                raise SystemExit(1)
+        finally:
+            f.close()
+
+        return
+
+    if options.events and not os.path.isdir(options.events):
+        os.makedirs(options.events)
+
+    results = []
+
+    for result in analyze(filenames, options.processes, options.events,
+            options.port):
+        results.append(result)
+
+        sys.stdout.write(json.dumps(result, sort_keys=True) + '\n')
+        sys.stdout.flush()
+
+    sys.stdout.write(json.dumps({'total': aggregate(results)},
+        sort_keys=True) + '\n')
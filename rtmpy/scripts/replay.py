@@ -0,0 +1,332 @@
+# Copyright the RTMPy Project
+#
+# RTMPy is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# RTMPy is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with RTMPy.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Replays a recording made by L{rtmpy.protocol.recorder} into a real
+L{server.ServerProtocol}.
+
+The inbound bytes of the recording are fed into the protocol through a fake
+transport, either as fast as possible or at the recorded pacing. Anything the
+server writes is counted and thrown away. This makes it possible to reproduce
+(and profile) performance problems seen in production without the network or
+the original client.
+
+@since: 0.2
+"""
+
+import sys
+import time
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from twisted.internet import address, defer, error
+from twisted.python import usage, log, failure, reflect
+
+from rtmpy import server
+from rtmpy.protocol import handshake, recorder
+from rtmpy.scripts.loadgen import cpu_time
+
+
+__all__ = ['ReplayFactory', 'replay', 'main']
+
+
+
+class ReplayTransport(object):
+    """
+    A transport that counts and discards everything written to it.
+    """
+
+    disconnecting = False
+
+
+    def __init__(self):
+        self.bytesWritten = 0
+        self.address = address.IPv4Address('TCP', '127.0.0.1', 0)
+
+
+    def write(self, data):
+        self.bytesWritten += len(data)
+
+
+    def writeSequence(self, seq):
+        for data in seq:
+            self.bytesWritten += len(data)
+
+
+    def loseConnection(self):
+        self.disconnecting = True
+
+
+    def getPeer(self):
+        return self.address
+
+
+    def getHost(self):
+        return self.address
+
+
+
+class ReplayNegotiator(handshake.ServerNegotiator):
+    """
+    The recorded client acknowledges the syn of the original server, which
+    cannot match the random payload generated for the replay. The ack is
+    accepted without verification.
+    """
+
+
+    def ackReceived(self):
+        """
+        """
+
+
+
+class ReplayFactory(server.ServerFactory):
+    """
+    A server factory that creates an application for any name the recorded
+    client connects to.
+
+    @ivar applicationClass: Called to create a new application.
+    """
+
+    handshake = ReplayNegotiator
+
+
+    def __init__(self, applicationClass=server.Application, applications=None):
+        server.ServerFactory.__init__(self, applications)
+
+        self.applicationClass = applicationClass
+
+
+    def getApplication(self, params, *args):
+        name = params['app']
+
+        self.registerApplication(name, self.applicationClass())
+
+        return self.applications.get(name, None)
+
+
+
+def replay(recording, factory=None, speed=None, reactor=None):
+    """
+    Replays the inbound data of C{recording} into a new server protocol.
+
+    @param recording: The recording to replay.
+    @type recording: L{recorder.RecordingReader}
+    @param factory: The L{server.ServerFactory} used to build the protocol.
+        Defaults to a L{ReplayFactory}.
+    @param speed: C{None} to replay as fast as possible, otherwise the
+        recorded pacing is divided by this factor (C{1.0} is real time).
+    @return: A L{defer.Deferred} that fires with the report C{dict} once all
+        the data has been consumed by the server.
+    """
+    if not recording.complete:
+        raise ValueError('The recording was started in the %r state and does '
+            'not contain the entire session' % (recording.state,))
+
+    if reactor is None:
+        from twisted.internet import reactor
+
+    if factory is None:
+        factory = ReplayFactory()
+
+    inbound = []
+    recordedBytesOut = 0
+
+    for direction, timestamp, data in recording:
+        if direction == recorder.INBOUND:
+            inbound.append((timestamp, data))
+        else:
+            recordedBytesOut += len(data)
+
+    transport = ReplayTransport()
+    protocol = factory.buildProtocol(transport.getPeer())
+
+    d = defer.Deferred()
+    state = {'bytes': 0, 'chunks': 0}
+
+    def feed(data):
+        if transport.disconnecting:
+            return
+
+        state['bytes'] += len(data)
+        state['chunks'] += 1
+
+        try:
+            protocol.dataReceived(data)
+        except:
+            transport.loseConnection()
+
+            raise
+
+    def idle():
+        if transport.disconnecting:
+            return True
+
+        return not (getattr(protocol, 'decoder_task', None) or
+            getattr(protocol, 'encoder_task', None))
+
+    def wait_until_idle():
+        if not idle():
+            reactor.callLater(0, wait_until_idle)
+
+            return
+
+        elapsed = time.time() - started
+        cpu = cpu_time() - cpuStarted
+
+        try:
+            protocol.connectionLost(failure.Failure(error.ConnectionDone()))
+        except:
+            log.err()
+
+        d.callback({
+            'chunks': state['chunks'],
+            'bytes_in': state['bytes'],
+            'bytes_out': transport.bytesWritten,
+            'recorded_bytes_out': recordedBytesOut,
+            'recorded_duration': round(inbound and inbound[-1][0] or 0, 3),
+            'duration': round(elapsed, 3),
+            'cpu_seconds': round(cpu, 3),
+            'bytes_per_second': round(state['bytes'] / (elapsed or 1e-9), 2),
+            'disconnected': transport.disconnecting,
+        })
+
+    def feed_all():
+        try:
+            for timestamp, data in inbound:
+                feed(data)
+        except:
+            d.errback()
+        else:
+            wait_until_idle()
+
+    def feed_paced(i):
+        timestamp, data = inbound[i]
+
+        try:
+            feed(data)
+        except:
+            d.errback()
+
+            return
+
+        i += 1
+
+        if i == len(inbound):
+            wait_until_idle()
+
+            return
+
+        delay = inbound[i][0] / speed - (time.time() - started)
+        reactor.callLater(max(delay, 0), feed_paced, i)
+
+    started = time.time()
+    cpuStarted = cpu_time()
+
+    protocol.makeConnection(transport)
+
+    if not inbound:
+        wait_until_idle()
+    elif speed is None:
+        feed_all()
+    else:
+        reactor.callLater(inbound[0][0] / speed, feed_paced, 0)
+
+    return d
+
+
+
+class Options(usage.Options):
+    """
+    Command line options for C{rtmpy-replay}.
+    """
+
+    synopsis = 'Usage: rtmpy-replay [options] recording'
+
+    optParameters = [
+        ['speed', 's', None, 'Replay at the recorded pacing multiplied by '
+            'this factor. The default is as fast as possible', float],
+        ['app', 'a', None, 'Fully qualified name of the application class '
+            'to replay against'],
+        ['output', 'o', None, 'Write the JSON report to this file'],
+    ]
+
+
+    def parseArgs(self, filename):
+        self['recording'] = filename
+
+
+
+def main(args=None):
+    """
+    Entry point for C{rtmpy-replay}.
+    """
+    from twisted.internet import reactor
+
+    config = Options()
+
+    try:
+        config.parseOptions(args)
+    except usage.UsageError, e:
+        print >> sys.stderr, '%s\n%s' % (config, e)
+
+        raise SystemExit(1)
+
+    if config['app']:
+        factory = ReplayFactory(reflect.namedAny(config['app']))
+    else:
+        factory = ReplayFactory()
+
+    fp = open(config['recording'], 'rb')
+
+    try:
+        recording = recorder.RecordingReader(fp)
+    except recorder.RecordingError, e:
+        print >> sys.stderr, '%s: %s' % (config['recording'], e)
+
+        raise SystemExit(1)
+
+    def write_report(report):
+        output = json.dumps(report, indent=2, sort_keys=True)
+
+        if config['output']:
+            out = open(config['output'], 'wt')
+
+            try:
+                out.write(output + '\n')
+            finally:
+                out.close()
+        else:
+            print output
+
+    def stop(result):
+        fp.close()
+        reactor.stop()
+
+        return result
+
+    def start():
+        d = defer.maybeDeferred(replay, recording, factory, config['speed'],
+            reactor)
+
+        d.addCallback(write_report)
+        d.addErrback(log.err)
+        d.addBoth(stop)
+
+    reactor.callWhenRunning(start)
+    reactor.run()
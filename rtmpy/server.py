@@ -16,19 +16,32 @@
 """
 Server implementation.
 """
+import os.path
 import urlparse
 
+try:
+    from hashlib import sha1
+except ImportError:
+    # support for Python2.4
+    from sha import new as sha1
+
 from zope.interface import Interface, Attribute, implements
-from twisted.internet import protocol, defer
+from twisted.internet import protocol, defer, task
 from twisted.python import failure, log
+from pyamf.util import BufferedByteStream
 import pyamf
 
-from rtmpy import util, exc, versions
+from rtmpy import util, exc, versions, timers, shaping, bwcheck, executor
+from rtmpy import sharedobject, flv
 from rtmpy import message, rpc, status, core
 from rtmpy.protocol import rtmp, handshake, version
 from rtmpy.status import codes
 
 
+#: FLV video frame type of a keyframe (the upper 4 bits of the first byte).
+KEYFRAME = 1
+
+
 class IApplication(Interface):
     """
     An application provides business logic for connected clients and streams.
@@ -190,15 +203,83 @@ class Client(object):
 
     @param nc: The L{ServerProtocol} instance.
     @param id: The application provided unique id for this client.
+    @ivar bandwidth: The last L{bwcheck.Result} measured for this client, or
+        C{None}.
     """
 
     def __init__(self, nc):
         self.nc = nc
         self.id = None
 
+        self.bandwidth = None
+        self._bandwidthWaiters = None
+
     def call(self, name, *args, **kwargs):
         return self.nc.call(name, *args, **kwargs)
 
+    def _getPinger(self):
+        return getattr(getattr(self.nc, 'protocol', None), 'pinger', None)
+
+    @property
+    def rtt(self):
+        """
+        The smoothed round trip time to the peer in seconds, or C{None} if it
+        is not being measured (see L{ServerFactory.pingInterval}).
+        """
+        return getattr(self._getPinger(), 'srtt', None)
+
+    @property
+    def jitter(self):
+        """
+        The variation of the round trip time in seconds, or C{None}.
+        """
+        return getattr(self._getPinger(), 'jitter', None)
+
+    def measureBandwidth(self, maxAge=None):
+        """
+        Measures the bandwidth to the peer, see L{bwcheck.BandwidthCheck}.
+        Concurrent calls share the same check.
+
+        @param maxAge: Seconds for which the last result is reused instead of
+            measuring again. C{None} always measures.
+        @return: A L{defer.Deferred} that fires with a L{bwcheck.Result}.
+        """
+        protocol = self.nc.protocol
+        wheel = protocol.getTimerWheel()
+
+        if self._bandwidthWaiters is None and maxAge is not None and \
+                self.bandwidth is not None and \
+                wheel.reactor.seconds() - self.bandwidth.measuredAt < maxAge:
+            return defer.succeed(self.bandwidth)
+
+        d = defer.Deferred()
+
+        if self._bandwidthWaiters is not None:
+            self._bandwidthWaiters.append(d)
+
+            return d
+
+        waiters = self._bandwidthWaiters = [d]
+
+        def done(result):
+            self._bandwidthWaiters = None
+
+            if isinstance(result, failure.Failure):
+                for w in waiters:
+                    w.errback(result)
+
+                return
+
+            self.bandwidth = result
+
+            for w in waiters:
+                w.callback(result)
+
+        check = bwcheck.BandwidthCheck(self.nc, wheel, protocol.pinger)
+        check.start().addBoth(done)
+
+        return d
+
 
 
 class NetStream(core.NetStream):
@@ -215,14 +296,34 @@ class NetStream(core.NetStream):
         receive the audio/video/meta data events from the peer. See
         L{StreamPublisher} for now.
     @type publisher: L{IPublishingStream}
+    @ivar droppedFrames: Audio/video frames not sent to the peer because it
+        was not acknowledging the data fast enough.
+    @ivar aggregateSize: Bytes of audio/video to bundle into one
+        L{message.Aggregate} when playing, C{0} sends each frame on its own.
+        Set from the factory when the stream starts playing.
+    @ivar aggregateDuration: Milliseconds of audio/video after which an
+        aggregate is sent, even if it is smaller than C{aggregateSize}.
+    @ivar source: When playing, the L{StreamPublisher} or L{flv.FLVPlayer}
+        that sends the audio/video to this stream.
     """
 
+    aggregateSize = 0
+    aggregateDuration = 250
+
     def __init__(self, nc, streamId):
         core.NetStream.__init__(self, nc, streamId)
 
         self.state = None
         self.name = None
         self.publisher = None
+        self.source = None
+
+        self.droppedFrames = 0
+        self._waitForKeyframe = False
+
+        self._aggregate = None
+        self._aggregateBytes = 0
+        self._chunkCache = None
 
     def publishingStarted(self, publisher, name):
         """
@@ -259,7 +360,9 @@ class NetStream(core.NetStream):
             s = None
 
             if isinstance(result, failure.Failure):
-                code = getattr(result.value, 'code', 'NetConnection.Call.Failed')
+                code = getattr(result.value, 'code', None) or \
+                    exc.codeByClass(result.value.__class__) or \
+                    'NetConnection.Call.Failed'
                 description = util.getFailureMessage(result) or 'Internal Server Error'
 
                 s = status.error(code, description)
@@ -294,6 +397,13 @@ class NetStream(core.NetStream):
                 return res
 
             d.addBoth(send_status)
+        elif self.state == 'playing' and self.source is not None:
+            try:
+                self.source.removeSubscriber(self)
+            except:
+                log.err()
+
+            self.source = None
 
         def clear_state(res):
             self.state = None
@@ -309,8 +419,41 @@ class NetStream(core.NetStream):
         Called when the producer stream has gone away. Perform clean up here.
         """
         # todo inform the nc that the stream went away
+        self.source = None
+        self.flushAggregate()
         self.sendStatus('NetStream.Play.UnpublishNotify')
 
+    def playComplete(self):
+        """
+        Called when a file being played has been sent to the peer.
+        """
+        self.flushAggregate()
+        self.sendStatus(codes.NS_PLAY_STOP,
+            description='Stopped playing %s' % (self.name,),
+            clientid=self.nc.clientId)
+
+    @rpc.expose
+    def seek(self, offset):
+        """
+        Called by the peer to carry on playing a file from C{offset}
+        milliseconds. Playback starts from the keyframe at or before
+        C{offset}.
+        """
+        seek = getattr(self.source, 'seek', None)
+
+        if self.state != 'playing' or seek is None:
+            self.sendStatus(status.error(codes.NS_SEEK_FAILED,
+                'Seeking is not supported by %s' % (self.name,)))
+
+            return
+
+        self.flushAggregate()
+        seek(int(offset))
+
+        self.sendStatus(codes.NS_SEEK_NOTIFY,
+            description='Seeking %d (stream ID: %d).' % (offset, self.streamId),
+            clientid=self.nc.clientId)
+
     def onVideoData(self, data, timestamp):
         """
         Called when a video packet has been received from the peer.
@@ -385,7 +528,21 @@ class NetStream(core.NetStream):
             self._videoChannel = self.nc.getStreamingChannel(self)
             self._videoChannel.setType(message.VIDEO_DATA)
 
+            f = getattr(self.nc.protocol, 'factory', None)
+
+            if f is not None:
+                self.aggregateSize = f.aggregateSize
+                self.aggregateDuration = f.aggregateDuration
+
+            if self.aggregateSize:
+                self._aggregateChannel = self.nc.getStreamingChannel(self)
+                self._aggregateChannel.setType(message.AGGREGATE)
+                self._aggregate = message.Aggregate()
+
             self.state = 'playing'
+            self.name = name
+            self.source = res
+            self._chunkCache = getattr(res, 'cache', None)
 
             # wtf
             self.sendMessage(message.ControlMessage(4, 1))
@@ -404,7 +561,8 @@ class NetStream(core.NetStream):
             return res
 
         def eb(fail):
-            code = getattr(fail.value, 'code', 'NetStream.Play.Failed')
+            code = getattr(fail.value, 'code', None) or \
+                exc.codeByClass(fail.value.__class__) or codes.NS_PLAY_FAILED
             description = util.getFailureMessage(fail) or 'Internal Server Error'
 
             self.sendStatus(status.error(code, description))
@@ -423,26 +581,118 @@ class NetStream(core.NetStream):
         """
         self.call('onMetaData', data)
 
-    def videoDataReceived(self, data, timestamp):
+    def _isBehind(self, encoder, data):
+        """
+        Whether a frame must be dropped because the peer is not keeping up or
+        the bandwidth budget of the connection is spent.
+        """
+        if encoder.congested:
+            return True
+
+        if encoder.throttled:
+            encoder.shaper.drop(len(data))
+
+            return True
+
+        return False
+
+    def videoDataReceived(self, data, timestamp, key=None):
+        """
+        @param key: Identifies C{data} in the L{flv.ChunkCache} of the source,
+            if it has one.
+        """
         if not self._firstPacketReceived:
             # set the framesize
             self.nc.protocol.setFrameSize(len(data))
             self._firstPacketReceived = True
 
-        self._videoChannel.sendData(data, timestamp)
+        if self._isBehind(self._videoChannel.encoder, data):
+            # skip to the next keyframe once the peer has caught up.
+            self.droppedFrames += 1
+            self._waitForKeyframe = True
 
-    def audioDataReceived(self, data, timestamp):
-        self._audioChannel.sendData(data, timestamp)
+            return
+
+        if self._waitForKeyframe:
+            if not data or ord(data[0]) >> 4 != KEYFRAME:
+                self.droppedFrames += 1
+
+                return
+
+            self._waitForKeyframe = False
+
+        self._sendData(self._videoChannel, message.VIDEO_DATA, data, timestamp,
+            key)
+
+    def audioDataReceived(self, data, timestamp, key=None):
+        if self._isBehind(self._audioChannel.encoder, data):
+            self.droppedFrames += 1
+
+            return
+
+        self._sendData(self._audioChannel, message.AUDIO_DATA, data, timestamp,
+            key)
+
+    def _sendData(self, channel, datatype, data, timestamp, key=None):
+        """
+        Sends a frame to the peer on C{channel}, or adds it to the aggregate
+        if aggregation is enabled.
+        """
+        aggregate = self._aggregate
+
+        if aggregate is None:
+            if key is None or self._chunkCache is None:
+                channel.sendData(data, timestamp)
+            else:
+                channel.sendFrames(self._chunkCache.getFrames(key, data,
+                    channel), len(data), timestamp)
+
+            return
+
+        # the tag timestamps must not go backwards within an aggregate
+        if aggregate.tags and timestamp < aggregate.tags[-1][1]:
+            self.flushAggregate()
+
+        aggregate.addTag(datatype, timestamp, data)
+        self._aggregateBytes += len(data) + 15
+
+        if self._aggregateBytes >= self.aggregateSize or \
+                timestamp - aggregate.tags[0][1] >= self.aggregateDuration:
+            self.flushAggregate()
+
+    def flushAggregate(self):
+        """
+        Sends the frames gathered for the aggregate, if any.
+        """
+        aggregate = self._aggregate
+
+        if aggregate is None or not aggregate.tags:
+            return
+
+        buf = BufferedByteStream()
+        aggregate.encode(buf)
+
+        self._aggregateChannel.sendData(buf.getvalue(), aggregate.tags[0][1])
+
+        aggregate.tags = []
+        self._aggregateBytes = 0
 
 
 
 class NetConnection(core.NetConnection):
     """
     Server side NetConnection implementation.
+
+    @ivar _clientTable: A C{dict} of name -> callable, resolved against
+        C{_tableClient}. See L{getCallable}.
+    @ivar _sharedObjectEvents: A L{defer.Deferred} that fires when the shared
+        object messages received so far have been applied.
     """
 
     objectEncoding = pyamf.AMF0
 
+    _tableClient = None
+
     def __init__(self, protocol):
         core.NetConnection.__init__(self, protocol)
 
@@ -450,6 +700,9 @@ class NetConnection(core.NetConnection):
         self.application = None
         self.clientId = None
 
+        self._clientTable = {}
+        self._sharedObjectEvents = defer.succeed(None)
+
 
     def buildStream(self, streamId):
         """
@@ -464,16 +717,37 @@ class NetConnection(core.NetConnection):
 
         @param stream: The L{NetStream} instance requesting the publication.
         @param streamName: The name of the stream to be published.
-        @param type_: Not quite sure of the significance of this yet - valid
-            values appear to be 'live', 'append', 'record'.
+        @param type_: C{live}, C{record} or C{append}, see
+            L{Application.publishStream}.
         """
         streamName = util.ParamedString(streamName)
 
         if not self.connected:
             raise exc.ConnectError('Cannot publish stream - not connected')
 
-        d = defer.maybeDeferred(self.application.publishStream,
-            self.client, stream, streamName, type_)
+        f = self.protocol.factory
+
+        d = f.checkLoad(f.publishLagThreshold, exc.StreamError)
+
+        def authorize(_):
+            app = self.application
+            func = getattr(app, 'authorizePublish', None)
+
+            if func is None:
+                return
+
+            key = None
+
+            if getattr(app, 'authCache', None) is not None:
+                key = app.getPublishKey(self.client, streamName)
+
+            return self._authorize(key, exc.PublishError,
+                'Not authorized to publish %s' % (streamName,), func,
+                self.client, streamName)
+
+        d.addCallback(authorize)
+        d.addCallback(lambda _: self.application.publishStream(
+            self.client, stream, streamName, type_))
 
         def cb(publisher):
             """
@@ -483,9 +757,11 @@ class NetConnection(core.NetConnection):
             """
             stream.publishingStarted(publisher, streamName)
             publisher.start()
-            self.application.onPublish(self.client, stream)
 
-            return publisher
+            d = defer.maybeDeferred(self.application.onPublish, self.client,
+                stream)
+
+            return d.addCallback(lambda _: publisher)
 
         d.addCallback(cb)
 
@@ -514,6 +790,33 @@ class NetConnection(core.NetConnection):
         """
 
 
+    @rpc.expose
+    def checkBandwidth(self, *args):
+        """
+        Called by players to measure their bandwidth. The result is sent with
+        C{onBWDone(kbps, kbytes, milliseconds, latency)}, see
+        L{Client.measureBandwidth}.
+        """
+        f = self.protocol.factory
+
+        if not f.bandwidthCheck:
+            raise exc.CallFailed('Bandwidth check is not enabled')
+
+        if not self.connected:
+            raise exc.CallFailed('Cannot check bandwidth - not connected')
+
+        def cb(result):
+            self.call('onBWDone', int(result.kbps), result.bytes // 1024,
+                int(result.duration * 1000), int(result.latency * 1000))
+
+        def eb(fail):
+            log.msg('Bandwidth check failed for %r: %s' % (self.client,
+                fail.getErrorMessage()))
+
+        d = self.client.measureBandwidth(f.bandwidthCacheTime)
+        d.addCallbacks(cb, eb)
+
+
     def closeStream(self):
         """
         Called when the stream is asked to close itself.
@@ -528,6 +831,7 @@ class NetConnection(core.NetConnection):
     def playStream(self, name, subscriber, *args):
         """
         """
+        f = self.protocol.factory
         d = defer.Deferred()
 
         def whenPublished(publisher):
@@ -535,36 +839,67 @@ class NetConnection(core.NetConnection):
 
             return publisher
 
-        self.application.whenPublished(name, d.callback)
+        def vod(player):
+            if player is None:
+                self.application.whenPublished(name, d.callback)
+            else:
+                d.callback(player)
+
+        def subscribe(result):
+            app = self.application
+
+            # published streams win over files of the same name
+            if app.vodPath is None or name in app.streams:
+                app.whenPublished(name, d.callback)
+
+                return
+
+            app.openVOD(name).addCallbacks(vod, d.errback)
+
+        check = f.checkLoad(f.playLagThreshold, exc.PlayFailed)
+        check.addCallbacks(subscribe, d.errback)
 
         d.addCallback(whenPublished)
 
         return d
 
 
-    def callExposedMethod(self, name, *args):
+    def getCallable(self, name):
         """
         Used to match a callable based on the supplied name when a notify or
-        invoke is encountered. Returns C{None} if not found.
+        invoke is encountered.
 
-        If no match is found from the superclass, the C{client} and then the
-        C{application} are checked in that order.
+        The C{client} is checked before the methods exposed by the connection.
+        All methods on a client are considered B{public} and accessible by the
+        peer.
 
-        All methods on a client/application is considered B{public} and
-        accessible by the peer.
+        Matches are remembered per name until the client changes, so a method
+        added to the client after it has been called by that name is not seen.
 
-        @see: L{rtmp.RTMPProtocol.getInvokableTarget}
+        @raise exc.CallFailed: No match was found.
         """
-        # all client methods are publicly accessible
         client = getattr(self, 'client', None)
 
+        if client is not self._tableClient:
+            self._tableClient = client
+            self._clientTable = {}
+
+        try:
+            return self._clientTable[name]
+        except KeyError:
+            pass
+
+        target = None
+
         if client:
             target = util.get_callable_target(client, name)
 
-            if target:
-                return defer.maybeDeferred(target, *args)
+        if target is None:
+            target = core.NetConnection.getCallable(self, name)
+
+        self._clientTable[name] = target
 
-        return core.NetConnection.callExposedMethod(self, name, *args)
+        return target
 
 
     @rpc.expose('connect')
@@ -597,6 +932,18 @@ class NetConnection(core.NetConnection):
             self.sendMessage(message.DownstreamBandwidth(f.downstreamBandwidth))
             self.sendMessage(message.UpstreamBandwidth(f.upstreamBandwidth, 2))
 
+            e = self.protocol.encoder
+
+            if f.maxUnacknowledgedWindows:
+                e.setAckWindow(f.downstreamBandwidth,
+                    f.maxUnacknowledgedWindows)
+
+            if e.shaper is not None:
+                bucket = f.getApplicationBucket(self.application.name)
+
+                if bucket is not None:
+                    e.shaper.addBucket(bucket)
+
             return res
 
         def return_success(res):
@@ -631,10 +978,30 @@ class NetConnection(core.NetConnection):
 
 
         def chain_errback(f):
-            self._pendingConnection.errback(f)
+            if not self._pendingConnection.called:
+                self._pendingConnection.errback(f)
+
+        def timed_out():
+            chain_errback(failure.Failure(
+                exc.ConnectFailed('Connection timed out')))
+
+            # the application may still be deciding, its answer is ignored
+            d.cancel()
 
         self._pendingConnection = defer.Deferred()
 
+        f = self.protocol.factory
+
+        if f.connectTimeout is not None:
+            timer = f.getTimerWheel().schedule(f.connectTimeout, timed_out)
+
+            def cancel_timeout(result):
+                timer.cancel()
+
+                return result
+
+            self._pendingConnection.addBoth(cancel_timeout)
+
         self._pendingConnection.addCallbacks(return_success, eb)
 
         d = defer.maybeDeferred(self._onConnect, params, *args)
@@ -642,7 +1009,6 @@ class NetConnection(core.NetConnection):
         d.addCallback(connection_accepted)
         d.addErrback(chain_errback)
 
-        # todo: timeout for connection
         return self._pendingConnection
 
     def _onConnect(self, params, *args):
@@ -660,27 +1026,88 @@ class NetConnection(core.NetConnection):
             # request.
             raise exc.ConnectFailed('Already connected.')
 
+        f = self.protocol.factory
+
+        d = f.checkLoad(f.connectLagThreshold, exc.ConnectRejected)
+
+        return d.addCallback(lambda _: self._connectApplication(params, *args))
+
+    def _connectApplication(self, params, *args):
+        """
+        Finds the application and asks it to accept the connection.
+        """
         self.application = self.protocol.factory.getApplicationWithDefault(params, *args)
 
         self.client = self.application.buildClient(self, params, *args)
 
         def cb(res):
             """
-            Called with the result of the connection attempt, either C{True} or
-            C{False}.
+            Called when the application has accepted the connection attempt.
             """
-            if res is False:
-                raise exc.ConnectRejected('Authorization is required')
+            pending = getattr(self, '_pendingConnection', None)
+
+            if pending is not None and pending.called:
+                # timed out, the connection has been rejected already
+                raise exc.ConnectFailed('Connection timed out')
 
             self.application.acceptConnection(self.client)
             self.application.onConnectAccept(self.client, *args)
 
-        d = defer.maybeDeferred(self.application.onConnect, self.client, *args)
+        key = None
+
+        if getattr(self.application, 'authCache', None) is not None:
+            key = self.application.getConnectKey(self.client, params, *args)
+
+        d = self._authorize(key, exc.ConnectRejected,
+            'Authorization is required', self.application.onConnect,
+            self.client, *args)
 
         d.addCallback(cb)
 
         return d
 
+    def _authorize(self, key, rejected, reason, func, *args):
+        """
+        Asks C{func} to authorize a request, unless the decision for C{key} is
+        in the C{authCache} of the application.
+
+        @param key: The cache key or C{None} to bypass the cache.
+        @param rejected: The exception class raised when C{func} returns
+            C{False}. Only rejections of this class are cached.
+        @return: A L{defer.Deferred} that fires with C{True}.
+        """
+        cache = getattr(self.application, 'authCache', None)
+
+        if key is not None:
+            decision = cache.get(key)
+
+            if decision is True:
+                return defer.succeed(True)
+
+            if decision is not None:
+                return defer.fail(decision)
+
+        def cb(result):
+            if result is False:
+                raise rejected(reason)
+
+            return True
+
+        def store(result):
+            if not isinstance(result, failure.Failure):
+                cache.set(key, True)
+            elif result.check(rejected):
+                cache.set(key, result.value)
+
+            return result
+
+        d = defer.maybeDeferred(func, *args).addCallback(cb)
+
+        if key is not None:
+            d.addBoth(store)
+
+        return d
+
     def sendMessage(self, msg, stream=None, whenDone=None):
         """
         """
@@ -691,6 +1118,91 @@ class NetConnection(core.NetConnection):
         return self.protocol.getStreamingChannel(stream)
 
 
+    def onSharedObject(self, msg, timestamp):
+        """
+        Applies the events of a shared object message from the peer to the
+        shared objects of the application.
+        """
+        if not self.connected or self.application is None:
+            return
+
+        # the messages wait for the shared objects used before them to load
+        d = self._sharedObjectEvents.addCallback(
+            lambda _: self._applySharedObjectEvents(msg, msg.events))
+
+        d.addErrback(log.err)
+
+
+    def _applySharedObjectEvents(self, msg, events):
+        if not self.connected:
+            return
+
+        store = self.application.getSharedObjectStore()
+
+        for i, (type_, value) in enumerate(events):
+            if type_ == msg.USE:
+                d = self._useSharedObject(store, msg)
+
+                return d.addCallback(lambda _: self._applySharedObjectEvents(
+                    msg, events[i + 1:]))
+
+            if type_ == msg.RELEASE:
+                store.release(self, msg.name)
+
+                continue
+
+            so = store.sharedObjects.get(msg.name, None)
+
+            if so is None or self not in so.subscribers:
+                continue
+
+            if type_ == msg.REQUEST_CHANGE:
+                so.setAttribute(value[0], value[1], self)
+            elif type_ == msg.REQUEST_REMOVE:
+                so.removeAttribute(value, self)
+            elif type_ == msg.SEND_MESSAGE:
+                so.sendMessage(*value)
+
+
+    def _useSharedObject(self, store, msg):
+        """
+        Subscribes to the shared object of C{msg} if the application allows
+        it, see L{IApplication.authorizeSharedObject}. The peer is sent a
+        C{STATUS} event if it does not.
+        """
+        func = getattr(self.application, 'authorizeSharedObject', None)
+
+        if func is None:
+            d = defer.succeed(None)
+        else:
+            d = defer.maybeDeferred(func, self.client, msg.name,
+                msg.persistent)
+
+        def use(allowed):
+            if allowed is False:
+                raise exc.SharedObjectError('Not authorized to use %s' % (
+                    msg.name,))
+
+            return store.use(self, msg.name, msg.persistent)
+
+        def eb(fail):
+            if not fail.check(exc.SharedObjectError):
+                log.err(fail, 'Failed to use shared object %r' % (msg.name,))
+
+            if not self.connected:
+                return
+
+            if self.objectEncoding == pyamf.AMF3:
+                klass = message.FlexSharedObjectMessage
+            else:
+                klass = message.SharedObjectMessage
+
+            self.sendMessage(klass(msg.name, 0, msg.persistent,
+                [(msg.STATUS, (codes.SO_CREATION_FAILED, 'error'))]))
+
+        return d.addCallback(use).addErrback(eb)
+
+
 
 class ServerProtocol(rtmp.RTMPProtocol):
     """
@@ -704,6 +1216,18 @@ class ServerProtocol(rtmp.RTMPProtocol):
     def buildStreamManager(self):
         return self.nc
 
+    def connectionMade(self):
+        f = getattr(self, 'factory', None)
+
+        if f is not None:
+            self.handshakeTimeout = f.handshakeTimeout
+            self.idleTimeout = f.idleTimeout
+            self.pingInterval = f.pingInterval
+            self.pingTimeout = f.pingTimeout
+            self.timerWheel = f.timerWheel
+
+        rtmp.RTMPProtocol.connectionMade(self)
+
     def versionSuccess(self):
         self.transport.write('\x03')
 
@@ -714,8 +1238,17 @@ class ServerProtocol(rtmp.RTMPProtocol):
         """
         self.nc = self.netconnection(self)
 
+        f = getattr(self, 'factory', None)
+
+        if f is not None:
+            self.nc.callTimeout = f.callTimeout
+            self.nc.timerWheel = f.timerWheel
+
         rtmp.RTMPProtocol.startStreaming(self)
 
+        if f is not None:
+            self.encoder.shaper = f.buildShaper()
+
 
     def onConnect(self, params, *args):
         return self.nc.onConnect(params, *args)
@@ -749,14 +1282,12 @@ class ServerProtocol(rtmp.RTMPProtocol):
         self.nc.onNotify(name, args, timestamp)
 
 
-    def onControlMessage(self, *args):
+    def onSharedObject(self, msg, timestamp):
         """
         """
+        self.nc.onSharedObject(msg, timestamp)
 
 
-    def onBytesRead(self, *args):
-        """
-        """
 
 
 
@@ -809,7 +1340,7 @@ class StreamPublisher(object):
         """
         Removes the subscriber from this publisher.
         """
-        self.subscribers.pop(subscriber)
+        self.subscribers.pop(subscriber, None)
 
     # events called by the stream
 
@@ -882,20 +1413,196 @@ class StreamPublisher(object):
         self.subscribers = {}
 
 
+def blocking(func):
+    """
+    A decorator for L{Application} callbacks that block, for example on a
+    database lookup::
+
+        class MyApp(server.Application):
+            @server.blocking
+            def onConnect(self, client, *args):
+                return db.authorise(client.params['token'])
+
+    The callback runs in the thread pool of the application (see
+    L{Application.getExecutor}) and returns a L{defer.Deferred} instead. It
+    must not call any Twisted API, including sending to the client.
+    """
+    def wrapper(self, *args, **kwargs):
+        return self.getExecutor().submit(func, self, *args, **kwargs)
+
+    wrapper.__name__ = func.__name__
+    wrapper.__doc__ = func.__doc__
+    wrapper.blocking = True
+
+    return wrapper
+
+
 class Application(object):
     """
     The business logic behind
+
+    @ivar blockingThreads: The most L{blocking} callbacks of this application
+        that run at the same time.
+    @ivar blockingQueue: The most L{blocking} callbacks waiting for a thread,
+        more fail with L{exc.ExecutorBusy}.
+    @ivar executor: The L{executor.ThreadExecutor} for the L{blocking}
+        callbacks, built on first use.
+    @ivar authCache: An optional L{authcache.AuthorizationCache} for the
+        decisions of L{onConnect} and L{authorizePublish}. A cached decision
+        skips the callback, so it must not have other side effects.
+    @ivar authCacheParams: The connect params that are part of the cache key.
+    @ivar authCacheQueryArgs: The query args of the C{tcUrl}, C{app} and
+        stream name (see L{util.ParamedString}) that are part of the cache key,
+        e.g. an auth token.
+    @ivar authCacheByIP: Whether the client ip is part of the cache key.
+    @ivar sharedObjectPath: The directory that persistent shared objects are
+        saved to, C{None} keeps them in memory only.
+    @ivar maxPersistentSharedObjects: The most persistent shared objects that
+        clients can create. C{None} is unlimited.
+    @ivar sharedObjects: The L{sharedobject.SharedObjectStore}, built on first
+        use.
+    @ivar recordPath: The directory that streams published with the type
+        C{record} or C{append} are written to, as C{<name>.flv}. C{None}
+        publishes them live only.
+    @ivar recordBlockSize: Bytes of each recording to buffer in memory
+        between writes.
+    @ivar vodPath: The directory of the FLV files that are played when no
+        stream of the same name is published, as C{<name>.flv}. C{None}
+        plays published streams only.
+    @ivar vodBurst: Seconds of a file sent as fast as possible when it
+        starts playing (or seeks), the rest is sent in real time.
+    @ivar vodCacheSize: Bytes of the files played to keep split into RTMP
+        frames, see L{flv.ChunkCache}. C{0} splits the tags for every viewer.
+    @ivar chunkCache: The L{flv.ChunkCache}, built on first use.
     """
 
     implements(IApplication)
 
     client = Client
 
+    blockingThreads = 4
+    blockingQueue = 64
+
+    executor = None
+
+    authCache = None
+    authCacheParams = ('tcUrl', 'app')
+    authCacheQueryArgs = ()
+    authCacheByIP = True
+
+    sharedObjectPath = None
+    maxPersistentSharedObjects = None
+    sharedObjects = None
+
+    recordPath = None
+    recordBlockSize = flv.FLVWriter.blockSize
+
+    vodPath = None
+    vodBurst = flv.FLVPlayer.burst
+    vodCacheSize = 0
+    chunkCache = None
+
     def __init__(self):
         self.clients = {}
         self.streams = {}
         self._streamingClients = {}
         self._pendingPublishedCallbacks = {}
+        # filename -> [flv.FLVFile, players]
+        self._vodFiles = {}
+
+
+    def getExecutor(self):
+        """
+        Returns the thread pool that runs the L{blocking} callbacks of this
+        application.
+        """
+        if self.executor is None:
+            self.executor = executor.ThreadExecutor(self.blockingThreads,
+                self.blockingQueue, 'application:%s' % (
+                    getattr(self, 'name', None),))
+
+        return self.executor
+
+
+    def getSharedObjectStore(self):
+        """
+        Returns the shared objects of this application.
+        """
+        if self.sharedObjects is None:
+            self.sharedObjects = sharedobject.SharedObjectStore(
+                self.sharedObjectPath,
+                maxPersistent=self.maxPersistentSharedObjects)
+
+        return self.sharedObjects
+
+
+    def _getQueryArgs(self, *names):
+        values = []
+
+        for name in names:
+            if not isinstance(name, util.ParamedString):
+                name = util.ParamedString(name or '')
+
+            query = name._query
+
+            for arg in self.authCacheQueryArgs:
+                values.append(tuple(query.get(arg, ())))
+
+        return values
+
+
+    def getConnectKey(self, client, params, *args):
+        """
+        Returns the L{authCache} key for the connect request of C{client}.
+
+        @param args: The extra connect arguments, where clients usually send
+            their credentials. They are part of the key as a digest of their
+            AMF0 encoding.
+        @return: The key or C{None} if C{args} cannot be encoded, the request
+            is not cached then.
+        """
+        key = ['connect']
+
+        if self.authCacheByIP:
+            key.append(getattr(client, 'ip', None))
+
+        key.extend([params.get(name, None) for name in self.authCacheParams])
+        key.extend(self._getQueryArgs(params.get('tcUrl', None),
+            params.get('app', None)))
+
+        if args:
+            encoder = pyamf.get_encoder(pyamf.AMF0)
+
+            try:
+                for arg in args:
+                    encoder.writeElement(arg)
+            except Exception:
+                return None
+
+            key.append(sha1(encoder.stream.getvalue()).digest())
+
+        return tuple(key)
+
+
+    def getPublishKey(self, client, name):
+        """
+        Returns the L{authCache} key for the request of C{client} to publish
+        C{name}.
+        """
+        key = ['publish']
+        uri = getattr(client, 'uri', None)
+
+        if self.authCacheByIP:
+            key.append(getattr(client, 'ip', None))
+
+        if not isinstance(name, util.ParamedString):
+            name = util.ParamedString(name)
+
+        key.append(uri)
+        key.append(unicode(name))
+        key.extend(self._getQueryArgs(uri, name))
+
+        return tuple(key)
 
 
     def startup(self):
@@ -931,6 +1638,58 @@ class Application(object):
         client.nc.protocol.transport.loseConnection()
 
 
+    def broadcast(self, name, *args, **kwargs):
+        """
+        Calls C{name} with C{args} on the connected clients. Like
+        L{Client.call}, no result is expected.
+
+        The message is encoded once and the same bytes are queued on every
+        connection. The sends are spread over several reactor iterations, so
+        a large audience does not stall the server.
+
+        @param filter: A callable that is passed each L{Client} and returns
+            whether the message should be sent to it. Optional.
+        @return: A L{defer.Deferred} that fires with the number of clients
+            that the message was sent to.
+        """
+        filter = kwargs.pop('filter', None)
+
+        if kwargs:
+            raise TypeError('Unexpected keyword arguments %r' % (
+                kwargs.keys(),))
+
+        msg = message.Invoke(name, rpc.NO_RESULT, None, *args)
+        buf = BufferedByteStream()
+
+        msg.encode(buf)
+
+        data = buf.getvalue()
+        datatype = msg.__data_type__
+        clients = self.clients.values()
+        sent = [0]
+
+        def send():
+            for client in clients:
+                nc = client.nc
+
+                # the client may have gone away since the broadcast started
+                if not nc.connected or client.id not in self.clients:
+                    continue
+
+                try:
+                    if filter is None or filter(client):
+                        nc.protocol.sendEncodedMessage(data, datatype, nc)
+                        sent[0] += 1
+                except Exception:
+                    log.err()
+
+                yield None
+
+        d = task.coiterate(send())
+
+        return d.addCallback(lambda _: sent[0])
+
+
     def _disconnect(self, client):
         """
         Removes the C{client} from this application.
@@ -941,7 +1700,7 @@ class Application(object):
             name = publisher.stream.name
 
             try:
-                self.unpublishStream(publisher, name)
+                self.unpublishStream(name, publisher.stream)
             except exc.BadNameError:
                 pass
             except:
@@ -949,15 +1708,16 @@ class Application(object):
 
             self.streams.pop(name, None)
 
+        if self.sharedObjects is not None:
+            self.sharedObjects.release(client.nc)
+
         c = self.clients.pop(client.id, None)
 
         if c is None:
             return
 
-        try:
-            self.onDisconnect(client)
-        except Exception:
-            log.err()
+        d = defer.maybeDeferred(self.onDisconnect, client)
+        d.addErrback(log.err)
 
 
     def buildClient(self, protocol, params, *args):
@@ -980,7 +1740,7 @@ class Application(object):
         c.application = self
 
         try:
-            c.ip = c.nc.transport.getPeer().host
+            c.ip = c.nc.protocol.transport.getPeer().host
         except AttributeError:
             c.ip = None
 
@@ -1047,7 +1807,8 @@ class Application(object):
         @param client: The L{Client} requesting the publishing the stream.
         @param stream: The L{NetStream} that will receive the a/v data.
         @param name: The name of the stream that will be published.
-        @param type_: Ignored for now.
+        @param type_: C{live}, or C{record}/C{append} to also write the
+            stream to a file, see L{startRecording}.
         """
         stream = self.streams.get(name, None)
 
@@ -1056,6 +1817,15 @@ class Application(object):
             stream = self.streams[name] = StreamPublisher(requestor, client)
             self._streamingClients[client] = stream
 
+            if type_ in ('record', 'append') and self.recordPath is not None:
+                try:
+                    self.startRecording(stream, name, type_ == 'append')
+                except:
+                    del self.streams[name]
+                    del self._streamingClients[client]
+
+                    raise
+
         if client.id != stream.client.id:
             raise exc.BadNameError("'%s' is already used" % (name,))
 
@@ -1064,6 +1834,114 @@ class Application(object):
         return stream
 
 
+    def _getFilename(self, path, name):
+        root = os.path.abspath(path)
+        filename = os.path.abspath(os.path.join(root, unicode(name) + '.flv'))
+
+        if not filename.startswith(root + os.sep):
+            raise exc.BadNameError('Invalid stream name %r' % (name,))
+
+        return filename
+
+
+    def getChunkCache(self):
+        """
+        Returns the cache of the tags of the files played by this
+        application, or C{None} if there is no C{vodCacheSize}.
+        """
+        if self.chunkCache is None and self.vodCacheSize:
+            self.chunkCache = flv.ChunkCache(self.vodCacheSize)
+
+        return self.chunkCache
+
+
+    def getRecordingFilename(self, name):
+        """
+        Returns the file that the stream C{name} is recorded to.
+
+        @raise exc.BadNameError: C{name} is outside of C{recordPath}.
+        """
+        return self._getFilename(self.recordPath, name)
+
+
+    def getVODFilename(self, name):
+        """
+        Returns the file that is played for the stream C{name}.
+
+        @raise exc.BadNameError: C{name} is outside of C{vodPath}.
+        """
+        return self._getFilename(self.vodPath, name)
+
+
+    def openVOD(self, name):
+        """
+        Opens the file for the stream C{name}. The players of a file share
+        one L{flv.FLVFile} (and so one mapping of the file and its index).
+
+        @return: A L{defer.Deferred} that fires with an L{flv.FLVPlayer} for
+            the file, or C{None} if there is no such file.
+        """
+        try:
+            filename = self.getVODFilename(name)
+        except exc.BadNameError:
+            return defer.fail()
+
+        entry = self._vodFiles.get(filename, None)
+
+        if entry is None:
+            if not os.path.isfile(filename):
+                return defer.succeed(None)
+
+            entry = self._vodFiles[filename] = [flv.FLVFile(filename), 0]
+
+        entry[1] += 1
+        vod = entry[0]
+
+        def opened(vod):
+            return flv.FLVPlayer(vod, self.vodBurst, self.releaseVOD,
+                cache=self.getChunkCache())
+
+        def failed(fail):
+            self.releaseVOD(vod)
+
+            return fail
+
+        return vod.open().addCallbacks(opened, failed)
+
+
+    def releaseVOD(self, vod):
+        """
+        Called when a player of the L{flv.FLVFile} C{vod} has stopped. The
+        file is closed with its last player.
+        """
+        entry = self._vodFiles.get(vod.filename, None)
+
+        if entry is None or entry[0] is not vod:
+            return
+
+        entry[1] -= 1
+
+        if entry[1] <= 0:
+            del self._vodFiles[vod.filename]
+            vod.close()
+
+
+    def startRecording(self, publisher, name, append=False):
+        """
+        Writes what C{publisher} publishes to L{getRecordingFilename}.
+
+        @return: The L{flv.FLVRecorder}.
+        """
+        writer = flv.FLVWriter(self.getRecordingFilename(name), append,
+            blockSize=self.recordBlockSize)
+        recorder = flv.FLVRecorder(writer)
+
+        recorder.start()
+        publisher.addSubscriber(recorder)
+
+        return recorder
+
+
     def unpublishStream(self, name, stream):
         try:
             source = self.streams[name]
@@ -1137,6 +2015,24 @@ class Application(object):
         @param args: The client supplied arguments to NetConnection.connect()
         """
 
+    def authorizePublish(self, client, name):
+        """
+        Called when a client asks to publish the stream C{name} (a
+        L{util.ParamedString}), before L{publishStream}. Return C{False} (or a
+        L{defer.Deferred} returning C{False}), or raise L{exc.PublishError},
+        to reject the request. The default is to allow it.
+
+        Unlike L{publishStream}, the decision may be kept in the L{authCache}.
+        """
+
+    def authorizeSharedObject(self, client, name, persistent):
+        """
+        Called when a client asks to use the shared object C{name}. Return
+        C{False} (or a L{defer.Deferred} returning C{False}), or raise
+        L{exc.SharedObjectError}, to reject the request. The default is to
+        allow it.
+        """
+
     def onPublish(self, client, stream):
         """
         Called when a client attempts to publish to a stream.
@@ -1174,15 +2070,164 @@ class ServerFactory(protocol.ServerFactory):
     downstreamBandwidth = 2500000L
     fmsVer = versions.FMS_MIN_H264
 
+    #: The number of acknowledgement windows (of C{downstreamBandwidth}
+    #: bytes) that can be sent to a peer before it must acknowledge them.
+    #: Subscribers drop frames while they are behind. C{None} disables flow
+    #: control.
+    maxUnacknowledgedWindows = None
+
+    #: An L{rtmpy.lag.LagMonitor}, started and stopped with the factory.
+    lagMonitor = None
+    #: Reactor lag (in seconds) above which new connections, plays and
+    #: publishes are turned away. C{None} never turns them away.
+    connectLagThreshold = None
+    playLagThreshold = None
+    publishLagThreshold = None
+    #: Seconds that a turned away request waits for the lag to recover
+    #: before it is rejected. C{0} rejects immediately.
+    lagWaitTimeout = 0
+
+    #: Timeouts in seconds, C{None} waits forever. See L{rtmp.StateEngine}
+    #: for the handshake and idle timeouts.
+    handshakeTimeout = None
+    connectTimeout = None
+    idleTimeout = None
+    #: Seconds to wait for the peer to answer an RPC call made by the server.
+    callTimeout = None
+    #: Seconds between pings to each peer, and to wait for the answer. See
+    #: L{rtmpy.protocol.ping.Pinger}.
+    pingInterval = None
+    pingTimeout = None
+    #: The L{rtmpy.timers.TimerWheel} for all the timeouts. The shared wheel
+    #: is used if this is C{None}.
+    timerWheel = None
+
+    #: Bytes per second that can be sent to each peer, to all the peers of an
+    #: application and to all the peers of this factory. C{None} is
+    #: unlimited. See L{rtmpy.shaping}.
+    connectionRate = None
+    applicationRate = None
+    nodeRate = None
+    #: Seconds of traffic that each bucket allows in a burst.
+    shapingBurst = 1.0
+
+    #: Whether to answer C{checkBandwidth} calls from players, see
+    #: L{rtmpy.bwcheck}.
+    bandwidthCheck = False
+    #: Seconds for which a client's measured bandwidth is reused.
+    bandwidthCacheTime = 300
+
+    #: Bytes of audio/video to bundle into each aggregate message sent to a
+    #: subscriber, fewer messages mean less header overhead and fewer writes.
+    #: An aggregate is also sent after C{aggregateDuration} milliseconds of
+    #: media. C{0} sends every frame on its own.
+    aggregateSize = 0
+    aggregateDuration = 250
+
     def __init__(self, applications=None):
         self.applications = {}
         self._pendingApplications = {}
 
+        self._nodeBucket = None
+        self._applicationBuckets = {}
+
         if applications:
             for name, app in applications.items():
                 self.registerApplication(name, app)
 
 
+    def getTimerWheel(self):
+        if self.timerWheel is None:
+            return timers.getWheel()
+
+        return self.timerWheel
+
+
+    def buildBucket(self, rate, name):
+        return shaping.TokenBucket(rate, rate * self.shapingBurst, name)
+
+
+    def buildShaper(self):
+        """
+        Returns the L{shaping.Shaper} for a new connection, charged to the
+        connection and the node, or C{None} if shaping is disabled.
+        """
+        if self.connectionRate is None and self.applicationRate is None and \
+                self.nodeRate is None:
+            return None
+
+        shaper = shaping.Shaper()
+
+        if self.connectionRate is not None:
+            shaper.addBucket(self.buildBucket(self.connectionRate,
+                'connection'))
+
+        if self.nodeRate is not None:
+            if self._nodeBucket is None:
+                self._nodeBucket = self.buildBucket(self.nodeRate, 'node')
+
+            shaper.addBucket(self._nodeBucket)
+
+        return shaper
+
+
+    def getApplicationBucket(self, name):
+        """
+        Returns the bucket shared by the connections to application C{name},
+        or C{None} if C{applicationRate} is not set.
+        """
+        if self.applicationRate is None:
+            return None
+
+        try:
+            return self._applicationBuckets[name]
+        except KeyError:
+            pass
+
+        bucket = self._applicationBuckets[name] = self.buildBucket(
+            self.applicationRate, 'application:%s' % (name,))
+
+        return bucket
+
+
+    def startFactory(self):
+        if self.lagMonitor is not None:
+            self.lagMonitor.start()
+
+
+    def stopFactory(self):
+        if self.lagMonitor is not None:
+            self.lagMonitor.stop()
+
+
+    def checkLoad(self, threshold, exception):
+        """
+        Decides whether a new request can be accepted given the current
+        reactor lag.
+
+        @param threshold: The lag in seconds above which the request is turned
+            away. C{None} always accepts.
+        @param exception: The exception class to reject the request with.
+        @return: A L{defer.Deferred} that fires with C{None} when the request
+            can go ahead or fails with C{exception} if the server is too busy.
+        """
+        monitor = self.lagMonitor
+
+        if threshold is None or monitor is None or \
+                not monitor.isLagging(threshold):
+            return defer.succeed(None)
+
+        def busy(*args):
+            raise exception('Server is too busy, try again later')
+
+        if not self.lagWaitTimeout:
+            return defer.maybeDeferred(busy)
+
+        d = monitor.whenBelow(threshold, self.lagWaitTimeout)
+
+        return d.addCallbacks(lambda _: None, busy)
+
+
     def buildHandshakeNegotiator(self, observer, output):
         """
         Returns a negotiator capable of handling server side handshakes.
@@ -1293,6 +2338,10 @@ class ServerFactory(protocol.ServerFactory):
             app.factory = None
             app.name = None
 
+            if getattr(app, 'executor', None) is not None:
+                app.executor.stop()
+                app.executor = None
+
             return app
 
         d.addBoth(cb)
@@ -0,0 +1,191 @@
+# -*- test-case-name: rtmpy.tests.test_shaping -*-
+
+# Copyright the RTMPy Project
+#
+# RTMPy is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# RTMPy is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with RTMPy.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Token bucket bandwidth shaping of the RTMP output.
+
+Every byte written by an L{rtmpy.protocol.rtmp.codec.Encoder} is charged to
+each bucket of its L{Shaper}, typically one for the connection, one shared by
+the application and one shared by the whole node. While any of the buckets is
+empty the encoder holds back queued messages and live audio/video frames are
+dropped. Command type messages (and the protocol control messages) are always
+sent.
+
+L{rtmpy.server.ServerFactory} builds the shapers::
+
+    factory = server.ServerFactory(apps)
+    factory.connectionRate = 256 * 1024
+    factory.nodeRate = 100 * 1024 * 1024
+
+@since: 0.2
+"""
+
+
+__all__ = ['TokenBucket', 'Shaper']
+
+
+
+class TokenBucket(object):
+    """
+    Allows C{rate} bytes per second with bursts of up to C{burst} bytes.
+
+    The bucket is allowed to go into debt, a single write is never split. It
+    is empty while it is in debt.
+
+    @ivar name: Identifies the bucket in the metrics, e.g. C{node}.
+    @ivar tokens: The bytes that can be written, as of the last refill.
+    @ivar dropped: Bytes of audio/video dropped because this bucket was one
+        of the shapers' buckets while throttled.
+    """
+
+
+    def __init__(self, rate, burst=None, name=None, reactor=None):
+        """
+        @param rate: Bytes per second.
+        @param burst: Bytes. Defaults to one second of C{rate}.
+        """
+        if rate <= 0:
+            raise ValueError('rate must be > 0')
+
+        if reactor is None:
+            from twisted.internet import reactor
+
+        if burst is None:
+            burst = rate
+
+        self.rate = rate
+        self.burst = burst
+        self.name = name
+        self.reactor = reactor
+
+        self.tokens = burst
+        self.dropped = 0
+
+        self._updated = reactor.seconds()
+
+
+    def refill(self):
+        now = self.reactor.seconds()
+
+        self.tokens = min(self.burst,
+            self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+
+    def consume(self, size):
+        self.refill()
+
+        self.tokens -= size
+
+
+    @property
+    def empty(self):
+        self.refill()
+
+        return self.tokens < 0
+
+
+    def delay(self):
+        """
+        Seconds until the bucket is no longer empty.
+        """
+        self.refill()
+
+        if self.tokens >= 0:
+            return 0
+
+        return -self.tokens / float(self.rate)
+
+
+
+class Shaper(object):
+    """
+    Charges the output of an encoder to a list of L{TokenBucket}s.
+
+    @ivar buckets: The buckets, in no particular order.
+    @ivar dropped: Bytes of audio/video dropped on this connection.
+    @ivar held: The number of times that the encoder was paused.
+    """
+
+
+    def __init__(self, buckets=(), reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+
+        self.buckets = list(buckets)
+        self.reactor = reactor
+
+        self.dropped = 0
+        self.held = 0
+
+
+    def addBucket(self, bucket):
+        if bucket not in self.buckets:
+            self.buckets.append(bucket)
+
+
+    def removeBucket(self, bucket):
+        if bucket in self.buckets:
+            self.buckets.remove(bucket)
+
+
+    def consume(self, size):
+        """
+        Charges C{size} written bytes to every bucket.
+        """
+        for bucket in self.buckets:
+            bucket.consume(size)
+
+
+    @property
+    def exhausted(self):
+        """
+        Whether any of the buckets is empty.
+        """
+        for bucket in self.buckets:
+            if bucket.empty:
+                return True
+
+        return False
+
+
+    def drop(self, size):
+        """
+        Records that C{size} bytes were dropped instead of being sent.
+        """
+        self.dropped += size
+
+        for bucket in self.buckets:
+            bucket.dropped += size
+
+
+    def delay(self):
+        """
+        Seconds until all the buckets have tokens.
+        """
+        return max([0] + [bucket.delay() for bucket in self.buckets])
+
+
+    def callWhenAvailable(self, func, *args, **kwargs):
+        """
+        Calls C{func} once all the buckets have tokens.
+
+        @return: The C{IDelayedCall}.
+        """
+        self.held += 1
+
+        return self.reactor.callLater(self.delay(), func, *args, **kwargs)
@@ -0,0 +1,498 @@
+# -*- test-case-name: rtmpy.tests.test_sharedobject -*-
+
+# Copyright the RTMPy Project
+#
+# RTMPy is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# RTMPy is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with RTMPy.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Server side remote shared objects.
+
+Each L{server.Application} has a L{SharedObjectStore}. Clients use a shared
+object with C{SharedObject.getRemote} and the application can change it too::
+
+    d = app.getSharedObjectStore().getSharedObject('chat')
+    d.addCallback(lambda so: so.setAttribute('topic', 'RTMP'))
+
+The changes made during a tick (C{flushInterval}) are sent to each subscriber
+as one message. The message is encoded once per object encoding and the same
+bytes are sent to every subscriber, only the subscribers that requested a
+change get their own message (acknowledging the change instead of echoing
+it).
+
+Persistent shared objects are read from and written to C{path} of the store,
+in a thread. C{maxPersistent} of the store limits how many of them clients
+can create.
+
+@since: 0.2
+"""
+
+import os
+import urllib
+
+import pyamf
+from pyamf.util import BufferedByteStream
+from twisted.python import log
+from twisted.internet import defer, threads
+
+from rtmpy import message, util, exc
+
+
+__all__ = [
+    'SharedObject',
+    'SharedObjectStore',
+]
+
+
+
+class SharedObject(object):
+    """
+    A remote shared object.
+
+    @ivar name: The name of the shared object.
+    @ivar persistent: Whether the shared object is saved by its L{store}.
+    @ivar version: Incremented for every change.
+    @ivar data: The slots, name -> value.
+    @ivar slotVersions: The L{version} in which each slot last changed.
+    @ivar subscribers: The L{server.NetConnection}s using the shared object.
+    @ivar flushInterval: Seconds to gather changes for before they are sent.
+    """
+
+    flushInterval = 0
+
+
+    def __init__(self, name, persistent=False, store=None, reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+
+        self.name = name
+        self.persistent = persistent
+        self.store = store
+        self.reactor = reactor
+
+        self.version = 0
+        self.data = {}
+        self.slotVersions = {}
+        self.subscribers = []
+
+        self._pending = util.OrderedDict()
+        self._messages = []
+        self._acks = {}
+        self._flushCall = None
+
+
+    def __repr__(self):
+        return '<%s %r version=%d subscribers=%d at 0x%x>' % (
+            self.__class__.__name__, self.name, self.version,
+            len(self.subscribers), id(self))
+
+
+    def subscribe(self, nc):
+        """
+        Adds C{nc} as a subscriber and sends it the slots.
+        """
+        if nc in self.subscribers:
+            return
+
+        self.subscribers.append(nc)
+
+        events = [
+            (message.SharedObjectMessage.USE_SUCCESS, None),
+            (message.SharedObjectMessage.CLEAR, None),
+        ]
+
+        for name, value in self.data.iteritems():
+            events.append((message.SharedObjectMessage.CHANGE, (name, value)))
+
+        self._send(nc, *self._encode(nc.objectEncoding, events))
+
+
+    def unsubscribe(self, nc):
+        """
+        Removes C{nc} as a subscriber.
+        """
+        try:
+            self.subscribers.remove(nc)
+        except ValueError:
+            pass
+
+        self._acks.pop(nc, None)
+
+
+    def getAttribute(self, name, default=None):
+        return self.data.get(name, default)
+
+
+    def setAttribute(self, name, value, source=None):
+        """
+        Sets the slot C{name} to C{value}.
+
+        @param source: The L{server.NetConnection} that requested the change,
+            if any.
+        """
+        if name not in self.data or self.data[name] != value:
+            self.data[name] = value
+            self._changed(name, message.SharedObjectMessage.CHANGE)
+
+        self._ack(source, name)
+
+
+    def removeAttribute(self, name, source=None):
+        """
+        Removes the slot C{name}.
+
+        @param source: The L{server.NetConnection} that requested the removal,
+            if any.
+        """
+        if name in self.data:
+            del self.data[name]
+            self._changed(name, message.SharedObjectMessage.REMOVE)
+
+        self._ack(source, name)
+
+
+    def sendMessage(self, handler, *args):
+        """
+        Calls C{handler} with C{args} on the shared object of all the
+        subscribers.
+        """
+        self._messages.append([handler] + list(args))
+        self._schedule()
+
+
+    def _changed(self, name, type_):
+        self.version += 1
+
+        if type_ == message.SharedObjectMessage.REMOVE:
+            self.slotVersions.pop(name, None)
+        else:
+            self.slotVersions[name] = self.version
+
+        self._pending.pop(name, None)
+        self._pending[name] = type_
+
+        # the last change wins, earlier requesters get the new value
+        for names in self._acks.itervalues():
+            names.discard(name)
+
+        self._schedule()
+
+
+    def _ack(self, source, name):
+        if source is None:
+            return
+
+        self._acks.setdefault(source, set()).add(name)
+        self._schedule()
+
+
+    def _schedule(self):
+        if self._flushCall is None:
+            self._flushCall = self.reactor.callLater(self.flushInterval,
+                self.flush)
+
+
+    def _encode(self, encoding, events):
+        if encoding == pyamf.AMF3:
+            klass = message.FlexSharedObjectMessage
+        else:
+            klass = message.SharedObjectMessage
+
+        msg = klass(self.name, self.version, self.persistent, events)
+        buf = BufferedByteStream()
+
+        msg.encode(buf)
+
+        return buf.getvalue(), msg.__data_type__
+
+
+    def _send(self, nc, data, datatype):
+        try:
+            nc.protocol.sendEncodedMessage(data, datatype, nc)
+        except Exception:
+            log.err()
+
+
+    def flush(self):
+        """
+        Sends the changes since the last flush to the subscribers.
+        """
+        if self._flushCall is not None:
+            if self._flushCall.active():
+                self._flushCall.cancel()
+
+            self._flushCall = None
+
+        pending, self._pending = self._pending, util.OrderedDict()
+        messages, self._messages = self._messages, []
+        acks, self._acks = self._acks, {}
+
+        changes = []
+
+        for name, type_ in pending.iteritems():
+            if type_ == message.SharedObjectMessage.CHANGE:
+                changes.append((name, (type_, (name, self.data[name]))))
+            else:
+                changes.append((name, (type_, name)))
+
+        calls = [(message.SharedObjectMessage.SEND_MESSAGE, args)
+            for args in messages]
+
+        # encoding -> (data, datatype)
+        shared = {}
+
+        for nc in self.subscribers:
+            encoding = nc.objectEncoding
+            names = acks.get(nc, None)
+
+            if names:
+                events = [(message.SharedObjectMessage.SUCCESS, name)
+                    for name in names]
+                events.extend([event for name, event in changes
+                    if name not in names])
+                events.extend(calls)
+
+                self._send(nc, *self._encode(encoding, events))
+
+                continue
+
+            if not changes and not calls:
+                continue
+
+            try:
+                encoded = shared[encoding]
+            except KeyError:
+                encoded = shared[encoding] = self._encode(encoding,
+                    [event for name, event in changes] + calls)
+
+            self._send(nc, *encoded)
+
+        if pending and self.persistent and self.store is not None:
+            self.store.save(self)
+
+
+
+class SharedObjectStore(object):
+    """
+    The shared objects of an application.
+
+    @ivar path: The directory that persistent shared objects are saved to,
+        C{None} keeps them in memory only.
+    @ivar maxPersistent: The most persistent shared objects that clients can
+        create with L{use}. C{None} is unlimited.
+    @ivar sharedObjects: name -> L{SharedObject}.
+    """
+
+    sharedObjectClass = SharedObject
+
+
+    def __init__(self, path=None, reactor=None, maxPersistent=None):
+        self.path = path
+        self.reactor = reactor
+        self.maxPersistent = maxPersistent
+
+        self.sharedObjects = {}
+
+        # name -> deferreds waiting for the shared object to load
+        self._loading = {}
+        self._saving = {}
+        self._dirty = set()
+
+
+    def getSharedObject(self, name, persistent=False):
+        """
+        Returns the shared object C{name}, creating it (or loading it from
+        L{path} in a thread) if needed.
+
+        @return: A L{defer.Deferred} that fires with the L{SharedObject}.
+        """
+        try:
+            return defer.succeed(self.sharedObjects[name])
+        except KeyError:
+            pass
+
+        waiters = self._loading.get(name, None)
+
+        if waiters is not None:
+            d = defer.Deferred()
+            waiters.append(d)
+
+            return d
+
+        so = self.sharedObjectClass(name, persistent, self, self.reactor)
+
+        if not persistent or self.path is None:
+            self.sharedObjects[name] = so
+
+            return defer.succeed(so)
+
+        waiters = self._loading[name] = []
+
+        def loaded(state):
+            if state is not None:
+                so.version = state['version']
+                so.data = dict(state['data'])
+                so.slotVersions = dict(state['slotVersions'])
+
+        def done(result):
+            del self._loading[name]
+            self.sharedObjects[name] = so
+
+            for d in waiters:
+                d.callback(so)
+
+            return so
+
+        d = threads.deferToThread(self.load, name)
+
+        d.addCallback(loaded)
+        d.addErrback(log.err, 'Failed to load shared object %r' % (name,))
+
+        return d.addCallback(done)
+
+
+    def use(self, nc, name, persistent=False):
+        """
+        Subscribes C{nc} to the shared object C{name}, unless it has
+        disconnected by the time the shared object has loaded.
+
+        @return: A L{defer.Deferred} that fires with the L{SharedObject}, or
+            fails with L{exc.SharedObjectError} if it would be one more than
+            L{maxPersistent} persistent shared objects.
+        """
+        if persistent and self.maxPersistent is not None and \
+                name not in self.sharedObjects and name not in self._loading:
+            count = len(self._loading)
+
+            for so in self.sharedObjects.itervalues():
+                if so.persistent:
+                    count += 1
+
+            if count >= self.maxPersistent:
+                return defer.fail(exc.SharedObjectError('Too many persistent '
+                    'shared objects to create %s' % (name,)))
+
+        def subscribe(so):
+            if nc.connected:
+                so.subscribe(nc)
+
+            return so
+
+        return self.getSharedObject(name, persistent).addCallback(subscribe)
+
+
+    def release(self, nc, name=None):
+        """
+        Unsubscribes C{nc} from the shared object C{name}, or from all of them.
+        Shared objects that are not persistent are discarded with their last
+        subscriber.
+        """
+        if name is None:
+            names = self.sharedObjects.keys()
+        else:
+            names = [name]
+
+        for name in names:
+            so = self.sharedObjects.get(name, None)
+
+            if so is None:
+                continue
+
+            so.unsubscribe(nc)
+
+            if not so.subscribers and not so.persistent:
+                del self.sharedObjects[name]
+
+
+    def getFilename(self, name):
+        """
+        Returns the file that the shared object C{name} is saved to.
+        """
+        return os.path.join(self.path, urllib.quote(name, '') + '.sol')
+
+
+    def load(self, name):
+        """
+        Returns the saved state of the shared object C{name}, or C{None}.
+        """
+        if self.path is None:
+            return None
+
+        filename = self.getFilename(name)
+
+        if not os.path.exists(filename):
+            return None
+
+        f = open(filename, 'rb')
+
+        try:
+            return pyamf.get_decoder(pyamf.AMF0, stream=f.read()).next()
+        finally:
+            f.close()
+
+
+    def save(self, so):
+        """
+        Writes C{so} to L{path} in a thread. There is at most one write per
+        shared object at a time, the changes made in the meantime are written
+        when it finishes.
+
+        @return: A L{defer.Deferred} that fires when C{so} has been written.
+        """
+        if self.path is None:
+            return defer.succeed(None)
+
+        d = self._saving.get(so.name, None)
+
+        if d is not None:
+            self._dirty.add(so.name)
+
+            return d
+
+        # the slots are encoded on the reactor thread, they may change
+        buf = BufferedByteStream()
+
+        pyamf.get_encoder(pyamf.AMF0, buf).writeElement({
+            'version': so.version,
+            'data': so.data,
+            'slotVersions': so.slotVersions,
+        })
+
+        d = self._saving[so.name] = threads.deferToThread(self._write,
+            self.getFilename(so.name), buf.getvalue())
+
+        def saved(result):
+            del self._saving[so.name]
+
+            if so.name in self._dirty:
+                self._dirty.discard(so.name)
+
+                return self.save(so)
+
+            return result
+
+        d.addErrback(log.err, 'Failed to save shared object %r' % (so.name,))
+
+        return d.addBoth(saved)
+
+
+    def _write(self, filename, data):
+        tmp = filename + '.tmp'
+        f = open(tmp, 'wb')
+
+        try:
+            f.write(data)
+        finally:
+            f.close()
+
+        os.rename(tmp, filename)
@@ -19,6 +19,7 @@ Flash Player throws a fit.
 """
 
 from zope.interface import Interface, Attribute, implements
+import pyamf
 
 
 __all__ = ['IStatus', 'status', 'error', 'fromFailure']
@@ -173,3 +174,9 @@ class Status(object):
         d.pop('description', None)
 
         return d
+
+
+
+# Registered anonymously (the encoded bytes are unchanged) so that encoding a
+# status does not build and compile a new class alias for every message.
+pyamf.register_class(Status)
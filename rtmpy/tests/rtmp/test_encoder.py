@@ -291,3 +291,96 @@ class CommandTypeTestCase(BaseTestCase):
         self.assertEqual(self.output.getvalue(), '')
         self.encoder.send('eggs', message.INVOKE, 0, 21)
         self.assertEqual(self.output.getvalue(), '')
+
+
+class FlowControlTestCase(BaseTestCase):
+    """
+    Tests for the acknowledgement window of L{codec.Encoder}.
+    """
+
+    def setUp(self):
+        BaseTestCase.setUp(self)
+
+        self.encoder.setAckWindow(100, 2)
+
+    def test_disabled(self):
+        e = codec.Encoder(self.output)
+        e.bytes = 10000
+
+        self.assertFalse(e.congested)
+
+    def test_congested(self):
+        self.encoder.send('x' * 1000, message.VIDEO_DATA, 1, 0)
+
+        while not self.encoder.congested:
+            self.encoder.next()
+
+        self.assertTrue(200 <= self.encoder.unacknowledged < 400)
+        self.assertRaises(StopIteration, self.encoder.next)
+        self.assertTrue(self.encoder.active)
+
+        # command types are not held back
+        before = self.encoder.bytes
+        self.encoder.send('eggs', message.CONTROL, 0, 0)
+
+        self.assertTrue(self.encoder.bytes > before)
+
+        self.encoder.bytesAcknowledged(self.encoder.bytes)
+
+        self.assertFalse(self.encoder.congested)
+        self.encoder.next()
+
+    def test_peer_ahead(self):
+        """
+        The peer counts the handshake, its total can be ahead of ours.
+        """
+        self.encoder.bytes = 50
+        self.encoder.bytesAcknowledged(3123)
+
+        self.assertEqual(self.encoder.unacknowledged, 0)
+
+    def test_wrap(self):
+        wrap = message.BytesRead.FOUR_GB_THRESHOLD
+
+        self.encoder.bytes = wrap + 150
+        self.encoder.bytesAcknowledged(wrap - 50)
+
+        self.assertEqual(self.encoder.unacknowledged, 200)
+        self.assertTrue(self.encoder.congested)
+
+
+class StreamingChannelTestCase(BaseTestCase):
+    """
+    Tests for L{codec.StreamingChannel}.
+    """
+
+    def send(self, func):
+        output = BufferedByteStream()
+        encoder = codec.Encoder(output)
+        encoder.setFrameSize(128)
+
+        channel = codec.StreamingChannel(encoder, 1, output)
+        channel.setType(message.VIDEO_DATA)
+
+        for timestamp, data in [(0, 'a' * 300), (40, 'b' * 10),
+                (80, 'c' * 256), (80, 'd' * 129)]:
+            func(channel, data, timestamp)
+
+        return output.getvalue(), encoder.bytes
+
+    def test_split(self):
+        self.assertEqual(codec.splitFrames('abcdefg', 3, '|'), 'abc|def|g')
+        self.assertEqual(codec.splitFrames('abc', 3, '|'), 'abc')
+
+    def test_send_frames(self):
+        """
+        Sending the frames writes the same bytes as sending the data.
+        """
+        def sendData(channel, data, timestamp):
+            channel.sendData(data, timestamp)
+
+        def sendFrames(channel, data, timestamp):
+            channel.sendFrames(channel.encodeFrames(data), len(data),
+                timestamp)
+
+        self.assertEqual(self.send(sendFrames), self.send(sendData))
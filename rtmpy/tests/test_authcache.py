@@ -0,0 +1,89 @@
+# Copyright the RTMPy Project
+#
+# RTMPy is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# RTMPy is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with RTMPy.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Tests for L{rtmpy.authcache}.
+"""
+
+from twisted.trial import unittest
+from twisted.internet import task
+
+from rtmpy import authcache, exc
+
+
+
+class AuthorizationCacheTestCase(unittest.TestCase):
+    """
+    Tests for L{authcache.AuthorizationCache}.
+    """
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.cache = authcache.AuthorizationCache(60, 10, 3,
+            reactor=self.clock)
+
+    def test_ttl(self):
+        self.cache.set('foo', True)
+
+        self.clock.advance(59)
+        self.assertEqual(self.cache.get('foo'), True)
+
+        self.clock.advance(1)
+        self.assertEqual(self.cache.get('foo'), None)
+        self.assertEqual(len(self.cache), 0)
+
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+    def test_negative(self):
+        e = exc.ConnectRejected('foo')
+        self.cache.set('foo', e)
+
+        self.assertIdentical(self.cache.get('foo'), e)
+
+        self.clock.advance(10)
+        self.assertFalse('foo' in self.cache)
+
+        self.cache.negativeTtl = 0
+        self.cache.set('foo', e)
+        self.assertFalse('foo' in self.cache)
+
+    def test_lru(self):
+        for key in ['a', 'b', 'c']:
+            self.cache.set(key, True)
+
+        self.cache.get('a')
+        self.cache.set('d', True)
+
+        self.assertFalse('b' in self.cache)
+        self.assertEqual(sorted(self.cache._entries), ['a', 'c', 'd'])
+        self.assertEqual(self.cache.evictions, 1)
+
+    def test_invalidate(self):
+        self.cache.set(('connect', '1.2.3.4'), True)
+        self.cache.set(('publish', '1.2.3.4'), True)
+        self.cache.set(('connect', '5.6.7.8'), True)
+
+        self.cache.invalidate(('connect', '5.6.7.8'))
+        self.cache.invalidate('unknown')
+
+        self.assertEqual(len(self.cache), 2)
+        self.assertEqual(self.cache.invalidateIf(
+            lambda key: key[1] == '1.2.3.4'), 2)
+        self.assertEqual(len(self.cache), 0)
+
+        self.cache.set('foo', True)
+        self.cache.clear()
+
+        self.assertEqual(len(self.cache), 0)
@@ -0,0 +1,234 @@
+# Copyright the RTMPy Project
+#
+# RTMPy is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# RTMPy is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with RTMPy.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Tests for L{rtmpy.bwcheck}.
+"""
+
+from twisted.trial import unittest
+from twisted.internet import defer, task
+
+from rtmpy import bwcheck, timers, server, exc
+
+
+
+class Peer(object):
+    """
+    Answers calls after sending them over a link of C{rate} bytes per second
+    with a round trip time of C{latency} seconds.
+    """
+
+    def __init__(self, clock, rate, latency):
+        self.clock = clock
+        self.rate = rate
+        self.latency = latency
+
+        self.calls = []
+        self.activeCalls = set()
+        self.answer = True
+        self._busyUntil = 0
+        self._lastCallId = 0
+
+    def getNextCallId(self):
+        return self._lastCallId + 1
+
+    def discardCall(self, callId):
+        self.activeCalls.discard(callId)
+
+    def call(self, name, *args, **kwargs):
+        self.calls.append((name, args))
+
+        if not kwargs.get('notify', False):
+            return
+
+        d = defer.Deferred()
+
+        self._lastCallId += 1
+        self.activeCalls.add(self._lastCallId)
+
+        if not self.answer:
+            return d
+
+        now = self.clock.seconds()
+        size = sum([len(a) for a in args])
+
+        self._busyUntil = max(self._busyUntil, now) + size / float(self.rate)
+        self.clock.callLater(self._busyUntil - now + self.latency,
+            d.callback, None)
+
+        return d
+
+
+
+class Pinger(object):
+    srtt = 0.1
+
+
+
+def run(clock, d):
+    """
+    Runs C{clock} until C{d} has fired.
+    """
+    while not d.called:
+        calls = clock.getDelayedCalls()
+
+        clock.advance(min([c.getTime() for c in calls]) - clock.seconds())
+
+
+
+class BandwidthCheckTestCase(unittest.TestCase):
+    """
+    Tests for L{bwcheck.BandwidthCheck}.
+    """
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.wheel = timers.TimerWheel(reactor=self.clock)
+        self.peer = Peer(self.clock, 100000, 0.05)
+
+        self.check = bwcheck.BandwidthCheck(self.peer, self.wheel)
+        self.check.payloadSize = 1000
+
+    def test_measure(self):
+        d = self.check.start()
+
+        self.assertIdentical(self.check.start(), d)
+
+        run(self.clock, d)
+
+        result = self.successResultOf(d)
+
+        self.assertEqual(self.peer.calls[0], ('onBWCheck', ()))
+        self.assertEqual(len(self.peer.calls), 1 + 63)
+        self.assertEqual(result.bytes, 63000)
+        self.assertAlmostEqual(result.latency, 0.05)
+        self.assertAlmostEqual(result.duration, 0.63)
+        self.assertAlmostEqual(result.kbps, 800)
+        self.assertEqual(len(self.wheel), 0)
+
+    def test_target_duration(self):
+        self.check.targetDuration = 0.1
+
+        d = self.check.start()
+        run(self.clock, d)
+
+        # bursts of 1, 2, 4 and 8 payloads
+        self.assertEqual(self.successResultOf(d).bytes, 15000)
+
+    def test_pinger(self):
+        self.check.pinger = Pinger()
+
+        d = self.check.start()
+        run(self.clock, d)
+
+        self.assertEqual(self.successResultOf(d).latency, 0.1)
+        self.assertNotEqual(self.peer.calls[0][1], ())
+
+    def test_timeout(self):
+        self.peer.answer = False
+
+        d = self.check.start()
+        self.clock.advance(10.5)
+
+        self.failureResultOf(d, defer.TimeoutError)
+
+    def test_timeout_discards_calls(self):
+        """
+        The probes that are still unanswered when the check times out are
+        discarded.
+        """
+        self.check.pinger = Pinger()
+        self.peer.answer = False
+
+        d = self.check.start()
+
+        self.assertEqual(self.peer.activeCalls, set([1]))
+
+        self.clock.advance(10.5)
+
+        self.failureResultOf(d, defer.TimeoutError)
+        self.assertEqual(self.peer.activeCalls, set())
+
+
+
+class ClientTestCase(unittest.TestCase):
+    """
+    Tests for the bandwidth check of L{server.Client} and
+    L{server.NetConnection}.
+    """
+
+    def setUp(self):
+        self.clock = task.Clock()
+
+        self.factory = server.ServerFactory()
+        self.factory.bandwidthCheck = True
+        self.factory.timerWheel = timers.TimerWheel(reactor=self.clock)
+
+        self.protocol = self.factory.buildProtocol(None)
+        self.protocol.pinger = None
+        self.protocol.getTimerWheel = lambda: self.factory.timerWheel
+
+        self.peer = Peer(self.clock, 100000, 0.05)
+
+        self.nc = server.NetConnection(self.protocol)
+        self.nc.connected = True
+        self.nc.call = self.peer.call
+
+        self.client = self.nc.client = server.Client(self.nc)
+
+        self.patch(bwcheck.BandwidthCheck, 'payloadSize', 1000)
+
+    def test_cache(self):
+        d1 = self.client.measureBandwidth(60)
+        d2 = self.client.measureBandwidth(60)
+
+        run(self.clock, d1)
+
+        result = self.successResultOf(d1)
+
+        self.assertIdentical(self.successResultOf(d2), result)
+        self.assertIdentical(self.client.bandwidth, result)
+
+        calls = len(self.peer.calls)
+        self.clock.advance(30)
+
+        self.assertIdentical(self.successResultOf(
+            self.client.measureBandwidth(60)), result)
+        self.assertEqual(len(self.peer.calls), calls)
+
+        self.clock.advance(31)
+
+        d = self.client.measureBandwidth(60)
+        self.assertNoResult(d)
+
+        run(self.clock, d)
+
+        self.assertNotIdentical(self.successResultOf(d), result)
+
+    def test_check_bandwidth(self):
+        self.nc.checkBandwidth(None)
+
+        run(self.clock, self.client._bandwidthWaiters[0])
+
+        name, args = self.peer.calls[-1]
+
+        self.assertEqual(name, 'onBWDone')
+        self.assertEqual(args[1:], (61, 630, 50))
+        self.assertTrue(799 <= args[0] <= 800)
+
+    def test_disabled(self):
+        self.factory.bandwidthCheck = False
+
+        self.assertRaises(exc.CallFailed, self.nc.checkBandwidth, None)
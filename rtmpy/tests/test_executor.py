@@ -0,0 +1,353 @@
+# Copyright the RTMPy Project
+#
+# RTMPy is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# RTMPy is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with RTMPy.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Tests for L{rtmpy.executor}.
+"""
+
+import os
+import pickle
+import threading
+
+from twisted.trial import unittest
+from twisted.internet import defer, task
+
+from rtmpy import executor, rpc, exc
+from rtmpy.status import codes
+
+
+
+class Handler(rpc.AbstractCallHandler):
+    """
+    Exposes methods that run in executors.
+    """
+
+    def __init__(self):
+        rpc.AbstractCallHandler.__init__(self)
+
+        self.messages = []
+
+
+    def sendMessage(self, msg, whenDone=None):
+        self.messages.append(msg)
+
+
+    @rpc.expose(executor='test-thread')
+    def thread(self, arg):
+        return arg, threading.currentThread().getName()
+
+
+    @rpc.expose('named', executor='test-process')
+    @staticmethod
+    def process(arg):
+        return arg, os.getpid()
+
+
+    @staticmethod
+    def fail(arg):
+        raise ValueError(arg)
+
+
+    @staticmethod
+    def unpicklable(arg):
+        return lambda: arg
+
+
+
+class NotStatic(rpc.AbstractCallHandler):
+    @rpc.expose(executor='test-process')
+    def process(self, arg):
+        return arg
+
+
+
+class Reactor(task.Clock):
+    """
+    A clock that runs the calls from other threads straight away.
+    """
+
+    def callFromThread(self, f, *args, **kwargs):
+        f(*args, **kwargs)
+
+
+    def addSystemEventTrigger(self, phase, eventType, f):
+        return (phase, eventType, f)
+
+
+    def removeSystemEventTrigger(self, trigger):
+        pass
+
+
+
+class ManualExecutor(executor.Executor):
+    """
+    Keeps the calls until the test finishes them.
+    """
+
+    def dispatch(self, func, args, kwargs, finished):
+        self.calls.append(finished)
+
+
+
+class TimeoutTestCase(unittest.TestCase):
+    """
+    Tests for L{executor.Executor.timeout}.
+    """
+
+    def setUp(self):
+        self.clock = Reactor()
+        self.executor = ManualExecutor(1, reactor=self.clock)
+        self.executor.calls = []
+        self.executor.timeout = 10
+
+    def test_result(self):
+        d = self.executor.submit(None)
+
+        self.executor.calls[0](True, 'foo')
+
+        self.assertEqual(self.successResultOf(d), 'foo')
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_timeout(self):
+        """
+        A call that times out fails its caller and holds on to its worker
+        until it finishes.
+        """
+        d1 = self.executor.submit(None)
+        d2 = self.executor.submit(None)
+
+        self.clock.advance(10)
+
+        self.failureResultOf(d1, defer.TimeoutError)
+        self.assertEqual(self.executor.running, 1)
+        self.assertEqual(self.executor.abandoned, 1)
+        self.assertEqual(self.executor.queued, 1)
+
+        self.executor.calls[0](True, 'foo')
+
+        self.assertEqual(self.executor.running, 1)
+        self.assertEqual(self.executor.abandoned, 0)
+        self.assertEqual(self.executor.completed, 1)
+
+        self.executor.calls[1](True, 'bar')
+
+        self.assertEqual(self.successResultOf(d2), 'bar')
+
+
+
+class ThreadExecutorTestCase(unittest.TestCase):
+    """
+    Tests for L{executor.ThreadExecutor}.
+    """
+
+    def setUp(self):
+        self.executor = executor.ThreadExecutor(1, 1, name='test')
+        self.addCleanup(self.executor.stop)
+
+    def test_submit(self):
+        d = self.executor.submit(lambda: threading.currentThread())
+
+        def check(thread):
+            self.assertNotIdentical(thread, threading.currentThread())
+            self.assertEqual(self.executor.running, 0)
+            self.assertEqual(self.executor.completed, 1)
+
+        return d.addCallback(check)
+
+    def test_failure(self):
+        d = self.executor.submit(Handler.fail, 'foo')
+
+        return self.assertFailure(d, ValueError)
+
+    def test_bounded(self):
+        event = threading.Event()
+
+        d1 = self.executor.submit(event.wait)
+        d2 = self.executor.submit(lambda: 'bar')
+        d3 = self.executor.submit(lambda: 'baz')
+
+        self.assertEqual(self.executor.running, 1)
+        self.assertEqual(self.executor.queued, 1)
+        self.assertEqual(self.executor.rejected, 1)
+        self.failureResultOf(d3, exc.ExecutorBusy)
+
+        event.set()
+
+        d = defer.gatherResults([d1, d2])
+
+        return d.addCallback(lambda result: self.assertEqual(result[1], 'bar'))
+
+    def test_stop(self):
+        event = threading.Event()
+
+        d1 = self.executor.submit(event.wait)
+        d2 = self.executor.submit(lambda: 'bar')
+
+        event.set()
+        self.executor.stop()
+
+        self.failureResultOf(d2, defer.CancelledError)
+
+        return d1
+
+
+
+class ProcessExecutorTestCase(unittest.TestCase):
+    """
+    Tests for L{executor.ProcessExecutor}.
+    """
+
+    def setUp(self):
+        self.executor = executor.ProcessExecutor(1, name='test')
+        self.addCleanup(self.executor.stop)
+
+    def test_submit(self):
+        func = executor.FunctionReference(__name__, ['Handler', 'process'])
+        d = self.executor.submit(func, 'foo')
+
+        def check(result):
+            self.assertEqual(result[0], 'foo')
+            self.assertNotEqual(result[1], os.getpid())
+
+        return d.addCallback(check)
+
+    def test_failure(self):
+        func = executor.FunctionReference(__name__, ['Handler', 'fail'])
+
+        return self.assertFailure(self.executor.submit(func, 'foo'),
+            ValueError)
+
+    def test_unpicklable_argument(self):
+        """
+        A call whose arguments cannot be pickled fails without taking a
+        worker.
+        """
+        func = executor.FunctionReference(__name__, ['Handler', 'process'])
+        d = self.executor.submit(func, lambda: 'foo')
+
+        def check(_):
+            self.assertEqual(self.executor.running, 0)
+            self.assertEqual(self.executor.completed, 1)
+
+        d = self.assertFailure(d, pickle.PicklingError)
+
+        return d.addCallback(check)
+
+    def test_unpicklable_result(self):
+        func = executor.FunctionReference(__name__, ['Handler', 'unpicklable'])
+        d = self.executor.submit(func, 'foo')
+
+        def check(_):
+            self.assertEqual(self.executor.running, 0)
+
+        return self.assertFailure(d, pickle.PicklingError).addCallback(check)
+
+    def test_worker_died(self):
+        """
+        A call whose worker dies fails after C{timeout} seconds, and the
+        workers are replaced.
+        """
+        self.executor.timeout = 0.5
+
+        d = self.executor.submit(os._exit, 1)
+
+        def submit(_):
+            func = executor.FunctionReference(__name__, ['Handler', 'process'])
+
+            return self.executor.submit(func, 'foo')
+
+        def check(result):
+            self.assertEqual(result[0], 'foo')
+            self.assertEqual(self.executor.running, 0)
+            self.assertEqual(self.executor.abandoned, 0)
+
+        d = self.assertFailure(d, defer.TimeoutError).addCallback(submit)
+
+        return d.addCallback(check)
+
+    def test_not_static(self):
+        self.assertRaises(TypeError, self.executor.wrap, NotStatic, 'process',
+            NotStatic().process)
+
+
+
+class ExposeTestCase(unittest.TestCase):
+    """
+    Tests for exposed methods that run in an executor.
+    """
+
+    def setUp(self):
+        for name, klass in [('test-thread', executor.ThreadExecutor),
+                ('test-process', executor.ProcessExecutor)]:
+            e = klass(1)
+            executor.register(name, e)
+
+            self.addCleanup(executor._executors.pop, name)
+            self.addCleanup(e.stop)
+
+        self.handler = Handler()
+
+    def test_meta(self):
+        self.assertEqual(rpc.getExposedExecutors(Handler), {
+            'thread': 'test-thread', 'process': 'test-process'})
+        self.assertEqual(rpc.getExposedMethods(Handler), {
+            'thread': 'thread', 'named': 'process'})
+
+    def test_thread(self):
+        d = self.handler.callReceived('thread', 1, 'foo')
+
+        def check(result):
+            msg = self.handler.messages[0]
+
+            self.assertEqual(msg.name, '_result')
+            self.assertEqual(msg.argv[1][0], 'foo')
+            self.assertNotEqual(result[1], threading.currentThread().getName())
+
+        return d.addCallback(check)
+
+    def test_process(self):
+        d = self.handler.callReceived('named', 1, 'foo')
+
+        def check(result):
+            self.assertEqual(self.handler.messages[0].argv[1], result)
+            self.assertNotEqual(result[1], os.getpid())
+
+        return d.addCallback(check)
+
+    def test_busy(self):
+        e = executor.get('test-thread')
+        e.maxQueued = 0
+        event = threading.Event()
+
+        e.submit(event.wait)
+        self.addCleanup(event.set)
+
+        self.failureResultOf(self.handler.callReceived('thread', 1, 'foo'),
+            exc.ExecutorBusy)
+
+        self.assertEqual(self.handler.messages[0].argv[1].code,
+            codes.NC_CALL_FAILED)
+
+    def test_get(self):
+        self.assertIdentical(executor.get('test-thread'),
+            executor._executors['test-thread'])
+        self.assertEqual(executor.get('test-thread').name, 'test-thread')
+        self.assertRaises(LookupError, executor.get, 'foo')
+
+    def test_status_code(self):
+        self.assertIdentical(exc.classByCode(codes.NC_CALL_FAILED),
+            exc.CallFailed)
+        self.assertEqual(exc.codeByClass(exc.ExecutorBusy),
+            codes.NC_CALL_FAILED)
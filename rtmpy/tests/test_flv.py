@@ -0,0 +1,895 @@
+# Copyright the RTMPy Project
+#
+# RTMPy is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# RTMPy is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with RTMPy.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Tests for L{rtmpy.flv}.
+"""
+
+import os
+import threading
+
+from pyamf.util import BufferedByteStream
+from twisted.trial import unittest
+from twisted.internet import defer, task
+
+from rtmpy import flv, message, server, exc
+from rtmpy.protocol.rtmp import codec
+
+
+
+def readFLV(filename):
+    """
+    Returns the metadata and the a/v tags of an FLV file.
+    """
+    data = open(filename, 'rb').read()
+
+    assert data.startswith(flv.HEADER)
+
+    # the tags of an aggregate are FLV tags
+    msg = message.Aggregate()
+    msg.decode(BufferedByteStream(data[len(flv.HEADER):]))
+
+    meta = message.Notify()
+    meta.decode(BufferedByteStream(msg.tags[0][2]))
+
+    return meta.argv[0], msg.tags[1:]
+
+
+
+def writeFLV(filename, tags):
+    """
+    Writes an FLV file of C{(datatype, timestamp, data)} tags.
+    """
+    f = open(filename, 'wb')
+
+    try:
+        f.write(flv.HEADER)
+
+        for tag in tags:
+            f.write(flv.encodeTag(*tag))
+    finally:
+        f.close()
+
+    return filename
+
+
+
+class EncodingTestCase(unittest.TestCase):
+    """
+    Tests for the encoding helpers.
+    """
+
+    def test_tag(self):
+        self.assertEqual(flv.encodeTag(message.VIDEO_DATA, 0x01020304, 'foo'),
+            '\x09\x00\x00\x03\x02\x03\x04\x01\x00\x00\x00foo\x00\x00\x00\x0e')
+
+    def test_meta_data(self):
+        body, offsets = flv.encodeMetaData({'width': 320, 'duration': 5})
+
+        msg = message.Notify()
+        msg.decode(BufferedByteStream(body))
+
+        self.assertEqual(msg.name, 'onMetaData')
+        self.assertEqual(msg.argv[0], {'width': 320, 'duration': 5,
+            'filesize': 0})
+        self.assertEqual(flv.findMetaData(body), offsets)
+        self.assertEqual(body[offsets['duration']:offsets['duration'] + 8],
+            '\x40\x14' + '\x00' * 6)
+
+    def test_find_other(self):
+        buf = BufferedByteStream()
+        message.Notify('onMetaData', {'duration': 1}).encode(buf)
+
+        self.assertIdentical(flv.findMetaData(buf.getvalue()), None)
+
+
+
+class FLVWriterTestCase(unittest.TestCase):
+    """
+    Tests for L{flv.FLVWriter}.
+    """
+
+    def setUp(self):
+        self.filename = self.mktemp()
+        self.writer = flv.FLVWriter(self.filename, metaData={'width': 320},
+            blockSize=64)
+
+    def test_record(self):
+        w = self.writer
+
+        # tags written before the file is open are kept
+        w.writeMetaData({'height': 240})
+        w.writeTag(message.VIDEO_DATA, 0, '\x17' + 'k' * 40)
+
+        d = w.open()
+
+        def write(_):
+            w.writeTag(message.AUDIO_DATA, 20, 'a' * 30)
+            w.writeTag(message.VIDEO_DATA, 40, '\x27' + 'i' * 40)
+            w.writeTag(message.VIDEO_DATA, 1500, '\x17' + 'k' * 40)
+
+            return w.close()
+
+        def check(result):
+            self.assertIdentical(result, w)
+
+            meta, tags = readFLV(self.filename)
+
+            self.assertEqual(meta, {'width': 320, 'height': 240,
+                'duration': 1.5, 'filesize': os.path.getsize(self.filename)})
+            self.assertEqual([(t[0], t[1]) for t in tags], [
+                (message.VIDEO_DATA, 0), (message.AUDIO_DATA, 20),
+                (message.VIDEO_DATA, 40), (message.VIDEO_DATA, 1500)])
+
+            data = open(self.filename, 'rb').read()
+
+            self.assertEqual(w.index.times, [0, 1500])
+            self.assertEqual(w.index.metaData, len(flv.HEADER))
+
+            for offset in w.index.offsets:
+                self.assertEqual(data[offset], '\x09')
+                self.assertEqual(data[offset + 11], '\x17')
+
+            # the sidecar is up to date
+            index = flv.readIndex(self.filename)
+
+            self.assertEqual(list(index.times), w.index.times)
+            self.assertEqual(list(index.offsets), w.index.offsets)
+            self.assertEqual(index.duration, 1500)
+
+            index.close()
+
+        d.addCallback(write)
+
+        return d.addCallback(check)
+
+    def test_append(self):
+        d = self.writer.open()
+
+        def first(_):
+            self.writer.writeTag(message.VIDEO_DATA, 1000, '\x17first')
+
+            return self.writer.close()
+
+        def second(_):
+            self.writer = flv.FLVWriter(self.filename, append=True)
+
+            return self.writer.open()
+
+        def write(_):
+            self.writer.writeMetaData({'ignored': True})
+            self.writer.writeTag(message.VIDEO_DATA, 500, '\x17second')
+
+            return self.writer.close()
+
+        def check(_):
+            meta, tags = readFLV(self.filename)
+
+            self.assertEqual([(t[0], t[1]) for t in tags], [
+                (message.VIDEO_DATA, 1000), (message.NOTIFY, 1000),
+                (message.VIDEO_DATA, 1500)])
+            self.assertEqual(tags[2][2], '\x17second')
+            self.assertEqual(meta['duration'], 1.5)
+            self.assertEqual(meta['filesize'], os.path.getsize(self.filename))
+
+            # the index carries on from the sidecar
+            index = flv.readIndex(self.filename)
+
+            self.assertEqual(list(index.times), [1000, 1500])
+
+            index.close()
+
+        d.addCallback(first)
+        d.addCallback(second)
+        d.addCallback(write)
+
+        return d.addCallback(check)
+
+    def test_append_stale(self):
+        """
+        Appending to a file with an out of date sidecar removes the sidecar.
+        """
+        d = self.writer.open()
+
+        def first(_):
+            self.writer.writeTag(message.VIDEO_DATA, 0, '\x17first')
+
+            return self.writer.close()
+
+        def second(_):
+            os.utime(self.filename, (0, 0))
+
+            self.writer = flv.FLVWriter(self.filename, append=True)
+
+            return self.writer.open()
+
+        def write(_):
+            self.assertIdentical(self.writer.index, None)
+
+            self.writer.writeTag(message.VIDEO_DATA, 500, '\x17second')
+
+            return self.writer.close()
+
+        def check(_):
+            self.assertFalse(os.path.exists(flv.getIndexFilename(
+                self.filename)))
+
+        d.addCallback(first)
+        d.addCallback(second)
+        d.addCallback(write)
+
+        return d.addCallback(check)
+
+    def test_close_opening(self):
+        """
+        Closing a writer that is still opening writes the tags.
+        """
+        self.writer.open()
+        self.writer.writeTag(message.AUDIO_DATA, 10, 'foo')
+
+        def check(_):
+            meta, tags = readFLV(self.filename)
+
+            self.assertEqual(tags, [(message.AUDIO_DATA, 10, 'foo')])
+
+        return self.writer.close().addCallback(check)
+
+    def test_blocks(self):
+        """
+        The tags are buffered until there is a block to write.
+        """
+        w = self.writer
+        writes = []
+        write = w._write
+
+        def record(data):
+            writes.append(len(data))
+            write(data)
+
+        w._write = record
+
+        def check(_):
+            # the header and metadata fill the first block
+            w.writeTag(message.AUDIO_DATA, 0, 'a' * 10)
+
+            self.assertEqual(w._buffered, 0)
+
+            w.writeTag(message.AUDIO_DATA, 0, 'a' * 10)
+            w.writeTag(message.AUDIO_DATA, 0, 'a' * 10)
+
+            self.assertEqual(w._buffered, 50)
+
+            w.writeTag(message.AUDIO_DATA, 0, 'a' * 10)
+
+            self.assertEqual(w._buffered, 0)
+
+            return w.close()
+
+        d = w.open().addCallback(check)
+
+        return d.addCallback(lambda _: self.assertEqual(len(writes), 2))
+
+    def test_failure(self):
+        w = flv.FLVWriter(os.path.join(self.mktemp(), 'foo.flv'))
+
+        d = w.open()
+        w.writeTag(message.AUDIO_DATA, 0, 'foo')
+
+        def check(_):
+            self.assertEqual(len(self.flushLoggedErrors(IOError)), 1)
+            self.assertNotIdentical(w.failure, None)
+
+            return w.close()
+
+        return d.addErrback(check)
+
+
+
+class RecordingTestCase(unittest.TestCase):
+    """
+    Tests for recording published streams.
+    """
+
+    def setUp(self):
+        self.app = server.Application()
+        self.app.recordPath = self.mktemp()
+        os.mkdir(self.app.recordPath)
+
+        self.client = server.Client(None)
+        self.client.id = 'foo'
+
+    def test_filename(self):
+        self.assertEqual(self.app.getRecordingFilename('a/b'),
+            os.path.join(os.path.abspath(self.app.recordPath), 'a', 'b.flv'))
+        self.assertRaises(exc.BadNameError, self.app.getRecordingFilename,
+            '../foo')
+
+    def test_live(self):
+        publisher = self.app.publishStream(self.client, None, 'foo')
+
+        self.assertEqual(publisher.subscribers, {})
+
+    def test_record(self):
+        publisher = self.app.publishStream(self.client, None, 'foo', 'record')
+
+        recorder, = publisher.subscribers.keys()
+
+        self.assertIsInstance(recorder, flv.FLVRecorder)
+        self.assertFalse(recorder.writer.append)
+
+        publisher.onMetaData({'width': 320})
+        publisher.videoDataReceived('\x17key', 10)
+        publisher.audioDataReceived('audio', 20)
+
+        def check(_):
+            meta, tags = readFLV(os.path.join(self.app.recordPath, 'foo.flv'))
+
+            self.assertEqual(meta['width'], 320)
+            self.assertEqual(tags, [(message.VIDEO_DATA, 10, '\x17key'),
+                (message.AUDIO_DATA, 20, 'audio')])
+
+        return recorder.unpublish().addCallback(check)
+
+    def test_append(self):
+        publisher = self.app.publishStream(self.client, None, 'foo', 'append')
+
+        recorder, = publisher.subscribers.keys()
+
+        self.assertTrue(recorder.writer.append)
+
+        return recorder.unpublish()
+
+    def test_bad_name(self):
+        self.assertRaises(exc.BadNameError, self.app.publishStream,
+            self.client, None, '../foo', 'record')
+        self.assertEqual(self.app.streams, {})
+
+
+
+#: 4 seconds of video at 2fps with a keyframe every 2 seconds, and audio,
+#: after the H.264 and AAC sequence headers.
+TAGS = [
+    (message.NOTIFY, 0, flv.encodeMetaData({'width': 320})[0]),
+    (message.VIDEO_DATA, 0, '\x17\x00avc'),
+    (message.AUDIO_DATA, 0, '\xaf\x00aac'),
+]
+
+for _i in xrange(8):
+    TAGS.append((message.VIDEO_DATA, _i * 500,
+        (_i % 4 and '\x27' or '\x17') + str(_i)))
+    TAGS.append((message.AUDIO_DATA, _i * 500 + 10, 'a' + str(_i)))
+
+
+
+class FLVFileTestCase(unittest.TestCase):
+    """
+    Tests for L{flv.FLVFile}.
+    """
+
+    def setUp(self):
+        self.file = flv.FLVFile(writeFLV(self.mktemp(), TAGS))
+
+        return self.file.open()
+
+    def tearDown(self):
+        self.file.close()
+
+    def test_index(self):
+        f = self.file
+
+        self.assertEqual(f.dataOffset, len(flv.HEADER))
+        self.assertEqual(f.duration, 3510)
+        self.assertEqual(list(f.index.times), [0, 2000])
+
+        for offset in f.index.offsets:
+            datatype, timestamp, data, next = f.readTag(offset)
+
+            self.assertEqual(datatype, message.VIDEO_DATA)
+            self.assertEqual(data[0], '\x17')
+
+        self.assertEqual(f.index.metaData, len(flv.HEADER))
+        self.assertEqual(f.readTag(f.index.videoConfig)[2], '\x17\x00avc')
+        self.assertEqual(f.readTag(f.index.audioConfig)[2], '\xaf\x00aac')
+
+    def test_sidecar(self):
+        """
+        The index is saved when the file is first opened and loaded (rather
+        than built) after that.
+        """
+        self.assertTrue(os.path.exists(flv.getIndexFilename(
+            self.file.filename)))
+
+        f = flv.FLVFile(self.file.filename)
+        f.scan = None
+
+        def check(_):
+            self.assertIsInstance(f.index.times, flv._Column)
+            self.assertEqual(list(f.index.times), [0, 2000])
+            self.assertEqual(list(f.index.offsets),
+                list(self.file.index.offsets))
+            self.assertEqual(f.duration, 3510)
+            self.assertEqual(f.index.videoConfig,
+                self.file.index.videoConfig)
+            self.assertEqual(f.seek(2500), self.file.seek(2500))
+
+            f.close()
+
+        return f.open().addCallback(check)
+
+    def test_stale(self):
+        """
+        The sidecar of a file that has changed is replaced.
+        """
+        f = open(self.file.filename, 'ab')
+        f.write(flv.encodeTag(message.VIDEO_DATA, 4000, '\x17end'))
+        f.close()
+
+        f = flv.FLVFile(self.file.filename)
+
+        def check(_):
+            self.assertEqual(list(f.index.times), [0, 2000, 4000])
+
+            f.close()
+
+            index = flv.readIndex(self.file.filename)
+
+            self.assertEqual(list(index.times), [0, 2000, 4000])
+
+            index.close()
+
+        return f.open().addCallback(check)
+
+    def test_read(self):
+        offset = self.file.dataOffset
+        tags = []
+
+        while True:
+            tag = self.file.readTag(offset)
+
+            if tag is None:
+                break
+
+            tags.append(tag[:3])
+            offset = tag[3]
+
+        self.assertEqual(tags, TAGS)
+
+    def test_seek(self):
+        f = self.file
+
+        self.assertEqual(f.seek(-1), f.dataOffset)
+        self.assertEqual(f.seek(1999), f.index.offsets[0])
+        self.assertEqual(f.seek(2000), f.index.offsets[1])
+        self.assertEqual(f.seek(10000), f.index.offsets[1])
+
+    def test_open_shared(self):
+        f = flv.FLVFile(self.file.filename)
+
+        d1, d2 = f.open(), f.open()
+
+        def check(result):
+            self.assertEqual(result, [(True, f), (True, f)])
+            self.assertEqual(list(f.index.times), [0, 2000])
+
+            f.close()
+
+        return defer.DeferredList([d1, d2]).addCallback(check)
+
+    def blockScan(self, f):
+        """
+        Makes the thread opening C{f} wait in L{flv.FLVFile.scan} until the
+        returned event is set.
+        """
+        scanning, proceed = threading.Event(), threading.Event()
+        scan = f.scan
+
+        def blocked(*args):
+            scanning.set()
+            proceed.wait(10)
+
+            return scan(*args)
+
+        f.scan = blocked
+        self.addCleanup(proceed.set)
+
+        return scanning, proceed
+
+    def test_open_scanning(self):
+        """
+        Opening a file that is being scanned waits for the index.
+        """
+        f = flv.FLVFile(writeFLV(self.mktemp(), TAGS))
+        scanning, proceed = self.blockScan(f)
+
+        d1 = f.open()
+        scanning.wait(10)
+        d2 = f.open()
+
+        self.assertFalse(d2.called)
+        self.assertIdentical(f.mmap, None)
+        self.assertIdentical(f.index, None)
+
+        proceed.set()
+
+        def check(result):
+            self.assertEqual(result, [(True, f), (True, f)])
+            self.assertEqual(f.dataOffset, len(flv.HEADER))
+            self.assertEqual(f.readTag(f.dataOffset)[:3], TAGS[0])
+
+            f.close()
+
+        return defer.DeferredList([d1, d2]).addCallback(check)
+
+    def test_open_loading(self):
+        """
+        Opening a file whose sidecar is being loaded waits for the index.
+        """
+        scanning, proceed = threading.Event(), threading.Event()
+        readIndex = flv.readIndex
+
+        def blocked(*args):
+            scanning.set()
+            proceed.wait(10)
+
+            return readIndex(*args)
+
+        self.patch(flv, 'readIndex', blocked)
+        self.addCleanup(proceed.set)
+
+        f = flv.FLVFile(self.file.filename)
+        f.scan = None
+
+        d1 = f.open()
+        scanning.wait(10)
+        d2 = f.open()
+
+        self.assertFalse(d2.called)
+        self.assertIdentical(f.index, None)
+
+        proceed.set()
+
+        def check(result):
+            self.assertEqual(result, [(True, f), (True, f)])
+            self.assertIsInstance(f.index.times, flv._Column)
+            self.assertEqual(f.duration, 3510)
+
+            f.close()
+
+        return defer.DeferredList([d1, d2]).addCallback(check)
+
+    def test_close_opening(self):
+        """
+        Closing a file that is being opened unmaps it once the thread is done
+        and fails the pending opens.
+        """
+        f = flv.FLVFile(writeFLV(self.mktemp(), TAGS))
+        scanning, proceed = self.blockScan(f)
+
+        d = f.open()
+        scanning.wait(10)
+        f.close()
+        proceed.set()
+
+        def check(_):
+            self.assertIdentical(f.mmap, None)
+            self.assertIdentical(f.index, None)
+
+            return f.open()
+
+        def reopened(_):
+            self.assertEqual(list(f.index.times), [0, 2000])
+
+            f.close()
+
+        d = self.assertFailure(d, defer.CancelledError)
+
+        return d.addCallback(check).addCallback(reopened)
+
+    def test_audio(self):
+        f = flv.FLVFile(writeFLV(self.mktemp(), [(message.AUDIO_DATA, i * 250,
+            'a') for i in xrange(10)]))
+
+        def check(_):
+            self.assertEqual(list(f.index.times), [0, 1000, 2000])
+
+            f.close()
+
+        return f.open().addCallback(check)
+
+    def test_not_flv(self):
+        filename = self.mktemp()
+        open(filename, 'wb').write('foo' * 10)
+
+        f = flv.FLVFile(filename)
+
+        d = f.open()
+
+        def check(_):
+            self.assertIdentical(f.mmap, None)
+
+        return self.assertFailure(d, ValueError).addCallback(check)
+
+
+
+class Subscriber(object):
+    """
+    Records what an L{flv.FLVPlayer} plays.
+    """
+
+    def __init__(self):
+        self.tags = []
+        self.meta = None
+        self.complete = False
+
+    def videoDataReceived(self, data, timestamp):
+        self.tags.append((message.VIDEO_DATA, timestamp, data))
+
+    def audioDataReceived(self, data, timestamp):
+        self.tags.append((message.AUDIO_DATA, timestamp, data))
+
+    def onMetaData(self, meta):
+        self.meta = meta
+
+    def playComplete(self):
+        self.complete = True
+
+
+
+class FLVPlayerTestCase(unittest.TestCase):
+    """
+    Tests for L{flv.FLVPlayer}.
+    """
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.released = []
+        self.file = flv.FLVFile(writeFLV(self.mktemp(), TAGS))
+        self.player = flv.FLVPlayer(self.file, 1.0, self.released.append,
+            self.clock)
+        self.subscriber = Subscriber()
+
+        return self.file.open()
+
+    def tearDown(self):
+        self.file.close()
+
+    def test_burst(self):
+        s = self.subscriber
+
+        self.player.addSubscriber(s)
+
+        self.assertEqual(s.tags, [])
+
+        self.clock.advance(0)
+
+        # the first second is sent straight away
+        self.assertEqual(s.meta, {'width': 320, 'duration': 0, 'filesize': 0})
+        self.assertEqual([t[1] for t in s.tags], [0, 0, 0, 10, 500, 510,
+            1000])
+
+        self.clock.advance(0.5)
+
+        self.assertEqual([t[1] for t in s.tags][7:], [1010, 1500])
+
+        self.clock.advance(3)
+
+        self.assertEqual(s.tags, [t for t in TAGS if t[0] != message.NOTIFY])
+        self.assertTrue(s.complete)
+
+    def test_seek(self):
+        s = self.subscriber
+
+        self.player.addSubscriber(s)
+        self.clock.advance(0)
+        del s.tags[:]
+
+        self.player.seek(2600)
+        self.clock.advance(0)
+
+        # the sequence headers come first
+        self.assertEqual(s.tags[:2], [(message.VIDEO_DATA, 2000,
+            '\x17\x00avc'), (message.AUDIO_DATA, 2000, '\xaf\x00aac')])
+        self.assertEqual([t[1] for t in s.tags[2:]], [2000, 2010, 2500, 2510,
+            3000])
+
+    def test_remove(self):
+        s = self.subscriber
+
+        self.player.addSubscriber(s)
+        self.player.removeSubscriber(s)
+        self.clock.advance(10)
+
+        self.assertEqual(s.tags, [])
+        self.assertEqual(self.released, [self.file])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_cache(self):
+        """
+        With a cache, the a/v tags are passed with their key.
+        """
+        keys = []
+        s = self.subscriber
+        s.videoDataReceived = lambda data, ts, key: keys.append(key)
+        s.audioDataReceived = s.videoDataReceived
+
+        self.player.cache = flv.ChunkCache(1000)
+        self.player.addSubscriber(s)
+        self.clock.advance(10)
+
+        offset = self.file.dataOffset
+        offsets = []
+
+        while True:
+            tag = self.file.readTag(offset)
+
+            if tag is None:
+                break
+
+            if tag[0] != message.NOTIFY:
+                offsets.append(offset)
+
+            offset = tag[3]
+
+        self.assertEqual(keys, [(self.file.key, offset) for offset in offsets])
+
+    def test_max_tags(self):
+        self.player.maxTags = 2
+        self.player.burst = 10
+        self.player.addSubscriber(self.subscriber)
+        self.player.stop()
+        self.player._send()
+
+        # the metadata and a video tag, the rest is left to the reactor
+        self.assertEqual(len(self.subscriber.tags), 1)
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+
+        self.clock.advance(0)
+
+        self.assertTrue(self.subscriber.complete)
+
+
+
+class VODTestCase(unittest.TestCase):
+    """
+    Tests for playing files from L{server.Application.vodPath}.
+    """
+
+    def setUp(self):
+        self.app = server.Application()
+        self.app.vodPath = self.mktemp()
+        os.mkdir(self.app.vodPath)
+
+        writeFLV(os.path.join(self.app.vodPath, 'foo.flv'), TAGS)
+
+    def test_filename(self):
+        self.assertEqual(self.app.getVODFilename('a/b'),
+            os.path.join(os.path.abspath(self.app.vodPath), 'a', 'b.flv'))
+        self.assertRaises(exc.BadNameError, self.app.getVODFilename, '../foo')
+
+    def test_missing(self):
+        d = self.app.openVOD('bar')
+
+        return d.addCallback(self.assertIdentical, None)
+
+    def test_bad_name(self):
+        return self.assertFailure(self.app.openVOD('../foo'),
+            exc.BadNameError)
+
+    def test_cache(self):
+        d = self.app.openVOD('foo')
+
+        def check(player):
+            self.assertIdentical(player.cache, None)
+
+            self.app.vodCacheSize = 1000
+
+            return self.app.openVOD('foo')
+
+        def cached(player):
+            self.assertIsInstance(player.cache, flv.ChunkCache)
+            self.assertIdentical(player.cache, self.app.getChunkCache())
+            self.assertEqual(player.cache.maxSize, 1000)
+
+        d.addCallback(check)
+
+        return d.addCallback(cached)
+
+    def test_shared(self):
+        d = defer.gatherResults([self.app.openVOD('foo'),
+            self.app.openVOD('foo')])
+
+        def check(players):
+            a, b = players
+
+            self.assertIsInstance(a, flv.FLVPlayer)
+            self.assertIdentical(a.file, b.file)
+            self.assertEqual(a.burst, self.app.vodBurst)
+
+            for player in players:
+                player.reactor = task.Clock()
+                player.addSubscriber(Subscriber())
+
+            a.removeSubscriber(a.subscriber)
+
+            self.assertNotIdentical(a.file.mmap, None)
+
+            b.removeSubscriber(b.subscriber)
+
+            self.assertIdentical(b.file.mmap, None)
+            self.assertEqual(self.app._vodFiles, {})
+
+        return d.addCallback(check)
+
+
+
+class ChunkCacheTestCase(unittest.TestCase):
+    """
+    Tests for L{flv.ChunkCache}.
+    """
+
+    def setUp(self):
+        self.cache = flv.ChunkCache(40)
+        self.channel = self.buildChannel()
+
+    def buildChannel(self, channelsInUse=0):
+        encoder = codec.Encoder(BufferedByteStream())
+        encoder.setFrameSize(4)
+        encoder.channelsInUse = channelsInUse
+
+        return codec.StreamingChannel(encoder, 1, BufferedByteStream())
+
+    def test_frames(self):
+        frames = self.cache.getFrames('a', 'x' * 10, self.channel)
+
+        self.assertEqual(frames, self.channel.encodeFrames('x' * 10))
+        self.assertEqual(self.cache.size, len(frames))
+
+        self.assertIdentical(self.cache.getFrames('a', 'x' * 10, self.channel),
+            frames)
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+    def test_one_frame(self):
+        self.assertEqual(self.cache.getFrames('a', 'xxxx', self.channel),
+            'xxxx')
+        self.assertEqual(self.cache.size, 0)
+
+    def test_channels(self):
+        """
+        The frames are cached per continuation header.
+        """
+        other = self.buildChannel(10)
+
+        a = self.cache.getFrames('a', 'x' * 10, self.channel)
+        b = self.cache.getFrames('a', 'x' * 10, other)
+
+        self.assertNotEqual(a, b)
+        self.assertEqual(self.cache.misses, 2)
+
+    def test_lru(self):
+        for key in 'abc':
+            self.cache.getFrames(key, 'x' * 10, self.channel)
+
+        # 12 bytes per tag
+        self.cache.getFrames('a', 'x' * 10, self.channel)
+        self.cache.getFrames('d', 'x' * 10, self.channel)
+
+        self.assertEqual(self.cache.size, 36)
+        self.assertEqual([key[0] for key in self.cache._entries],
+            ['c', 'a', 'd'])
+
+    def test_too_big(self):
+        self.cache.getFrames('a', 'x' * 50, self.channel)
+
+        self.assertEqual(self.cache.size, 0)
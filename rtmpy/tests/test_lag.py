@@ -0,0 +1,105 @@
+# Copyright the RTMPy Project
+#
+# RTMPy is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# RTMPy is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with RTMPy.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Tests for L{rtmpy.lag}.
+"""
+
+from twisted.trial import unittest
+from twisted.internet import task, defer
+
+from rtmpy import lag, metrics
+
+
+
+class LagMonitorTestCase(unittest.TestCase):
+    """
+    Tests for L{lag.LagMonitor}
+    """
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.registry = metrics.Registry()
+        self.monitor = lag.LagMonitor(1.0, self.clock, self.registry)
+
+        self.monitor.start()
+        self.addCleanup(self.monitor.stop)
+
+    def test_sample(self):
+        self.clock.advance(1.0)
+
+        self.assertEqual(self.monitor.lag, 0.0)
+        self.assertEqual(self.monitor.samples, 1)
+
+        # the reactor was blocked for 2 seconds
+        self.clock.advance(3.0)
+
+        self.assertEqual(self.monitor.lag, 2.0)
+        self.assertEqual(self.monitor.maxLag, 2.0)
+        self.assertTrue(self.monitor.isLagging(1.0))
+
+        self.clock.advance(1.0)
+
+        self.assertEqual(self.monitor.lag, 1.4)
+        self.assertEqual(self.monitor.maxLag, 2.0)
+
+    def test_metric(self):
+        self.clock.advance(3.0)
+
+        self.assertEqual(self.registry.samples(), [
+            ('rtmpy_reactor_lag_max_seconds', {}, 2.0),
+            ('rtmpy_reactor_lag_seconds', {}, 2.0),
+        ])
+
+        self.monitor.stop()
+
+        self.assertEqual(self.registry.samples(), [])
+
+    def test_when_below(self):
+        self.assertTrue(self.monitor.whenBelow(0.5, 10).called)
+
+        self.clock.advance(3.0)
+
+        d = self.monitor.whenBelow(0.5, 10)
+        result = []
+        d.addCallback(result.append)
+
+        for i in xrange(4):
+            self.clock.advance(1.0)
+
+        self.assertEqual(len(result), 1)
+        self.assertTrue(result[0] <= 0.5)
+
+    def test_when_below_timeout(self):
+        self.clock.advance(101.0)
+
+        d = self.monitor.whenBelow(0.5, 2)
+
+        self.clock.advance(1.0)
+        self.clock.advance(1.0)
+
+        return self.assertFailure(d, defer.TimeoutError)
+
+    def test_stop(self):
+        self.clock.advance(3.0)
+
+        d = self.monitor.whenBelow(0.5, 10)
+
+        self.monitor.stop()
+
+        self.assertFalse(self.monitor.running)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+        return self.assertFailure(d, defer.CancelledError)
@@ -0,0 +1,112 @@
+# Copyright the RTMPy Project
+#
+# RTMPy is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# RTMPy is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with RTMPy.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Tests for L{rtmpy.scripts.loadgen}.
+"""
+
+from twisted.trial import unittest
+
+from rtmpy.scripts import loadgen
+
+
+
+class PercentileTestCase(unittest.TestCase):
+    """
+    Tests for L{loadgen.percentile}
+    """
+
+    def test_empty(self):
+        self.assertEqual(loadgen.percentile([], 50), None)
+
+    def test_values(self):
+        values = [x / 1000.0 for x in range(1, 101)]
+
+        self.assertEqual(loadgen.percentile(values, 0), 1.0)
+        self.assertEqual(loadgen.percentile(values, 50), 51.0)
+        self.assertEqual(loadgen.percentile(values, 100), 100.0)
+
+
+
+class StatisticsTestCase(unittest.TestCase):
+    """
+    Tests for L{loadgen.Statistics}
+    """
+
+    def setUp(self):
+        self.stats = loadgen.Statistics()
+
+    def test_latency(self):
+        data = loadgen.VIDEO_KEYFRAME + loadgen._timestamp.pack(100.0) + 'x' * 10
+
+        self.stats.packetReceived(data, now=100.25)
+
+        self.assertEqual(self.stats.messagesReceived, 1)
+        self.assertEqual(self.stats.bytesReceived, len(data))
+        self.assertEqual(self.stats.latencies, [0.25])
+
+    def test_short_packet(self):
+        self.stats.packetReceived('\x17')
+
+        self.assertEqual(self.stats.messagesReceived, 1)
+        self.assertEqual(self.stats.latencies, [])
+
+    def test_reservoir(self):
+        self.stats.maxSamples = 10
+        data = loadgen.AUDIO_FRAME + loadgen._timestamp.pack(0)
+
+        for i in xrange(100):
+            self.stats.packetReceived(data, now=i)
+
+        self.assertEqual(len(self.stats.latencies), 10)
+        self.assertEqual(self.stats.messagesReceived, 100)
+
+    def test_report(self):
+        report = self.stats.report(1, 2, 1024)
+
+        self.assertEqual(report['publishers'], 1)
+        self.assertEqual(report['subscribers'], 2)
+        self.assertEqual(report['memory_per_connection'], 1024)
+        self.assertEqual(report['latency_ms'], {
+            'p50': None, 'p90': None, 'p99': None, 'max': None})
+
+
+
+class LoopbackTestCase(unittest.TestCase):
+    """
+    Runs the load generator against a real server over the loopback interface.
+    """
+
+    def test_run(self):
+        config = {
+            'publishers': 1,
+            'subscribers': 2,
+            'duration': 0.5,
+            'warmup': 0.5,
+            'fps': 25,
+            'video-size': 500,
+            'audio-size': 100,
+            'chunk-size': 1024,
+        }
+
+        d = loadgen.run(config)
+
+        def cb(report):
+            self.assertEqual(report['errors'], 0)
+            self.assertTrue(report['messages_sent'] > 0)
+            self.assertTrue(report['messages_received'] > 0)
+            self.assertNotEqual(report['latency_ms']['p50'], None)
+
+        return d.addCallback(cb)
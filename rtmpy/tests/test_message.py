@@ -57,6 +57,9 @@ class MockMessageListener(object):
     def onVideoData(self, *args, **kwargs):
         self.calls.append(('video', args, kwargs))
 
+    def onSharedObject(self, *args, **kwargs):
+        self.calls.append(('so', args, kwargs))
+
 
 class BaseTestCase(unittest.TestCase):
     """
@@ -636,6 +639,140 @@ class VideoDataTestCase(BaseTestCase):
         self.assertEquals(self.listener.calls, [('video', ('foo', 54), {})])
 
 
+class SharedObjectMessageTestCase(BaseTestCase):
+    """
+    Tests for L{message.SharedObjectMessage}
+    """
+
+    klass = message.SharedObjectMessage
+
+    def test_create(self):
+        x = self.klass()
+        self.assertEquals(x.__dict__, {'name': None, 'version': 0,
+            'persistent': False, 'events': []})
+
+    def test_encode(self):
+        x = self.klass(u'foo', 3, True, [
+            (self.klass.USE_SUCCESS, None),
+            (self.klass.CHANGE, (u'a', 'b')),
+            (self.klass.SUCCESS, u'c'),
+        ])
+
+        x.encode(self.buffer)
+
+        self.assertEquals(self.buffer.getvalue(), '\x00\x03foo\x00\x00\x00'
+            '\x03\x00\x00\x00\x02\x00\x00\x00\x00\x0b\x00\x00\x00\x00\x04'
+            '\x00\x00\x00\x07\x00\x01a\x02\x00\x01b\x05\x00\x00\x00\x03\x00'
+            '\x01c')
+
+    def test_round_trip(self):
+        events = [
+            (self.klass.USE, None),
+            (self.klass.REQUEST_CHANGE, (u'a', {'b': [1, 2]})),
+            (self.klass.REQUEST_REMOVE, u'c'),
+            (self.klass.SEND_MESSAGE, [u'onMsg', 1, u'x']),
+            (self.klass.STATUS, (u'SharedObject.BadPersistence', u'error')),
+            (self.klass.CLEAR, None),
+        ]
+
+        for codecs in [None, message.AMFCodecs()]:
+            buf = BufferedByteStream()
+            self.klass(u'foo', 7, False, events).encode(buf, codecs)
+
+            x = self.klass()
+            x.decode(BufferedByteStream(buf.getvalue()), codecs)
+
+            self.assertEquals((x.name, x.version, x.persistent, x.events),
+                (u'foo', 7, False, events))
+
+    def test_dispatch(self):
+        x = self.klass(u'foo')
+
+        x.dispatch(self.listener, 54)
+
+        self.assertEquals(self.listener.calls, [('so', (x, 54), {})])
+
+
+class FlexSharedObjectMessageTestCase(SharedObjectMessageTestCase):
+    """
+    Tests for L{message.FlexSharedObjectMessage}
+    """
+
+    klass = message.FlexSharedObjectMessage
+
+    def test_encode(self):
+        x = self.klass(u'foo', 3, False, [(self.klass.CHANGE, (u'a', 'b'))])
+
+        x.encode(self.buffer)
+
+        self.assertEquals(self.buffer.getvalue(), '\x03\x00\x03foo\x00\x00'
+            '\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x04\x00\x00\x00\x06'
+            '\x00\x01a\x06\x03b')
+
+    def test_decode_amf0(self):
+        x = self.klass()
+
+        self.buffer.append('\x00\x00\x03foo\x00\x00\x00\x03\x00\x00\x00\x00'
+            '\x00\x00\x00\x00\x04\x00\x00\x00\x07\x00\x01a\x02\x00\x01b')
+        x.decode(self.buffer)
+
+        self.assertEquals(x.encoding, 0)
+        self.assertEquals(x.events, [(x.CHANGE, (u'a', u'b'))])
+
+
+class AggregateTestCase(BaseTestCase):
+    """
+    Tests for L{message.Aggregate}
+    """
+
+    def test_create(self):
+        x = message.Aggregate()
+        self.assertEquals(x.__dict__, {'tags': []})
+
+    def test_encode(self):
+        x = message.Aggregate()
+        x.addTag(message.AUDIO_DATA, 0x01020304, 'foo')
+
+        x.encode(self.buffer)
+
+        self.assertEquals(self.buffer.getvalue(), '\x08\x00\x00\x03\x02\x03'
+            '\x04\x01\x00\x00\x00foo\x00\x00\x00\x0e')
+
+    def test_encode_type(self):
+        x = message.Aggregate([(message.INVOKE, 0, 'foo')])
+
+        self.assertRaises(message.EncodeError, x.encode, self.buffer)
+
+    def test_decode(self):
+        x = message.Aggregate()
+
+        self.buffer.append('\x08\x00\x00\x03\x02\x03\x04\x01\x00\x00\x00foo'
+            '\x00\x00\x00\x0e\x09\x00\x00\x01\x02\x03\x05\x01\x00\x00\x00'
+            'b\x00\x00\x00\x0c')
+        x.decode(self.buffer)
+
+        self.assertEquals(x.tags, [(message.AUDIO_DATA, 0x01020304, 'foo'),
+            (message.VIDEO_DATA, 0x01020305, 'b')])
+
+    def test_dispatch(self):
+        buf = BufferedByteStream()
+        message.Notify('onMetaData', {'a': 1}).encode(buf)
+
+        x = message.Aggregate([
+            (message.AUDIO_DATA, 1000, 'foo'),
+            (message.VIDEO_DATA, 1040, 'bar'),
+            (message.NOTIFY, 1040, buf.getvalue()),
+            (message.INVOKE, 1050, 'ignored'),
+        ])
+
+        x.dispatch(self.listener, 20)
+
+        self.assertEquals(self.listener.calls, [
+            ('audio', ('foo', 20), {}),
+            ('video', ('bar', 60), {}),
+            ('notify', ('onMetaData', [{'a': 1}], 60), {})])
+
+
 class HelperTestCase(unittest.TestCase):
     def test_type_class(self):
         for k, v in message.TYPE_MAP.iteritems():
@@ -643,3 +780,45 @@ class HelperTestCase(unittest.TestCase):
 
         self.assertFalse('foo' in message.TYPE_MAP.keys())
         self.assertRaises(message.UnknownType, message.classByType, 'foo')
+
+
+class AMFCodecsTestCase(unittest.TestCase):
+    """
+    Tests for L{message.AMFCodecs}
+    """
+
+    def setUp(self):
+        self.codecs = message.AMFCodecs()
+
+    def encode(self, msg, codecs=None):
+        buf = BufferedByteStream()
+
+        msg.encode(buf, codecs)
+
+        return buf.getvalue()
+
+    def test_reuse(self):
+        obj = {'foo': 'bar'}
+        a = message.Invoke('_result', 1, None, obj, obj)
+        b = message.Notify('onStatus', obj)
+
+        expected = [self.encode(a), self.encode(b)]
+
+        self.assertEqual([self.encode(a, self.codecs),
+            self.encode(b, self.codecs)], expected)
+        # no object references carried over from the previous message
+        self.assertEqual(self.encode(a, self.codecs), expected[0])
+
+        self.assertEqual(len(self.codecs.encoders), 1)
+
+    def test_decode(self):
+        data = self.encode(message.Invoke('foo', 2, None, {'a': 'b'}))
+
+        for i in xrange(2):
+            m = message.Invoke()
+            m.decode(BufferedByteStream(data), self.codecs)
+
+            self.assertEqual((m.name, m.id, m.argv), ('foo', 2, [None,
+                {'a': 'b'}]))
+
+        self.assertEqual(len(self.codecs.decoders), 1)
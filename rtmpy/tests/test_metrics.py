@@ -0,0 +1,280 @@
+# Copyright the RTMPy Project
+#
+# RTMPy is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# RTMPy is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with RTMPy.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Tests for L{rtmpy.metrics}.
+"""
+
+from twisted.trial import unittest
+from twisted.internet import reactor, defer
+
+from rtmpy import metrics, server, rpc, exc
+from rtmpy.protocol import rtmp
+from rtmpy.protocol.rtmp import codec
+from rtmpy.scripts import loadgen
+
+
+
+class RegistryTestCase(unittest.TestCase):
+    """
+    Tests for L{metrics.Registry}
+    """
+
+    def setUp(self):
+        self.registry = metrics.Registry()
+
+    def test_counter(self):
+        c = self.registry.counter('foo_total', 'Foo', ['bar'])
+
+        c.inc(bar='a')
+        c.inc(2, bar='a')
+        c.inc(bar='b"\n')
+
+        self.assertEqual(c.get(bar='a'), 3)
+        self.assertEqual(self.registry.render(),
+            '# HELP foo_total Foo\n'
+            '# TYPE foo_total counter\n'
+            'foo_total{bar="a"} 3.0\n'
+            'foo_total{bar="b\\"\\n"} 1.0\n')
+
+    def test_labels(self):
+        c = self.registry.counter('foo_total', 'Foo', ['bar'])
+
+        self.assertRaises(ValueError, c.inc)
+        self.assertRaises(ValueError, c.inc, baz='a')
+
+    def test_get_or_create(self):
+        c = self.registry.counter('foo', 'Foo')
+
+        self.assertIdentical(self.registry.counter('foo', 'Foo'), c)
+        self.assertRaises(ValueError, self.registry.gauge, 'foo', 'Foo')
+
+    def test_histogram(self):
+        h = self.registry.histogram('spam_seconds', 'Spam', buckets=(1, 2))
+
+        h.observe(0.5)
+        h.observe(1.5)
+        h.observe(3)
+
+        self.assertEqual(h.get(), (3, 5.0))
+        self.assertEqual(self.registry.render(),
+            '# HELP spam_seconds Spam\n'
+            '# TYPE spam_seconds histogram\n'
+            'spam_seconds_bucket{le="1.0"} 1.0\n'
+            'spam_seconds_bucket{le="2.0"} 2.0\n'
+            'spam_seconds_bucket{le="+Inf"} 3.0\n'
+            'spam_seconds_sum 5.0\n'
+            'spam_seconds_count 3.0\n')
+
+    def test_collector(self):
+        def collect():
+            g = metrics.Gauge('eggs', 'Eggs')
+            g.set(12)
+
+            return [g]
+
+        self.registry.addCollector(collect)
+
+        self.assertEqual(self.registry.samples(), [('eggs', {}, 12)])
+
+        self.registry.removeCollector(collect)
+
+        self.assertEqual(self.registry.samples(), [])
+
+
+
+class EnableTestCase(unittest.TestCase):
+    """
+    Tests for L{metrics.enable} and L{metrics.disable}
+    """
+
+    def tearDown(self):
+        metrics.disable()
+
+    def test_restore(self):
+        originals = [
+            rtmp.StateEngine.__dict__['connectionMade'],
+            rtmp.MessageDispatcher.__dict__['dispatchMessage'],
+            codec.ChannelMuxer.__dict__['send'],
+            codec.StreamingChannel.__dict__['sendData'],
+            codec.StreamingChannel.__dict__['sendFrames'],
+            rpc.AbstractCallHandler.__dict__['callReceived'],
+        ]
+
+        metrics.enable(metrics.Registry())
+
+        self.assertTrue(metrics.enabled)
+        self.assertNotIdentical(
+            rtmp.StateEngine.__dict__['connectionMade'], originals[0])
+
+        metrics.disable()
+
+        self.assertFalse(metrics.enabled)
+        self.assertEqual(originals, [
+            rtmp.StateEngine.__dict__['connectionMade'],
+            rtmp.MessageDispatcher.__dict__['dispatchMessage'],
+            codec.ChannelMuxer.__dict__['send'],
+            codec.StreamingChannel.__dict__['sendData'],
+            codec.StreamingChannel.__dict__['sendFrames'],
+            rpc.AbstractCallHandler.__dict__['callReceived'],
+        ])
+
+
+
+class CallHandler(rpc.AbstractCallHandler):
+    def sendMessage(self, msg, whenDone=None):
+        pass
+
+    @rpc.expose
+    def echo(self, arg):
+        return arg
+
+
+
+class RPCTestCase(unittest.TestCase):
+    """
+    Tests for the RPC timings.
+    """
+
+    def setUp(self):
+        self.registry = metrics.Registry()
+        metrics.enable(self.registry)
+
+    def tearDown(self):
+        metrics.disable()
+
+    def test_unknown_method(self):
+        """
+        Calls to methods that are not exposed share one label.
+        """
+        handler = CallHandler()
+
+        handler.callReceived('echo', 1, 'foo')
+
+        for i in xrange(10):
+            self.failureResultOf(handler.callReceived('nope%d' % (i,), 2 + i),
+                exc.CallFailed)
+
+        samples = {}
+
+        for name, labels, value in self.registry.samples():
+            if name == 'rtmpy_rpc_seconds_count':
+                samples[labels['method']] = value
+
+        self.assertEqual(samples, {'echo': 1, metrics.OTHER_METHOD: 10})
+
+
+
+class LiveTestCase(unittest.TestCase):
+    """
+    Collects metrics from a real publishing session.
+    """
+
+    def setUp(self):
+        self.registry = metrics.Registry()
+        metrics.enable(self.registry)
+
+    def tearDown(self):
+        metrics.disable()
+
+    def test_publish(self):
+        app = server.Application()
+        factory = server.ServerFactory({'bench': app})
+        app.getExecutor()
+        port = reactor.listenTCP(0, factory, interface='127.0.0.1')
+
+        stats = loadgen.Statistics()
+        stats.finished = False
+
+        client = loadgen.ClientFactory(loadgen.PublishingProtocol, stats,
+            'foo', fps=50, videoSize=500, audioSize=100, frameSize=1024)
+
+        connector = reactor.connectTCP('127.0.0.1', port.getHost().port,
+            client)
+
+        d = defer.Deferred()
+
+        def check():
+            samples = {}
+
+            for name, labels, value in self.registry.samples():
+                samples[name, tuple(sorted(labels.items()))] = value
+
+            # client and server
+            self.assertEqual(samples['rtmpy_connections_total', ()], 2)
+            self.assertEqual(samples['rtmpy_handshake_seconds_count', ()], 2)
+            self.assertTrue(samples['rtmpy_messages_received_total',
+                (('datatype', 'video_data'),)] > 0)
+            self.assertTrue(samples['rtmpy_sent_bytes_total',
+                (('datatype', 'audio_data'),)] > 0)
+            self.assertEqual(samples['rtmpy_connections',
+                (('application', 'bench'),)], 1)
+            self.assertEqual(samples['rtmpy_stream_subscribers',
+                (('application', 'bench'), ('stream', 'foo'))], 0)
+            self.assertTrue(samples['rtmpy_rpc_seconds_count',
+                (('method', 'connect'),)] >= 1)
+            self.assertEqual(samples['rtmpy_executor_queued_calls',
+                (('executor', 'application:bench'),)], 0)
+
+            text = self.registry.render()
+
+            self.assertTrue('# TYPE rtmpy_encoder_pending_messages gauge'
+                in text)
+
+        def stop():
+            try:
+                check()
+            except:
+                d.errback()
+            else:
+                d.callback(None)
+
+            stats.finished = True
+            connector.disconnect()
+
+        reactor.callLater(0.5, stop)
+
+        def cleanup(result):
+            later = defer.Deferred()
+            reactor.callLater(0.1, later.callback, None)
+
+            return later.addCallback(lambda _: port.stopListening()).addCallback(
+                lambda _: result)
+
+        return d.addBoth(cleanup)
+
+
+
+class ResourceTestCase(unittest.TestCase):
+    """
+    Tests for L{metrics.getResource}
+    """
+
+    def test_render(self):
+        try:
+            from twisted.web.test.requesthelper import DummyRequest
+        except ImportError:
+            from twisted.web.test.test_web import DummyRequest
+
+        registry = metrics.Registry()
+        registry.counter('foo_total', 'Foo').inc()
+
+        request = DummyRequest([''])
+        body = metrics.getResource(registry).render(request)
+
+        self.assertEqual(body, registry.render())
+        self.assertEqual(
+            request.responseHeaders.getRawHeaders('content-type'),
+            ['text/plain; version=0.0.4'])
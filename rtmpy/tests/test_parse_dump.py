@@ -0,0 +1,399 @@
+# Copyright the RTMPy Project
+#
+# RTMPy is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# RTMPy is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with RTMPy.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Tests for L{rtmpy.scripts.parse_dump}.
+"""
+
+import os
+import struct
+import shutil
+import tempfile
+import unittest
+from StringIO import StringIO
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from pyamf.util import BufferedByteStream
+
+from rtmpy import message
+from rtmpy.protocol.rtmp import codec
+from rtmpy.scripts import parse_dump
+
+
+CLIENT = ('\x0a\x00\x00\x01', 50000)
+SERVER = ('\x0a\x00\x00\x02', 1935)
+
+
+def to_c_array(name, data, width=8):
+    lines = ['char %s[] = {' % (name,)]
+    values = ['0x%02x' % (ord(x),) for x in data]
+
+    for i in xrange(0, len(values), width):
+        lines.append(', '.join(values[i:i + width]) + ',')
+
+    lines[-1] = lines[-1][:-1] + ' };'
+
+    return '\n'.join(lines) + '\n'
+
+
+def tcp_segment(src, dst, seq, payload='', flags=0x18):
+    tcp = struct.pack('!HHLLBBHHH', src[1], dst[1], seq, 0, 5 << 4, flags,
+        0xffff, 0, 0)
+
+    return tcp + payload
+
+
+def ipv4_frame(src, dst, seq, payload='', flags=0x18):
+    tcp = tcp_segment(src, dst, seq, payload, flags)
+    ip = struct.pack('!BBHHHBBH4s4s', 0x45, 0, 20 + len(tcp), 0, 0, 64, 6, 0,
+        src[0], dst[0])
+
+    # ethernet frames are padded to a minimum length
+    return '\x00' * 12 + '\x08\x00' + ip + tcp + '\x00' * 6
+
+
+def pcap(frames, linktype=1):
+    """
+    @param frames: A list of frames or C{(time, frame)} tuples.
+    """
+    s = struct.pack('<LHHlLLL', 0xa1b2c3d4, 2, 4, 0, 0, 65535, linktype)
+
+    for frame in frames:
+        t = 0
+
+        if isinstance(frame, tuple):
+            t, frame = frame
+
+        s += struct.pack('<LLLL', int(t), int(round(t % 1 * 1e6)), len(frame),
+            len(frame)) + frame
+
+    return s
+
+
+def encode(encoder, msg, streamId=0, timestamp=0):
+    buf = BufferedByteStream()
+    msg.encode(buf)
+
+    encoder.send(buf.getvalue(), msg.__data_type__, streamId, timestamp)
+
+    while encoder.active:
+        encoder.next()
+
+
+def rtmp_stream(*messages):
+    """
+    Returns the handshake followed by the encoded C{messages}.
+    """
+    output = BufferedByteStream()
+    encoder = codec.Encoder(output)
+
+    for msg in messages:
+        encode(encoder, msg)
+
+    return '\x03' + '\x00' * 1536 * 2 + output.getvalue()
+
+
+
+class Observer(object):
+
+    def __init__(self):
+        self.messages = []
+
+    def messageStart(self, packet):
+        pass
+
+    def messageReceived(self, msg):
+        self.messages.append((msg.type, msg.context))
+
+    def messageComplete(self, packet):
+        pass
+
+
+
+class ParseBytesTestCase(unittest.TestCase):
+    """
+    Tests for L{parse_dump.parse_bytes}
+    """
+
+    def test_simple(self):
+        self.assertEqual(parse_dump.parse_bytes('0x03, 0x0a, 0xff,'),
+            '\x03\x0a\xff')
+
+    def test_no_padding(self):
+        self.assertEqual(parse_dump.parse_bytes('0x3, 0xa,0xFF'),
+            '\x03\x0a\xff')
+
+    def test_empty(self):
+        self.assertEqual(parse_dump.parse_bytes(''), '')
+
+
+
+class ReadDumpTestCase(unittest.TestCase):
+    """
+    Tests for L{parse_dump.read_dump}
+    """
+
+    def test_blocks(self):
+        f = StringIO(to_c_array('peer0_0', 'foobar' * 10) +
+            to_c_array('peer1_0', 'spam') + '\r\n' +
+            to_c_array('peer0_1', 'eggs'))
+
+        self.assertEqual(list(parse_dump.read_dump(f)), [
+            ('send', 'foobar' * 10),
+            ('recv', 'spam'),
+            ('send', 'eggs'),
+        ])
+
+    def test_missing_data(self):
+        f = StringIO(to_c_array('peer0_0', 'foo') +
+            '[1234 bytes missing in capture file]\n')
+
+        gen = parse_dump.read_dump(f)
+
+        self.assertEqual(gen.next(), ('send', 'foo'))
+        self.assertRaises(parse_dump.MissingDataError, gen.next)
+
+    def test_parse(self):
+        data = rtmp_stream(message.FrameSize(4096), message.BytesRead(200))
+        observer = Observer()
+
+        parse_dump.parse_dump(StringIO(to_c_array('peer0_0', data)), observer)
+
+        self.assertEqual(observer.messages, [
+            ('frame_size', {'size': 4096}),
+            ('bytes_read', {'value': 200}),
+        ])
+
+
+
+class ReadPcapTestCase(unittest.TestCase):
+    """
+    Tests for L{parse_dump.read_pcap}
+    """
+
+    def read(self, frames, **kwargs):
+        return list(parse_dump.read_pcap(StringIO(pcap(frames)), **kwargs))
+
+    def read_raw(self, data):
+        return list(parse_dump.read_pcap(StringIO(data)))
+
+    def test_not_pcap(self):
+        self.assertRaises(parse_dump.PcapError, self.read_raw, 'x' * 24)
+
+    def test_link_type(self):
+        self.assertRaises(parse_dump.PcapError, self.read_raw,
+            pcap([], linktype=999))
+
+    def test_directions(self):
+        frames = [
+            ipv4_frame(CLIENT, SERVER, 99, flags=0x02),
+            ipv4_frame(SERVER, CLIENT, 499, flags=0x12),
+            ipv4_frame(CLIENT, SERVER, 100, 'foo'),
+            ipv4_frame(SERVER, CLIENT, 500, 'bar'),
+            ipv4_frame(CLIENT, SERVER, 103, 'baz'),
+        ]
+
+        self.assertEqual(self.read(frames), [
+            ('send', 'foo'),
+            ('recv', 'bar'),
+            ('send', 'baz'),
+        ])
+
+    def test_retransmission(self):
+        frames = [
+            ipv4_frame(CLIENT, SERVER, 100, 'foo'),
+            ipv4_frame(CLIENT, SERVER, 100, 'foo'),
+            ipv4_frame(CLIENT, SERVER, 101, 'oob'),
+            ipv4_frame(CLIENT, SERVER, 104, 'ar'),
+        ]
+
+        self.assertEqual(self.read(frames), [
+            ('send', 'foo'),
+            ('send', 'b'),
+            ('send', 'ar'),
+        ])
+
+    def test_gap(self):
+        frames = [
+            ipv4_frame(CLIENT, SERVER, 100, 'foo'),
+            ipv4_frame(CLIENT, SERVER, 200, 'bar'),
+        ]
+
+        self.assertRaises(parse_dump.MissingDataError, self.read, frames)
+
+    def test_other_connections(self):
+        other = ('\x0a\x00\x00\x03', 50001)
+
+        frames = [
+            ipv4_frame(CLIENT, SERVER, 100, 'foo'),
+            ipv4_frame(other, SERVER, 100, 'bar'),
+            ipv4_frame(SERVER, other, 100, 'baz'),
+            ipv4_frame(CLIENT, ('\x0a\x00\x00\x02', 80), 100, 'spam'),
+        ]
+
+        self.assertEqual(self.read(frames), [('send', 'foo')])
+
+    def test_ipv6(self):
+        src = ('\x00' * 15 + '\x01', 50000)
+        dst = ('\x00' * 15 + '\x02', 1935)
+
+        tcp = tcp_segment(src, dst, 0, 'foo')
+        ip = struct.pack('!LHBB16s16s', 6 << 28, len(tcp), 6, 64, src[0],
+            dst[0])
+
+        self.assertEqual(self.read(['\x00' * 12 + '\x86\xdd' + ip + tcp]),
+            [('send', 'foo')])
+
+    def test_parse(self):
+        data = rtmp_stream(message.FrameSize(4096), message.BytesRead(200))
+        frames = []
+        seq = 0
+
+        for i in xrange(0, len(data), 1000):
+            frames.append(ipv4_frame(CLIENT, SERVER, seq, data[i:i + 1000]))
+            seq += len(data[i:i + 1000])
+
+        observer = Observer()
+
+        parse_dump.parse_pcap(StringIO(pcap(frames)), observer)
+
+        self.assertEqual(observer.messages, [
+            ('frame_size', {'size': 4096}),
+            ('bytes_read', {'value': 200}),
+        ])
+
+
+
+class StatisticsTestCase(unittest.TestCase):
+    """
+    Tests for L{parse_dump.StatisticsObserver} and L{parse_dump.analyze}.
+    """
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def build_pcap(self):
+        """
+        A client connects, the server responds 250ms later. The client then
+        publishes video with a 2 second hole in it.
+        """
+        client = BufferedByteStream()
+        server = BufferedByteStream()
+        c = codec.Encoder(client)
+        s = codec.Encoder(server)
+
+        handshake = '\x03' + '\x00' * 1536 * 2
+        frames = [
+            (10.0, ipv4_frame(CLIENT, SERVER, 0, handshake)),
+            (10.0, ipv4_frame(SERVER, CLIENT, 0, handshake)),
+        ]
+        seq = {'c': len(handshake), 's': len(handshake)}
+
+        def add(t, buf, direction):
+            data = buf.getvalue()
+            buf.truncate()
+
+            if direction == 'c':
+                frame = ipv4_frame(CLIENT, SERVER, seq['c'], data)
+            else:
+                frame = ipv4_frame(SERVER, CLIENT, seq['s'], data)
+
+            seq[direction] += len(data)
+            frames.append((t, frame))
+
+        encode(c, message.Invoke('connect', 1, {}))
+        add(10.5, client, 'c')
+        encode(s, message.Invoke('_result', 1, None, {}))
+        add(10.75, server, 's')
+        encode(c, message.FrameSize(4096))
+        add(11.0, client, 'c')
+
+        video = codec.StreamingChannel(c, 1, client)
+        video.setType(message.VIDEO_DATA)
+
+        for i, timestamp in enumerate([0, 40, 80, 2080, 2120]):
+            video.sendData('x' * 100, timestamp)
+            add(12 + i, client, 'c')
+
+        return pcap(frames)
+
+    def write(self, name, data):
+        filename = os.path.join(self.tmp, name)
+
+        f = open(filename, 'wb')
+        f.write(data)
+        f.close()
+
+        return filename
+
+    def test_statistics(self):
+        stats = parse_dump.StatisticsObserver()
+
+        parse_dump.parse_pcap(StringIO(self.build_pcap()), stats)
+
+        summary = stats.summary()
+
+        self.assertEqual(summary['messages'], {
+            'invoke': 2, 'frame_size': 1, 'video': 5})
+        self.assertEqual(summary['invoke_latency_ms'], {'connect': {
+            'count': 1, 'p50': 250.0, 'p90': 250.0, 'max': 250.0}})
+        self.assertEqual(summary['unanswered_invokes'], 0)
+        self.assertEqual(summary['frame_sizes'], [
+            {'from': 'client', 'size': 4096, 'time': 11.0}])
+        self.assertEqual(summary['timestamp_gaps'], [{'from': 'client',
+            'stream': 1, 'type': 'video', 'timestamp': 80, 'gap': 2000}])
+        self.assertEqual(summary['stream_bytes']['client/1'], 500)
+
+    def test_analyze(self):
+        filenames = [self.write('a.pcap', self.build_pcap()),
+            self.write('b.pcap', self.build_pcap()),
+            self.write('c.dump', to_c_array('peer0_0',
+                rtmp_stream(message.FrameSize(4096))) +
+                '[1 bytes missing in capture file]\n')]
+        events = os.path.join(self.tmp, 'events')
+        os.mkdir(events)
+
+        results = list(parse_dump.analyze(filenames, processes=2,
+            events=events))
+
+        self.assertEqual(sorted([r['dump'] for r in results]),
+            sorted(filenames))
+
+        results = dict([(os.path.basename(r['dump']), r) for r in results])
+
+        self.assertEqual(results['a.pcap']['error'], None)
+        self.assertEqual(results['c.dump']['error'], 'missing data')
+        self.assertEqual(results['c.dump']['messages'], {'frame_size': 1})
+
+        lines = open(os.path.join(events, 'a.jsonl')).readlines()
+
+        self.assertEqual(len(lines), 8)
+        self.assertEqual(json.loads(lines[0])['name'], 'connect')
+        self.assertEqual(json.loads(lines[0])['time'], 10.5)
+
+        total = parse_dump.aggregate(results.values())
+
+        self.assertEqual(total['dumps'], 3)
+        self.assertEqual(total['errors'], 1)
+        self.assertEqual(total['messages']['video'], 10)
+        self.assertEqual(total['frame_size_changes'], 3)
+        self.assertEqual(total['max_timestamp_gap'], 2000)
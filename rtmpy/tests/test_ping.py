@@ -0,0 +1,180 @@
+# Copyright the RTMPy Project
+#
+# RTMPy is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# RTMPy is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with RTMPy.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Tests for L{rtmpy.protocol.ping}.
+"""
+
+from twisted.trial import unittest
+from twisted.internet import task, reactor, defer
+
+from rtmpy import message, timers, server, metrics
+from rtmpy.protocol import ping
+from rtmpy.scripts import loadgen
+
+
+
+class DummyProtocol(object):
+    """
+    Records the messages sent by the pinger.
+    """
+
+    controlStream = 'control'
+
+
+    def __init__(self):
+        self.messages = []
+        self.reason = None
+
+
+    def sendMessage(self, msg, stream):
+        self.messages.append((msg, stream))
+
+
+    def timeoutConnection(self, reason):
+        self.reason = reason
+
+
+
+class PingerTestCase(unittest.TestCase):
+    """
+    Tests for L{ping.Pinger}
+    """
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.wheel = timers.TimerWheel(0.5, 16, self.clock)
+        self.protocol = DummyProtocol()
+
+        self.pinger = ping.Pinger(self.protocol, 2, 5, self.wheel)
+        self.pinger.start()
+
+    def pong(self, delay):
+        msg, stream = self.protocol.messages.pop(0)
+
+        self.assertEqual(stream, 'control')
+        self.assertEqual(msg.type, message.ControlMessage.PING)
+
+        self.clock.advance(delay)
+        self.pinger.pongReceived(msg.value1)
+
+    def test_ping(self):
+        self.clock.advance(2)
+
+        self.assertEqual(len(self.protocol.messages), 1)
+        self.assertEqual(self.pinger.sent, 1)
+
+        self.pong(0.5)
+
+        self.assertEqual(self.pinger.rtt, 0.5)
+        self.assertEqual(self.pinger.srtt, 0.5)
+        self.assertEqual(self.pinger.jitter, 0.25)
+
+        self.clock.advance(1.5)
+        self.pong(1.0)
+
+        self.assertEqual(self.pinger.rtt, 1.0)
+        self.assertEqual(self.pinger.srtt, 0.5625)
+        self.assertEqual(self.pinger.jitter, 0.3125)
+        self.assertEqual(self.pinger.received, 2)
+        self.assertEqual(self.protocol.reason, None)
+
+    def test_unknown_pong(self):
+        self.pinger.pongReceived(1234)
+
+        self.assertEqual(self.pinger.rtt, None)
+
+    def test_dead(self):
+        for i in xrange(7):
+            self.clock.advance(1)
+
+        self.assertEqual(self.pinger.sent, 3)
+        self.assertNotEqual(self.protocol.reason, None)
+
+        # nothing left scheduled
+        self.assertEqual(len(self.wheel), 0)
+
+    def test_stop(self):
+        self.clock.advance(2)
+        self.pinger.stop()
+
+        self.assertEqual(len(self.wheel), 0)
+
+
+
+class LiveTestCase(unittest.TestCase):
+    """
+    Pings a real client.
+    """
+
+    def setUp(self):
+        self.registry = metrics.Registry()
+        metrics.enable(self.registry)
+
+    def tearDown(self):
+        metrics.disable()
+
+    def test_rtt(self):
+        app = server.Application()
+        factory = server.ServerFactory({'bench': app})
+        factory.timerWheel = timers.TimerWheel(0.05)
+        factory.pingInterval = 0.1
+
+        port = reactor.listenTCP(0, factory, interface='127.0.0.1')
+
+        stats = loadgen.Statistics()
+        stats.finished = False
+
+        client = loadgen.ClientFactory(loadgen.PublishingProtocol, stats,
+            'foo', fps=10, videoSize=100, audioSize=10, frameSize=1024)
+
+        connector = reactor.connectTCP('127.0.0.1', port.getHost().port,
+            client)
+
+        d = defer.Deferred()
+
+        def check():
+            c = app.clients.values()[0]
+
+            self.assertNotEqual(c.rtt, None)
+            self.assertTrue(c.rtt < 0.1)
+            self.assertTrue(c.jitter >= 0)
+
+            names = [s[0] for s in self.registry.samples()]
+
+            self.assertTrue('rtmpy_connection_rtt_seconds' in names)
+
+        def stop():
+            try:
+                check()
+            except:
+                d.errback()
+            else:
+                d.callback(None)
+
+            stats.finished = True
+            connector.disconnect()
+
+            reactor.callLater(0.1, port.stopListening)
+
+        reactor.callLater(0.5, stop)
+
+        def wait(result):
+            later = defer.Deferred()
+            reactor.callLater(0.2, later.callback, result)
+
+            return later
+
+        return d.addBoth(wait)
@@ -0,0 +1,244 @@
+# Copyright the RTMPy Project
+#
+# RTMPy is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# RTMPy is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with RTMPy.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Tests for L{rtmpy.protocol.recorder} and L{rtmpy.scripts.replay}.
+"""
+
+from StringIO import StringIO
+
+from twisted.trial import unittest
+from twisted.internet import reactor, defer
+
+from rtmpy import server
+from rtmpy.protocol import recorder
+from rtmpy.scripts import loadgen, replay
+from rtmpy.tests.util import StringTransport
+
+
+
+class DummyProtocol(object):
+    """
+    Swaps its instance C{dataReceived} like L{rtmpy.protocol.rtmp.StateEngine}
+    does when streaming starts.
+    """
+
+    state = 'version'
+
+
+    def __init__(self):
+        self.transport = StringTransport()
+        self.received = []
+        self.lost = False
+
+
+    def dataReceived(self, data):
+        self.received.append(data)
+
+        if data == 'stream':
+            self.state = 'stream'
+            self.dataReceived = lambda x: self.received.append(x.upper())
+
+
+    def connectionLost(self, reason):
+        self.lost = True
+
+
+
+class RecorderTestCase(unittest.TestCase):
+    """
+    Tests for L{recorder.Recorder}
+    """
+
+    def setUp(self):
+        self.protocol = DummyProtocol()
+        self.fileobj = StringIO()
+        self.clock = iter(xrange(100)).next
+
+        self.recorder = recorder.Recorder(self.fileobj, clock=self.clock)
+        self.recorder.start(self.protocol)
+
+    def read(self):
+        return recorder.RecordingReader(StringIO(self.fileobj.getvalue()))
+
+    def test_record(self):
+        self.protocol.dataReceived('foo')
+        self.protocol.transport.write('bar')
+        self.protocol.transport.writeSequence(['b', 'az'])
+
+        reader = self.read()
+
+        self.assertEqual(reader.startTime, 0)
+        self.assertEqual(reader.state, 'version')
+        self.assertTrue(reader.complete)
+        self.assertEqual(list(reader), [
+            (recorder.INBOUND, 1, 'foo'),
+            (recorder.OUTBOUND, 2, 'bar'),
+            (recorder.OUTBOUND, 3, 'baz'),
+        ])
+
+        self.assertEqual(self.protocol.received, ['foo'])
+        self.assertEqual(self.protocol.transport.value(), 'barbaz')
+
+    def test_state_change(self):
+        """
+        Recording continues after the protocol swaps out C{dataReceived}.
+        """
+        self.protocol.dataReceived('stream')
+        self.protocol.dataReceived('foo')
+
+        self.assertEqual([x[2] for x in self.read()], ['stream', 'foo'])
+        self.assertEqual(self.protocol.received, ['stream', 'FOO'])
+
+        self.recorder.stop()
+        self.protocol.dataReceived('bar')
+
+        self.assertEqual(self.protocol.received, ['stream', 'FOO', 'BAR'])
+
+    def test_stop(self):
+        self.recorder.stop()
+
+        self.assertFalse(self.recorder.recording)
+        self.assertFalse('dataReceived' in self.protocol.__dict__)
+        self.assertFalse('write' in self.protocol.transport.__dict__)
+        self.assertFalse('connectionLost' in self.protocol.__dict__)
+
+        self.protocol.dataReceived('foo')
+
+        self.assertEqual(list(self.read()), [])
+
+    def test_connection_lost(self):
+        self.protocol.connectionLost(None)
+
+        self.assertTrue(self.protocol.lost)
+        self.assertTrue(self.fileobj.closed)
+        self.assertFalse(self.recorder.recording)
+
+    def test_already_recording(self):
+        self.assertRaises(RuntimeError, self.recorder.start, DummyProtocol())
+
+
+
+class RecordingReaderTestCase(unittest.TestCase):
+    """
+    Tests for L{recorder.RecordingReader}
+    """
+
+    def test_bad_magic(self):
+        self.assertRaises(recorder.RecordingError, recorder.RecordingReader,
+            StringIO('x' * 18))
+
+    def test_truncated_header(self):
+        self.assertRaises(recorder.RecordingError, recorder.RecordingReader,
+            StringIO('RTMPyREC'))
+
+    def test_truncated_record(self):
+        fileobj = StringIO()
+        r = recorder.Recorder(fileobj)
+
+        r.start(DummyProtocol())
+        r.protocol.dataReceived('foobar')
+
+        reader = recorder.RecordingReader(StringIO(fileobj.getvalue()[:-1]))
+
+        self.assertRaises(recorder.RecordingError, list, reader)
+
+    def test_incomplete(self):
+        fileobj = StringIO()
+        p = DummyProtocol()
+        p.state = 'stream'
+
+        recorder.Recorder(fileobj).start(p)
+
+        reader = recorder.RecordingReader(StringIO(fileobj.getvalue()))
+
+        self.assertFalse(reader.complete)
+        self.assertRaises(ValueError, replay.replay, reader)
+
+
+
+class RecordingServerProtocol(server.ServerProtocol):
+    """
+    Records every connection from the start.
+    """
+
+    def connectionMade(self):
+        self.recorder = recorder.Recorder(self.factory.fileobj)
+        self.recorder.start(self)
+
+        server.ServerProtocol.connectionMade(self)
+
+
+
+class ReplayTestCase(unittest.TestCase):
+    """
+    Records a real publishing session and replays it.
+    """
+
+    def record(self):
+        factory = server.ServerFactory({'bench': server.Application()})
+        factory.protocol = RecordingServerProtocol
+        factory.fileobj = StringIO()
+        factory.fileobj.close = lambda: None
+
+        port = reactor.listenTCP(0, factory, interface='127.0.0.1')
+        stats = loadgen.Statistics()
+        stats.finished = False
+
+        client = loadgen.ClientFactory(loadgen.PublishingProtocol, stats,
+            'foo', fps=50, videoSize=500, audioSize=100, frameSize=1024)
+
+        connector = reactor.connectTCP('127.0.0.1', port.getHost().port,
+            client)
+
+        d = defer.Deferred()
+
+        def stop():
+            stats.finished = True
+            connector.disconnect()
+            reactor.callLater(0.1, finish)
+
+        def finish():
+            d.callback(factory.fileobj.getvalue())
+
+            return port.stopListening()
+
+        reactor.callLater(0.5, stop)
+
+        return d
+
+    def replay(self, data, **kwargs):
+        reader = recorder.RecordingReader(StringIO(data))
+        inbound = sum([len(x[2]) for x in reader
+            if x[0] == recorder.INBOUND])
+
+        factory = replay.ReplayFactory()
+        d = replay.replay(recorder.RecordingReader(StringIO(data)), factory,
+            **kwargs)
+
+        def cb(report):
+            self.assertEqual(report['bytes_in'], inbound)
+            self.assertFalse(report['disconnected'])
+            self.assertTrue(report['bytes_out'] > 0)
+            self.assertTrue(report['recorded_bytes_out'] > 0)
+            self.assertTrue('bench' in factory.applications)
+
+        return d.addCallback(cb)
+
+    def test_max_speed(self):
+        return self.record().addCallback(self.replay)
+
+    def test_paced(self):
+        return self.record().addCallback(self.replay, speed=10.0)
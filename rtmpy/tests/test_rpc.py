@@ -19,9 +19,9 @@ Tests for L{rtmpy.rpc}.
 
 
 from twisted.trial import unittest
-from twisted.internet import defer
+from twisted.internet import defer, task
 
-from rtmpy import rpc, message, exc
+from rtmpy import rpc, message, exc, timers
 
 
 
@@ -712,6 +712,13 @@ class SimpleFacilitator(rpc.AbstractCallHandler):
         return rpc.CommandResult('foo', {'one': 'two'})
 
 
+    @rpc.expose
+    def deferred_return(self):
+        self.test.deferred = defer.Deferred()
+
+        return self.test.deferred
+
+
 
 class CallReceiverTestCase(unittest.TestCase):
     """
@@ -863,3 +870,106 @@ class CallReceiverTestCase(unittest.TestCase):
         self.assertEqual(msg.name, '_result')
         self.assertEqual(msg.argv, [{'one': 'two'}, 'foo'])
         self.assertEqual(msg.id, 1)
+
+
+    def test_synchronous_result(self):
+        """
+        A synchronous result is returned as is, the response has already been
+        sent.
+        """
+        ret = self.makeCall('known_return')
+
+        self.assertEqual(ret, 'foo')
+        self.assertEqual(self.messages[0].argv, [None, 'foo'])
+        self.assertFalse(self.receiver.isCallActive(1))
+
+
+    def test_deferred_result(self):
+        """
+        The response to a method that returns a L{defer.Deferred} is sent once
+        it has fired.
+        """
+        d = self.makeCall('deferred_return')
+
+        self.assertIdentical(d, self.deferred)
+        self.assertEqual(self.messages, [])
+
+        self.deferred.callback('bar')
+
+        self.assertEqual(self.successResultOf(d), 'bar')
+        self.assertEqual(self.messages[0].argv, [None, 'bar'])
+
+
+    def test_dispatch_table(self):
+        """
+        The exposed methods are bound once per instance.
+        """
+        table = self.receiver.getDispatchTable()
+
+        self.assertIdentical(self.receiver.getDispatchTable(), table)
+        self.assertEqual(sorted(table.keys()), ['command_result',
+            'deferred_return', 'exposed', 'known_failure', 'known_return',
+            'named'])
+        self.assertIdentical(self.receiver.getCallable('named'),
+            table['named'])
+        self.assertRaises(exc.CallFailed, self.receiver.getCallable,
+            'not_exposed')
+
+        other = SimpleFacilitator(self)
+
+        self.assertNotIdentical(other.getDispatchTable(), table)
+
+
+
+class CallTimeoutTestCase(unittest.TestCase):
+    """
+    Tests for L{rpc.BaseCallHandler.callTimeout}
+    """
+
+    def setUp(self):
+        self.clock = task.Clock()
+
+        self.invoker = SimpleInitiator()
+        self.invoker.callTimeout = 5
+        self.invoker.timerWheel = timers.TimerWheel(1.0, 8, self.clock)
+
+    def test_timeout(self):
+        i = self.invoker
+
+        d = i.call('remote_method', notify=True)
+        callId = i.messages[0].id
+
+        self.clock.advance(4)
+
+        self.assertTrue(i.isCallActive(callId))
+        self.assertFalse(d.called)
+
+        self.clock.advance(1)
+
+        self.assertFalse(i.isCallActive(callId))
+        self.assertEqual(i._callTimers, {})
+
+        return self.assertFailure(d, defer.TimeoutError)
+
+    def test_response(self):
+        i = self.invoker
+
+        d = i.call('remote_method', notify=True)
+
+        i.handleResponse(rpc.RESPONSE_RESULT, i.messages[0].id, 'foo')
+
+        self.assertEqual(len(i.timerWheel), 0)
+        self.assertEqual(i._callTimers, {})
+
+        return d.addCallback(self.assertEqual, 'foo')
+
+    def test_received(self):
+        """
+        Calls from the peer are discarded.
+        """
+        i = self.invoker
+
+        i.initiateCall('foo', callId=3)
+        self.clock.advance(5)
+
+        self.assertFalse(i.isCallActive(3))
@@ -18,11 +18,15 @@
 """
 """
 
+import os
+import threading
+
 from twisted.trial import unittest
-from twisted.internet import defer, reactor, protocol
+from twisted.internet import defer, reactor, protocol, task, address
 from twisted.test.proto_helpers import StringTransportWithDisconnection, StringIOWithoutClosing
+from pyamf.util import BufferedByteStream
 
-from rtmpy import server, exc, rpc, util
+from rtmpy import server, exc, rpc, util, lag, timers, authcache, flv
 from rtmpy.protocol.rtmp import message
 
 
@@ -811,7 +815,7 @@ class ConnectingTestCase(unittest.TestCase):
         Ensure that buildClient properly populates Client properties
         """
         a = server.Application()
-        p = MockProtocol(True)
+        p = server.NetConnection(MockProtocol(True))
 
         client_params = {
             'flashVer': 'MAC 10,2,154,13', 'app': 'what',
@@ -836,7 +840,7 @@ class ConnectingTestCase(unittest.TestCase):
         Ensure that buildClient properly handles missing properties
         """
         a = server.Application()
-        p = MockProtocol(False)
+        p = server.NetConnection(MockProtocol(False))
 
         client_params = {'app': 'what'}
 
@@ -946,6 +950,38 @@ class ClientInterfaceTestCase(unittest.TestCase):
         self.assertEqual(kwargs, {'kw': 'Hello'})
 
 
+
+class ClientDispatchTestCase(unittest.TestCase):
+    """
+    Tests for matching calls to the client or the L{server.NetConnection}.
+    """
+
+    def setUp(self):
+        protocol = server.ServerFactory().buildProtocol(None)
+
+        self.nc = server.NetConnection(protocol)
+        self.client = self.nc.client = server.Client(self.nc)
+
+    def test_client(self):
+        self.client.foo = lambda *args: args
+
+        self.assertEqual(self.nc.callReceived('foo', 0, 1, 2), (1, 2))
+        self.assertIdentical(self.nc.getCallable('foo'), self.client.foo)
+
+    def test_connection(self):
+        self.assertEqual(self.nc.getCallable('connect'), self.nc.onConnect)
+        self.assertRaises(exc.CallFailed, self.nc.getCallable, 'foo')
+
+    def test_new_client(self):
+        self.client.foo = lambda: 'foo'
+        self.nc.getCallable('foo')
+
+        client = self.nc.client = server.Client(self.nc)
+        client.foo = lambda: 'bar'
+
+        self.assertEqual(self.nc.getCallable('foo')(), 'bar')
+
+
 class PublishingTestCase(ServerFactoryTestCase):
     """
     Tests for all facets of publishing a stream
@@ -1162,6 +1198,71 @@ class PlayTestCase(ServerFactoryTestCase):
         return d
 
 
+    def test_vod(self):
+        """
+        Streams that are not published are played from C{vodPath}.
+        """
+        self.app.vodPath = self.mktemp()
+        os.mkdir(self.app.vodPath)
+
+        f = open(os.path.join(self.app.vodPath, 'foo.flv'), 'wb')
+        f.write(flv.HEADER + flv.encodeTag(message.VIDEO_DATA, 0, '\x17foo'))
+        f.close()
+
+        self.connect(self.app, self.protocol)
+        s = self.createStream(self.protocol.streamManager)
+
+        def cb(player):
+            self.assertIsInstance(player, flv.FLVPlayer)
+            self.assertIdentical(s.source, player)
+            self.assertEqual(s.state, 'playing')
+
+            s.closeStream()
+
+            self.assertIdentical(s.source, None)
+            self.assertEqual(self.app._vodFiles, {})
+
+        return s.play('foo').addCallback(cb)
+
+
+    def test_vod_missing(self):
+        """
+        A stream without a file waits to be published.
+        """
+        self.app.vodPath = self.mktemp()
+        os.mkdir(self.app.vodPath)
+
+        client = self.connect(self.app, self.protocol)
+        s = self.createStream(self.protocol.streamManager)
+
+        d = s.play('foo')
+
+        def published(_):
+            res = self.app.publishStream(client, s, 'foo')
+
+            self.assertTrue(s in res.subscribers)
+
+            return d
+
+        return task.deferLater(reactor, 0, lambda: None).addCallback(
+            published)
+
+
+    def test_seek_live(self):
+        client = self.connect(self.app, self.protocol)
+        s = self.createStream(self.protocol.streamManager)
+
+        self.app.publishStream(client, s, 'foo')
+        s.play('foo')
+
+        statuses = []
+        s.sendStatus = lambda code, *args, **kwargs: statuses.append(code)
+
+        s.seek(1000)
+
+        self.assertEqual(statuses[0].code, 'NetStream.Seek.Failed')
+
+
 
 class Publisher(object):
     """
@@ -1269,3 +1370,870 @@ class SendTestCase(ServerFactoryTestCase):
 
         self.clearMetaData()
         self.assertMetaData({})
+
+
+
+class LoadSheddingTestCase(ServerFactoryTestCase):
+    """
+    Tests for turning away requests when the reactor is lagging.
+    """
+
+    def setUp(self):
+        ServerFactoryTestCase.setUp(self)
+
+        self.clock = task.Clock()
+        self.factory.lagMonitor = lag.LagMonitor(1.0, self.clock, None)
+        self.factory.lagMonitor.lag = 2.0
+
+        self.app = server.Application()
+
+        return self.factory.registerApplication('foo', self.app)
+
+    def test_below_threshold(self):
+        self.factory.playLagThreshold = 3.0
+
+        self.assertTrue(self.factory.checkLoad(3.0, exc.PlayFailed).called)
+        self.assertTrue(self.factory.checkLoad(None, exc.PlayFailed).called)
+
+    def test_connect(self):
+        self.factory.connectLagThreshold = 1.0
+
+        d = self.protocol.nc.onConnect({'app': 'foo'})
+
+        def cb(res):
+            self.assertEqual(res, {
+                'code': 'NetConnection.Connect.Rejected',
+                'description': 'Server is too busy, try again later',
+                'level': 'error',
+                'objectEncoding': 0
+            })
+
+            self.assertIdentical(self.protocol.nc.application, None)
+
+        return d.addCallback(cb)
+
+    def test_play(self):
+        self.factory.playLagThreshold = 1.0
+        self.connect(self.app, self.protocol)
+
+        s = self.createStream(self.protocol.streamManager)
+        sent = []
+        s.sendStatus = sent.append
+
+        d = s.play('foo')
+
+        def eb(fail):
+            fail.trap(exc.PlayFailed)
+
+            self.assertEqual(sent[0].code, 'NetStream.Play.Failed')
+
+        return d.addCallbacks(self.fail, eb)
+
+    def test_deferred_play(self):
+        self.factory.playLagThreshold = 1.0
+        self.factory.lagWaitTimeout = 10
+        client = self.connect(self.app, self.protocol)
+
+        s = self.createStream(self.protocol.streamManager)
+        d = s.play('foo')
+
+        self.app.publishStream(client, s, 'foo')
+
+        self.assertFalse(d.called)
+
+        self.factory.lagMonitor.start()
+        self.addCleanup(self.factory.lagMonitor.stop)
+
+        self.clock.advance(1.0)
+
+        self.assertFalse(d.called)
+
+        self.clock.advance(1.0)
+
+        self.assertTrue(self.factory.lagMonitor.lag < 1.0)
+        self.assertTrue(d.called)
+
+        return d
+
+    def test_publish(self):
+        self.factory.publishLagThreshold = 1.0
+        self.connect(self.app, self.protocol)
+
+        s = self.createStream(self.protocol.streamManager)
+        sent = []
+        s.sendStatus = sent.append
+
+        d = s.publish('foo')
+
+        def eb(fail):
+            fail.trap(exc.StreamError)
+
+            self.assertEqual(sent[0].code, 'NetStream.Failed')
+            self.assertFalse('foo' in self.app.streams)
+
+        return d.addCallbacks(self.fail, eb)
+
+
+
+class TimeoutTestCase(unittest.TestCase):
+    """
+    Tests for the handshake, connect and idle timeouts.
+    """
+
+    def setUp(self):
+        self.clock = task.Clock()
+
+        self.factory = server.ServerFactory()
+        self.factory.timerWheel = timers.TimerWheel(1.0, 16, self.clock)
+
+        self.protocol = self.factory.buildProtocol(None)
+        self.transport = StringTransportWithDisconnection()
+        self.transport.protocol = self.protocol
+
+    def handshake(self):
+        self.protocol.makeConnection(self.transport)
+        self.protocol.versionReceived(3)
+        self.protocol.handshakeSuccess('')
+
+    def test_handshake(self):
+        self.factory.handshakeTimeout = 5
+
+        self.protocol.makeConnection(self.transport)
+        self.clock.advance(5)
+
+        self.assertFalse(self.transport.connected)
+
+    def test_handshake_success(self):
+        self.factory.handshakeTimeout = 5
+
+        self.handshake()
+        self.clock.advance(5)
+
+        self.assertTrue(self.transport.connected)
+        self.assertEqual(len(self.factory.timerWheel), 0)
+
+    def test_idle(self):
+        self.factory.idleTimeout = 5
+
+        self.handshake()
+
+        self.clock.advance(4)
+        self.protocol.decoder.bytes += 10
+        self.clock.advance(1)
+
+        self.assertTrue(self.transport.connected)
+
+        self.clock.advance(5)
+
+        self.assertFalse(self.transport.connected)
+        self.assertEqual(len(self.factory.timerWheel), 0)
+
+    def test_connect(self):
+        self.factory.connectTimeout = 5
+
+        app = server.Application()
+        app.onConnect = lambda *args: defer.Deferred()
+
+        self.handshake()
+        self.factory.registerApplication('foo', app)
+
+        d = self.protocol.nc.onConnect({'app': 'foo'})
+
+        self.assertFalse(d.called)
+
+        self.clock.advance(5)
+
+        def cb(res):
+            self.assertEqual(res, {
+                'code': 'NetConnection.Connect.Failed',
+                'description': 'Connection timed out',
+                'level': 'error',
+                'objectEncoding': 0
+            })
+
+        return d.addCallback(cb)
+
+    def test_connect_accepted_late(self):
+        """
+        An application that accepts the connection after it has timed out
+        does not get the client.
+        """
+        self.factory.connectTimeout = 5
+
+        app = server.Application()
+        accepted = []
+        decision = defer.Deferred()
+
+        app.onConnect = lambda *args: decision
+        app.onConnectAccept = lambda client, *args: accepted.append(client)
+
+        self.handshake()
+        self.factory.registerApplication('foo', app)
+
+        d = self.protocol.nc.onConnect({'app': 'foo'})
+
+        self.clock.advance(5)
+
+        self.assertEqual(self.successResultOf(d).result.code,
+            'NetConnection.Connect.Failed')
+
+        decision.callback(True)
+
+        self.assertEqual(app.clients, {})
+        self.assertEqual(accepted, [])
+        self.assertFalse(self.protocol.nc.connected)
+
+    def test_call(self):
+        self.factory.callTimeout = 5
+
+        self.handshake()
+
+        self.assertEqual(self.protocol.nc.callTimeout, 5)
+        self.assertIdentical(self.protocol.nc.timerWheel,
+            self.factory.timerWheel)
+
+
+
+class FlowControlTestCase(ServerFactoryTestCase):
+    """
+    Tests for the acknowledgement window with a peer that acknowledges late.
+    """
+
+    def test_late_ack(self):
+        p = self.protocol
+        e = p.encoder
+
+        e.setAckWindow(1000, 2)
+        start = len(self.transport.value())
+
+        for i in xrange(10):
+            p.nc.sendMessage(message.Invoke('foo', 0, None, 'x' * 500))
+
+        def paused(result):
+            self.assertTrue(e.congested)
+            self.assertTrue(e.active)
+            self.assertTrue(2000 <= len(self.transport.value()) - start < 3000)
+
+            # the peer finally acknowledges everything it has received
+            p.onBytesRead(e.bytes, 0)
+
+            self.assertFalse(e.congested)
+
+            return p.encoder_task.addCallback(drained)
+
+        def drained(result):
+            if not e.active:
+                return
+
+            self.assertTrue(e.congested)
+            p.onBytesRead(e.bytes, 0)
+
+            return p.encoder_task.addCallback(drained)
+
+        def resumed(result):
+            self.assertFalse(e.active)
+            self.assertTrue(len(self.transport.value()) - start > 5000)
+
+        return p.encoder_task.addCallback(paused).addCallback(resumed)
+
+
+    def test_connect(self):
+        """
+        Flow control starts with the window sent when connecting.
+        """
+        self.factory.maxUnacknowledgedWindows = 2
+        self.factory.registerApplication('foo', server.Application())
+
+        self.protocol.nc.onConnect({'app': 'foo'})
+
+        self.assertEqual(self.protocol.encoder.maxUnacknowledged,
+            self.factory.downstreamBandwidth * 2)
+
+
+    def test_connect_default(self):
+        """
+        Flow control is off unless the factory opts in.
+        """
+        self.factory.registerApplication('foo', server.Application())
+
+        self.protocol.nc.onConnect({'app': 'foo'})
+
+        self.assertEqual(self.protocol.encoder.maxUnacknowledged, None)
+
+
+
+class ChannelStub(object):
+    """
+    Stands in for a L{codec.StreamingChannel}.
+    """
+
+    def __init__(self, encoder):
+        self.encoder = encoder
+        self.sent = []
+        self.timestamps = []
+
+    def sendData(self, data, timestamp):
+        self.sent.append(data)
+        self.timestamps.append(timestamp)
+
+
+
+class SlowSubscriberTestCase(ServerFactoryTestCase):
+    """
+    Subscribers drop frames while the peer is behind on acknowledgements.
+    """
+
+    def setUp(self):
+        ServerFactoryTestCase.setUp(self)
+
+        self.encoder = self.protocol.encoder
+        self.encoder.setAckWindow(100, 1)
+
+        self.stream = self.createStream(self.protocol.streamManager)
+        self.stream._firstPacketReceived = True
+        self.stream._videoChannel = ChannelStub(self.encoder)
+        self.stream._audioChannel = ChannelStub(self.encoder)
+
+    def test_drop(self):
+        s = self.stream
+
+        self.encoder.bytes = 100
+
+        s.videoDataReceived('\x17key', 0)
+        s.audioDataReceived('audio', 0)
+
+        self.assertEqual(s.droppedFrames, 2)
+
+        self.encoder.bytesAcknowledged(100)
+
+        # wait for a keyframe
+        s.videoDataReceived('\x27inter', 0)
+        s.audioDataReceived('audio', 0)
+        s.videoDataReceived('\x17key', 0)
+        s.videoDataReceived('\x27inter', 0)
+
+        self.assertEqual(s.droppedFrames, 3)
+        self.assertEqual(s._videoChannel.sent, ['\x17key', '\x27inter'])
+        self.assertEqual(s._audioChannel.sent, ['audio'])
+
+
+
+class AggregateTestCase(ServerFactoryTestCase):
+    """
+    Subscribers bundle frames into aggregate messages.
+    """
+
+    def setUp(self):
+        ServerFactoryTestCase.setUp(self)
+
+        self.stream = self.createStream(self.protocol.streamManager)
+        self.stream._firstPacketReceived = True
+
+        for name in ['_videoChannel', '_audioChannel', '_aggregateChannel']:
+            setattr(self.stream, name, ChannelStub(self.protocol.encoder))
+
+        self.stream.aggregateSize = 100
+        self.stream.aggregateDuration = 50
+        self.stream._aggregate = message.Aggregate()
+
+    def decode(self):
+        tags = []
+
+        for data in self.stream._aggregateChannel.sent:
+            msg = message.Aggregate()
+            msg.decode(BufferedByteStream(data))
+
+            tags.append(msg.tags)
+
+        return tags
+
+    def test_size(self):
+        s = self.stream
+
+        s.videoDataReceived('\x17' + 'x' * 40, 10)
+        s.audioDataReceived('a' * 20, 12)
+
+        self.assertEqual(s._aggregateChannel.sent, [])
+
+        s.videoDataReceived('\x27' + 'y' * 20, 20)
+
+        self.assertEqual(self.decode(), [[
+            (message.VIDEO_DATA, 10, '\x17' + 'x' * 40),
+            (message.AUDIO_DATA, 12, 'a' * 20),
+            (message.VIDEO_DATA, 20, '\x27' + 'y' * 20)]])
+        self.assertEqual(s._aggregateChannel.timestamps, [10])
+        self.assertEqual(s._videoChannel.sent, [])
+
+    def test_duration(self):
+        s = self.stream
+
+        s.audioDataReceived('a', 0)
+        s.audioDataReceived('b', 49)
+
+        self.assertEqual(s._aggregateChannel.sent, [])
+
+        s.audioDataReceived('c', 50)
+
+        self.assertEqual(len(self.decode()[0]), 3)
+
+    def test_backwards(self):
+        """
+        A frame older than the last of the aggregate starts a new one.
+        """
+        s = self.stream
+
+        s.videoDataReceived('\x17v', 10)
+        s.audioDataReceived('a', 5)
+        s.flushAggregate()
+
+        self.assertEqual(self.decode(), [
+            [(message.VIDEO_DATA, 10, '\x17v')],
+            [(message.AUDIO_DATA, 5, 'a')]])
+
+    def test_backwards_last(self):
+        """
+        A frame older than the last of the aggregate, but not the first,
+        starts a new one.
+        """
+        s = self.stream
+
+        s.videoDataReceived('\x17v', 10)
+        s.audioDataReceived('a', 20)
+        s.audioDataReceived('b', 15)
+        s.flushAggregate()
+
+        self.assertEqual(self.decode(), [
+            [(message.VIDEO_DATA, 10, '\x17v'), (message.AUDIO_DATA, 20, 'a')],
+            [(message.AUDIO_DATA, 15, 'b')]])
+
+    def test_unpublish(self):
+        s = self.stream
+
+        s.audioDataReceived('a', 0)
+        s.unpublish()
+
+        self.assertEqual(len(s._aggregateChannel.sent), 1)
+
+    def test_play(self):
+        """
+        Aggregation is enabled by the factory.
+        """
+        self.factory.aggregateSize = 1000
+        app = server.Application()
+        self.factory.registerApplication('foo', app)
+
+        client = self.connect(app, self.protocol)
+        s = self.createStream(self.protocol.streamManager)
+
+        app.publishStream(client, s, 'foo')
+        p = self.createStream(self.protocol.streamManager)
+        p.play('foo')
+
+        self.assertEqual(p.aggregateSize, 1000)
+        self.assertEqual(p._aggregateChannel.type, message.AGGREGATE)
+
+
+
+class ChunkCacheTestCase(ServerFactoryTestCase):
+    """
+    Subscribers playing files send the frames from the L{flv.ChunkCache}.
+    """
+
+    def setUp(self):
+        ServerFactoryTestCase.setUp(self)
+
+        self.stream = self.createStream(self.protocol.streamManager)
+        self.stream._firstPacketReceived = True
+
+        self.stream._videoChannel = self.protocol.getStreamingChannel(
+            self.stream)
+        self.stream._videoChannel.setType(message.VIDEO_DATA)
+
+        self.cache = self.stream._chunkCache = flv.ChunkCache(10000)
+
+    def test_send(self):
+        data = '\x17' + 'x' * 300
+
+        self.transport.clear()
+
+        self.stream.videoDataReceived(data, 0, 'foo')
+        self.stream.videoDataReceived(data, 40, 'foo')
+        sent = self.transport.value()
+
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+        # the same bytes as splitting the tag for each message
+        self.setUp()
+        self.transport.clear()
+
+        self.stream.videoDataReceived(data, 0)
+        self.stream.videoDataReceived(data, 40)
+
+        self.assertEqual(self.cache.misses, 0)
+        self.assertEqual(self.transport.value(), sent)
+
+
+
+class BroadcastTestCase(unittest.TestCase):
+    """
+    Tests for L{server.Application.broadcast}.
+    """
+
+    def setUp(self):
+        self.factory = server.ServerFactory()
+        self.app = server.Application()
+        self.transports = []
+
+        return self.factory.registerApplication('foo', self.app)
+
+    def connect(self):
+        p = self.factory.buildProtocol(None)
+        transport = StringTransportWithDisconnection()
+
+        p.makeConnection(transport)
+        transport.protocol = p
+        p.versionReceived(3)
+        p.handshakeSuccess('')
+
+        client = self.app.buildClient(p.nc, {'app': 'foo'})
+        self.app.acceptConnection(client)
+
+        p.nc.connected = True
+        p.nc.client = client
+        p.nc.application = self.app
+
+        transport.clear()
+        self.transports.append(transport)
+
+        return client
+
+    def flush(self, *args):
+        """
+        Returns a deferred that fires once the encoders have written out all
+        that is queued.
+        """
+        tasks = [getattr(t.protocol, 'encoder_task', None)
+            for t in self.transports]
+
+        return defer.DeferredList([d for d in tasks if d is not None])
+
+    def test_encode_once(self):
+        clients = [self.connect() for i in xrange(5)]
+        encoded = []
+        encode = message.Invoke.encode
+
+        def count(msg, buf):
+            encoded.append(msg)
+
+            return encode(msg, buf)
+
+        self.patch(message.Invoke, 'encode', count)
+
+        d = self.app.broadcast('onNews', 'spam', 3)
+
+        def check(sent):
+            self.assertEqual(sent, 5)
+            self.assertEqual(len(encoded), 1)
+
+            values = [t.value() for t in self.transports]
+
+            self.assertTrue('onNews' in values[0])
+            self.assertEqual(values, [values[0]] * 5)
+
+        return d.addCallback(
+            lambda sent: self.flush().addCallback(lambda _: check(sent)))
+
+    def test_filter(self):
+        clients = [self.connect() for i in xrange(4)]
+
+        self.app.disconnect(clients[3])
+
+        d = self.app.broadcast('onNews',
+            filter=lambda client: client is not clients[0])
+
+        def check(sent):
+            self.assertEqual(sent, 2)
+
+            self.assertFalse('onNews' in self.transports[0].value())
+            self.assertTrue('onNews' in self.transports[1].value())
+
+        return d.addCallback(
+            lambda sent: self.flush().addCallback(lambda _: check(sent)))
+
+    def test_keywords(self):
+        self.assertRaises(TypeError, self.app.broadcast, 'foo', bar=1)
+
+
+
+class BlockingApplication(server.Application):
+    """
+    Records the threads that the blocking callbacks run in.
+    """
+
+    def __init__(self):
+        server.Application.__init__(self)
+
+        self.threads = []
+        self.event = None
+
+    @server.blocking
+    def onConnect(self, client, *args):
+        if self.event is not None:
+            self.event.wait()
+
+        self.threads.append(threading.currentThread())
+
+    @server.blocking
+    def onPublish(self, client, stream):
+        self.threads.append(threading.currentThread())
+
+    @server.blocking
+    def onDisconnect(self, client):
+        if self.event is not None:
+            self.event.wait()
+
+        self.threads.append(threading.currentThread())
+
+
+class BlockingTestCase(ServerFactoryTestCase):
+    """
+    Tests for L{server.blocking} application callbacks.
+    """
+
+    def setUp(self):
+        ServerFactoryTestCase.setUp(self)
+
+        self.app = BlockingApplication()
+        self.addCleanup(lambda: self.app.executor and self.app.executor.stop())
+
+        return self.factory.registerApplication('foo', self.app)
+
+    def assertThreaded(self, result=None):
+        self.assertNotEqual(self.app.threads, [])
+
+        for thread in self.app.threads:
+            self.assertNotIdentical(thread, threading.currentThread())
+
+    def test_connect(self):
+        nc = self.protocol.nc
+        d = nc._onConnect({'app': 'foo'})
+
+        def cb(result):
+            self.assertEqual(self.app.clients.values(), [nc.client])
+            self.assertThreaded()
+            self.assertEqual(self.app.executor.name, 'application:foo')
+
+        return d.addCallback(cb)
+
+    def test_publish(self):
+        self.connect(self.app, self.protocol)
+
+        s = self.createStream(self.manager)
+        s.sendStatus = lambda status: None
+
+        d = s.publish('foo')
+
+        def cb(result):
+            self.assertIdentical(result, self.app.streams['foo'])
+            self.assertThreaded()
+
+        return d.addCallback(cb)
+
+    def test_disconnect(self):
+        self.transport.loseConnection = lambda: None
+        self.app.blockingThreads = 1
+        self.app.event = threading.Event()
+        self.addCleanup(self.app.event.set)
+
+        client = self.connect(self.app, self.protocol)
+
+        self.app.disconnect(client)
+
+        self.assertEqual(self.app.threads, [])
+
+        self.app.event.set()
+
+        return self.app.executor.submit(lambda: None).addCallback(
+            self.assertThreaded)
+
+    def test_busy(self):
+        self.app.blockingThreads = 1
+        self.app.blockingQueue = 0
+        self.app.event = threading.Event()
+
+        d = self.app.onConnect(None)
+        self.addCleanup(self.app.event.set)
+
+        self.failureResultOf(self.app.onConnect(None), exc.ExecutorBusy)
+        self.assertEqual(self.app.executor.running, 1)
+
+        self.app.event.set()
+
+        return d
+
+    def test_unregister(self):
+        self.app.getExecutor()
+
+        d = self.factory.unregisterApplication('foo')
+
+        return d.addCallback(
+            lambda app: self.assertIdentical(app.executor, None))
+
+
+
+class AuthorizingApplication(server.Application):
+    """
+    Counts the authorization requests.
+    """
+
+    def __init__(self):
+        server.Application.__init__(self)
+
+        self.requests = []
+        self.allow = True
+        self.credentials = None
+
+    def onConnect(self, client, *args):
+        self.requests.append('connect')
+
+        if self.credentials is not None and args != self.credentials:
+            return False
+
+        return self.allow
+
+    def authorizePublish(self, client, name):
+        self.requests.append(('publish', name.token))
+
+        if not self.allow:
+            raise exc.PublishError('Bad token')
+
+
+class AuthCacheTestCase(ServerFactoryTestCase):
+    """
+    Tests for the authorization cache of L{server.Application}.
+    """
+
+    def setUp(self):
+        ServerFactoryTestCase.setUp(self)
+
+        self.clock = task.Clock()
+
+        self.app = AuthorizingApplication()
+        self.app.authCacheQueryArgs = ('token',)
+        self.app.authCache = authcache.AuthorizationCache(reactor=self.clock)
+
+        return self.factory.registerApplication('foo', self.app)
+
+    def connect(self, token='a', *args):
+        nc = server.NetConnection(self.protocol)
+
+        return nc._onConnect({'app': 'foo',
+            'tcUrl': 'rtmp://localhost/foo?token=%s' % (token,)}, *args)
+
+    def test_connect(self):
+        self.successResultOf(self.connect())
+        self.successResultOf(self.connect())
+
+        self.assertEqual(self.app.requests, ['connect'])
+        self.assertEqual(len(self.app.clients), 2)
+
+        self.successResultOf(self.connect('b'))
+
+        self.assertEqual(self.app.requests, ['connect', 'connect'])
+
+    def test_rejected(self):
+        self.app.allow = False
+
+        self.failureResultOf(self.connect(), exc.ConnectRejected)
+        self.failureResultOf(self.connect(), exc.ConnectRejected)
+
+        self.assertEqual(self.app.requests, ['connect'])
+
+        self.clock.advance(self.app.authCache.negativeTtl)
+        self.app.allow = True
+
+        self.successResultOf(self.connect())
+        self.assertEqual(self.app.requests, ['connect', 'connect'])
+
+    def test_ip(self):
+        """
+        A decision is not shared with clients connecting from another ip.
+        """
+        self.successResultOf(self.connect())
+
+        p = self.factory.buildProtocol(None)
+        p.makeConnection(StringTransportWithDisconnection(
+            peerAddress=address.IPv4Address('TCP', '10.0.0.2', 1935)))
+
+        nc = server.NetConnection(p)
+
+        self.successResultOf(nc._onConnect({'app': 'foo',
+            'tcUrl': 'rtmp://localhost/foo?token=a'}))
+
+        self.assertEqual(self.app.requests, ['connect', 'connect'])
+        self.assertEqual(sorted([c.ip for c in self.app.clients.values()]),
+            ['10.0.0.2', '192.168.1.1'])
+
+    def test_credentials(self):
+        """
+        The connect arguments are part of the key, an accepted client does
+        not let others from the same ip in with other credentials.
+        """
+        self.app.credentials = ('user', 'secret')
+
+        self.successResultOf(self.connect('a', 'user', 'secret'))
+        self.failureResultOf(self.connect('a', 'user', 'wrong'),
+            exc.ConnectRejected)
+        self.failureResultOf(self.connect('a'), exc.ConnectRejected)
+        self.successResultOf(self.connect('a', 'user', 'secret'))
+
+        self.assertEqual(self.app.requests, ['connect'] * 3)
+        self.assertEqual(len(self.app.clients), 2)
+
+    def test_key(self):
+        client = self.app.buildClient(server.NetConnection(self.protocol),
+            {'tcUrl': 'rtmp://localhost/foo'})
+
+        self.assertEqual(client.ip, '192.168.1.1')
+
+        client.ip = '1.2.3.4'
+
+        self.assertEqual(self.app.getConnectKey(client, {'app': 'foo?token=a',
+            'tcUrl': 'rtmp://localhost/foo'}), ('connect', '1.2.3.4',
+            'rtmp://localhost/foo', 'foo?token=a', (), ('a',)))
+        self.assertEqual(self.app.getPublishKey(client, 'bar?token=b'), (
+            'publish', '1.2.3.4', 'rtmp://localhost/foo', u'bar', (), ('b',)))
+
+        self.app.authCacheByIP = False
+
+        self.assertEqual(self.app.getPublishKey(client, 'bar')[1],
+            'rtmp://localhost/foo')
+
+    def test_publish(self):
+        self.app.allow = False
+        self.client = ServerFactoryTestCase.connect(self, self.app,
+            self.protocol)
+
+        for i in xrange(2):
+            s = self.createStream(self.manager)
+            s.sendStatus = lambda status: None
+
+            self.failureResultOf(self.protocol.nc.publishStream(s,
+                'bar?token=x', 'live'), exc.PublishError)
+
+        self.assertEqual(self.app.requests, [('publish', 'x')])
+        self.assertEqual(self.app.streams, {})
+
+        self.app.authCache.invalidateIf(lambda key: key[0] == 'publish')
+        self.app.allow = True
+
+        s = self.createStream(self.manager)
+        s.sendStatus = lambda status: None
+
+        self.successResultOf(self.protocol.nc.publishStream(s, 'bar?token=y',
+            'live'))
+
+        self.assertEqual(self.app.requests, [('publish', 'x'),
+            ('publish', 'y')])
+        self.assertTrue(self.app.getPublishKey(self.client, 'bar?token=y')
+            in self.app.authCache)
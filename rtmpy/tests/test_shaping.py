@@ -0,0 +1,219 @@
+# Copyright the RTMPy Project
+#
+# RTMPy is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# RTMPy is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with RTMPy.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Tests for L{rtmpy.shaping}.
+"""
+
+from twisted.trial import unittest
+from twisted.internet import task
+from twisted.test.proto_helpers import StringTransportWithDisconnection
+
+from rtmpy import shaping, server
+from rtmpy.protocol.rtmp import message
+
+
+
+class Channel(object):
+    """
+    Stands in for a L{codec.StreamingChannel}.
+    """
+
+    def __init__(self, encoder):
+        self.encoder = encoder
+
+    def sendData(self, data, timestamp):
+        raise AssertionError('Frame was not dropped')
+
+
+
+class TokenBucketTestCase(unittest.TestCase):
+    """
+    Tests for L{shaping.TokenBucket}.
+    """
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.bucket = shaping.TokenBucket(100, 50, reactor=self.clock)
+
+    def test_create(self):
+        self.assertEqual(self.bucket.tokens, 50)
+        self.assertFalse(self.bucket.empty)
+        self.assertEqual(shaping.TokenBucket(100, reactor=self.clock).burst,
+            100)
+
+        self.assertRaises(ValueError, shaping.TokenBucket, 0)
+
+    def test_debt(self):
+        self.bucket.consume(70)
+
+        self.assertTrue(self.bucket.empty)
+        self.assertEqual(self.bucket.delay(), 0.2)
+
+        self.clock.advance(0.2)
+
+        self.assertFalse(self.bucket.empty)
+        self.assertEqual(self.bucket.delay(), 0)
+
+    def test_burst(self):
+        self.clock.advance(10)
+        self.bucket.refill()
+
+        self.assertEqual(self.bucket.tokens, 50)
+
+
+
+class ShaperTestCase(unittest.TestCase):
+    """
+    Tests for L{shaping.Shaper}.
+    """
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.fast = shaping.TokenBucket(1000, reactor=self.clock)
+        self.slow = shaping.TokenBucket(10, reactor=self.clock)
+
+        self.shaper = shaping.Shaper([self.fast], reactor=self.clock)
+
+    def test_buckets(self):
+        self.shaper.addBucket(self.slow)
+        self.shaper.addBucket(self.slow)
+
+        self.assertEqual(self.shaper.buckets, [self.fast, self.slow])
+
+        self.shaper.consume(20)
+
+        self.assertEqual(self.fast.tokens, 980)
+        self.assertTrue(self.shaper.exhausted)
+        self.assertEqual(self.shaper.delay(), 1)
+
+        self.shaper.removeBucket(self.slow)
+
+        self.assertFalse(self.shaper.exhausted)
+
+    def test_drop(self):
+        self.shaper.drop(30)
+
+        self.assertEqual(self.shaper.dropped, 30)
+        self.assertEqual(self.fast.dropped, 30)
+
+    def test_call_when_available(self):
+        called = []
+
+        self.shaper.consume(1500)
+        self.shaper.callWhenAvailable(called.append, 'foo')
+
+        self.clock.advance(0.4)
+        self.assertEqual(called, [])
+
+        self.clock.advance(0.1)
+        self.assertEqual(called, ['foo'])
+        self.assertEqual(self.shaper.held, 1)
+
+
+
+class ShapedProtocolTestCase(unittest.TestCase):
+    """
+    Tests for a shaped L{server.ServerProtocol}.
+    """
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.factory = server.ServerFactory()
+        self.factory.connectionRate = 1000
+        self.factory.nodeRate = 10000
+        self.factory.applicationRate = 5000
+
+        self.factory.buildBucket = lambda rate, name: shaping.TokenBucket(
+            rate, rate, name, reactor=self.clock)
+
+        self.protocol = self.factory.buildProtocol(None)
+        self.transport = StringTransportWithDisconnection()
+
+        self.protocol.makeConnection(self.transport)
+        self.transport.protocol = self.protocol
+        self.protocol.versionReceived(3)
+        self.protocol.handshakeSuccess('')
+
+        self.encoder = self.protocol.encoder
+        self.encoder.shaper.reactor = self.clock
+
+    def test_disabled(self):
+        self.assertIdentical(server.ServerFactory().buildShaper(), None)
+
+    def test_buckets(self):
+        other = self.factory.buildShaper()
+
+        self.assertEqual([b.name for b in self.encoder.shaper.buckets],
+            ['connection', 'node'])
+        self.assertNotIdentical(self.encoder.shaper.buckets[0],
+            other.buckets[0])
+        self.assertIdentical(self.encoder.shaper.buckets[1], other.buckets[1])
+
+    def test_connect(self):
+        self.factory.registerApplication('foo', server.Application())
+
+        self.protocol.nc.onConnect({'app': 'foo'})
+
+        bucket = self.encoder.shaper.buckets[-1]
+
+        self.assertEqual(bucket.name, 'application:foo')
+        self.assertIdentical(self.factory.getApplicationBucket('foo'), bucket)
+
+    def test_hold(self):
+        p = self.protocol
+        e = self.encoder
+        start = len(self.transport.value())
+
+        for i in xrange(10):
+            p.nc.sendMessage(message.Invoke('foo', 0, None, 'x' * 500))
+
+        def paused(result):
+            self.assertTrue(e.throttled)
+            self.assertTrue(e.active)
+            self.assertEqual(e.shaper.held, 1)
+            self.assertTrue(1000 <= len(self.transport.value()) - start < 1500)
+
+            return drain(None)
+
+        def drain(result):
+            while e.active:
+                self.clock.advance(e.shaper.delay())
+
+                # encoding restarted, or the call was rescheduled
+                self.assertTrue(p.encoder_task or p._shaperCall)
+
+                if p.encoder_task:
+                    return p.encoder_task.addCallback(drain)
+
+        def done(result):
+            self.assertFalse(e.active)
+            self.assertTrue(len(self.transport.value()) - start > 5000)
+            self.assertTrue(e.shaper.held > 4)
+
+        return p.encoder_task.addCallback(paused).addCallback(done)
+
+    def test_drop(self):
+        stream = server.NetStream(self.protocol.nc, 1)
+        stream._firstPacketReceived = True
+        stream._videoChannel = Channel(self.encoder)
+
+        self.encoder.shaper.consume(2000)
+
+        stream.videoDataReceived('\x17key', 0)
+
+        self.assertEqual(stream.droppedFrames, 1)
+        self.assertEqual(self.encoder.shaper.dropped, 4)
+        self.assertEqual(self.factory._nodeBucket.dropped, 4)
@@ -0,0 +1,413 @@
+# Copyright the RTMPy Project
+#
+# RTMPy is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# RTMPy is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with RTMPy.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Tests for L{rtmpy.sharedobject}.
+"""
+
+import os
+
+import pyamf
+from pyamf.util import BufferedByteStream
+from twisted.trial import unittest
+from twisted.internet import defer, task
+
+from rtmpy import sharedobject, message, server, exc
+from rtmpy.status import codes
+
+
+SO = message.SharedObjectMessage
+
+
+
+class Protocol(object):
+    """
+    Records the encoded messages.
+    """
+
+    def __init__(self):
+        self.sent = []
+
+
+    def sendEncodedMessage(self, data, datatype, stream, whenDone=None):
+        self.sent.append((data, datatype))
+
+
+    def sendMessage(self, msg, stream, whenDone=None):
+        buf = BufferedByteStream()
+        msg.encode(buf)
+
+        self.sent.append((buf.getvalue(), msg.__data_type__))
+
+
+
+class NetConnection(server.NetConnection):
+    def __init__(self, objectEncoding=pyamf.AMF0):
+        server.NetConnection.__init__(self, Protocol())
+
+        self.objectEncoding = objectEncoding
+        self.connected = True
+
+
+    def getMessages(self):
+        messages = []
+
+        for data, datatype in self.protocol.sent:
+            msg = message.classByType(datatype)()
+            msg.decode(BufferedByteStream(data))
+
+            messages.append(msg)
+
+        del self.protocol.sent[:]
+
+        return messages
+
+
+
+class SharedObjectTestCase(unittest.TestCase):
+    """
+    Tests for L{sharedobject.SharedObject}.
+    """
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.so = sharedobject.SharedObject(u'foo', reactor=self.clock)
+
+    def test_subscribe(self):
+        nc = NetConnection()
+
+        self.so.setAttribute(u'a', 1)
+        self.so.subscribe(nc)
+
+        msg, = nc.getMessages()
+
+        self.assertEqual(msg.name, u'foo')
+        self.assertEqual(msg.version, 1)
+        self.assertEqual(msg.events, [(SO.USE_SUCCESS, None), (SO.CLEAR, None),
+            (SO.CHANGE, (u'a', 1))])
+
+    def test_versions(self):
+        self.so.setAttribute(u'a', 1)
+        self.so.setAttribute(u'b', 2)
+        self.so.setAttribute(u'a', 1)
+
+        self.assertEqual(self.so.version, 2)
+        self.assertEqual(self.so.slotVersions, {u'a': 1, u'b': 2})
+
+        self.so.removeAttribute(u'a')
+
+        self.assertEqual(self.so.version, 3)
+        self.assertEqual(self.so.slotVersions, {u'b': 2})
+
+    def test_batch(self):
+        """
+        The changes made during a tick are sent as one message.
+        """
+        nc = NetConnection()
+        self.so.subscribe(nc)
+        nc.getMessages()
+
+        self.so.setAttribute(u'a', 1)
+        self.so.setAttribute(u'b', 2)
+        self.so.setAttribute(u'a', 3)
+        self.so.removeAttribute(u'b')
+        self.so.sendMessage(u'onMsg', u'hi')
+
+        self.assertEqual(nc.getMessages(), [])
+
+        self.clock.advance(0)
+
+        msg, = nc.getMessages()
+
+        self.assertEqual(msg.version, 4)
+        self.assertEqual(msg.events, [(SO.CHANGE, (u'a', 3)),
+            (SO.REMOVE, u'b'), (SO.SEND_MESSAGE, [u'onMsg', u'hi'])])
+
+        self.clock.advance(0)
+        self.assertEqual(nc.getMessages(), [])
+
+    def test_encode_once(self):
+        """
+        The delta is encoded once per object encoding.
+        """
+        clients = [NetConnection(), NetConnection(), NetConnection(pyamf.AMF3)]
+
+        for nc in clients:
+            self.so.subscribe(nc)
+            nc.protocol.sent = []
+
+        self.so.setAttribute(u'a', 1)
+        self.clock.advance(0)
+
+        amf0, amf0_2, amf3 = [nc.protocol.sent[0] for nc in clients]
+
+        self.assertIdentical(amf0[0], amf0_2[0])
+        self.assertEqual(amf0[1], message.SHARED_OBJECT)
+        self.assertEqual(amf3[1], message.FLEX_SHARED_OBJECT)
+
+        self.assertEqual(clients[2].getMessages()[0].events,
+            [(SO.CHANGE, (u'a', 1))])
+
+    def test_ack(self):
+        """
+        The client that requested a change gets a success instead.
+        """
+        a, b = NetConnection(), NetConnection()
+
+        for nc in [a, b]:
+            self.so.subscribe(nc)
+            nc.getMessages()
+
+        self.so.setAttribute(u'x', 1, a)
+        self.so.setAttribute(u'y', 2)
+        self.clock.advance(0)
+
+        self.assertEqual(a.getMessages()[0].events, [(SO.SUCCESS, u'x'),
+            (SO.CHANGE, (u'y', 2))])
+        self.assertEqual(b.getMessages()[0].events, [(SO.CHANGE, (u'x', 1)),
+            (SO.CHANGE, (u'y', 2))])
+
+    def test_last_change_wins(self):
+        a, b = NetConnection(), NetConnection()
+
+        for nc in [a, b]:
+            self.so.subscribe(nc)
+            nc.getMessages()
+
+        self.so.setAttribute(u'x', 1, a)
+        self.so.setAttribute(u'x', 2, b)
+        self.clock.advance(0)
+
+        self.assertEqual(a.getMessages()[0].events, [(SO.CHANGE, (u'x', 2))])
+        self.assertEqual(b.getMessages()[0].events, [(SO.SUCCESS, u'x')])
+
+    def test_interval(self):
+        nc = NetConnection()
+        self.so.flushInterval = 0.5
+        self.so.subscribe(nc)
+        nc.getMessages()
+
+        self.so.setAttribute(u'a', 1)
+        self.clock.advance(0.25)
+        self.so.setAttribute(u'b', 1)
+
+        self.assertEqual(nc.getMessages(), [])
+
+        self.clock.advance(0.25)
+
+        self.assertEqual(len(nc.getMessages()[0].events), 2)
+
+
+
+class SharedObjectStoreTestCase(unittest.TestCase):
+    """
+    Tests for L{sharedobject.SharedObjectStore}.
+    """
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.store = sharedobject.SharedObjectStore(reactor=self.clock)
+
+    def test_release(self):
+        nc = NetConnection()
+
+        so = self.successResultOf(self.store.use(nc, u'foo'))
+        persistent = self.successResultOf(self.store.use(nc, u'bar', True))
+
+        self.assertIdentical(
+            self.successResultOf(self.store.getSharedObject(u'foo')), so)
+
+        self.store.release(nc)
+
+        self.assertEqual(self.store.sharedObjects, {u'bar': persistent})
+        self.assertEqual(persistent.subscribers, [])
+
+    def test_persistence(self):
+        self.store.path = self.mktemp()
+        os.mkdir(self.store.path)
+
+        def change(so):
+            so.setAttribute(u'x', {'y': 1})
+            self.clock.advance(0)
+
+            d = self.store._saving[u'a/b']
+
+            # a second change while the write is in flight is coalesced
+            so.setAttribute(u'z', 2)
+            self.clock.advance(0)
+
+            self.assertIdentical(self.store._saving[u'a/b'], d)
+
+            return d
+
+        def load(result):
+            store = sharedobject.SharedObjectStore(self.store.path)
+
+            return store.getSharedObject(u'a/b', True)
+
+        def check(loaded):
+            self.assertEqual(loaded.version, 2)
+            self.assertEqual(loaded.data, {u'x': {'y': 1}, u'z': 2})
+            self.assertEqual(loaded.slotVersions, {u'x': 1, u'z': 2})
+            self.assertEqual(os.listdir(self.store.path), ['a%2Fb.sol'])
+
+        d = self.store.getSharedObject(u'a/b', True)
+
+        return d.addCallback(change).addCallback(load).addCallback(check)
+
+    def test_loading(self):
+        """
+        A persistent shared object is loaded in a thread, once.
+        """
+        self.store.path = self.mktemp()
+        os.mkdir(self.store.path)
+
+        d1 = self.store.getSharedObject(u'foo', True)
+        d2 = self.store.getSharedObject(u'foo', True)
+
+        self.assertNoResult(d2)
+        self.assertEqual(self.store.sharedObjects, {})
+
+        def check(so):
+            self.assertIdentical(self.successResultOf(d2), so)
+            self.assertEqual(self.store.sharedObjects, {u'foo': so})
+            self.assertEqual(self.store._loading, {})
+
+        return d1.addCallback(check)
+
+    def test_max_persistent(self):
+        """
+        Clients cannot create more than C{maxPersistent} persistent shared
+        objects.
+        """
+        nc = NetConnection()
+        self.store.maxPersistent = 1
+
+        so = self.successResultOf(self.store.use(nc, u'foo', True))
+
+        self.failureResultOf(self.store.use(nc, u'bar', True),
+            exc.SharedObjectError)
+
+        self.assertIdentical(
+            self.successResultOf(self.store.use(nc, u'foo', True)), so)
+        self.successResultOf(self.store.use(nc, u'baz'))
+
+        self.assertEqual(sorted(self.store.sharedObjects), [u'baz', u'foo'])
+
+    def test_not_persistent(self):
+        self.store.path = self.mktemp()
+
+        so = self.successResultOf(self.store.getSharedObject(u'foo'))
+        so.setAttribute(u'x', 1)
+        self.clock.advance(0)
+
+        self.assertFalse(os.path.exists(self.store.path))
+
+
+
+class NetConnectionTestCase(unittest.TestCase):
+    """
+    Tests for the shared object messages received by L{server.NetConnection}.
+    """
+
+    def setUp(self):
+        self.app = server.Application()
+        self.app.sharedObjects = sharedobject.SharedObjectStore(
+            reactor=task.Clock())
+
+        self.nc = NetConnection()
+        self.nc.connected = True
+        self.nc.application = self.app
+
+    def receive(self, *events):
+        self.nc.onSharedObject(SO(u'foo', 0, False, list(events)), 0)
+
+    def test_use(self):
+        self.receive((SO.USE, None), (SO.REQUEST_CHANGE, (u'a', 1)))
+
+        so = self.app.sharedObjects.sharedObjects[u'foo']
+
+        self.assertEqual(so.subscribers, [self.nc])
+        self.assertEqual(so.data, {u'a': 1})
+
+        so.reactor.advance(0)
+
+        self.assertEqual([m.events for m in self.nc.getMessages()], [
+            [(SO.USE_SUCCESS, None), (SO.CLEAR, None)],
+            [(SO.SUCCESS, u'a')]])
+
+        self.receive((SO.REQUEST_REMOVE, u'a'), (SO.RELEASE, None))
+
+        self.assertEqual(so.data, {})
+        self.assertEqual(self.app.sharedObjects.sharedObjects, {})
+
+    def test_not_subscribed(self):
+        self.receive((SO.REQUEST_CHANGE, (u'a', 1)))
+
+        self.assertEqual(self.app.sharedObjects.sharedObjects, {})
+
+    def test_loading(self):
+        """
+        The events wait for the shared object used before them to load.
+        """
+        store = self.app.sharedObjects
+        d = defer.Deferred()
+        store.getSharedObject = lambda name, persistent: d
+
+        self.receive((SO.USE, None))
+        self.receive((SO.REQUEST_CHANGE, (u'a', 1)))
+
+        so = sharedobject.SharedObject(u'foo', reactor=store.reactor)
+        store.sharedObjects[u'foo'] = so
+
+        self.assertEqual(so.subscribers, [])
+
+        d.callback(so)
+
+        self.assertEqual(so.subscribers, [self.nc])
+        self.assertEqual(so.data, {u'a': 1})
+
+    def test_disconnect_loading(self):
+        """
+        A peer that disconnects while the shared object loads is not
+        subscribed to it.
+        """
+        d = defer.Deferred()
+        self.app.sharedObjects.getSharedObject = lambda name, persistent: d
+
+        self.receive((SO.USE, None))
+        self.nc.connected = False
+
+        so = sharedobject.SharedObject(u'foo')
+        d.callback(so)
+
+        self.assertEqual(so.subscribers, [])
+
+    def test_not_authorized(self):
+        self.app.authorizeSharedObject = lambda client, name, persistent: False
+
+        self.receive((SO.USE, None), (SO.REQUEST_CHANGE, (u'a', 1)))
+
+        self.assertEqual(self.app.sharedObjects.sharedObjects, {})
+        self.assertEqual([m.events for m in self.nc.getMessages()], [
+            [(SO.STATUS, (codes.SO_CREATION_FAILED, 'error'))]])
+
+    def test_disconnect(self):
+        self.receive((SO.USE, None))
+
+        self.nc.client = self.app.client(self.nc)
+        self.app._disconnect(self.nc.client)
+
+        self.assertEqual(self.app.sharedObjects.sharedObjects, {})
@@ -0,0 +1,126 @@
+# Copyright the RTMPy Project
+#
+# RTMPy is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# RTMPy is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with RTMPy.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Tests for L{rtmpy.timers}.
+"""
+
+from twisted.trial import unittest
+from twisted.internet import task
+
+from rtmpy import timers
+
+
+
+class TimerWheelTestCase(unittest.TestCase):
+    """
+    Tests for L{timers.TimerWheel}
+    """
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.wheel = timers.TimerWheel(1.0, 4, self.clock)
+        self.fired = []
+
+    def schedule(self, delay):
+        return self.wheel.schedule(delay, self.fired.append, delay)
+
+    def test_fire(self):
+        t = self.schedule(2)
+
+        self.assertEqual(len(self.wheel), 1)
+        self.assertTrue(t.active())
+
+        self.clock.advance(1)
+        self.assertEqual(self.fired, [])
+
+        self.clock.advance(1)
+        self.assertEqual(self.fired, [2])
+        self.assertFalse(t.active())
+        self.assertEqual(len(self.wheel), 0)
+
+        # the wheel stops ticking when it is empty
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_rounding(self):
+        self.schedule(0)
+        self.schedule(1.5)
+
+        self.clock.advance(1)
+        self.assertEqual(self.fired, [0])
+
+        self.clock.advance(1)
+        self.assertEqual(self.fired, [0, 1.5])
+
+    def test_rounds(self):
+        """
+        Delays longer than the wheel wrap around it.
+        """
+        for delay in (4, 5, 9):
+            self.schedule(delay)
+
+        for i in xrange(10):
+            self.clock.advance(1)
+
+            if i + 1 in (4, 5, 9):
+                self.assertEqual(self.fired[-1], i + 1)
+
+        self.assertEqual(self.fired, [4, 5, 9])
+
+    def test_cancel(self):
+        t = self.schedule(2)
+        self.schedule(3)
+
+        t.cancel()
+        t.cancel()
+
+        self.assertEqual(len(self.wheel), 1)
+
+        self.clock.advance(3)
+        self.assertEqual(self.fired, [3])
+
+    def test_late_reactor(self):
+        """
+        Ticks missed while the reactor was busy are caught up.
+        """
+        self.schedule(2)
+        self.schedule(3)
+        self.schedule(6)
+
+        self.clock.advance(3.5)
+        self.assertEqual(self.fired, [2, 3])
+
+        self.clock.advance(2.5)
+        self.assertEqual(self.fired, [2, 3, 6])
+
+    def test_error(self):
+        def boom():
+            raise RuntimeError
+
+        self.wheel.schedule(1, boom)
+        self.schedule(1)
+
+        self.clock.advance(1)
+
+        self.assertEqual(self.fired, [1])
+        self.assertEqual(len(self.flushLoggedErrors(RuntimeError)), 1)
+
+    def test_stop(self):
+        t = self.schedule(1)
+
+        self.wheel.stop()
+
+        self.assertFalse(t.active())
+        self.assertEqual(self.clock.getDelayedCalls(), [])
@@ -0,0 +1,155 @@
+# Copyright the RTMPy Project
+#
+# RTMPy is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# RTMPy is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with RTMPy.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Tests for L{rtmpy.timing}.
+"""
+
+from twisted.trial import unittest
+from twisted.internet import reactor, defer
+
+from rtmpy import timing, metrics, server
+from rtmpy.protocol import rtmp
+from rtmpy.scripts import loadgen
+
+
+
+class Stage(object):
+    """
+    A stand in for a pipeline stage.
+    """
+
+    def __init__(self, application):
+        self.application = application
+
+    def run(self, x):
+        return x * 2
+
+
+
+class ProfilerTestCase(unittest.TestCase):
+    """
+    Tests for L{timing.Profiler}
+    """
+
+    def setUp(self):
+        self.clock = iter(xrange(0, 1000, 2)).next
+        self.cpuClock = iter(xrange(1000)).next
+
+        self.profiler = timing.Profiler(3, self.clock, self.cpuClock)
+        self.profiler.hook('run', Stage, 'run',
+            lambda s, *args: s.application.name)
+
+        self.addCleanup(self.profiler.uninstall)
+
+    def test_sampling(self):
+        app = server.Application()
+        app.name = 'foo'
+
+        for i in xrange(7):
+            self.assertEqual(Stage(app).run(i), i * 2)
+
+        self.assertEqual(self.profiler.samples, {
+            ('run', 'foo'): [2, 4.0, 2.0, 2.0]})
+
+        report = self.profiler.report()
+
+        self.assertEqual(self.profiler.calls, {'run': 7})
+        self.assertEqual(report, [{
+            'stage': 'run',
+            'application': 'foo',
+            'samples': 2,
+            'wall': 12.0,
+            'cpu': 6.0,
+            'mean_wall': 2.0,
+            'max_wall': 2.0,
+        }])
+
+        self.assertTrue(self.profiler.dump().startswith(
+            "application 'foo' (1 in 3 calls sampled)"))
+
+    def test_uninstall(self):
+        self.profiler.uninstall()
+
+        self.assertFalse('timed' in repr(Stage.__dict__['run']))
+
+    def test_bad_rate(self):
+        self.assertRaises(ValueError, timing.Profiler, 0)
+
+
+
+class LiveTestCase(unittest.TestCase):
+    """
+    Times a real publishing session, alongside the metrics hooks.
+    """
+
+    def setUp(self):
+        self.original = rtmp.MessageDispatcher.__dict__['dispatchMessage']
+
+        metrics.enable(metrics.Registry())
+        timing.enable(sampleRate=1)
+
+    def tearDown(self):
+        metrics.disable()
+        timing.disable()
+
+    def test_publish(self):
+        factory = server.ServerFactory({'bench': server.Application()})
+        port = reactor.listenTCP(0, factory, interface='127.0.0.1')
+
+        stats = loadgen.Statistics()
+        stats.finished = False
+
+        client = loadgen.ClientFactory(loadgen.PublishingProtocol, stats,
+            'foo', fps=50, videoSize=500, audioSize=100, frameSize=1024)
+
+        connector = reactor.connectTCP('127.0.0.1', port.getHost().port,
+            client)
+
+        d = defer.Deferred()
+
+        def stop():
+            stats.finished = True
+            connector.disconnect()
+
+            reactor.callLater(0.1, finish)
+
+        def check():
+            # both wrap dispatchMessage, unwrap out of order
+            metrics.disable()
+            timing.disable()
+
+            self.assertIdentical(
+                rtmp.MessageDispatcher.__dict__['dispatchMessage'],
+                self.original)
+
+            stages = [s['stage'] for s in timing.top()['bench']]
+
+            for stage in ['decode', 'dispatch', 'fanout', 'flush']:
+                self.assertTrue(stage in stages, stage)
+
+        def finish():
+            try:
+                check()
+            except:
+                d.errback()
+            else:
+                d.callback(None)
+
+            return port.stopListening()
+
+        reactor.callLater(0.5, stop)
+
+        return d
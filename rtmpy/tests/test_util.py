@@ -176,4 +176,98 @@ if not sys.platform.startswith('darwin'):
     DarwinUptimeTestCase.skip = 'Tested platform is not darwin'
 
 UnknownPlatformUptimeTestCase = None
-DarwinUptimeTestCase = None
\ No newline at end of file
+DarwinUptimeTestCase = None
+
+
+class WrapMethodTestCase(unittest.TestCase):
+    """
+    Tests for L{util.wrapMethod} and L{util.unwrapMethod}
+    """
+
+    def setUp(self):
+        class TestObject(object):
+            def foo(self, x):
+                return [x]
+
+        self.cls = TestObject
+        self.original = TestObject.__dict__['foo']
+
+    def wrapper(self, tag):
+        def wrapper(orig):
+            def foo(self, x):
+                return orig(self, x) + [tag]
+
+            return foo
+
+        return wrapper
+
+    def test_wrap(self):
+        h = util.wrapMethod(self.cls, 'foo', self.wrapper('a'))
+
+        self.assertEqual(self.cls().foo(1), [1, 'a'])
+
+        util.unwrapMethod(h)
+
+        self.assertIdentical(self.cls.__dict__['foo'], self.original)
+
+    def test_unwrap_out_of_order(self):
+        a = util.wrapMethod(self.cls, 'foo', self.wrapper('a'))
+        b = util.wrapMethod(self.cls, 'foo', self.wrapper('b'))
+
+        self.assertEqual(self.cls().foo(1), [1, 'a', 'b'])
+
+        util.unwrapMethod(a)
+
+        self.assertEqual(self.cls().foo(1), [1, 'b'])
+
+        util.unwrapMethod(b)
+
+        self.assertIdentical(self.cls.__dict__['foo'], self.original)
+
+
+class OrderedDictTestCase(unittest.TestCase):
+    """
+    Tests for L{util._OrderedDict}, the L{util.OrderedDict} of Python < 2.7.
+    """
+
+    def test_order(self):
+        d = util._OrderedDict()
+
+        for key in 'cab':
+            d[key] = key.upper()
+
+        d['c'] = 'C'
+
+        self.assertEqual(d.keys(), ['c', 'a', 'b'])
+        self.assertEqual(list(d.iteritems()), [('c', 'C'), ('a', 'A'),
+            ('b', 'B')])
+
+        d['c'] = d.pop('c')
+
+        self.assertEqual(d.keys(), ['a', 'b', 'c'])
+        self.assertEqual(len(d), 3)
+
+    def test_pop(self):
+        d = util._OrderedDict()
+        d['a'] = 1
+
+        self.assertEqual(d.pop('a'), 1)
+        self.assertEqual(d.pop('a', None), None)
+        self.assertRaises(KeyError, d.pop, 'a')
+        self.assertEqual(d.keys(), [])
+
+    def test_popitem(self):
+        d = util._OrderedDict()
+
+        for i in xrange(4):
+            d[i] = str(i)
+
+        self.assertEqual(d.popitem(False), (0, '0'))
+        self.assertEqual(d.popitem(), (3, '3'))
+        self.assertEqual(d.keys(), [1, 2])
+
+        del d[1]
+        d.clear()
+
+        self.assertRaises(KeyError, d.popitem)
+        self.assertEqual(list(d), [])
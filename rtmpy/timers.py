@@ -0,0 +1,205 @@
+# -*- test-case-name: rtmpy.tests.test_timers -*-
+
+# Copyright the RTMPy Project
+#
+# RTMPy is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# RTMPy is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with RTMPy.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+A hashed timer wheel for the many coarse timeouts of a busy server.
+
+Every connection has a handshake, connect, idle and RPC timeout. Almost none
+of them ever fire and most are cancelled soon after they are set. A
+C{reactor.callLater} per timeout keeps tens of thousands of entries in the
+reactor's heap. The wheel keeps them in a ring of slots, one slot per tick of
+C{resolution} seconds. Scheduling and cancelling are O(1) and the reactor only
+sees a single call per tick (and none while the wheel is empty).
+
+Timeouts fire up to one C{resolution} late, which is fine for timeouts
+measured in seconds.
+
+@since: 0.2
+"""
+
+from twisted.python import log
+
+
+__all__ = ['TimerWheel', 'getWheel']
+
+
+
+class Timer(object):
+    """
+    A call scheduled on a L{TimerWheel}. Returned by L{TimerWheel.schedule}.
+    """
+
+    __slots__ = ('wheel', 'slot', 'rounds', 'func', 'args', 'kwargs')
+
+
+    def __init__(self, wheel, slot, rounds, func, args, kwargs):
+        self.wheel = wheel
+        self.slot = slot
+        self.rounds = rounds
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+
+
+    def active(self):
+        """
+        Whether this timer is still waiting to fire.
+        """
+        return self.slot is not None
+
+
+    def cancel(self):
+        """
+        Stops this timer from firing. Does nothing if it is not active.
+        """
+        if self.slot is None:
+            return
+
+        self.slot.discard(self)
+        self.slot = None
+        self.wheel.count -= 1
+
+
+
+class TimerWheel(object):
+    """
+    Schedules calls at a resolution of C{resolution} seconds.
+
+    @ivar resolution: Seconds per tick.
+    @ivar size: The number of slots. Delays longer than C{size * resolution}
+        wrap around the wheel and are kept for more than one round.
+    @ivar count: The number of active timers.
+    """
+
+
+    def __init__(self, resolution=0.5, size=512, reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+
+        self.resolution = resolution
+        self.size = size
+        self.reactor = reactor
+
+        self.slots = [set() for i in xrange(size)]
+        self.position = 0
+        self.count = 0
+
+        self._call = None
+        self._nextTick = None
+
+
+    def __len__(self):
+        return self.count
+
+
+    def schedule(self, delay, func, *args, **kwargs):
+        """
+        Calls C{func(*args, **kwargs)} after at least C{delay} seconds.
+
+        @rtype: L{Timer}
+        """
+        ticks = int(delay / self.resolution)
+
+        if ticks * self.resolution < delay or ticks < 1:
+            ticks += 1
+
+        slot = self.slots[(self.position + ticks) % self.size]
+        timer = Timer(self, slot, (ticks - 1) // self.size, func, args, kwargs)
+
+        slot.add(timer)
+        self.count += 1
+
+        if self._call is None:
+            self._nextTick = self.reactor.seconds() + self.resolution
+            self._call = self.reactor.callLater(self.resolution, self._tick)
+
+        return timer
+
+
+    def stop(self):
+        """
+        Cancels all the timers.
+        """
+        for slot in self.slots:
+            for timer in list(slot):
+                timer.cancel()
+
+        if self._call is not None and self._call.active():
+            self._call.cancel()
+
+        self._call = None
+
+
+    def advance(self):
+        """
+        Moves the wheel on by one tick and fires the timers that are due.
+        """
+        self.position = (self.position + 1) % self.size
+        slot = self.slots[self.position]
+
+        if not slot:
+            return
+
+        due = [timer for timer in slot if not timer.rounds]
+
+        for timer in slot:
+            timer.rounds -= 1
+
+        for timer in due:
+            if timer.slot is None:
+                # cancelled by an earlier timer
+                continue
+
+            timer.cancel()
+
+            try:
+                timer.func(*timer.args, **timer.kwargs)
+            except:
+                log.err()
+
+
+    def _tick(self):
+        now = self.reactor.seconds()
+
+        # catch up if the reactor ran us late
+        while self._nextTick <= now:
+            self.advance()
+            self._nextTick += self.resolution
+
+        if not self.count:
+            self._call = None
+
+            return
+
+        self._call = self.reactor.callLater(max(0, self._nextTick - now),
+            self._tick)
+
+
+
+_wheel = None
+
+
+def getWheel():
+    """
+    Returns the shared L{TimerWheel}, creating it on first use.
+    """
+    global _wheel
+
+    if _wheel is None:
+        _wheel = TimerWheel()
+
+    return _wheel
@@ -0,0 +1,386 @@
+# -*- test-case-name: rtmpy.tests.test_timing -*-
+
+# Copyright the RTMPy Project
+#
+# RTMPy is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# RTMPy is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with RTMPy.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Sampling timers for the stages of the RTMP pipeline.
+
+When enabled, 1 in every C{sampleRate} calls to each stage is timed (wall
+clock and CPU) and attributed to the application of the connection::
+
+    decode      codec.Decoder.next (includes dispatch)
+    dispatch    rtmp.MessageDispatcher.dispatchMessage (includes rpc/fanout)
+    rpc         rpc.AbstractCallHandler.callReceived
+    fanout      server.StreamPublisher audio/video delivery
+    flush       codec.Encoder.flush
+
+Times are inclusive, a stage includes the stages that it calls. The hooks
+are installed by L{enable} and removed by L{disable}, when disabled the
+stages run the original, unwrapped methods.
+
+Example::
+
+    from rtmpy import timing
+
+    timing.enable(sampleRate=50)
+    ...
+    timing.dump()
+    timing.disable()
+
+@since: 0.2
+"""
+
+import os
+import sys
+import time
+
+from twisted.python import log
+
+from rtmpy import rpc, server, util
+from rtmpy.protocol import rtmp
+from rtmpy.protocol.rtmp import codec
+
+
+__all__ = [
+    'Profiler',
+    'enable',
+    'disable',
+    'toggle',
+    'reset',
+    'top',
+    'dump',
+]
+
+
+#: Whether the hooks are installed.
+enabled = False
+
+#: The active L{Profiler}.
+profiler = None
+
+
+if sys.platform.startswith('win'):
+    def cpuClock():
+        t = os.times()
+
+        return t[0] + t[1]
+else:
+    cpuClock = time.clock
+
+
+
+def _applicationName(app):
+    return getattr(app, 'name', None) or ''
+
+
+def _protocolApplication(protocol):
+    nc = getattr(protocol, 'nc', None)
+
+    return _applicationName(getattr(nc, 'application', None))
+
+
+def _streamApplication(stream):
+    """
+    C{stream} is a NetConnection or a NetStream.
+    """
+    app = getattr(stream, 'application', None)
+
+    if app is None:
+        app = getattr(getattr(stream, 'nc', None), 'application', None)
+
+    return _applicationName(app)
+
+
+def _decoderApplication(decoder, *args):
+    return _protocolApplication(getattr(decoder.dispatcher, 'streamer', None))
+
+
+def _dispatcherApplication(dispatcher, stream, *args):
+    return _streamApplication(stream)
+
+
+def _callApplication(handler, *args):
+    return _streamApplication(handler)
+
+
+def _publisherApplication(publisher, *args):
+    return _streamApplication(publisher.stream)
+
+
+def _encoderApplication(encoder, *args):
+    # twisted transports keep a reference to their protocol
+    return _protocolApplication(getattr(encoder.output, 'protocol', None))
+
+
+#: C{(stage, class, method name, application getter)}
+STAGES = [
+    ('decode', codec.Decoder, 'next', _decoderApplication),
+    ('dispatch', rtmp.MessageDispatcher, 'dispatchMessage',
+        _dispatcherApplication),
+    ('rpc', rpc.AbstractCallHandler, 'callReceived', _callApplication),
+    ('fanout', server.StreamPublisher, 'videoDataReceived',
+        _publisherApplication),
+    ('fanout', server.StreamPublisher, 'audioDataReceived',
+        _publisherApplication),
+    ('flush', codec.Encoder, 'flush', _encoderApplication),
+]
+
+
+
+class Profiler(object):
+    """
+    Times a sample of the calls made to each stage.
+
+    @ivar sampleRate: Time 1 in every C{sampleRate} calls.
+    @ivar calls: Stage name -> number of calls (sampled or not).
+    @ivar samples: C{(stage, application)} -> C{[count, wall, cpu, max]}.
+    """
+
+
+    def __init__(self, sampleRate=100, clock=time.time, cpuClock=cpuClock):
+        if sampleRate < 1:
+            raise ValueError('sampleRate must be >= 1')
+
+        self.sampleRate = sampleRate
+        self.clock = clock
+        self.cpuClock = cpuClock
+
+        self._handles = []
+        self._counters = {}
+
+        self.reset()
+
+
+    def reset(self):
+        """
+        Throws away the samples taken so far.
+        """
+        self.calls = {}
+        self.samples = {}
+
+        for counter in self._counters.values():
+            counter[0] = 0
+
+
+    def hook(self, stage, cls, name, getApplication):
+        """
+        Times calls to the method C{name} of C{cls} as C{stage}.
+        """
+        profiler = self
+        counter = self._counters.setdefault(stage, [0])
+        sampleRate = self.sampleRate
+        clock = self.clock
+        cpuClock = self.cpuClock
+
+        def wrapper(orig):
+            def timed(self, *args, **kwargs):
+                counter[0] += 1
+
+                if counter[0] % sampleRate:
+                    return orig(self, *args, **kwargs)
+
+                wall, cpu = clock(), cpuClock()
+
+                try:
+                    return orig(self, *args, **kwargs)
+                finally:
+                    profiler.record(stage, getApplication(self, *args),
+                        clock() - wall, cpuClock() - cpu)
+
+            return timed
+
+        self._handles.append(util.wrapMethod(cls, name, wrapper))
+
+
+    def install(self, stages=STAGES):
+        for stage in stages:
+            self.hook(*stage)
+
+
+    def uninstall(self):
+        while self._handles:
+            util.unwrapMethod(self._handles.pop())
+
+
+    def record(self, stage, application, wall, cpu):
+        key = (stage, application)
+
+        try:
+            s = self.samples[key]
+        except KeyError:
+            s = self.samples[key] = [0, 0.0, 0.0, 0.0]
+
+        s[0] += 1
+        s[1] += wall
+        s[2] += cpu
+
+        if wall > s[3]:
+            s[3] = wall
+
+
+    def report(self):
+        """
+        Returns a list of C{dict}s, one per stage and application, ordered by
+        the time spent. C{wall}/C{cpu} are the estimated totals (the sampled
+        times multiplied by C{sampleRate}).
+        """
+        self.calls = dict([(stage, counter[0])
+            for stage, counter in self._counters.items()])
+
+        result = []
+
+        for (stage, application), (count, wall, cpu, worst) in \
+                self.samples.items():
+            result.append({
+                'stage': stage,
+                'application': application,
+                'samples': count,
+                'wall': wall * self.sampleRate,
+                'cpu': cpu * self.sampleRate,
+                'mean_wall': wall / count,
+                'max_wall': worst,
+            })
+
+        result.sort(key=lambda x: (-x['wall'], x['stage'], x['application']))
+
+        return result
+
+
+    def top(self, n=10):
+        """
+        Returns the C{n} most expensive stages for each application.
+
+        @rtype: C{dict} of application name -> C{list}
+        """
+        result = {}
+
+        for entry in self.report():
+            stages = result.setdefault(entry['application'], [])
+
+            if len(stages) < n:
+                stages.append(entry)
+
+        return result
+
+
+    def dump(self, n=10):
+        """
+        Returns L{top} as a table of text.
+        """
+        lines = []
+
+        for application, stages in sorted(self.top(n).items()):
+            lines.append('application %r (1 in %d calls sampled)' % (
+                application, self.sampleRate))
+            lines.append('  %-10s %8s %10s %10s %10s %10s' % (
+                'stage', 'samples', 'wall', 'cpu', 'mean ms', 'max ms'))
+
+            for s in stages:
+                lines.append('  %-10s %8d %10.3f %10.3f %10.3f %10.3f' % (
+                    s['stage'], s['samples'], s['wall'], s['cpu'],
+                    s['mean_wall'] * 1000, s['max_wall'] * 1000))
+
+        return '\n'.join(lines)
+
+
+
+def enable(sampleRate=100):
+    """
+    Installs the timing hooks. Does nothing if they are already installed.
+    """
+    global enabled, profiler
+
+    if enabled:
+        return profiler
+
+    profiler = Profiler(sampleRate)
+    profiler.install()
+
+    enabled = True
+
+    return profiler
+
+
+def disable():
+    """
+    Removes the timing hooks. The samples are kept until the next L{enable}.
+    """
+    global enabled
+
+    if not enabled:
+        return
+
+    profiler.uninstall()
+
+    enabled = False
+
+
+def toggle(sampleRate=100):
+    """
+    Enables the timing hooks if they are disabled and vice versa. When
+    disabling, the collected timings are logged.
+    """
+    if not enabled:
+        enable(sampleRate)
+
+        return
+
+    disable()
+    log.msg('Stage timings:\n' + dump())
+
+
+def reset():
+    if profiler is not None:
+        profiler.reset()
+
+
+def top(n=10):
+    """
+    See L{Profiler.top}.
+    """
+    if profiler is None:
+        return {}
+
+    return profiler.top(n)
+
+
+def dump(n=10):
+    """
+    See L{Profiler.dump}.
+    """
+    if profiler is None:
+        return ''
+
+    return profiler.dump(n)
+
+
+def installSignalHandler(signum=None, sampleRate=100, reactor=None):
+    """
+    Calls L{toggle} when the process receives C{signum} (C{SIGUSR2} by
+    default), so timing can be switched on and off on a running server.
+    """
+    import signal
+
+    if signum is None:
+        signum = signal.SIGUSR2
+
+    if reactor is None:
+        from twisted.internet import reactor
+
+    def handler(*args):
+        reactor.callFromThread(toggle, sampleRate)
+
+    signal.signal(signum, handler)
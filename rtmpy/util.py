@@ -326,4 +326,177 @@ def getFailureMessage(failure):
         except IndexError:
             value = ""
 
-    return value
\ No newline at end of file
+    return value
+
+
+_wrappedMethods = []
+
+
+def wrapMethod(cls, name, wrapper):
+    """
+    Replaces the method C{name} on C{cls} with C{wrapper(original)}. Used to
+    install instrumentation at runtime so that it costs nothing until it is
+    switched on.
+
+    Methods can be wrapped more than once and unwrapped in any order.
+
+    @param wrapper: Called with the original function, returns the function
+        to install in its place.
+    @return: A handle to pass to L{unwrapMethod}.
+    """
+    handle = [cls, name, cls.__dict__[name], None]
+
+    def original(*args, **kwargs):
+        return handle[2](*args, **kwargs)
+
+    handle[3] = wrapper(original)
+
+    setattr(cls, name, handle[3])
+    _wrappedMethods.append(handle)
+
+    return handle
+
+
+def unwrapMethod(handle):
+    """
+    Removes a wrapper installed by L{wrapMethod}.
+    """
+    cls, name, original, wrapped = handle
+
+    _wrappedMethods.remove(handle)
+
+    if cls.__dict__.get(name, None) is wrapped:
+        setattr(cls, name, original)
+
+        return
+
+    # another wrapper was installed on top of this one
+    for other in _wrappedMethods:
+        if other[2] is wrapped:
+            other[2] = original
+
+
+
+class _OrderedDict(dict):
+    """
+    A C{dict} that remembers the order in which its keys were added, the
+    parts of C{collections.OrderedDict} (Python 2.7) that RTMPy uses. The keys
+    are kept in a doubly linked list of C{[prev, next, key]} nodes.
+    """
+
+
+    def __init__(self):
+        dict.__init__(self)
+
+        self._root = root = []
+        root[:] = [root, root, None]
+        self._nodes = {}
+
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, self.items())
+
+
+    def __setitem__(self, key, value):
+        if key not in self:
+            root = self._root
+            last = root[0]
+            last[1] = root[0] = self._nodes[key] = [last, root, key]
+
+        dict.__setitem__(self, key, value)
+
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+
+        prev, next, key = self._nodes.pop(key)
+        prev[1] = next
+        next[0] = prev
+
+
+    def __iter__(self):
+        root = self._root
+        node = root[1]
+
+        while node is not root:
+            yield node[2]
+
+            node = node[1]
+
+
+    iterkeys = __iter__
+
+
+    def itervalues(self):
+        for key in self:
+            yield self[key]
+
+
+    def iteritems(self):
+        for key in self:
+            yield key, self[key]
+
+
+    def keys(self):
+        return list(self)
+
+
+    def values(self):
+        return list(self.itervalues())
+
+
+    def items(self):
+        return list(self.iteritems())
+
+
+    def pop(self, key, *default):
+        if key in self:
+            value = dict.__getitem__(self, key)
+            del self[key]
+
+            return value
+
+        if default:
+            return default[0]
+
+        raise KeyError(key)
+
+
+    def popitem(self, last=True):
+        if not self:
+            raise KeyError('dictionary is empty')
+
+        if last:
+            key = self._root[0][2]
+        else:
+            key = self._root[1][2]
+
+        return key, self.pop(key)
+
+
+    def clear(self):
+        dict.clear(self)
+
+        self._nodes.clear()
+        root = self._root
+        root[:] = [root, root, None]
+
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+
+        return self[key]
+
+
+    def update(self, other):
+        for key, value in other.items():
+            self[key] = value
+
+
+
+try:
+    from collections import OrderedDict
+except ImportError:
+    # support for Python2.4 - 2.6
+    OrderedDict = _OrderedDict